@@ -0,0 +1,60 @@
+# Benchmark of the synapse lookup table used when merging hyper voxels.
+#
+# Compares SnuddaDetect.create_lookup_table_slow (one row at a time in Python) with the vectorised
+# SnuddaDetect.create_lookup_table (run length encoding of the neuron pairs) on a random sorted synapse matrix.
+#
+# Usage: python benchmark_lookup_table.py [--num_synapses N] [--num_neurons M] [--repeats R]
+
+import argparse
+import timeit
+
+import numpy as np
+
+from snudda.detect import SnuddaDetect
+
+
+def create_synapses(num_synapses, num_neurons, rng):
+
+    synapses = np.zeros((num_synapses, 13), dtype=np.int32)
+    synapses[:, 0] = rng.integers(0, num_neurons, num_synapses)
+    synapses[:, 1] = rng.integers(0, num_neurons, num_synapses)
+    synapses[:, 6] = rng.integers(10, 12, num_synapses)
+
+    # Sorted on dest_id, then src_id, same as the hyper voxel synapse matrix
+    sort_idx = np.lexsort((synapses[:, 6], synapses[:, 0], synapses[:, 1]))
+
+    return synapses[sort_idx, :]
+
+
+def run_benchmark(num_synapses=1000000, num_neurons=1000, repeats=3):
+
+    synapses = create_synapses(num_synapses=num_synapses, num_neurons=num_neurons, rng=np.random.default_rng(1234))
+
+    print(f"Lookup table for {num_synapses} synapses, {num_neurons} neurons")
+
+    lookup_tables = dict()
+
+    for name, lookup_func in [("row by row", SnuddaDetect.create_lookup_table_slow),
+                              ("vectorised", SnuddaDetect.create_lookup_table)]:
+        durations = []
+
+        for _ in range(0, repeats):
+            start_time = timeit.default_timer()
+            lookup_tables[name] = lookup_func(data=synapses, n_rows=num_synapses, data_type="synapses",
+                                              num_neurons=num_neurons, max_synapse_type=12)
+            durations.append(timeit.default_timer() - start_time)
+
+        print(f"{name:>12s}: {np.min(durations):.3f} s, {lookup_tables[name].shape[0]} neuron pairs")
+
+    assert (lookup_tables["row by row"] == lookup_tables["vectorised"]).all()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser("Benchmark synapse lookup table")
+    parser.add_argument("--num_synapses", type=int, default=1000000)
+    parser.add_argument("--num_neurons", type=int, default=1000)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    run_benchmark(num_synapses=args.num_synapses, num_neurons=args.num_neurons, repeats=args.repeats)
@@ -0,0 +1,124 @@
+# Benchmark of morphology rasterisation in touch detection.
+#
+# Compares the per section helpers (SnuddaDetect.fill_voxels_dend / fill_voxels_axon, one compiled call
+# per section) with the bulk kernel (SegmentTable + rasterise_segment_table, one compiled call for all
+# sections in the hyper voxel), using both the "step" and the "dda" rasterisation.
+#
+# Usage: python benchmark_rasterise.py [--num_neurons N] [--hvsize HVSIZE] [--repeats R]
+
+import argparse
+import glob
+import os
+import timeit
+
+import numpy as np
+
+import snudda
+from snudda.detect import SnuddaDetect
+from snudda.detect.rasterise import SegmentTable
+from snudda.neurons.neuron_morphology_extended import NeuronMorphologyExtended
+from snudda.place.rotation import SnuddaRotate
+
+
+def setup_neurons(sd, num_neurons, rng):
+
+    morphology_dir = os.path.join(os.path.dirname(snudda.__file__), "data", "neurons", "striatum")
+    swc_files = sorted(glob.glob(os.path.join(morphology_dir, "*", "*", "*.swc")))
+
+    centre_pos = sd.num_bins * sd.voxel_size / 2
+    neurons = []
+
+    for neuron_id in range(0, num_neurons):
+        neuron = NeuronMorphologyExtended(name=f"neuron_{neuron_id}",
+                                          swc_filename=swc_files[neuron_id % len(swc_files)])
+        position = centre_pos + rng.uniform(-50e-6, 50e-6, size=3)
+        neurons.append(neuron.clone(position=position, rotation=SnuddaRotate.rand_rotation_matrix(rng=rng)))
+
+    return neurons
+
+
+def has_sections(neuron, section_type):
+    return section_type in neuron.morphology_data["neuron"].sections
+
+
+def reset_voxels(sd):
+    sd.setup_hyper_voxel(hyper_voxel_id=0, hyper_voxel_origo=np.zeros((3,)))
+    sd.voxel_overflow_counter = 0
+
+
+def fill_per_section(sd, neurons):
+
+    for neuron_id, neuron in enumerate(neurons):
+        if has_sections(neuron, 3):
+            sd.fill_voxels_dend(voxel_space=sd.dend_voxels, voxel_space_ctr=sd.dend_voxel_ctr,
+                                voxel_sec_id=sd.dend_sec_id, voxel_sec_x=sd.dend_sec_x,
+                                voxel_soma_dist=sd.dend_soma_dist, neuron=neuron, neuron_id=neuron_id)
+        if has_sections(neuron, 2):
+            sd.fill_voxels_axon(voxel_space=sd.axon_voxels, voxel_space_ctr=sd.axon_voxel_ctr,
+                                voxel_axon_dist=sd.axon_soma_dist, neuron=neuron, neuron_id=neuron_id)
+
+
+def fill_bulk(sd, neurons, method):
+
+    dend_table = SegmentTable()
+    axon_table = SegmentTable()
+
+    for neuron_id, neuron in enumerate(neurons):
+        if has_sections(neuron, 3):
+            dend_table.add_sections(neuron.morphology_data["neuron"], section_type=3, neuron_id=neuron_id)
+        if has_sections(neuron, 2):
+            axon_table.add_sections(neuron.morphology_data["neuron"], section_type=2, neuron_id=neuron_id)
+
+    for table, voxel_type in [(dend_table, "dend"), (axon_table, "axon")]:
+        vx, vy, vz, neuron_id, sec_id, sec_x, soma_dist, order = \
+            table.rasterise(hyper_voxel_origo=sd.hyper_voxel_origo, voxel_size=sd.voxel_size,
+                            num_bins=sd.num_bins, step_multiplier=sd.step_multiplier, method=method)
+        sd.add_voxel_items(voxel_type=voxel_type, vx=vx, vy=vy, vz=vz, neuron_id=neuron_id,
+                           sec_id=sec_id, sec_x=sec_x, soma_dist=soma_dist)
+
+
+def run_benchmark(num_neurons=20, hyper_voxel_size=50, repeats=3):
+
+    sd = SnuddaDetect(hyper_voxel_size=hyper_voxel_size)
+    sd.hyper_voxels = {0: {"random_seed": 1234}}
+    sd.max_axon = 200
+    sd.max_dend = 200
+
+    reset_voxels(sd)
+    neurons = setup_neurons(sd, num_neurons=num_neurons, rng=np.random.default_rng(1234))
+
+    variants = [("per section (step)", lambda: fill_per_section(sd, neurons)),
+                ("bulk (step)", lambda: fill_bulk(sd, neurons, method="step")),
+                ("bulk (dda)", lambda: fill_bulk(sd, neurons, method="dda"))]
+
+    print(f"Rasterising {num_neurons} neurons, hyper voxel {hyper_voxel_size}^3 voxels, "
+          f"step_multiplier {sd.step_multiplier}")
+
+    for name, fill_func in variants:
+
+        # First call compiles the numba functions, not included in timing
+        reset_voxels(sd)
+        fill_func()
+
+        durations = []
+        for _ in range(0, repeats):
+            reset_voxels(sd)
+            start_time = timeit.default_timer()
+            fill_func()
+            durations.append(timeit.default_timer() - start_time)
+
+        print(f"{name:>20s}: {np.min(durations):.3f} s, "
+              f"dend items {np.sum(sd.dend_voxel_ctr)} (voxels {np.sum(sd.dend_voxel_ctr > 0)}), "
+              f"axon items {np.sum(sd.axon_voxel_ctr)} (voxels {np.sum(sd.axon_voxel_ctr > 0)}), "
+              f"overflow {sd.voxel_overflow_counter}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser("Benchmark morphology rasterisation")
+    parser.add_argument("--num_neurons", type=int, default=20)
+    parser.add_argument("--hvsize", type=int, default=50)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    run_benchmark(num_neurons=args.num_neurons, hyper_voxel_size=args.hvsize, repeats=args.repeats)
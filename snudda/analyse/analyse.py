@@ -16,6 +16,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 import scipy.sparse as sps
 
+from snudda.analyse.analysis_cache import SnuddaAnalysisCache
 from snudda.utils.load import SnuddaLoad
 from snudda.utils.snudda_path import snudda_parse_path
 from snudda.utils.numpy_encoder import NumpyEncoder
@@ -28,6 +29,8 @@ class SnuddaAnalyse:
     # saveCache = should we save a pickled file with connection matrix?
     # loadCache = should we load cache file if available
     # lowMemory = if false, uses dense matrix which is faster (assuming lots of memory)
+    # use_analysis_cache = if true, keeps expensive results on disk (up to analysis_cache_size bytes),
+    #                      keyed on a hash of the full network file content
 
     def __init__(self,
                  hdf5_file=None,
@@ -39,7 +42,9 @@ class SnuddaAnalyse:
                  volume_id=None,
                  n_max_analyse=None,
                  show_plots=False,
-                 close_plots=True):  # "cube" or "full"
+                 close_plots=True,
+                 use_analysis_cache=False,
+                 analysis_cache_size=1e9):  # "cube" or "full"
 
         self.debug = False
         self.show_plots = show_plots
@@ -74,6 +79,12 @@ class SnuddaAnalyse:
             print(f"Creating figures directory {self.fig_dir}")
             os.makedirs(self.fig_dir)
 
+        # Persistent cache of expensive results, keyed on network file content and arguments
+        if use_analysis_cache:
+            self.analysis_cache = SnuddaAnalysisCache(network_file=hdf5_file, max_size=analysis_cache_size)
+        else:
+            self.analysis_cache = None
+
         # First load all data but synapses
         self.network_load = SnuddaLoad(hdf5_file, load_synapses=False)
 
@@ -108,8 +119,9 @@ class SnuddaAnalyse:
             # self.connectionMatrix = self.createConnectionMatrix(synType=1,
             #                                                    lowMemory=lowMemory)
 
-            self.connection_matrix = self.create_connection_matrix(low_memory=low_memory)
-            self.connection_matrix_gj = self.create_connection_matrix_gj()
+            self.connection_matrix = self.memoise("connection_matrix", self.create_connection_matrix,
+                                                  low_memory=low_memory)
+            self.connection_matrix_gj = self.memoise("connection_matrix_gj", self.create_connection_matrix_gj)
 
             # self.connectionMatrix = self.createConnectionMatrixSLOW(synType=1)
             self.make_pop_dict()
@@ -149,6 +161,24 @@ class SnuddaAnalyse:
 
     ############################################################################
 
+    def memoise(self, name, function, extra_key=None, **kwargs):
+
+        """ Returns function(**kwargs), using the persistent analysis cache if enabled (see SnuddaAnalysisCache).
+            Results must be arrays, sparse matrices, or tuples, lists or dicts of those. """
+
+        if self.analysis_cache is None:
+            return function(**kwargs)
+
+        return self.analysis_cache.memoise(name, function, extra_key=extra_key, **kwargs)
+
+    def get_sub_pop_key(self):
+
+        """ Values that get_sub_pop depends on, used as extra key for cached results. """
+
+        return {"volume_type": self.volume_type, "num_max_analyse": self.num_max_analyse}
+
+    ############################################################################
+
     # Reading the HDF5 files takes a lot of time, this stores a cached copy
     # of the connection matrix, positions and populations
 
@@ -1361,7 +1391,27 @@ class SnuddaAnalyse:
                                num_bins=86,
                                num_points=10000000.0,
                                dist_3d=True,
-                               connection_type="synapses"):
+                               connection_type="synapses",
+                               exact=False,
+                               block_size=1000000):
+
+        """
+        Calculates connection probability as a function of soma distance, between pre_id and post_id neurons.
+
+        Args:
+            pre_id : Presynaptic neuron IDs
+            post_id : Postsynaptic neuron IDs
+            num_bins (int) : Number of distance bins (0 to 1700 micrometers)
+            num_points (float) : Number of pairs to sample (ignored if exact=True)
+            dist_3d (bool) : Use 3D distance, otherwise XY distance (and pairs more than 70 micrometers apart in
+                             Z are rejected)
+            connection_type (str) : "synapses" or "gap_junctions"
+            exact (bool) : Use all pre-post pairs, instead of sampling num_points pairs
+            block_size (int) : Number of pairs processed at a time
+
+        Returns:
+            dist, p_con, count_con, count_all
+        """
 
         # Count the connected neurons
         print("Counting connections")
@@ -1372,8 +1422,6 @@ class SnuddaAnalyse:
         count_all = np.zeros((num_bins, 1))
         count_rejected = 0
 
-        num_per_pair = num_points / len(pre_id)
-
         if connection_type == "synapses":
             con_mat = self.connection_matrix
         elif connection_type == "gap_junctions" or connection_type == "gapjunctions":
@@ -1381,71 +1429,122 @@ class SnuddaAnalyse:
         else:
             assert False, f"Unknown connection_type: {connection_type}"
 
-        # Make this loop use threads, to speed it up
+        if sps.issparse(con_mat):
+            # Converted once, CSR supports fast lookup of element pairs
+            con_mat = con_mat.tocsr()
 
-        for xi, x in enumerate(pre_id):
-            t_a = timeit.default_timer()
+        for pre_block, post_block in self.get_connection_pair_blocks(pre_id=pre_id, post_id=post_id,
+                                                                     num_points=num_points, exact=exact,
+                                                                     block_size=block_size):
 
-            if num_per_pair - np.floor(num_per_pair) > np.random.rand():
-                n_pts = int(np.ceil(num_per_pair))
+            # Do not count self connections in statistics!!
+            # This can lead to what looks like an artificial drop in connectivity proximally
+            keep_idx = pre_block != post_block
+            pre_block, post_block = pre_block[keep_idx], post_block[keep_idx]
+
+            if dist_3d:
+                d = np.linalg.norm(self.positions[pre_block, :] - self.positions[post_block, :], axis=1)
             else:
-                n_pts = int(np.floor(num_per_pair))
+                d = np.linalg.norm(self.positions[pre_block, 0:2] - self.positions[post_block, 0:2], axis=1)
 
-            po_id = np.random.permutation(post_id)[0:min(n_pts, len(post_id))]
+                # We also need to check that z-distance is not too large
 
-            for y in po_id:  # postID:
+                # Gilad email 2017-11-21:
+                # The 100 um is the lateral (XY) distance between somata of
+                # recorded cells. In terms of the Z axis, the slice
+                # thickness is 250 um but the recordings are all done in the
+                # upper half of the slice due to visibility of the cells. So
+                # lets say in a depth of roughly 40-110 um from the upper
+                # surface of the slice.
 
-                if x == y:
-                    # Do not count self connections in statistics!!
-                    # This can lead to what looks like an artificial drop in
-                    # connectivity proximally
-                    continue
+                # Using dzMax = 70, see comment above from Gilad, skip pairs too far away in z-depth
+                dz = np.abs(self.positions[pre_block, 2] - self.positions[post_block, 2])
+                keep_idx = dz <= 70e-6
+                count_rejected += np.sum(~keep_idx)
+                pre_block, post_block, d = pre_block[keep_idx], post_block[keep_idx], d[keep_idx]
 
-                if dist_3d:
-                    d = np.sqrt(np.sum((self.positions[x, :] - self.positions[y, :]) ** 2))
-                else:
-                    d = np.sqrt(np.sum((self.positions[x, 0:2] - self.positions[y, 0:2]) ** 2))
-                    # We also need to check that z-distance is not too large
+            idx = np.floor(d / delta_dist).astype(int)
+            assert (idx < num_bins).all(), f"Idx too large {np.max(idx)}"
 
-                    # Gilad email 2017-11-21:
-                    # The 100 um is the lateral (XY) distance between somata of
-                    # recorded cells. In terms of the Z axis, the slice
-                    # thickness is 250 um but the recordings are all done in the
-                    # upper half of the slice due to visibility of the cells. So
-                    # lets say in a depth of roughly 40-110 um from the upper
-                    # surface of the slice.
-                    dz = np.abs(self.positions[x, 2] - self.positions[y, 2])
+            connected = self.get_connection_values(con_mat, pre_block, post_block) > 0
 
-                    # Using dzMax = 70, see comment above from Gilad.
-                    if dz > 70e-6:
-                        # Skip this pair, too far away in z-depth
-                        count_rejected += 1
-                        continue
+            count_con[:, 0] += np.bincount(idx[connected], minlength=num_bins)
+            count_all[:, 0] += np.bincount(idx, minlength=num_bins)
 
-                idx = int(np.floor(d / delta_dist))
-                assert (idx < num_bins), "Idx too large " + str(idx)
+        p_con = np.divide(count_con, count_all)
 
-                if con_mat[x, y] > 0:
-                    count_con[idx] += 1
+        print(f"Requested: {'all pairs' if exact else num_points} calculated {sum(count_all)}")
 
-                count_all[idx] += 1
+        if not dist_3d:
+            print(f"Rejected (too large z-depth): {count_rejected}")
 
-            t_b = timeit.default_timer()
+        return dist, p_con, count_con, count_all
 
-            if self.debug:
-                print(f"{xi + 1}/{len(pre_id)} {t_b - t_a} s")
+    @staticmethod
+    def get_connection_pair_blocks(pre_id, post_id, num_points, exact=False, block_size=1000000):
 
-        p_con = np.divide(count_con, count_all)
+        """
+        Generator returning blocks of (pre_id, post_id) pairs for connection_probability.
 
-        print(f"Requested: {num_points} calculated {sum(count_all)}")
+        Args:
+            pre_id : Presynaptic neuron IDs
+            post_id : Postsynaptic neuron IDs
+            num_points (float) : Number of pairs to sample, each presynaptic neuron is paired with on average
+                                 num_points / len(pre_id) postsynaptic neurons (without replacement)
+            exact (bool) : Return all pairs
+            block_size (int) : Approximate number of pairs per block
+        """
 
-        if not dist_3d:
-            print(f"Rejected (too large z-depth): {count_rejected}")
+        pre_id = np.asarray(pre_id, dtype=int)
+        post_id = np.asarray(post_id, dtype=int)
 
-        # import pdb
-        # pdb.set_trace()
+        if len(pre_id) == 0 or len(post_id) == 0:
+            return
 
-        return dist, p_con, count_con, count_all
+        if exact:
+            pre_per_block = max(1, block_size // len(post_id))
+
+            for start_idx in range(0, len(pre_id), pre_per_block):
+                pre_chunk = pre_id[start_idx:start_idx + pre_per_block]
+                yield np.repeat(pre_chunk, len(post_id)), np.tile(post_id, len(pre_chunk))
+
+            return
+
+        num_per_pair = num_points / len(pre_id)
+        n_pts = np.floor(num_per_pair) + (num_per_pair - np.floor(num_per_pair) > np.random.rand(len(pre_id)))
+        n_pts = np.minimum(n_pts.astype(int), len(post_id))
+        max_pts = np.max(n_pts)
+
+        if max_pts == 0:
+            return
+
+        # Sampling without replacement for a block of presynaptic neurons at a time, each row uses the
+        # max_pts smallest of len(post_id) uniform random numbers, which picks a random subset of post_id
+        pre_per_block = max(1, block_size // len(post_id))
+
+        for start_idx in range(0, len(pre_id), pre_per_block):
+            pre_chunk = pre_id[start_idx:start_idx + pre_per_block]
+            n_chunk = n_pts[start_idx:start_idx + pre_per_block]
+            rand_val = np.random.random((len(pre_chunk), len(post_id)))
+
+            if max_pts < len(post_id):
+                sample_idx = np.argpartition(rand_val, max_pts, axis=1)[:, :max_pts]
+            else:
+                sample_idx = np.argsort(rand_val, axis=1)
+
+            keep = np.arange(max_pts) < n_chunk[:, None]
+
+            yield np.repeat(pre_chunk, n_chunk), post_id[sample_idx[keep]]
+
+    @staticmethod
+    def get_connection_values(con_mat, pre_id, post_id):
+
+        """ Returns con_mat[pre_id[i], post_id[i]] for all i, con_mat is a dense or sparse (CSR) matrix. """
+
+        if sps.issparse(con_mat):
+            return np.asarray(con_mat[pre_id, post_id]).ravel()
+        else:
+            return con_mat[pre_id, post_id]
 
     ############################################################################
 
@@ -1561,6 +1660,21 @@ class SnuddaAnalyse:
         if side_len is None:
             side_len = 100e-6
 
+        return self.memoise("num_incoming_connections", self._num_incoming_connections,
+                            extra_key=self.get_sub_pop_key(),
+                            neuron_type=neuron_type, pre_type=pre_type, side_len=side_len, volume_id=volume_id,
+                            connection_type=connection_type)
+
+    def _num_incoming_connections(self, neuron_type, pre_type, side_len=None,
+                                  volume_id=None,
+                                  connection_type="synapses"):
+
+        if volume_id is None:
+            volume_id = self.volume_id
+
+        if side_len is None:
+            side_len = 100e-6
+
         print(f"Calculating number of incoming connections {pre_type} -> {neuron_type}")
 
         # Only use post synaptic cell in central part of structure,
@@ -1609,6 +1723,24 @@ class SnuddaAnalyse:
         if side_len is None:
             side_len = 100e-6
 
+        return self.memoise("num_outgoing_connections", self._num_outgoing_connections,
+                            extra_key=self.get_sub_pop_key(),
+                            post_type=post_type, pre_type=pre_type, side_len=side_len, volume_id=volume_id,
+                            connection_type=connection_type)
+
+    def _num_outgoing_connections(self,
+                                  post_type,
+                                  pre_type,
+                                  side_len=None,
+                                  volume_id=None,
+                                  connection_type="synapses"):
+
+        if volume_id is None:
+            volume_id = self.volume_id
+
+        if side_len is None:
+            side_len = 100e-6
+
         print(f"Calculating number of outgoing connections {pre_type} -> {post_type}")
 
         # Only use post synaptic cell in central part of structure,
@@ -1838,12 +1970,30 @@ class SnuddaAnalyse:
 
     def synapse_dist(self, side_len=None, volume_id=None):
 
+        """ Calculates histograms of synapse distance to soma along dendrite, for all pairs of neuron types.
+            Sets all_types, neuron_type_id, dend_position_bin and dend_position_edges. """
+
         if volume_id is None:
             volume_id = self.volume_id
 
         if side_len is None:
             side_len = self.side_len
 
+        result = self.memoise("synapse_dist", self._synapse_dist, extra_key=self.get_sub_pop_key(),
+                              side_len=side_len, volume_id=volume_id)
+
+        self.all_types = [str(x) for x in result["all_types"]]
+        self.neuron_type_id = [int(x) for x in result["neuron_type_id"]]
+        self.dend_position_edges = result["dend_position_edges"]
+        self.dend_position_bin = dict()
+
+        for pre_type_id in range(0, len(self.all_types)):
+            for post_type_id in range(0, len(self.all_types)):
+                self.dend_position_bin[(pre_type_id, post_type_id)] \
+                    = result["dend_position_bin"][pre_type_id, post_type_id, :].copy()
+
+    def _synapse_dist(self, side_len, volume_id):
+
         t_a = timeit.default_timer()
 
         # cornerID = self.cornerNeurons(sideLen=sideLen)
@@ -1937,6 +2087,15 @@ class SnuddaAnalyse:
 
         print(f"Created distance histogram (optimised) in {t_b - t_a} seconds")
 
+        dend_position_bin = np.array([[self.dend_position_bin[(pre_type_id, post_type_id)]
+                                       for post_type_id in range(0, len(self.all_types))]
+                                      for pre_type_id in range(0, len(self.all_types))])
+
+        return {"all_types": np.array(self.all_types, dtype=str),
+                "neuron_type_id": np.array(self.neuron_type_id, dtype=int),
+                "dend_position_bin": dend_position_bin,
+                "dend_position_edges": self.dend_position_edges}
+
     ############################################################################
 
     def plot_synapse_cum_dist_summary(self, pair_list):
@@ -2,6 +2,7 @@ import os
 import numpy as np
 import h5py
 from snudda.utils import SnuddaLoad
+from snudda.utils.input_spikes import get_num_inputs
 
 
 class AnalyseInput:
@@ -38,7 +39,7 @@ class AnalyseInput:
 
             for input_name in self.input_data["input"][neuron_id_str].keys():
                 input_num[neuron_id][input_name] = \
-                    self.input_data["input"][neuron_id_str][input_name]["spikes"].shape[0]
+                    get_num_inputs(self.input_data["input"][neuron_id_str][input_name])
 
         return input_num
 
@@ -5,12 +5,14 @@ import matplotlib.pyplot as plt
 
 import h5py
 # from elephant.spike_train_correlation import spike_time_tiling_coefficient
-from snudda.analyse.spike_time_tiling_coefficient import spike_time_tiling_coefficient
+from snudda.analyse.spike_time_tiling_coefficient import spike_time_tiling_coefficient, \
+    spike_time_tiling_coefficient_all_to_all, spike_time_tiling_coefficient_block
 # from neo import SpikeTrain as NeoSpikeTrain
 # import quantities as pq
 
 from snudda.utils.load_network_simulation import SnuddaLoadNetworkSimulation
 from snudda.utils.load import SnuddaLoad
+from snudda.utils.input_spikes import get_input_spike_matrix
 
 
 class AnalyseSpikeTrains:
@@ -74,30 +76,59 @@ class AnalyseSpikeTrains:
     def get_end_time(self):
         return np.max(self.output_data.get_time())
 
+    @staticmethod
+    def to_csr(spike_trains, start_time, end_time):
+
+        """ Returns (spike_times, offset) with the spike times within start_time and end_time,
+            spike train i is spike_times[offset[i]:offset[i+1]]. """
+
+        pruned_spike_trains = []
+        for st in spike_trains:
+            st = np.asarray(st).flatten()
+            pruned_spike_trains.append(np.sort(st[np.logical_and(start_time <= st, st <= end_time)]))
+
+        offset = np.concatenate([[0], np.cumsum([len(st) for st in pruned_spike_trains])]).astype(np.int64)
+        spike_times = np.concatenate(pruned_spike_trains).astype(float) if len(pruned_spike_trains) > 0 \
+            else np.zeros((0,))
+
+        return spike_times, offset
+
     def calculate_sttc_all_to_all(self, spike_trains, n_spikes, dt, start_time=0, end_time=None):
+
+        """ Returns STTC between all pairs of spike_trains, as a condensed matrix (pair i, j with i < j
+            in row major order, see spike_time_tiling_coefficient_all_to_all). """
+
         n_spike_trains = len(n_spikes)
         assert spike_trains.shape[0] == n_spike_trains
 
-        corr = []
+        if end_time is None:
+            end_time = self.get_end_time()
+
+        spike_times, offset = self.to_csr(spike_trains, start_time=start_time, end_time=end_time)
+
+        return spike_time_tiling_coefficient_all_to_all(spike_times, offset, end_time=end_time,
+                                                        start_time=start_time, dt=dt)
+
+    def calculate_sttc_neuron_types(self, neuron_type_a, neuron_type_b, dt, start_time=0, end_time=None):
+
+        """ Returns STTC between the spike trains of all neurons of neuron_type_a (rows) and
+            neuron_type_b (columns), together with the neuron ID of the rows and columns. """
 
         if end_time is None:
             end_time = self.get_end_time()
 
-        pruned_spike_trains = []
-        for st in spike_trains:
-            idx = np.where(np.logical_and(start_time <= st, st <= end_time))[0]
-            pruned_spike_trains.append(st[idx].flatten())
-
-        for i in range(0, n_spike_trains):
-            if i % 50 == 0:
-                print(f'{i} / {n_spike_trains}')
-            for j in range(i+1, n_spike_trains):
-                corr.append(spike_time_tiling_coefficient(spiketrain_a=pruned_spike_trains[i],
-                                                          spiketrain_b=pruned_spike_trains[j],
-                                                          dt=dt, start_time=start_time, end_time=end_time))
-        print(f'{i} / {n_spike_trains}')
+        neuron_id_a = np.array(self.output_data.get_id_of_neuron_type(neuron_type_a), dtype=int)
+        neuron_id_b = np.array(self.output_data.get_id_of_neuron_type(neuron_type_b), dtype=int)
 
-        return np.array(corr)
+        spike_table = self.output_data.get_spike_table()
+        offset = spike_table["offset"]
+        spike_trains = [spike_table["time"][offset[idx]:offset[idx + 1]] for idx in range(0, len(offset) - 1)]
+        spike_times, offset = self.to_csr(spike_trains, start_time=start_time, end_time=end_time)
+
+        corr = spike_time_tiling_coefficient_block(spike_times, offset, neuron_id_a, neuron_id_b,
+                                                   end_time=end_time, start_time=start_time, dt=dt)
+
+        return corr, neuron_id_a, neuron_id_b
 
     def calculate_sttc_one_to_all(self, spike_train, spike_trains, n_spikes, dt, start_time=0, end_time=None):
         n_spike_trains = len(n_spikes)
@@ -122,8 +153,7 @@ class AnalyseSpikeTrains:
         return np.array(corr)
 
     def input_correlation(self, neuron_id, input_type, dt):
-        input_spikes = self.input_data[f"input/{neuron_id}/{input_type}/spikes"][()].copy()
-        n_spikes = self.input_data[f"input/{neuron_id}/{input_type}/spikes"].attrs["num_spikes"].copy()
+        input_spikes, n_spikes = get_input_spike_matrix(self.input_data[f"input/{neuron_id}/{input_type}"])
 
         corr = self.calculate_sttc_all_to_all(spike_trains=input_spikes, n_spikes=n_spikes, dt=dt)
         return corr
@@ -135,7 +165,7 @@ class AnalyseSpikeTrains:
 
         # First gather all input spikes
         for input_type, input_spikes in self.input_data[f"input/{neuron_id}"].items():
-            input_data[input_type] = input_spikes["spikes"][()].copy(), input_spikes["spikes"].attrs["num_spikes"].copy()
+            input_data[input_type] = get_input_spike_matrix(input_spikes)
 
         output_data = self.output_data.get_spikes(neuron_id=neuron_id)
 
@@ -159,7 +189,7 @@ class AnalyseSpikeTrains:
 
     def calculate_spike_multiplicity(self, neuron_id, input_type, jitter=0, start_time=None, end_time=None):
 
-        input_spikes = self.input_data[f"input/{neuron_id}/{input_type}/spikes"][()].flatten()
+        input_spikes = get_input_spike_matrix(self.input_data[f"input/{neuron_id}/{input_type}"])[0].flatten()
         return self.calculate_multiplicity_helper(input_spikes=input_spikes, jitter=jitter,
                                                   start_time=start_time, end_time=end_time)
 
@@ -0,0 +1,218 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import scipy.sparse as sps
+
+from snudda.utils.numpy_encoder import NumpyEncoder
+
+
+class SnuddaAnalysisCache:
+
+    """
+    Persistent cache for expensive analysis results (connection matrices, histograms, counts).
+
+    Results are stored as compressed npz files in cache_dir, the key is the hash of the network file content
+    together with the name of the result and the arguments used to compute it. Changing the network file
+    therefore invalidates the cache. When the cache grows larger than max_size the least recently used files
+    are removed.
+    """
+
+    # Content hash of network files, keyed on (path, size, modification time), to avoid hashing the same file twice
+    network_hash_lookup = dict()
+
+    def __init__(self, network_file, cache_dir=None, max_size=1e9, verbose=True):
+
+        """
+        Constructor.
+
+        Args:
+            network_file (str): Path to network file
+            cache_dir (str): Path to cache directory (default: analysis_cache next to network_file)
+            max_size (float): Maximum total size of cache files in bytes
+            verbose (bool): Print cache hits and misses
+        """
+
+        self.network_file = network_file
+
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(network_file), "analysis_cache")
+
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.verbose = verbose
+
+    def get_network_hash(self):
+
+        """ Returns sha256 hash of the network file content. """
+
+        file_stat = os.stat(self.network_file)
+        lookup_key = (os.path.abspath(self.network_file), file_stat.st_size, file_stat.st_mtime_ns)
+
+        if lookup_key not in SnuddaAnalysisCache.network_hash_lookup:
+            file_hash = hashlib.sha256()
+
+            with open(self.network_file, "rb") as f:
+                for block in iter(lambda: f.read(16 * 1024 * 1024), b""):
+                    file_hash.update(block)
+
+            SnuddaAnalysisCache.network_hash_lookup[lookup_key] = file_hash.hexdigest()
+
+        return SnuddaAnalysisCache.network_hash_lookup[lookup_key]
+
+    def get_cache_file(self, name, **kwargs):
+
+        """ Returns path to cache file for result name, computed with arguments kwargs. """
+
+        key_str = json.dumps({"network_hash": self.get_network_hash(), "name": name, "kwargs": kwargs},
+                             sort_keys=True, cls=NumpyEncoder)
+        key = hashlib.sha256(key_str.encode()).hexdigest()
+
+        return os.path.join(self.cache_dir, f"{name}-{key[:24]}.npz")
+
+    ############################################################################
+
+    @staticmethod
+    def pack(value, prefix=""):
+
+        """ Converts value (np.ndarray, scipy sparse matrix, tuple, list or dict with str keys, possibly nested)
+            into a flat dictionary of arrays that can be saved with np.savez. """
+
+        if sps.issparse(value):
+            value = sps.csr_matrix(value)
+            return {f"{prefix}__csr_data__": value.data,
+                    f"{prefix}__csr_indices__": value.indices,
+                    f"{prefix}__csr_indptr__": value.indptr,
+                    f"{prefix}__csr_shape__": np.array(value.shape)}
+
+        if isinstance(value, (tuple, list)):
+            packed = {f"{prefix}__{type(value).__name__}__": np.array(len(value))}
+            for idx, v in enumerate(value):
+                packed.update(SnuddaAnalysisCache.pack(v, prefix=f"{prefix}{idx}/"))
+            return packed
+
+        if isinstance(value, dict):
+            packed = {f"{prefix}__dict__": np.array(list(value.keys()), dtype=str)}
+            for k, v in value.items():
+                packed.update(SnuddaAnalysisCache.pack(v, prefix=f"{prefix}{k}/"))
+            return packed
+
+        return {f"{prefix}__array__": np.asarray(value)}
+
+    @staticmethod
+    def unpack(data, prefix=""):
+
+        """ Inverse of pack. """
+
+        if f"{prefix}__csr_data__" in data:
+            return sps.csr_matrix((data[f"{prefix}__csr_data__"],
+                                   data[f"{prefix}__csr_indices__"],
+                                   data[f"{prefix}__csr_indptr__"]),
+                                  shape=tuple(data[f"{prefix}__csr_shape__"]))
+
+        for seq_type in [tuple, list]:
+            if f"{prefix}__{seq_type.__name__}__" in data:
+                return seq_type(SnuddaAnalysisCache.unpack(data, prefix=f"{prefix}{idx}/")
+                                for idx in range(0, int(data[f"{prefix}__{seq_type.__name__}__"])))
+
+        if f"{prefix}__dict__" in data:
+            return {k: SnuddaAnalysisCache.unpack(data, prefix=f"{prefix}{k}/") for k in data[f"{prefix}__dict__"]}
+
+        return data[f"{prefix}__array__"]
+
+    ############################################################################
+
+    def load(self, name, **kwargs):
+
+        """ Returns cached result name computed with arguments kwargs, or None if it is not in the cache. """
+
+        cache_file = self.get_cache_file(name, **kwargs)
+
+        if not os.path.isfile(cache_file):
+            if self.verbose:
+                print(f"Analysis cache miss: {name}")
+            return None
+
+        try:
+            with np.load(cache_file, allow_pickle=False) as data:
+                value = self.unpack({k: data[k] for k in data.files})
+        except Exception as e:
+            print(f"Failed to read analysis cache {cache_file} ({e}), ignoring it.")
+            return None
+
+        # Mark as recently used, used for eviction
+        os.utime(cache_file)
+
+        if self.verbose:
+            print(f"Analysis cache hit: {name} ({cache_file})")
+
+        return value
+
+    def save(self, name, value, **kwargs):
+
+        """ Saves result name computed with arguments kwargs to the cache. """
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cache_file = self.get_cache_file(name, **kwargs)
+
+        # Write to temporary file first, so a crash does not leave a broken cache file
+        tmp_file = f"{cache_file}.tmp.npz"
+        np.savez_compressed(tmp_file, **self.pack(value))
+        os.replace(tmp_file, cache_file)
+
+        self.evict(keep_file=cache_file)
+
+    def memoise(self, name, function, extra_key=None, **kwargs):
+
+        """
+        Returns function(**kwargs), using the cached result name if available.
+
+        Args:
+            name (str): Name of result
+            function: Function computing result
+            extra_key (dict): Additional values the result depends on, that are not arguments to function
+            kwargs: Arguments to function, also part of the cache key
+        """
+
+        key_kwargs = dict(kwargs, **(extra_key or dict()))
+        value = self.load(name, **key_kwargs)
+
+        if value is None:
+            value = function(**kwargs)
+            self.save(name, value, **key_kwargs)
+
+        return value
+
+    def evict(self, keep_file=None):
+
+        """ Removes least recently used cache files until the cache is smaller than max_size. """
+
+        if not os.path.isdir(self.cache_dir):
+            return
+
+        cache_files = [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir) if f.endswith(".npz")]
+        file_stat = {f: os.stat(f) for f in cache_files}
+        total_size = sum(s.st_size for s in file_stat.values())
+
+        for cache_file in sorted(cache_files, key=lambda f: file_stat[f].st_mtime_ns):
+            if total_size <= self.max_size:
+                break
+
+            if cache_file == keep_file:
+                continue
+
+            os.remove(cache_file)
+            total_size -= file_stat[cache_file].st_size
+
+            if self.verbose:
+                print(f"Evicted {cache_file} from analysis cache")
+
+    def clear(self):
+
+        """ Removes all cache files. """
+
+        if os.path.isdir(self.cache_dir):
+            for f in os.listdir(self.cache_dir):
+                if f.endswith(".npz"):
+                    os.remove(os.path.join(self.cache_dir, f))
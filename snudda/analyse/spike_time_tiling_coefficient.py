@@ -2,7 +2,7 @@
 # and modified to use numba for faster run time.
 
 import numpy as np
-from numba import jit
+from numba import jit, prange
 
 
 @jit(nopython=True, fastmath=True, cache=True)
@@ -46,25 +46,121 @@ def spike_time_tiling_coefficient(spiketrain_a, spiketrain_b, end_time, start_ti
         PA = PA / N1
         PB = run_p(spiketrain_b, spiketrain_a, dt=dt)
         PB = PB / N2
-        # check if the P and T values are 1 to avoid division by zero
-        # This only happens for TA = PB = 1 and/or TB = PA = 1,
-        # which leads to 0/0 in the calculation of the index.
-        # In those cases, every spike in the train with P = 1
-        # is within dt of a spike in the other train,
-        # so we set the respective (partial) index to 1.
-        if PA * TB == 1:
-            if PB * TA == 1:
-                index = 1.
-            else:
-                index = 0.5 + 0.5 * (PB - TA) / (1 - PB * TA)
-        elif PB * TA == 1:
-            index = 0.5 + 0.5 * (PA - TB) / (1 - PA * TB)
+        index = sttc_index(PA, PB, TA, TB)
+
+    return index
+
+
+@jit(nopython=True, fastmath=True, cache=True)
+def sttc_index(PA, PB, TA, TB):
+    """
+    Combine the P and T values of two spike trains into the STTC.
+    """
+    # check if the P and T values are 1 to avoid division by zero
+    # This only happens for TA = PB = 1 and/or TB = PA = 1,
+    # which leads to 0/0 in the calculation of the index.
+    # In those cases, every spike in the train with P = 1
+    # is within dt of a spike in the other train,
+    # so we set the respective (partial) index to 1.
+    if PA * TB == 1:
+        if PB * TA == 1:
+            index = 1.
         else:
-            index = 0.5 * (PA - TB) / (1 - PA * TB) + 0.5 * (PB - TA) / (1 - PB * TA)
+            index = 0.5 + 0.5 * (PB - TA) / (1 - PB * TA)
+    elif PB * TA == 1:
+        index = 0.5 + 0.5 * (PA - TB) / (1 - PA * TB)
+    else:
+        index = 0.5 * (PA - TB) / (1 - PA * TB) + 0.5 * (PB - TA) / (1 - PB * TA)
 
     return index
 
 
+@jit(nopython=True, fastmath=True, cache=True, parallel=True)
+def run_t_all(spike_times, offset, end_time, start_time=0, dt=0.005):
+    """
+    Calculate run_t for all spike trains, spike train i is spike_times[offset[i]:offset[i+1]].
+    Empty spike trains get T = 0.
+    """
+    n_trains = len(offset) - 1
+    T = np.zeros((n_trains,))
+
+    for i in prange(n_trains):
+        if offset[i + 1] > offset[i]:
+            T[i] = run_t(spike_times[offset[i]:offset[i + 1]], end_time=end_time, start_time=start_time, dt=dt)
+
+    return T
+
+
+@jit(nopython=True, fastmath=True, cache=True, parallel=True)
+def spike_time_tiling_coefficient_all_to_all(spike_times, offset, end_time, start_time=0, dt=0.005):
+    """
+    Calculates the STTC between all pairs of spike trains. The spike trains are given in CSR format,
+    spike train i is spike_times[offset[i]:offset[i+1]] (sorted). The T values are calculated once per spike train,
+    and the rows are processed in parallel.
+
+    Returns a condensed matrix (same order as scipy.spatial.distance.squareform), the STTC between spike train i
+    and j (i < j) is at index n*i - i*(i+1)//2 + j - i - 1. Pairs with an empty spike train are NaN.
+    """
+    n_trains = len(offset) - 1
+    T = run_t_all(spike_times, offset, end_time=end_time, start_time=start_time, dt=dt)
+    sttc = np.full((n_trains * (n_trains - 1) // 2,), np.nan)
+
+    for i in prange(n_trains):
+        row_offset = n_trains * i - i * (i + 1) // 2 - i - 1
+        spiketrain_a = spike_times[offset[i]:offset[i + 1]]
+        N1 = len(spiketrain_a)
+
+        if N1 == 0:
+            continue
+
+        for j in range(i + 1, n_trains):
+            spiketrain_b = spike_times[offset[j]:offset[j + 1]]
+            N2 = len(spiketrain_b)
+
+            if N2 == 0:
+                continue
+
+            PA = run_p(spiketrain_a, spiketrain_b, dt=dt) / N1
+            PB = run_p(spiketrain_b, spiketrain_a, dt=dt) / N2
+            sttc[row_offset + j] = sttc_index(PA, PB, T[i], T[j])
+
+    return sttc
+
+
+@jit(nopython=True, fastmath=True, cache=True, parallel=True)
+def spike_time_tiling_coefficient_block(spike_times, offset, idx_a, idx_b, end_time, start_time=0, dt=0.005):
+    """
+    Calculates the STTC between spike trains idx_a and idx_b (e.g. neurons of two neuron types),
+    spike trains are given in CSR format (see spike_time_tiling_coefficient_all_to_all).
+
+    Returns a matrix with len(idx_a) rows and len(idx_b) columns. Pairs with an empty spike train are NaN.
+    """
+    T = run_t_all(spike_times, offset, end_time=end_time, start_time=start_time, dt=dt)
+    sttc = np.full((len(idx_a), len(idx_b)), np.nan)
+
+    for row in prange(len(idx_a)):
+        i = idx_a[row]
+        spiketrain_a = spike_times[offset[i]:offset[i + 1]]
+        N1 = len(spiketrain_a)
+
+        if N1 == 0:
+            continue
+
+        for col in range(len(idx_b)):
+            j = idx_b[col]
+            spiketrain_b = spike_times[offset[j]:offset[j + 1]]
+            N2 = len(spiketrain_b)
+
+            if N2 == 0:
+                continue
+
+            PA = run_p(spiketrain_a, spiketrain_b, dt=dt) / N1
+            PB = run_p(spiketrain_b, spiketrain_a, dt=dt) / N2
+            sttc[row, col] = sttc_index(PA, PB, T[i], T[j])
+
+    return sttc
+
+
 @jit(nopython=True, fastmath=True, cache=True)
 def run_p(spiketrain_a, spiketrain_b, dt=0.005):
     """
@@ -77,6 +77,11 @@ def snudda_cli():
     detect_parser.add_argument("-cont", "--cont", help="Continue partial touch detection", action="store_true")
     detect_parser.add_argument("-hvsize", "--hvsize", default=100,
                                help="Hyper voxel size, eg. 100 = 100x100x100 voxels in hypervoxel")
+    detect_parser.add_argument("--sparse_voxels", action="store_true", default=False,
+                               help="Sparse voxel storage, no voxel overflow and allows larger hvsize")
+    detect_parser.add_argument("--rasterise_method", choices=["step", "dda"], default="step",
+                               help="Morphology rasterisation, 'step' samples segments (default), "
+                                    "'dda' marks every voxel a segment passes through")
     detect_parser.add_argument("--volumeID", help="Specify volume ID for detection step")
     detect_parser.add_argument("--profile", help="Run python cProfile", action="store_true")
     detect_parser.add_argument("--verbose", action="store_true")
@@ -98,6 +103,8 @@ def snudda_cli():
                               help="Keep temp and voxel files after pruning (e.g. useful if you want to rerun pruning)")
     prune_parser.add_argument("--savePutative", action="store_true",
                               help="Also saved network-putative-synapses.hdf5 with unpruned network")
+    prune_parser.add_argument("--uncompressed", action="store_true",
+                              help="Write uncompressed synapse matrices, allows memory mapping with SnuddaLoad(lazy=True)")
     prune_parser.add_argument("-parallel", "--parallel", action="store_true", default=False)
     prune_parser.add_argument("-ipython_profile", "--ipython_profile", default=None)
     prune_parser.add_argument("-ipython_timeout", "--ipython_timeout", default=120, type=int)
@@ -119,6 +126,10 @@ def snudda_cli():
     input_parser.add_argument("-ipython_profile", "--ipython_profile", default=None)
     input_parser.add_argument("-ipython_timeout", "--ipython_timeout", default=120, type=int)
     input_parser.add_argument("-no_meta_input", "--no_meta_input", help="Do not use meta.json as stimulation input", action="store_true", default=False)
+    input_parser.add_argument("--spike_format", choices=["dense", "csr"], default="dense",
+                              help="Layout of input spikes in hdf5 file, dense (padded matrix) or csr (concatenated)")
+    input_parser.add_argument("--stream_output", action="store_true", default=False,
+                              help="Write input to file as it is generated, reduces memory usage of master process")
 
     simulate_parser = sub_parsers.add_parser("simulate")
     simulate_parser.add_argument("path", help="Location of network")
@@ -148,6 +159,20 @@ def snudda_cli():
     simulate_parser.add_argument("--disableGJ", "--disableGapJunctions", action="store_true", dest="disable_gj", default=None,
                                  help="Disable gap junctions")
 
+    simulate_parser.add_argument("--distribution", dest="distribution_strategy", default=None,
+                                 choices=["round_robin", "contiguous", "load_balanced"],
+                                 help="How neurons are distributed between workers (default: round_robin)")
+
+    simulate_parser.add_argument("--share_spike_sources", action="store_true", default=None,
+                                 help="Inputs with identical spike trains onto a neuron share a single VecStim")
+
+    simulate_parser.add_argument("--shard_output", action="store_true", default=None,
+                                 help="Each worker writes its output to its own shard file, "
+                                      "presented as one output file using HDF5 virtual datasets")
+
+    simulate_parser.add_argument("--flush_interval", type=float, default=None,
+                                 help="Write recordings to disk every flush_interval seconds of simulated time")
+
     simulate_parser.add_argument("-mechdir", "--mechDir", dest="mech_dir",
                                  help="mechanism directory if not default", default=None)
     simulate_parser.add_argument("--profile", help="Run python cProfile", action="store_true")
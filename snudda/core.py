@@ -285,7 +285,7 @@ class Snudda(object):
             args : command line arguments from argparse
 
         Example:
-            snudda detect [-cont] [-hvsize HVSIZE] [--volumeID VOLUMEID] [--profile] [--verbose] [--h5legacy] [-parallel] path
+            snudda detect [-cont] [-hvsize HVSIZE] [--sparse_voxels] [--rasterise_method {step,dda}] [--volumeID VOLUMEID] [--profile] [--verbose] [--h5legacy] [-parallel] path
 
         """
 
@@ -306,6 +306,8 @@ class Snudda(object):
                              hyper_voxel_size=hyper_voxel_size,
                              volume_id=args.volumeID,
                              h5libver=h5libver,
+                             sparse_voxels=args.sparse_voxels,
+                             rasterise_method=args.rasterise_method,
                              verbose=args.verbose,
                              cont=args.cont)
 
@@ -317,6 +319,8 @@ class Snudda(object):
                         hyper_voxel_size=100,
                         volume_id=None,
                         h5libver="latest",
+                        sparse_voxels=False,
+                        rasterise_method="step",
                         verbose=False,
                         cont=False):
 
@@ -362,6 +366,8 @@ class Snudda(object):
                           hyper_voxel_size=hyper_voxel_size,
                           h5libver=h5libver,
                           random_seed=random_seed,
+                          sparse_voxels=sparse_voxels,
+                          rasterise_method=rasterise_method,
                           verbose=verbose)
 
         if cont:
@@ -396,7 +402,7 @@ class Snudda(object):
             args : command line arguments from argparse
 
         Example:
-            snudda prune [--configFile CONFIG_FILE] [--profile] [--verbose] [--h5legacy] [--keepfiles] [-parallel] path
+            snudda prune [--configFile CONFIG_FILE] [--profile] [--verbose] [--h5legacy] [--keepfiles] [--uncompressed] [-parallel] path
         """
 
         if args.h5legacy:
@@ -411,7 +417,8 @@ class Snudda(object):
                             ipython_timeout=args.ipython_timeout,
                             verbose=args.verbose,
                             keep_files=args.keepfiles,
-                            save_putative_synapses = args.savePutative)
+                            save_putative_synapses = args.savePutative,
+                            compress_synapses=not args.uncompressed)
 
     def prune_synapses(self,
                        config_file=None,
@@ -422,7 +429,8 @@ class Snudda(object):
                        h5libver="latest",
                        verbose=False,
                        keep_files=False,
-                       save_putative_synapses=False):
+                       save_putative_synapses=False,
+                       compress_synapses=True):
 
         if parallel is None:
             parallel = self.parallel
@@ -455,7 +463,8 @@ class Snudda(object):
                          h5libver=h5libver,
                          random_seed=random_seed,
                          verbose=verbose,
-                         keep_files=keep_files or save_putative_synapses)
+                         keep_files=keep_files or save_putative_synapses,
+                         compress_synapses=compress_synapses)
 
         sp.prune()
 
@@ -496,6 +505,8 @@ class Snudda(object):
                          parallel=args.parallel,
                          ipython_profile=args.ipython_profile,
                          ipython_timeout=args.ipython_timeout,
+                         spike_format=args.spike_format,
+                         stream_output=args.stream_output,
                          verbose=args.verbose)
 
     def setup_input(self,
@@ -509,6 +520,8 @@ class Snudda(object):
                     parallel=None,
                     ipython_profile=None,
                     ipython_timeout=120,
+                    spike_format="dense",
+                    stream_output=False,
                     verbose=False):
 
         if parallel is None:
@@ -551,7 +564,9 @@ class Snudda(object):
                          random_seed=random_seed,
                          h5libver=h5libver,
                          verbose=verbose,
-                         use_meta_input=use_meta_input)
+                         use_meta_input=use_meta_input,
+                         spike_format=spike_format,
+                         stream_output=stream_output)
         si.generate()
 
         self.cleanup_workers()
@@ -651,7 +666,7 @@ class Snudda(object):
         Example:
             snudda simulate [--networkFile NETWORK_FILE] [--inputFile INPUT_FILE] [--time TIME]
             [--spikesOut SPIKES_OUT] [--neuromodulation NEUROMODULATION] [--noVolt] [--disableGJ]
-            [-mechdir MECH_DIR] [--profile] [--verbose] [--exportCoreNeuron] path
+            [--distribution DISTRIBUTION] [-mechdir MECH_DIR] [--profile] [--verbose] [--exportCoreNeuron] path
         """
 
         print(f"args: {args}")
@@ -663,6 +678,10 @@ class Snudda(object):
                             neuromodulation=args.neuromodulation,
                             disable_synapses=args.disable_synapses,
                             disable_gj=args.disable_gj,
+                            distribution_strategy=args.distribution_strategy,
+                            share_spike_sources=args.share_spike_sources,
+                            shard_output=args.shard_output,
+                            flush_interval=args.flush_interval,
                             record_volt=args.record_volt,
                             record_all=args.record_all,
                             simulation_config=args.simulation_config,
@@ -681,6 +700,10 @@ class Snudda(object):
                  neuromodulation=None,
                  disable_synapses=None,
                  disable_gj=False,
+                 distribution_strategy=None,
+                 share_spike_sources=None,
+                 shard_output=None,
+                 flush_interval=None,
                  record_volt=True,
                  record_all=False,
                  simulation_config=None,
@@ -814,6 +837,10 @@ class Snudda(object):
                                  disable_synapses=disable_synapses,
                                  log_file=log_file,
                                  simulation_config=simulation_config,
+                                 distribution_strategy=distribution_strategy,
+                                 share_spike_sources=share_spike_sources,
+                                 shard_output=shard_output,
+                                 flush_interval=flush_interval,
                                  verbose=verbose)
             sim.setup()
             sim.add_external_input()
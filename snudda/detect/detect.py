@@ -32,6 +32,8 @@ from snudda.neurons.morphology_data import MorphologyData
 from snudda.utils import NumpyEncoder
 from snudda.utils.snudda_path import get_snudda_data, snudda_parse_path
 from snudda.detect.projection_detection import ProjectionDetection
+from snudda.detect.rasterise import SegmentTable, rasterise_section, write_dense_voxel_items
+from snudda.detect.sparse_voxels import SparseVoxels
 from snudda.neurons.neuron_prototype import NeuronPrototype
 from snudda.utils.load import SnuddaLoad
 
@@ -65,6 +67,8 @@ class SnuddaDetect(object):
                  simulation_origo=None,  # Auto detect
                  h5libver=None,  # Default: "latest"
                  random_seed=None,
+                 sparse_voxels=False,
+                 rasterise_method="step",
                  debug_flag=False):
 
         """
@@ -89,6 +93,11 @@ class SnuddaDetect(object):
             simulation_origo (np.array, optional): Origo for touch detection hypervoxels and voxels, voxel coordinates must always positive.
             h5libver (string, optional): h5py library version (default "latest")
             random_seed (int, optional): Random seed
+            sparse_voxels (bool, optional): Use sparse voxel storage, no limit on items per voxel,
+                                            memory scales with voxels occupied (default: False)
+            rasterise_method (str, optional): How morphologies are converted to voxels, "step" samples the
+                                              segments, "dda" marks each voxel a segment passes through
+                                              (default: "step")
             debug_flag (bool, optional): Save additional information for debugging (Default: False)
 
         """
@@ -183,6 +192,16 @@ class SnuddaDetect(object):
         self.axon_voxels = None
         self.dend_voxels = None
 
+        # Sparse alternative to the dense voxel matrices, see SparseVoxels
+        self.sparse_voxels = sparse_voxels
+        self.axon_voxel_store = None
+        self.dend_voxel_store = None
+
+        if rasterise_method not in ["step", "dda"]:
+            raise ValueError(f"Unknown rasterise_method {rasterise_method}, must be 'step' or 'dda'")
+
+        self.rasterise_method = rasterise_method
+
         self.volume_id = volume_id
         if volume_id is not None:
             self.write_log(f"Touch detection only {volume_id}")
@@ -263,6 +282,19 @@ class SnuddaDetect(object):
         # self.connectivityDistributionsGJ = dict([])
         self.next_channel_model_id = 10
 
+        # Integer versions of the connectivity_distributions, used by the compiled synapse detection
+        # these are created by setup_connectivity_lookup
+        self.neuron_type_id = None
+        self.connectivity_lookup = None
+        self.synapse_channel_model_id = None
+        self.synapse_lognormal_mu_sigma = None
+        self.synapse_min_conductance = None
+        self.synapse_cluster_size_mean_std = None
+        self.synapse_cluster_spread_mean_std = None
+
+        # Section point index for each morphology, used when placing cluster synapses
+        self.section_point_index_cache = dict()
+
         self.prototype_neurons = dict([])
         self.neuron_cache = dict()
         self.extra_axon_cache = dict()
@@ -1100,6 +1132,23 @@ class SnuddaDetect(object):
         # Used by plotHyperVoxel to make sure synapses are displayed correctly
         self.hyper_voxel_offset = None
 
+        if self.sparse_voxels:
+            self.setup_sparse_voxels()
+        else:
+            self.setup_dense_voxels()
+
+        self.voxel_overflow_counter = 0
+
+        if self.role == "worker":
+            # Let's clear the cache between hyper voxels if we are running in parallel
+            # (less chance of cache hits between hyper voxels, and avoid too many copies cached)
+            self.neuron_cache = dict()
+            self.extra_axon_cache = dict()
+
+    def setup_dense_voxels(self):
+
+        """ Allocates (or clears) the dense voxel matrices, holding at most max_axon and max_dend items per voxel. """
+
         # Which axons populate the different voxels
         if self.axon_voxels is None:
             self.axon_voxels = np.zeros((self.num_bins[0],
@@ -1157,13 +1206,19 @@ class SnuddaDetect(object):
             self.dend_sec_x[:] = 0
             self.dend_soma_dist[:] = 0
 
-        self.voxel_overflow_counter = 0
+    def setup_sparse_voxels(self):
 
-        if self.role == "worker":
-            # Let's clear the cache between hyper voxels if we are running in parallel
-            # (less chance of cache hits between hyper voxels, and avoid too many copies cached)
-            self.neuron_cache = dict()
-            self.extra_axon_cache = dict()
+        """ Allocates (or clears) the sparse voxel stores, the voxel counters refer to the counters in the stores. """
+
+        if self.axon_voxel_store is None:
+            self.axon_voxel_store = SparseVoxels(num_bins=self.num_bins)
+            self.dend_voxel_store = SparseVoxels(num_bins=self.num_bins)
+        else:
+            self.axon_voxel_store.clear()
+            self.dend_voxel_store.clear()
+
+        self.axon_voxel_ctr = self.axon_voxel_store.voxel_ctr
+        self.dend_voxel_ctr = self.dend_voxel_store.voxel_ctr
 
     def free_memory(self):
         # Clear some variables to free memory, reset max values to default, and perform garbage collection
@@ -1185,6 +1240,9 @@ class SnuddaDetect(object):
         self.dend_sec_x = None
         self.dend_soma_dist = None
 
+        self.axon_voxel_store = None
+        self.dend_voxel_store = None
+
         mem_available_before = self.memory_fraction_free()
 
         gc.collect()
@@ -1217,133 +1275,10 @@ class SnuddaDetect(object):
             self.max_axon_voxel_ctr = np.amax(self.axon_voxel_ctr)
             self.max_dend_voxel_ctr = np.amax(self.dend_voxel_ctr)
 
-        for x, y, z in zip(x_syn, y_syn, z_syn):
-            axon_id_list = self.axon_voxels[x, y, z, :self.axon_voxel_ctr[x, y, z]]
-            dend_id_list = self.dend_voxels[x, y, z, :self.dend_voxel_ctr[x, y, z]]
-
-            axon_dist = self.axon_soma_dist[x, y, z, :self.axon_voxel_ctr[x, y, z]]
-            dend_dist = self.dend_soma_dist[x, y, z, :self.dend_voxel_ctr[x, y, z]]
-
-            dend_sec_id = self.dend_sec_id[x, y, z, :self.dend_voxel_ctr[x, y, z]]
-            dend_sec_x = self.dend_sec_x[x, y, z, :self.dend_voxel_ctr[x, y, z]]
-
-            # Maybe make dendrite loop outer, since it has more variables?
-            # speedup??
-            for (ax_id, ax_dist) in zip(axon_id_list, axon_dist):
-                for (d_id, d_sec_id, d_sec_x, d_dist) \
-                        in zip(dend_id_list, dend_sec_id, dend_sec_x, dend_dist):
-
-                    if ax_id == d_id:
-                        # Avoid self connections
-                        continue
-
-                    pre_type = self.neurons[ax_id]["type"]
-                    post_type = self.neurons[d_id]["type"]
+        if self.neuron_type_id is None:
+            self.setup_connectivity_lookup()
 
-                    if (pre_type, post_type) in self.connectivity_distributions:
-
-                        con_dict = self.connectivity_distributions[pre_type, post_type]
-
-                        # We need to loop over conDict in case there are multiple
-                        # types of synapses from this neuron
-                        for con_type in con_dict:
-                            if con_type == "gap_junction":
-                                # This part detects only axon-dend synapses, skip gap junctions
-                                continue
-
-                            synapse_mu, synapse_sigma = con_dict[con_type]["lognormal_mu_sigma"]
-                            mean_synapse_cond, std_synapse_cond = con_dict[con_type]["conductance"]
-                            channel_model_id = con_dict[con_type]["channel_model_id"]
-
-                            # Should we add just one synapse, or a cluster of synapses
-                            cluster_size = con_dict[con_type]["cluster_size"]
-
-                            if isinstance(cluster_size, (np.ndarray, list)):
-                                cluster_size = round(self.hyper_voxel_rng.normal(loc=cluster_size[0],
-                                                                                 scale=cluster_size[1]))
-                                
-                            if cluster_size > 1:
-                                cluster_spread = con_dict[con_type]["cluster_spread"]
-
-                                if cluster_spread is None:
-                                    raise ValueError(f"cluster_spread ({cluster_spread}) must be a distance (in meters), e.g. 10e-6. ")
-                                
-                                if isinstance(cluster_spread, (np.ndarray, list)):
-                                    cluster_spread = np.maximum(np.abs(self.hyper_voxel_rng.normal(loc=cluster_spread[0],
-                                                                                                   scale=cluster_spread[1])),
-                                                                5e-6)
-
-                                # This uses clone in neuron_prototype which should be cached (not anymore, but will be cached for 2nd hit)
-                                neuron = self.load_neuron(self.neurons[d_id])
-                                
-                                try:
-                                    cluster_sec_x, syn_coords, soma_dist \
-                                        = neuron.cluster_synapses(sec_id=d_sec_id, sec_x=d_sec_x,
-                                                                  count=cluster_size, distance=cluster_spread,
-                                                                  rng=self.hyper_voxel_rng)
-                                except:
-                                    import traceback
-                                    tstr = traceback.format_exc()
-                                    print(tstr)
-                                    import pdb
-                                    pdb.set_trace()
-
-                                if self.hyper_voxel_synapse_ctr + cluster_size >= self.max_synapses:
-                                    self.resize_hyper_voxel_synapses_matrix()
-
-                                cluster_cond = self.hyper_voxel_rng.lognormal(synapse_mu, synapse_sigma, cluster_size)
-                                cluster_cond = np.maximum(cluster_cond, mean_synapse_cond * 0.1)
-                                cluster_param_id = self.hyper_voxel_rng.integers(1000000, size=cluster_size)
-
-                                # We need to convert coords to hyper voxel coords, to fit with other coords
-                                coords_all = np.floor((syn_coords - self.hyper_voxel_origo)/self.voxel_size).astype(int)
-
-                                for d_sec_x, x, y, z, d_dist, cond, param_id \
-                                        in zip(cluster_sec_x, coords_all[:, 0], coords_all[:, 1], coords_all[:, 2],
-                                               soma_dist * 1e6, cluster_cond, cluster_param_id):
-                                    assert cond > 0, f"Conductance should be larger than 0. cond = {cond}"
-
-                                    self.hyper_voxel_synapses[self.hyper_voxel_synapse_ctr, :] = \
-                                        [ax_id, d_id, x, y, z, self.hyper_voxel_id, channel_model_id,
-                                         ax_dist, d_dist, d_sec_id, d_sec_x * 1000, cond * 1e12, param_id]
-
-                                    # !!! OBS, dSegX is a value between 0 and 1, multiplied by 1000
-                                    # need to divide by 1000 later
-
-                                    self.hyper_voxel_synapse_ctr += 1
-
-                            else:
-                                # We can not do pruning at this stage, since we only see
-                                # synapses within hyper voxel, and pruning depends on
-                                # all synapses between two connected cells.
-
-                                # Do we have enough space allocated?
-                                if self.hyper_voxel_synapse_ctr >= self.max_synapses:
-                                    self.resize_hyper_voxel_synapses_matrix()
-
-                                # Synapse conductance varies between synapses
-                                # cond = self.hyper_voxel_rng.normal(mean_synapse_cond, std_synapse_cond)
-
-                                # lognormal distribution -- https://www.nature.com/articles/nrn3687
-                                # https://en.wikipedia.org/wiki/Log-normal_distribution
-                                cond = self.hyper_voxel_rng.lognormal(synapse_mu, synapse_sigma)
-
-                                # Need to make sure the conductance is not negative,
-                                # set lower cap at 10% of mean value
-                                cond = np.maximum(cond, mean_synapse_cond * 0.1)
-                                assert cond > 0, f"Conductance should be larger than 0. cond = {cond}"
-
-                                param_id = self.hyper_voxel_rng.integers(1000000)
-
-                                # Add synapse
-                                self.hyper_voxel_synapses[self.hyper_voxel_synapse_ctr, :] = \
-                                    [ax_id, d_id, x, y, z, self.hyper_voxel_id, channel_model_id,
-                                     ax_dist, d_dist, d_sec_id, d_sec_x * 1000, cond * 1e12, param_id]
-
-                                # !!! OBS, dSegX is a value between 0 and 1, multiplied by 1000
-                                # need to divide by 1000 later
-
-                                self.hyper_voxel_synapse_ctr += 1
+        self.place_touch_synapses(x_syn=x_syn, y_syn=y_syn, z_syn=z_syn)
 
         # Sort the synapses (note sortIdx will not contain the empty rows
         # at the end.
@@ -1398,6 +1333,486 @@ class SnuddaDetect(object):
 
     ############################################################################
 
+    def get_axon_voxel_items(self, x, y, z):
+
+        """
+        Returns flat views of the axon voxel items, works for both dense and sparse voxels.
+
+        Args:
+            x, y, z : Voxel coordinates (within hyper voxel)
+
+        Returns:
+            start, ctr : The items of voxel i are at index start[i] to start[i] + ctr[i] in the item arrays
+            neuron_id, soma_dist : Item arrays
+        """
+
+        if self.sparse_voxels:
+            self.axon_voxel_store.finalise()
+            start, ctr = self.axon_voxel_store.get_item_range(x, y, z)
+
+            return start, ctr, self.axon_voxel_store.item_neuron_id, self.axon_voxel_store.item_soma_dist
+
+        max_items = self.axon_voxels.shape[3]
+        start = np.ravel_multi_index((x, y, z), self.num_bins).astype(np.int64) * max_items
+        ctr = self.axon_voxel_ctr[x, y, z]
+
+        return start, ctr, self.axon_voxels.reshape(-1), self.axon_soma_dist.reshape(-1)
+
+    def get_dend_voxel_items(self, x, y, z):
+
+        """
+        Returns flat views of the dendrite voxel items, works for both dense and sparse voxels.
+
+        Args:
+            x, y, z : Voxel coordinates (within hyper voxel)
+
+        Returns:
+            start, ctr : The items of voxel i are at index start[i] to start[i] + ctr[i] in the item arrays
+            neuron_id, sec_id, sec_x, soma_dist : Item arrays
+        """
+
+        if self.sparse_voxels:
+            store = self.dend_voxel_store
+            store.finalise()
+            start, ctr = store.get_item_range(x, y, z)
+
+            return start, ctr, store.item_neuron_id, store.item_sec_id, store.item_sec_x, store.item_soma_dist
+
+        max_items = self.dend_voxels.shape[3]
+        start = np.ravel_multi_index((x, y, z), self.num_bins).astype(np.int64) * max_items
+        ctr = self.dend_voxel_ctr[x, y, z]
+
+        return (start, ctr, self.dend_voxels.reshape(-1), self.dend_sec_id.reshape(-1),
+                self.dend_sec_x.reshape(-1), self.dend_soma_dist.reshape(-1))
+
+    def get_voxel_neuron_id(self, x, y, z, voxel_type):
+
+        """ Returns the neuron IDs in voxel (x, y, z), voxel_type is "axon" or "dend". """
+
+        if voxel_type == "axon":
+            start, ctr, neuron_id = self.get_axon_voxel_items(x, y, z)[:3]
+        elif voxel_type == "dend":
+            start, ctr, neuron_id = self.get_dend_voxel_items(x, y, z)[:3]
+        else:
+            raise ValueError(f"Unknown voxel_type {voxel_type}, must be 'axon' or 'dend'")
+
+        return neuron_id[start:start + ctr]
+
+    def place_touch_synapses(self, x_syn, y_syn, z_syn):
+
+        """
+        Adds synapses for all axon-dendrite overlaps in the voxels x_syn, y_syn, z_syn to
+        self.hyper_voxel_synapses. Compiled version, also handles cluster synapses. The result only
+        depends on the seed of self.hyper_voxel_rng.
+
+        Args:
+            x_syn, y_syn, z_syn : Voxel coordinates (within hyper voxel) that contain both axon and dendrites
+        """
+
+        old_max_synapses = self.hyper_voxel_synapses.shape[0]
+
+        axon_start, axon_ctr, axon_neuron_id, axon_soma_dist = self.get_axon_voxel_items(x_syn, y_syn, z_syn)
+        dend_start, dend_ctr, dend_neuron_id, dend_sec_id, dend_sec_x, dend_soma_dist = \
+            self.get_dend_voxel_items(x_syn, y_syn, z_syn)
+
+        cluster_row = np.zeros((1000,), dtype=np.int64)
+        cluster_info = np.zeros((1000, 3), dtype=np.float64)
+
+        self.hyper_voxel_synapses, self.hyper_voxel_synapse_ctr, cluster_row, cluster_info, cluster_ctr = \
+            SnuddaDetect.place_touch_synapses_helper(x_syn=x_syn, y_syn=y_syn, z_syn=z_syn,
+                                                     axon_start=axon_start,
+                                                     axon_ctr=axon_ctr,
+                                                     axon_neuron_id=axon_neuron_id,
+                                                     axon_soma_dist=axon_soma_dist,
+                                                     dend_start=dend_start,
+                                                     dend_ctr=dend_ctr,
+                                                     dend_neuron_id=dend_neuron_id,
+                                                     dend_sec_id=dend_sec_id,
+                                                     dend_sec_x=dend_sec_x,
+                                                     dend_soma_dist=dend_soma_dist,
+                                                     neuron_type_id=self.neuron_type_id,
+                                                     connectivity_lookup=self.connectivity_lookup,
+                                                     channel_model_id=self.synapse_channel_model_id,
+                                                     lognormal_mu_sigma=self.synapse_lognormal_mu_sigma,
+                                                     min_conductance=self.synapse_min_conductance,
+                                                     cluster_size_mean_std=self.synapse_cluster_size_mean_std,
+                                                     cluster_spread_mean_std=self.synapse_cluster_spread_mean_std,
+                                                     hyper_voxel_id=self.hyper_voxel_id,
+                                                     rng=self.hyper_voxel_rng,
+                                                     synapses=self.hyper_voxel_synapses,
+                                                     synapse_ctr=self.hyper_voxel_synapse_ctr,
+                                                     cluster_row=cluster_row,
+                                                     cluster_info=cluster_info,
+                                                     cluster_ctr=0)
+
+        if self.hyper_voxel_synapses.shape[0] != old_max_synapses:
+            self.max_synapses = self.hyper_voxel_synapses.shape[0]
+            self.write_log(f"Increasing max synapses to {self.max_synapses}")
+
+        if cluster_ctr > 0:
+            self.place_cluster_synapses(cluster_row=cluster_row[:cluster_ctr], cluster_info=cluster_info[:cluster_ctr, :])
+
+    @staticmethod
+    @jit(nopython=True, cache=True)
+    def place_touch_synapses_helper(x_syn, y_syn, z_syn,
+                                    axon_start, axon_ctr, axon_neuron_id, axon_soma_dist,
+                                    dend_start, dend_ctr, dend_neuron_id, dend_sec_id, dend_sec_x, dend_soma_dist,
+                                    neuron_type_id, connectivity_lookup,
+                                    channel_model_id, lognormal_mu_sigma, min_conductance,
+                                    cluster_size_mean_std, cluster_spread_mean_std,
+                                    hyper_voxel_id, rng, synapses, synapse_ctr,
+                                    cluster_row, cluster_info, cluster_ctr):
+
+        """ Helper function for place_touch_synapses, static method needed for NUMBA.
+
+            The axon items of voxel idx are axon_neuron_id[axon_start[idx]:axon_start[idx]+axon_ctr[idx]], and
+            the same for the dendrite items (see get_axon_voxel_items and get_dend_voxel_items).
+
+            The random numbers are drawn from rng voxel by voxel, looping over axon items, then dendrite items.
+            The synapses, cluster_row and cluster_info matrices are grown if needed, and returned.
+
+            Cluster synapses are added with voxel coordinates, soma distance and section x missing, instead
+            their row, the random number for their section x, the cluster centre section x and the cluster spread
+            are saved in cluster_row and cluster_info, so that place_cluster_synapses_helper can complete them.
+        """
+
+        for idx in range(0, len(x_syn)):
+            x, y, z = x_syn[idx], y_syn[idx], z_syn[idx]
+
+            for a_idx in range(axon_start[idx], axon_start[idx] + axon_ctr[idx]):
+                ax_id = axon_neuron_id[a_idx]
+                ax_dist = axon_soma_dist[a_idx]
+                pre_type_id = neuron_type_id[ax_id]
+
+                for d_idx in range(dend_start[idx], dend_start[idx] + dend_ctr[idx]):
+                    d_id = dend_neuron_id[d_idx]
+
+                    if ax_id == d_id:
+                        # Avoid self connections
+                        continue
+
+                    post_type_id = neuron_type_id[d_id]
+
+                    for con_idx in range(connectivity_lookup[pre_type_id, post_type_id, 0],
+                                         connectivity_lookup[pre_type_id, post_type_id, 1]):
+
+                        # Should we add just one synapse, or a cluster of synapses (NaN std means fixed size)
+                        if np.isnan(cluster_size_mean_std[con_idx, 1]):
+                            cluster_size = int(cluster_size_mean_std[con_idx, 0])
+                        else:
+                            cluster_size = round(rng.normal(cluster_size_mean_std[con_idx, 0],
+                                                            cluster_size_mean_std[con_idx, 1]))
+
+                        num_new = max(cluster_size, 1)
+                        cluster_spread = 0.0
+
+                        if synapse_ctr + num_new >= synapses.shape[0]:
+                            new_synapses = np.zeros((max(int(np.ceil(1.5 * synapses.shape[0])),
+                                                         synapse_ctr + num_new + 1),
+                                                     synapses.shape[1]), dtype=synapses.dtype)
+                            new_synapses[:synapse_ctr, :] = synapses[:synapse_ctr, :]
+                            synapses = new_synapses
+
+                        if cluster_size > 1:
+                            if np.isnan(cluster_spread_mean_std[con_idx, 1]):
+                                cluster_spread = cluster_spread_mean_std[con_idx, 0]
+                            else:
+                                cluster_spread = max(abs(rng.normal(cluster_spread_mean_std[con_idx, 0],
+                                                                    cluster_spread_mean_std[con_idx, 1])), 5e-6)
+
+                            if cluster_ctr + cluster_size >= cluster_row.shape[0]:
+                                new_size = max(int(np.ceil(1.5 * cluster_row.shape[0])), cluster_ctr + cluster_size + 1)
+                                new_cluster_row = np.zeros((new_size,), dtype=cluster_row.dtype)
+                                new_cluster_row[:cluster_ctr] = cluster_row[:cluster_ctr]
+                                cluster_row = new_cluster_row
+                                new_cluster_info = np.zeros((new_size, cluster_info.shape[1]), dtype=cluster_info.dtype)
+                                new_cluster_info[:cluster_ctr, :] = cluster_info[:cluster_ctr, :]
+                                cluster_info = new_cluster_info
+
+                            # Section x is drawn uniformly within the cluster spread, the limits depend on
+                            # the section length so the scaling is done in place_cluster_synapses_helper
+                            cluster_rand = rng.random(cluster_size)
+                            cluster_cond = rng.lognormal(lognormal_mu_sigma[con_idx, 0],
+                                                         lognormal_mu_sigma[con_idx, 1], cluster_size)
+                            cluster_param_id = rng.integers(0, 1000000, cluster_size)
+
+                        else:
+                            cluster_rand = np.zeros((1,))
+                            cluster_cond = np.full((1,), rng.lognormal(lognormal_mu_sigma[con_idx, 0],
+                                                                       lognormal_mu_sigma[con_idx, 1]))
+                            cluster_param_id = np.full((1,), rng.integers(0, 1000000))
+
+                        for c_idx in range(0, num_new):
+
+                            # Need to make sure the conductance is not negative,
+                            # set lower cap at 10% of mean value
+                            cond = max(cluster_cond[c_idx], min_conductance[con_idx])
+
+                            if cond <= 0:
+                                raise ValueError("Conductance should be larger than 0.")
+
+                            synapses[synapse_ctr, 0] = ax_id
+                            synapses[synapse_ctr, 1] = d_id
+                            synapses[synapse_ctr, 2] = x
+                            synapses[synapse_ctr, 3] = y
+                            synapses[synapse_ctr, 4] = z
+                            synapses[synapse_ctr, 5] = hyper_voxel_id
+                            synapses[synapse_ctr, 6] = channel_model_id[con_idx]
+                            synapses[synapse_ctr, 7] = ax_dist
+                            synapses[synapse_ctr, 8] = dend_soma_dist[d_idx]
+                            synapses[synapse_ctr, 9] = dend_sec_id[d_idx]
+                            # !!! OBS, dSegX is a value between 0 and 1, multiplied by 1000
+                            synapses[synapse_ctr, 10] = dend_sec_x[d_idx] * 1000
+                            synapses[synapse_ctr, 11] = cond * 1e12
+                            synapses[synapse_ctr, 12] = cluster_param_id[c_idx]
+
+                            if cluster_size > 1:
+                                cluster_row[cluster_ctr] = synapse_ctr
+                                cluster_info[cluster_ctr, 0] = cluster_rand[c_idx]
+                                cluster_info[cluster_ctr, 1] = dend_sec_x[d_idx]
+                                cluster_info[cluster_ctr, 2] = cluster_spread
+                                cluster_ctr += 1
+
+                            synapse_ctr += 1
+
+        return synapses, synapse_ctr, cluster_row, cluster_info, cluster_ctr
+
+    def place_cluster_synapses(self, cluster_row, cluster_info):
+
+        """
+        Sets voxel coordinates, soma distance and section x for the cluster synapses added by
+        place_touch_synapses_helper. All cluster synapses in the hyper voxel are handled in one call.
+
+        Args:
+            cluster_row : Rows in self.hyper_voxel_synapses that hold cluster synapses
+            cluster_info : Matrix with random number for section x, cluster centre section x and cluster spread
+        """
+
+        post_id = self.hyper_voxel_synapses[cluster_row, 1]
+        unique_post_id, post_idx = np.unique(post_id, return_inverse=True)
+
+        geometry_list = []
+        section_data_list = []
+        sec_point_offset_list = []
+        sec_point_idx_list = []
+        soma_point_idx = np.zeros((len(unique_post_id),), dtype=np.int64)
+        neuron_section_start = np.zeros((len(unique_post_id),), dtype=np.int64)
+
+        point_ctr = 0
+        section_ctr = 0
+        sec_point_ctr = 0
+
+        for idx, neuron_id in enumerate(unique_post_id):
+            neuron = self.load_neuron(self.neurons[neuron_id])
+            morphology_data = neuron.morphology_data["neuron"]
+
+            sec_point_offset, sec_point_idx, soma_idx = self.get_section_point_index(morphology_data)
+
+            geometry_list.append(morphology_data.geometry)
+            section_data_list.append(morphology_data.section_data)
+            sec_point_offset_list.append(sec_point_offset + sec_point_ctr)
+            sec_point_idx_list.append(sec_point_idx + point_ctr)
+            soma_point_idx[idx] = soma_idx + point_ctr
+            neuron_section_start[idx] = section_ctr
+
+            point_ctr += morphology_data.geometry.shape[0]
+            section_ctr += len(sec_point_offset)
+            sec_point_ctr += len(sec_point_idx)
+
+        SnuddaDetect.place_cluster_synapses_helper(synapses=self.hyper_voxel_synapses,
+                                                   cluster_row=cluster_row,
+                                                   cluster_info=cluster_info,
+                                                   post_idx=post_idx.astype(np.int64),
+                                                   neuron_section_start=neuron_section_start,
+                                                   sec_point_offset=np.concatenate(sec_point_offset_list),
+                                                   sec_point_idx=np.concatenate(sec_point_idx_list),
+                                                   soma_point_idx=soma_point_idx,
+                                                   geometry=np.concatenate(geometry_list),
+                                                   section_data=np.concatenate(section_data_list),
+                                                   hyper_voxel_origo=self.hyper_voxel_origo,
+                                                   voxel_size=self.voxel_size)
+
+    @staticmethod
+    @jit(nopython=True, cache=True)
+    def place_cluster_synapses_helper(synapses, cluster_row, cluster_info, post_idx,
+                                      neuron_section_start, sec_point_offset, sec_point_idx, soma_point_idx,
+                                      geometry, section_data, hyper_voxel_origo, voxel_size):
+
+        """ Helper function for place_cluster_synapses, static method needed for NUMBA.
+
+            Does the same calculation as NeuronMorphologyExtended.cluster_synapses for all cluster synapses,
+            the geometry and section_data of the post synaptic neurons are concatenated, and the section
+            points for dendrite section sec_id of the k:th neuron are
+            sec_point_idx[sec_point_offset[neuron_section_start[k] + sec_id]:sec_point_offset[... + sec_id + 1]]
+        """
+
+        for c_idx in range(0, len(cluster_row)):
+            row = cluster_row[c_idx]
+            sec_id = synapses[row, 9]
+            sec_x = cluster_info[c_idx, 1]
+            distance = cluster_info[c_idx, 2]
+
+            if sec_id == -1:
+                # Soma, the synapses are placed at the soma centre
+                cluster_sec_x = 0 + (1 - 0) * cluster_info[c_idx, 0]
+                point_idx = soma_point_idx[post_idx[c_idx]:post_idx[c_idx]+1]
+                syn_coords = geometry[point_idx[0], :3].astype(np.float64)
+                soma_dist = 0.0
+
+            else:
+                sec_idx = neuron_section_start[post_idx[c_idx]] + sec_id
+                point_idx = sec_point_idx[sec_point_offset[sec_idx]:sec_point_offset[sec_idx+1]]
+
+                sec_len = geometry[point_idx[-1], 4] - geometry[point_idx[0], 4]
+                if sec_len <= 0:
+                    raise ValueError("Negative section length detected.")
+
+                min_sec_x = max(1e-3, sec_x - 0.5 * distance / sec_len)
+                max_sec_x = min(1 - 1e-3, sec_x + 0.5 * distance / sec_len)
+                cluster_sec_x = min_sec_x + (max_sec_x - min_sec_x) * cluster_info[c_idx, 0]
+
+                # section_data stores section_x * 1e3 (as int), so we need to scale up before comparing
+                cx = cluster_sec_x * 1e3
+                idx = 0
+                for p_idx in point_idx:
+                    if cx > section_data[p_idx, 1]:
+                        idx += 1
+
+                # The interpolation uses the precision of geometry for the coordinates (float32), same as numpy
+                if idx == 0:
+                    syn_coords = geometry[point_idx[idx], :3].astype(np.float64)
+                    soma_dist = geometry[point_idx[idx], 4]
+                else:
+                    sd_diff = section_data[point_idx[idx], 1] - section_data[point_idx[idx-1], 1]
+
+                    if sd_diff > 0:
+                        f = (cx - section_data[point_idx[idx-1], 1]) / sd_diff
+                    else:
+                        f = 0.0
+
+                    f_coords = np.array([1-f, f], dtype=geometry.dtype)
+                    syn_coords = (f_coords[0]*geometry[point_idx[idx-1], :3]
+                                  + f_coords[1]*geometry[point_idx[idx], :3]).astype(np.float64)
+                    soma_dist = (1-f)*geometry[point_idx[idx-1], 4] + f*geometry[point_idx[idx], 4]
+
+            # We need to convert coords to hyper voxel coords, to fit with other coords
+            for dim in range(0, 3):
+                synapses[row, 2 + dim] = np.floor((syn_coords[dim] - hyper_voxel_origo[dim]) / voxel_size)
+
+            synapses[row, 8] = soma_dist * 1e6
+            synapses[row, 10] = cluster_sec_x * 1000
+
+    def get_section_point_index(self, morphology_data):
+
+        """
+        Returns section point index for dendrites of morphology, cached per morphology.
+
+        Args:
+            morphology_data : MorphologyData object
+
+        Returns:
+            sec_point_offset : the points of section sec_id are sec_point_idx[sec_point_offset[sec_id]:sec_point_offset[sec_id+1]]
+            sec_point_idx : point index into geometry and section_data
+            soma_point_idx : point index of soma
+        """
+
+        if morphology_data.swc_file in self.section_point_index_cache:
+            return self.section_point_index_cache[morphology_data.swc_file]
+
+        dend_sections = morphology_data.sections[3]
+        num_sections = max(dend_sections.keys()) + 1 if len(dend_sections) > 0 else 0
+
+        sec_point_offset = np.zeros((num_sections + 1,), dtype=np.int64)
+        point_idx_list = []
+
+        for sec_id in range(0, num_sections):
+            if sec_id in dend_sections:
+                point_idx_list.append(dend_sections[sec_id].point_idx.astype(np.int64))
+                sec_point_offset[sec_id + 1] = sec_point_offset[sec_id] + len(dend_sections[sec_id].point_idx)
+            else:
+                sec_point_offset[sec_id + 1] = sec_point_offset[sec_id]
+
+        if len(point_idx_list) > 0:
+            sec_point_idx = np.concatenate(point_idx_list)
+        else:
+            sec_point_idx = np.zeros((0,), dtype=np.int64)
+
+        if 1 in morphology_data.sections and 0 in morphology_data.sections[1]:
+            soma_point_idx = int(morphology_data.sections[1][0].point_idx[0])
+        else:
+            soma_point_idx = 0
+
+        self.section_point_index_cache[morphology_data.swc_file] = (sec_point_offset, sec_point_idx, soma_point_idx)
+
+        return sec_point_offset, sec_point_idx, soma_point_idx
+
+    ############################################################################
+
+    def setup_connectivity_lookup(self):
+
+        """
+        Maps neuron types to integer IDs, and flattens self.connectivity_distributions into arrays
+        used by the compiled synapse detection. For each (pre_type_id, post_type_id) the
+        self.connectivity_lookup holds start and end index of the synapse types (gap junctions excluded),
+        in the same order as they are listed in self.connectivity_distributions.
+        """
+
+        type_names = set(neuron["type"] for neuron in self.neurons)
+        for pre_type, post_type in self.connectivity_distributions:
+            type_names.update([pre_type, post_type])
+
+        type_lookup = dict([(name, idx) for idx, name in enumerate(sorted(type_names))])
+        self.neuron_type_id = np.array([type_lookup[neuron["type"]] for neuron in self.neurons], dtype=np.int32)
+
+        channel_model_id = []
+        lognormal_mu_sigma = []
+        min_conductance = []
+        cluster_size_mean_std = []
+        cluster_spread_mean_std = []
+
+        self.connectivity_lookup = np.zeros((len(type_lookup), len(type_lookup), 2), dtype=np.int64)
+
+        for (pre_type, post_type), con_dict in self.connectivity_distributions.items():
+            start_idx = len(channel_model_id)
+
+            for con_type, con_info in con_dict.items():
+                if con_type == "gap_junction":
+                    continue
+
+                channel_model_id.append(con_info["channel_model_id"])
+                lognormal_mu_sigma.append(con_info["lognormal_mu_sigma"])
+                min_conductance.append(con_info["conductance"][0] * 0.1)
+
+                # Fixed cluster size and spread are marked by std NaN
+                cluster_size = con_info["cluster_size"]
+                cluster_spread = con_info["cluster_spread"]
+
+                if isinstance(cluster_size, (np.ndarray, list)):
+                    cluster_size_mean_std.append(cluster_size[:2])
+                else:
+                    cluster_size_mean_std.append([cluster_size, np.nan])
+
+                if cluster_spread is None:
+                    if isinstance(cluster_size, (np.ndarray, list)) or cluster_size > 1:
+                        raise ValueError(f"cluster_spread ({cluster_spread}) must be a distance (in meters), "
+                                         f"e.g. 10e-6. ")
+                    cluster_spread_mean_std.append([np.nan, np.nan])
+                elif isinstance(cluster_spread, (np.ndarray, list)):
+                    cluster_spread_mean_std.append(cluster_spread[:2])
+                else:
+                    cluster_spread_mean_std.append([cluster_spread, np.nan])
+
+            self.connectivity_lookup[type_lookup[pre_type], type_lookup[post_type], :] \
+                = start_idx, len(channel_model_id)
+
+        self.synapse_channel_model_id = np.array(channel_model_id, dtype=np.int32)
+        self.synapse_lognormal_mu_sigma = np.array(lognormal_mu_sigma, dtype=np.float64).reshape((-1, 2))
+        self.synapse_min_conductance = np.array(min_conductance, dtype=np.float64)
+        self.synapse_cluster_size_mean_std = np.array(cluster_size_mean_std, dtype=np.float64).reshape((-1, 2))
+        self.synapse_cluster_spread_mean_std = np.array(cluster_spread_mean_std, dtype=np.float64).reshape((-1, 2))
+
+    ############################################################################
+
     def place_synapses_no_axon(self, hyper_id, voxel_space, voxel_space_ctr,
                                voxel_axon_dist):
 
@@ -1410,6 +1825,8 @@ class SnuddaDetect(object):
             voxel_space_ctr: Synapse counter (int) for voxels (n_bins x n_bins x n_bins)
             voxel_axon_dist: Axonal distance from soma to synapses (n_bins x n_bins x n_bins)
 
+        The points are added using add_voxel_items, voxel_space, voxel_space_ctr and voxel_axon_dist are unused.
+
         """
 
         start_time = timeit.default_timer()
@@ -1485,25 +1902,9 @@ class SnuddaDetect(object):
 
             neuron_id = na_neuron["neuron_id"]
 
-            for idx in range(0, na_voxel_coords.shape[0]):
-                x_idx = na_voxel_coords[idx, 0]
-                y_idx = na_voxel_coords[idx, 1]
-                z_idx = na_voxel_coords[idx, 2]
-                axon_dist = na_axon_dist[idx]
-
-                v_ctr = voxel_space_ctr[x_idx, y_idx, z_idx]
-                if v_ctr > 0 and voxel_space[x_idx, y_idx, z_idx, v_ctr - 1] == neuron_id:
-                    # Voxel already has neuron_id, skip
-                    continue
-
-                try:
-                    voxel_space[x_idx, y_idx, z_idx, v_ctr] = neuron_id
-                    voxel_axon_dist[x_idx, y_idx, z_idx, v_ctr] = axon_dist
-                    voxel_space_ctr[x_idx, y_idx, z_idx] += 1
-                except:
-                    self.voxel_overflow_counter += 1
-                    self.write_log(f"!!! Axon voxel space overflow: {voxel_space_ctr[x_idx, y_idx, z_idx]}",
-                                   is_error=True)
+            self.add_voxel_items(voxel_type="axon",
+                                 vx=na_voxel_coords[:, 0], vy=na_voxel_coords[:, 1], vz=na_voxel_coords[:, 2],
+                                 neuron_id=neuron_id, soma_dist=na_axon_dist)
 
             # if(True):
             #  # Debug plot
@@ -1798,6 +2199,9 @@ class SnuddaDetect(object):
         Returns a matrix where first column is a UID = srcID*nNeurons + destID
         and the following two columns are start row and end row (-1) in matrix
 
+        The synapses between a pair of neurons are consecutive rows, the groups are found (run length encoded)
+        from where column 0 or 1 changes.
+
         Args:
             data : either synapse matrix, or gap junction matrix
             n_rows : number of rows in matrix that are used (matrix itself can be larger)
@@ -1810,48 +2214,28 @@ class SnuddaDetect(object):
         and the following two columns are start row and end row (-1) in matrix
         """
 
-        # self.write_log("Create lookup table")
-        # nRows = data.shape[0] -- zero padded, cant use shape
-        lookup_table = np.zeros((data.shape[0], 3), dtype=int)
+        assert data_type in ["synapses", "gap_junctions"], \
+            f"Unknown data_type {data_type}, should be 'synapses' or ' gap_junctions'"
 
-        next_idx = 0
-        start_idx = 0
-
-        lookup_idx = 0
-        # num_neurons = len(self.neurons)
-
-        if data_type == "synapses":
-            hardcoded_synapse_type = None
-        elif data_type == "gap_junctions":
-            hardcoded_synapse_type = 3  # Hardcoded for gap junctions
-        else:
-            assert False, f"Unknown data_type {data_type}, should be 'synapses' or ' gap_junctions'"
+        if n_rows == 0:
+            return np.zeros((0, 3), dtype=int)
 
-        # max_synapse_type = self.next_channel_model_id   # This needs to be saved in HDF5 file
+        neuron_pair = data[:n_rows, 0:2]
+        start_idx = np.flatnonzero(np.concatenate(([True], np.any(neuron_pair[1:, :] != neuron_pair[:-1, :],
+                                                                  axis=1))))
+        end_idx = np.append(start_idx[1:], n_rows)
 
-        while next_idx < n_rows:
-            src_id = data[next_idx, 0]
-            dest_id = data[next_idx, 1]
+        src_id = data[start_idx, 0].astype(int)
+        dest_id = data[start_idx, 1].astype(int)
 
-            if hardcoded_synapse_type:
-                synapse_type = hardcoded_synapse_type
-            else:
-                synapse_type = data[next_idx, 6]
-
-            next_idx += 1
-
-            while (next_idx < n_rows
-                   and data[next_idx, 0] == src_id
-                   and data[next_idx, 1] == dest_id):
-                next_idx += 1
-
-            lookup_table[lookup_idx, :] = [(dest_id * num_neurons + src_id) * max_synapse_type + synapse_type,
-                                           start_idx, next_idx]
+        if data_type == "gap_junctions":
+            synapse_type = 3  # Hardcoded for gap junctions
+        else:
+            synapse_type = data[start_idx, 6].astype(int)
 
-            start_idx = next_idx
-            lookup_idx += 1
+        unique_id = (dest_id * num_neurons + src_id) * max_synapse_type + synapse_type
 
-        return lookup_table[:lookup_idx, :]
+        return np.stack((unique_id, start_idx, end_idx), axis=1)
 
     ############################################################################
 
@@ -1886,16 +2270,15 @@ class SnuddaDetect(object):
 
         [x_dv, y_dv, z_dv] = np.where(self.dend_voxel_ctr > 0)
 
-        for x, y, z in zip(x_dv, y_dv, z_dv):
+        dend_start, dend_ctr, dend_neuron_id, dend_sec_id, dend_sec_x, _ = \
+            self.get_dend_voxel_items(x_dv, y_dv, z_dv)
 
-            neuron_id_list = self.dend_voxels[x, y, z, :self.dend_voxel_ctr[x, y, z]]
-            seg_id = self.dend_sec_id[x, y, z, :self.dend_voxel_ctr[x, y, z]]
-            seg_x = self.dend_sec_x[x, y, z, :self.dend_voxel_ctr[x, y, z]]
+        for x, y, z, start, ctr in zip(x_dv, y_dv, z_dv, dend_start, dend_ctr):
 
             # All possible pairs
-            for pairs in itertools.combinations(np.arange(0, self.dend_voxel_ctr[x, y, z]), 2):
-                neuron_id1 = self.dend_voxels[x, y, z, pairs[0]]
-                neuron_id2 = self.dend_voxels[x, y, z, pairs[1]]
+            for pairs in itertools.combinations(np.arange(start, start + ctr), 2):
+                neuron_id1 = dend_neuron_id[pairs[0]]
+                neuron_id2 = dend_neuron_id[pairs[1]]
 
                 # !!! Check no self connections??
 
@@ -1908,11 +2291,11 @@ class SnuddaDetect(object):
                     if "gap_junction" in self.connectivity_distributions[pre_type, post_type]:
                         con_info = self.connectivity_distributions[pre_type, post_type]["gap_junction"]
 
-                        seg_id1 = self.dend_sec_id[x, y, z, pairs[0]]
-                        seg_id2 = self.dend_sec_id[x, y, z, pairs[1]]
+                        seg_id1 = dend_sec_id[pairs[0]]
+                        seg_id2 = dend_sec_id[pairs[1]]
 
-                        seg_x1 = self.dend_sec_x[x, y, z, pairs[0]]
-                        seg_x2 = self.dend_sec_x[x, y, z, pairs[1]]
+                        seg_x1 = dend_sec_x[pairs[0]]
+                        seg_x2 = dend_sec_x[pairs[1]]
 
                         mean_gj_cond, std_gj_cond = con_info["conductance"]
                         gj_mu, gj_sigma = con_info["lognormal_mu_sigma"]
@@ -2179,6 +2562,9 @@ class SnuddaDetect(object):
         self.neurons = pos_info["neurons"]
         num_neurons = len(self.neurons)
 
+        # Neuron type lookup is recreated by setup_connectivity_lookup when needed
+        self.neuron_type_id = None
+
         self.neuron_positions = np.zeros((num_neurons, 3))
 
         for ni, neuron in enumerate(pos_info["neurons"]):
@@ -2256,7 +2642,8 @@ class SnuddaDetect(object):
                 meta_data.create_dataset("max_dend_voxel_ctr", data=self.max_dend_voxel_ctr)
 
             if self.voxel_overflow_counter > 0:
-                self.write_log("!!! Voxel overflow detected, please increase max_axon and max_dend", is_error=True)
+                self.write_log("!!! Voxel overflow detected, please increase max_axon and max_dend "
+                               "(or use sparse_voxels)", is_error=True)
 
             network_group = out_file.create_group("network")
             network_group.create_dataset("synapses",
@@ -2286,8 +2673,9 @@ class SnuddaDetect(object):
             if self.debug_flag:
                 debug_group = out_file.create_group("debug")
 
-                debug_group.create_dataset("dend_voxels", data=self.dend_voxels)
-                debug_group.create_dataset("axon_voxels", data=self.axon_voxels)
+                if not self.sparse_voxels:
+                    debug_group.create_dataset("dend_voxels", data=self.dend_voxels)
+                    debug_group.create_dataset("axon_voxels", data=self.axon_voxels)
 
                 debug_group.create_dataset("dend_voxel_ctr", data=self.dend_voxel_ctr)
                 debug_group.create_dataset("axon_voxel_ctr", data=self.axon_voxel_ctr)
@@ -2631,7 +3019,9 @@ class SnuddaDetect(object):
                      "verbose": self.verbose,
                      "slurm_id": self.slurm_id,
                      "save_file": self.save_file,
-                     "random_seed": self.random_seed},
+                     "random_seed": self.random_seed,
+                     "sparse_voxels": self.sparse_voxels,
+                     "rasterise_method": self.rasterise_method},
                     block=True)
 
         self.write_log("Init values pushed to workers")
@@ -2639,7 +3029,8 @@ class SnuddaDetect(object):
         cmd_str = ("sd = SnuddaDetect(config_file=config_file, position_file=position_file,voxel_size=voxel_size,"
                    "snudda_data=snudda_data,"
                    "hyper_voxel_size=hyper_voxel_size,verbose=verbose,logfile_name=logfile_name[0],"
-                   "save_file=save_file,slurm_id=slurm_id,role='worker', random_seed=random_seed)")
+                   "save_file=save_file,slurm_id=slurm_id,role='worker', random_seed=random_seed,"
+                   "sparse_voxels=sparse_voxels, rasterise_method=rasterise_method)")
         d_view.execute(cmd_str, block=True)
 
         self.write_log(f"Workers setup: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())}")
@@ -2754,25 +3145,16 @@ class SnuddaDetect(object):
     ############################################################################
 
     #TODO: We should probably NUMBA this method
-    def fill_voxels_soma(self, voxel_space, voxel_space_ctr,
-                         voxel_sec_id, voxel_sec_x,
-                         neuron, neuron_id, verbose=False):
+    def get_soma_voxels(self, neuron, neuron_id):
 
         """
-        Marks all the dendrite voxels that all the somas in the hyper voxel occupy.
-
-        voxel_space : n x n x n x k matrix holding the voxel content, normally self.dend_voxels (neuron IDs)
-        voxel_space_ctr : n x n x n matrix holding count of how many items each voxel holds
-        voxel_sec_id : n x n x n x k matrix, holding section ID of each item
-        voxel_sec_x : n x n x n x k matrix, holding section X of each item
-        soma_coord : (x,y,z,r) location of soma to place, and radius
-        neuron_id : ID of the neurons
-        verbose (bool) : how much to print out
+        Returns voxel coordinates (vx, vy, vz) of all voxels within the hyper voxel that the soma occupies.
 
+        Args:
+            neuron : NeuronMorphologyExtended object
+            neuron_id : ID of the neuron
         """
 
-        if "neuron" not in  neuron.morphology_data:
-            return  # No soma defined
         soma_coord = neuron.morphology_data["neuron"].geometry[0, :]
 
         if neuron.morphology_data["neuron"].section_data[0, 2] != 1:
@@ -2803,6 +3185,8 @@ class SnuddaDetect(object):
 
         # self.write_log(f"Soma check x: {vx_min} - {vx_max} y: {vy_min} - {vy_max} z: {vz_min} - {vz_max}")
 
+        soma_voxels = []
+
         for vx in range(vx_min, vx_max):
             for vy in range(vy_min, vy_max):
                 for vz in range(vz_min, vz_max):
@@ -2812,25 +3196,53 @@ class SnuddaDetect(object):
                           + ((vz + 0.5) * self.voxel_size + self.hyper_voxel_origo[2] - soma_coord[2]) ** 2)
 
                     if d2 < radius2:
-                        # Mark the point
-                        try:
-                            v_ctr = voxel_space_ctr[vx, vy, vz]
-
-                            if (v_ctr > 0
-                                    and voxel_space[vx, vy, vz, v_ctr - 1] == neuron_id):
-                                # Voxel already has neuron_id, skip
-                                continue
-
-                            voxel_space[vx, vy, vz, v_ctr] = neuron_id
-                            voxel_sec_id[vx, vy, vz, v_ctr] = -1  # Soma is section_id -1
-                            voxel_sec_x[vx, vy, vz, v_ctr] = 0.5
-
-                            voxel_space_ctr[vx, vy, vz] += 1
-                        except:
-                            self.voxel_overflow_counter += 1
-                            self.write_log("!!! If you see this you need to increase max_dend above "
-                                           f"{voxel_space_ctr[vx, vy, vz]}", is_error=True)
-                            continue
+                        soma_voxels.append((vx, vy, vz))
+
+        soma_voxels = np.array(soma_voxels, dtype=int).reshape((-1, 3))
+
+        return soma_voxels[:, 0], soma_voxels[:, 1], soma_voxels[:, 2]
+
+    def fill_voxels_soma(self, voxel_space, voxel_space_ctr,
+                         voxel_sec_id, voxel_sec_x,
+                         neuron, neuron_id, verbose=False):
+
+        """
+        Marks all the dendrite voxels that all the somas in the hyper voxel occupy.
+
+        voxel_space : n x n x n x k matrix holding the voxel content, normally self.dend_voxels (neuron IDs)
+        voxel_space_ctr : n x n x n matrix holding count of how many items each voxel holds
+        voxel_sec_id : n x n x n x k matrix, holding section ID of each item
+        voxel_sec_x : n x n x n x k matrix, holding section X of each item
+        soma_coord : (x,y,z,r) location of soma to place, and radius
+        neuron_id : ID of the neurons
+        verbose (bool) : how much to print out
+
+        """
+
+        if "neuron" not in  neuron.morphology_data:
+            return  # No soma defined
+
+        for vx, vy, vz in zip(*self.get_soma_voxels(neuron=neuron, neuron_id=neuron_id)):
+
+            # Mark the point
+            try:
+                v_ctr = voxel_space_ctr[vx, vy, vz]
+
+                if (v_ctr > 0
+                        and voxel_space[vx, vy, vz, v_ctr - 1] == neuron_id):
+                    # Voxel already has neuron_id, skip
+                    continue
+
+                voxel_space[vx, vy, vz, v_ctr] = neuron_id
+                voxel_sec_id[vx, vy, vz, v_ctr] = -1  # Soma is section_id -1
+                voxel_sec_x[vx, vy, vz, v_ctr] = 0.5
+
+                voxel_space_ctr[vx, vy, vz] += 1
+            except:
+                self.voxel_overflow_counter += 1
+                self.write_log("!!! If you see this you need to increase max_dend above "
+                               f"{voxel_space_ctr[vx, vy, vz]}", is_error=True)
+                continue
 
     ############################################################################
 
@@ -2885,122 +3297,37 @@ class SnuddaDetect(object):
 
         self_voxel_overflow_counter = 0
 
-        # We use padding to include line segments where both points are outside, but their
-        # line intersect the hypervoxel.
-        padding = 1
-        lower_padding_bound = 0 - padding
-        upper_padding_bound = self_num_bins + padding
-
         section_id = section_data[point_idx, 0]
         section_x = section_data[point_idx, 1] * 1e-3  # Stored as section_x*1000 (since int)
         section_x[0] = 0
 
-        coords = geometry[point_idx, :3]
-        voxel_coords = (coords - self_hyper_voxel_origo) / self_voxel_size
-        point_inside = np.sum(np.logical_and(lower_padding_bound <= voxel_coords,
-                                             voxel_coords < upper_padding_bound),
-                              axis=1) == 3
-        scaled_soma_dist = geometry[point_idx, 4] * 1e6  # Dist to soma
-
-        # Numba does not support third argument axis of np.diff, so transpose it instead
-        # num_steps = np.ceil(np.amax(np.abs(np.diff(voxel_coords, axis=0)) * self_step_multiplier, axis=1)).astype(int)
-        # dv_step = np.diff(voxel_coords, axis=0) / num_steps[:, None]
-
-        step_diff = np.abs(np.diff(voxel_coords.T).T)
-        sec_length = np.zeros((step_diff.shape[0], ))
-        for i in range(0, step_diff.shape[0]):
-            sec_length[i] = np.sqrt(step_diff[i, 0] ** 2 + step_diff[i, 1] ** 2 + step_diff[i, 2]**2)
-
-        # TODO: Should we change the code to do the steps using coords rather than in voxel coords, and then
-        #       convert to voxel coords after? (slower, but would be more accurate)
-
-        num_steps = np.ceil(sec_length*self_step_multiplier).astype(np.int64)
-
-        # OLD VERSION
-        # This is just does same as numpy.amax for axis=1, but inlined for NUMBA
-        # max_val = step_diff[:, 0].copy()
-        # for j in range(1, step_diff.shape[1]):
-        #     for i in range(0, step_diff.shape[0]):
-        #         if max_val[i] < step_diff[i, j]:
-        #             max_val[i] = step_diff[i, j]
-        #
-        # num_steps = np.ceil(max_val * self_step_multiplier).astype(np.int64)
-
-        # TODO: num_steps should perhaps instead depend on the total length (with a small oversampling?)
-        #       the reference should be that a line should occupy the same number of voxels regardless
-        #       of what orientation it has.
-
-        # [:, None] is here used to divide first row by first element in num_step
-        # second row divide by second element in num_step etc. Pretty clever.
-        # https://stackoverflow.com/questions/19602187/numpy-divide-each-row-by-a-vector-element
-        # Looks like NUMBA cant handle this though,
-        # dv_step = np.diff(voxel_coords.T).T / num_steps[:, None]
-
-        dv_step = np.diff(voxel_coords.T).T
-        for i in range(0, dv_step.shape[0]):
-            dv_step[i, :] /= num_steps[i]
-
-        ds_step = np.divide(np.diff(section_x), num_steps)
-        dd_step = np.divide(np.diff(scaled_soma_dist), num_steps)
-
-        # Remove this check later... should be done in morphology_data
-        if (num_steps <= 0).any(): 
-            print(f"Found zero length dendrite segment in neuron_id {neuron_id}")
-            # import pdb
-            # pdb.set_trace()
-
-            raise ValueError(f"Found zero length dendrite segment (please check morphologies).")
-
-
-        # Loop through all point-pairs of the section
-        for idx in range(0, len(scaled_soma_dist)-1):
-
-            if point_inside[idx] or point_inside[idx+1]:
-                # Either of the points are within the cube + padding zone
-
-                steps = np.arange(0, num_steps[idx] + 1)
-                # vp = np.floor(voxel_coords[idx, :] + dv_step[idx, :] * steps[:, None]).astype(np.int64)
-                # OBS! np.floor below is crucial -- np.floor(-0.2) = -1, vs int(-0.2) = 0
-                vp_x = np.floor(voxel_coords[idx, 0] + dv_step[idx, 0] * steps).astype(np.int64)
-                vp_y = np.floor(voxel_coords[idx, 1] + dv_step[idx, 1] * steps).astype(np.int64)
-                vp_z = np.floor(voxel_coords[idx, 2] + dv_step[idx, 2] * steps).astype(np.int64)
-
-                # Dirty fix no longer needed, section_x for first element set to 0 now
-                # if idx == 0:
-                #     # Dirty fix to handle that parent point has section_x = 1, but
-                #     # child's first point should have section_x = 0
-                #     s_x = (section_x[1] / num_steps[0]) * steps
-                # else:
-                s_x = section_x[idx] + ds_step[idx] * steps
-
-                soma_dist = np.floor(scaled_soma_dist[idx] + dd_step[idx]*steps).astype(np.int64)
-
-                # p_inside = np.sum(np.logical_and(0 <= vp, vp < self_num_bins), axis=1) == 3
-                p_inside = np.logical_and(np.logical_and(0 <= vp_x, vp_x < self_num_bins[0]),
-                                          np.logical_and(np.logical_and(0 <= vp_y, vp_y < self_num_bins[1]),
-                                                         np.logical_and(0 <= vp_z, vp_z < self_num_bins[2])))
-
-                # For each point pair in a section, find the intermediate points and mark voxels
-                for i in steps:
-                    if p_inside[i]:
-                        # v_idx = tuple(vp[i, :])
-                        v_idx = (vp_x[i], vp_y[i], vp_z[i])
-                        v_ctr = voxel_space_ctr[v_idx]
-
-                        if v_ctr > 0 and voxel_space[v_idx][v_ctr-1] == neuron_id:
-                            # Voxel already contains neuron_id, skip
-                            continue
-
-                        if v_ctr < self_max_dend:
-                            voxel_space[v_idx][v_ctr] = neuron_id
-                            # Use section id from last point for section as first point has parent's section id
-                            voxel_sec_id[v_idx][v_ctr] = section_id[-1]
-                            voxel_sec_x[v_idx][v_ctr] = s_x[i]
-                            voxel_soma_dist[v_idx][v_ctr] = soma_dist[i]
-                            voxel_space_ctr[v_idx] += 1
-                        else:
-                            # Overflow, not enough space to store info
-                            self_voxel_overflow_counter += 1
+        vp_x, vp_y, vp_z, s_x, soma_dist = rasterise_section(point_idx=point_idx,
+                                                             geometry=geometry,
+                                                             section_x=section_x,
+                                                             neuron_id=neuron_id,
+                                                             hyper_voxel_origo=self_hyper_voxel_origo,
+                                                             voxel_size=self_voxel_size,
+                                                             num_bins=self_num_bins,
+                                                             step_multiplier=self_step_multiplier)
+
+        for i in range(0, len(vp_x)):
+            v_idx = (vp_x[i], vp_y[i], vp_z[i])
+            v_ctr = voxel_space_ctr[v_idx]
+
+            if v_ctr > 0 and voxel_space[v_idx][v_ctr-1] == neuron_id:
+                # Voxel already contains neuron_id, skip
+                continue
+
+            if v_ctr < self_max_dend:
+                voxel_space[v_idx][v_ctr] = neuron_id
+                # Use section id from last point for section as first point has parent's section id
+                voxel_sec_id[v_idx][v_ctr] = section_id[-1]
+                voxel_sec_x[v_idx][v_ctr] = s_x[i]
+                voxel_soma_dist[v_idx][v_ctr] = soma_dist[i]
+                voxel_space_ctr[v_idx] += 1
+            else:
+                # Overflow, not enough space to store info
+                self_voxel_overflow_counter += 1
 
         return self_voxel_overflow_counter
 
@@ -3038,7 +3365,6 @@ class SnuddaDetect(object):
 
             self.voxel_overflow_counter += voxel_overflow_ctr
 
-    # Temporarily disabling NUMBA, since amax does not support axis in NUMBA
     @staticmethod
     @jit(nopython=True, fastmath=True, cache=True)
     def fill_voxels_axon_helper(voxel_space,
@@ -3053,101 +3379,160 @@ class SnuddaDetect(object):
                                 self_max_axon,
                                 self_step_multiplier):
 
+        """ Helper function for fill_voxels_axon, static method needed for NUMBA. """
+
         self_voxel_overflow_counter = 0
 
-        # We use padding to include line segments where both points are outside, but their
-        # line intersect the hypervoxel.
-        padding = 1
-        lower_padding_bound = 0 - padding
-        upper_padding_bound = self_num_bins + padding
-
-        coords = geometry[point_idx, :3]
-        voxel_coords = (coords - self_hyper_voxel_origo) / self_voxel_size
-        point_inside = np.sum(np.logical_and(lower_padding_bound <= voxel_coords,
-                                             voxel_coords < upper_padding_bound),
-                              axis=1) == 3
-        scaled_soma_dist = geometry[point_idx, 4] * 1e6  # Dist to soma
-
-        # Numba does not support third argument axis of np.diff, so transpose it instead
-        # num_steps = np.ceil(np.amax(np.abs(np.diff(voxel_coords, axis=0)) * self_step_multiplier, axis=1)).astype(int)
-        # dv_step = np.diff(voxel_coords, axis=0) / num_steps[:, None]
-
-        step_diff = np.abs(np.diff(voxel_coords.T).T)
-        sec_length = np.zeros((step_diff.shape[0], ))
-        for i in range(0, step_diff.shape[0]):
-            sec_length[i] = np.sqrt(step_diff[i, 0] ** 2 + step_diff[i, 1] ** 2 + step_diff[i, 2]**2)
-
-        num_steps = np.ceil(sec_length*self_step_multiplier).astype(np.int64)
-
-        # OLD VERSION
-        # This is just does same as numpy.amax for axis=1, but inlined for NUMBA
-        # max_val = step_diff[:, 0].copy()
-        # for j in range(1, step_diff.shape[1]):
-        #     for i in range(0, step_diff.shape[0]):
-        #         if max_val[i] < step_diff[i, j]:
-        #             max_val[i] = step_diff[i, j]
-        #
-        # num_steps = np.ceil(max_val * self_step_multiplier).astype(np.int64)
-
-        # [:, None] is here used to divide first row by first element in num_step
-        # second row divide by second element in num_step etc. Pretty clever.
-        # https://stackoverflow.com/questions/19602187/numpy-divide-each-row-by-a-vector-element
-        # Looks like NUMBA cant handle this though,
-        # dv_step = np.diff(voxel_coords.T).T / num_steps[:, None]
-        dv_step = np.diff(voxel_coords.T).T
-        for i in range(0, dv_step.shape[0]):
-            dv_step[i, :] /= num_steps[i]
-
-        dd_step = np.divide(np.diff(scaled_soma_dist), num_steps)
-
-        # Remove this check later... should be done in morphology_data
-        if (num_steps <= 0).any():
-            print(f"Found zero length axon segment in neuron_id {neuron_id}")
-            # Numba does not allow variables in exceptions...
-            # raise ValueError(f"Found zero length axon segment in neuron_id {neuron_id}")
-            raise ValueError(f"Found zero length axon segment (please check morphologies")
-
-        # Loop through all point-pairs of the section
-        for idx in range(0, len(scaled_soma_dist)-1):
-
-            if point_inside[idx] or point_inside[idx+1]:
-                # Either of the points are within the cube or padding zone
-
-                steps = np.arange(0, num_steps[idx] + 1)
-                # vp = np.floor(voxel_coords[idx, :] + dv_step[idx, :] * steps[:, None]).astype(np.int64)
-                # OBS, we must have np.floor here, since np.floor(-0.2) = -1, and int(-0.2) = 0... we want the former
-                vp_x = np.floor(voxel_coords[idx, 0] + dv_step[idx, 0] * steps).astype(np.int64)
-                vp_y = np.floor(voxel_coords[idx, 1] + dv_step[idx, 1] * steps).astype(np.int64)
-                vp_z = np.floor(voxel_coords[idx, 2] + dv_step[idx, 2] * steps).astype(np.int64)
-
-                soma_dist = np.floor(scaled_soma_dist[idx] + dd_step[idx]*steps).astype(np.int64)
-
-                # p_inside = np.sum(np.logical_and(0 <= vp, vp < self_num_bins), axis=1) == 3
-                p_inside = np.logical_and(np.logical_and(0 <= vp_x, vp_x < self_num_bins[0]),
-                                          np.logical_and(np.logical_and(0 <= vp_y, vp_y < self_num_bins[1]),
-                                                         np.logical_and(0 <= vp_z, vp_z < self_num_bins[2])))
-
-                # For each point pair in a section, find the intermediate points and mark voxels
-                for i in steps:
-                    if p_inside[i]:
-                        # v_idx = tuple(vp[i, :])
-                        v_idx = (vp_x[i], vp_y[i], vp_z[i])
-                        v_ctr = voxel_space_ctr[v_idx]
-
-                        if v_ctr > 0 and voxel_space[v_idx][v_ctr-1] == neuron_id:
-                            # Voxel already contains neuron_id, skip
-                            continue
-
-                        if v_ctr < self_max_axon:
-                            voxel_space[v_idx][v_ctr] = neuron_id
-                            voxel_axon_dist[v_idx][v_ctr] = soma_dist[i]
-                            voxel_space_ctr[v_idx] += 1
-                        else:
-                            # Overflow, not enough space to store info
-                            self_voxel_overflow_counter += 1
+        vp_x, vp_y, vp_z, s_x, soma_dist = rasterise_section(point_idx=point_idx,
+                                                             geometry=geometry,
+                                                             section_x=np.zeros((len(point_idx),)),
+                                                             neuron_id=neuron_id,
+                                                             hyper_voxel_origo=self_hyper_voxel_origo,
+                                                             voxel_size=self_voxel_size,
+                                                             num_bins=self_num_bins,
+                                                             step_multiplier=self_step_multiplier)
+
+        for i in range(0, len(vp_x)):
+            v_idx = (vp_x[i], vp_y[i], vp_z[i])
+            v_ctr = voxel_space_ctr[v_idx]
+
+            if v_ctr > 0 and voxel_space[v_idx][v_ctr-1] == neuron_id:
+                # Voxel already contains neuron_id, skip
+                continue
+
+            if v_ctr < self_max_axon:
+                voxel_space[v_idx][v_ctr] = neuron_id
+                voxel_axon_dist[v_idx][v_ctr] = soma_dist[i]
+                voxel_space_ctr[v_idx] += 1
+            else:
+                # Overflow, not enough space to store info
+                self_voxel_overflow_counter += 1
 
         return self_voxel_overflow_counter
 
+    def fill_hyper_voxel(self, hyper_id):
+
+        """
+        Marks the voxels occupied by the somas, dendrites and axons of all neurons in the hyper voxel.
+
+        All dendrite sections and all axon sections in the hyper voxel are collected in a SegmentTable each,
+        and rasterised in one compiled pass (see rasterise_segment_table) using self.rasterise_method.
+        The voxel items are added in the same order as when calling fill_voxels_soma, fill_voxels_dend and
+        fill_voxels_axon neuron by neuron, so the "step" method gives the same voxels as those functions.
+
+        Args:
+            hyper_id : ID of hyper voxel
+        """
+
+        dend_table = SegmentTable()
+        axon_table = SegmentTable()
+        soma_items = []
+
+        for neuron_order, neuron_id in enumerate(sorted(self.hyper_voxels[hyper_id]["neurons"].keys())):
+
+            neuron_info = self.hyper_voxels[hyper_id]["neurons"][neuron_id]
+            neuron = self.load_neuron(self.neurons[neuron_id], use_cache=False)  # !!! Cached objects get huge
+
+            # Order keys: soma items of a neuron go before its dendrite items
+            if "soma" in neuron_info and "neuron" in neuron.morphology_data:
+                vx, vy, vz = self.get_soma_voxels(neuron=neuron, neuron_id=neuron_id)
+                soma_items.append((vx, vy, vz, np.full(vx.shape, neuron_id), np.full(vx.shape, 2 * neuron_order)))
+
+            if "dend" in neuron_info:
+                dend_table.add_sections(neuron.morphology_data["neuron"], section_type=3,
+                                        section_id=neuron_info["dend"],
+                                        neuron_id=neuron_id, order=2 * neuron_order + 1)
+
+            if "axon" in neuron_info:
+                for section_id, subtree in neuron_info["axon"]:
+                    axon_table.add_sections(neuron.morphology_data[subtree], section_type=2,
+                                            section_id=section_id,
+                                            neuron_id=neuron_id, order=neuron_order)
+
+        vx, vy, vz, neuron_id, sec_id, sec_x, soma_dist, order = \
+            dend_table.rasterise(hyper_voxel_origo=self.hyper_voxel_origo, voxel_size=self.voxel_size,
+                                 num_bins=self.num_bins, step_multiplier=self.step_multiplier,
+                                 method=self.rasterise_method)
+
+        if len(soma_items) > 0:
+            # Soma is section_id -1, with section_x 0.5
+            soma_vx, soma_vy, soma_vz, soma_neuron_id, soma_order = [np.concatenate(x) for x in zip(*soma_items)]
+            num_soma = soma_vx.shape[0]
+
+            sort_idx = np.argsort(np.concatenate((soma_order, order)), kind="stable")
+
+            vx = np.concatenate((soma_vx, vx))[sort_idx]
+            vy = np.concatenate((soma_vy, vy))[sort_idx]
+            vz = np.concatenate((soma_vz, vz))[sort_idx]
+            neuron_id = np.concatenate((soma_neuron_id, neuron_id))[sort_idx]
+            sec_id = np.concatenate((np.full((num_soma,), -1), sec_id))[sort_idx]
+            sec_x = np.concatenate((np.full((num_soma,), 0.5), sec_x))[sort_idx]
+            soma_dist = np.concatenate((np.zeros((num_soma,), dtype=int), soma_dist))[sort_idx]
+
+        self.add_voxel_items(voxel_type="dend", vx=vx, vy=vy, vz=vz, neuron_id=neuron_id,
+                             sec_id=sec_id, sec_x=sec_x, soma_dist=soma_dist)
+
+        vx, vy, vz, neuron_id, sec_id, sec_x, soma_dist, order = \
+            axon_table.rasterise(hyper_voxel_origo=self.hyper_voxel_origo, voxel_size=self.voxel_size,
+                                 num_bins=self.num_bins, step_multiplier=self.step_multiplier,
+                                 method=self.rasterise_method)
+
+        self.add_voxel_items(voxel_type="axon", vx=vx, vy=vy, vz=vz, neuron_id=neuron_id, soma_dist=soma_dist)
+
+    def add_voxel_items(self, voxel_type, vx, vy, vz, neuron_id, sec_id=0, sec_x=0.0, soma_dist=0):
+
+        """
+        Adds items to the axon or dendrite voxels (dense or sparse). An item is skipped if the last item
+        in its voxel belongs to the same neuron.
+
+        Args:
+            voxel_type (str) : "axon" or "dend"
+            vx, vy, vz : Voxel coordinates (within hyper voxel)
+            neuron_id : Neuron ID of each item (int or array)
+            sec_id : Section ID of each item (int or array)
+            sec_x : Section X of each item (float or array)
+            soma_dist : Distance to soma of each item, micrometers (int or array)
+        """
+
+        if voxel_type not in ["axon", "dend"]:
+            raise ValueError(f"Unknown voxel_type {voxel_type}, must be 'axon' or 'dend'")
+
+        if self.sparse_voxels:
+            voxel_store = self.axon_voxel_store if voxel_type == "axon" else self.dend_voxel_store
+            voxel_store.add_items(vx, vy, vz, neuron_id=neuron_id, sec_id=sec_id, sec_x=sec_x, soma_dist=soma_dist)
+            return
+
+        vx = np.asarray(vx, dtype=np.int64)
+        num_items = vx.shape[0]
+
+        neuron_id = np.broadcast_to(neuron_id, (num_items,)).astype(np.int64)
+        sec_id = np.broadcast_to(sec_id, (num_items,)).astype(np.int64)
+        sec_x = np.broadcast_to(sec_x, (num_items,)).astype(np.float64)
+        soma_dist = np.broadcast_to(soma_dist, (num_items,)).astype(np.int64)
+
+        if voxel_type == "axon":
+            voxel_overflow_ctr = write_dense_voxel_items(voxel_space=self.axon_voxels,
+                                                         voxel_space_ctr=self.axon_voxel_ctr,
+                                                         voxel_sec_id=None,
+                                                         voxel_sec_x=None,
+                                                         voxel_soma_dist=self.axon_soma_dist,
+                                                         vx=vx, vy=np.asarray(vy, dtype=np.int64),
+                                                         vz=np.asarray(vz, dtype=np.int64),
+                                                         neuron_id=neuron_id, sec_id=sec_id,
+                                                         sec_x=sec_x, soma_dist=soma_dist)
+        else:
+            voxel_overflow_ctr = write_dense_voxel_items(voxel_space=self.dend_voxels,
+                                                         voxel_space_ctr=self.dend_voxel_ctr,
+                                                         voxel_sec_id=self.dend_sec_id,
+                                                         voxel_sec_x=self.dend_sec_x,
+                                                         voxel_soma_dist=self.dend_soma_dist,
+                                                         vx=vx, vy=np.asarray(vy, dtype=np.int64),
+                                                         vz=np.asarray(vz, dtype=np.int64),
+                                                         neuron_id=neuron_id, sec_id=sec_id,
+                                                         sec_x=sec_x, soma_dist=soma_dist)
+
+        self.voxel_overflow_counter += voxel_overflow_ctr
+
     ############################################################################
 
     # TODO: Add a filter, neurons that are not included in connectivity definition as either
@@ -3185,43 +3570,9 @@ class SnuddaDetect(object):
             # GJ touch detection, after that add rest of neurons (to get complete set)
             # and then do axon-dend synapse touch detection
 
-            for neuron_id in sorted(self.hyper_voxels[hyper_id]["neurons"].keys()):
-
-                neuron_info = self.hyper_voxels[hyper_id]["neurons"][neuron_id]
-                neuron = self.load_neuron(self.neurons[neuron_id], use_cache=False)  # !!! Cached objects get huge
-
-                if "soma" in neuron_info:
-                    self.fill_voxels_soma(self.dend_voxels,
-                                          self.dend_voxel_ctr,
-                                          self.dend_sec_id,
-                                          self.dend_sec_x,
-                                          neuron,
-                                          neuron_id)
-
-                if "dend" in neuron_info:
-                    section_id = neuron_info["dend"]
-
-                    self.fill_voxels_dend(voxel_space=self.dend_voxels,
-                                          voxel_space_ctr=self.dend_voxel_ctr,
-                                          voxel_sec_id=self.dend_sec_id,
-                                          voxel_sec_x=self.dend_sec_x,
-                                          voxel_soma_dist=self.dend_soma_dist,
-                                          neuron=neuron,
-                                          neuron_id=neuron_id,
-                                          section_id=section_id)
-
-                if "axon" in neuron_info:
-                    for section_id, subtree in neuron_info["axon"]:
-
-                        self.fill_voxels_axon(voxel_space=self.axon_voxels,
-                                              voxel_space_ctr=self.axon_voxel_ctr,
-                                              voxel_axon_dist=self.axon_soma_dist,
-                                              neuron=neuron,
-                                              neuron_id=neuron_id,
-                                              section_id=section_id,
-                                              subtree=subtree)
-
-            # This should be outside the neuron loop
+            # Marks soma, dendrite and axon voxels of all neurons in hyper voxel
+            self.fill_hyper_voxel(hyper_id)
+
             # This places axon voxels for neurons without axon morphologies
             self.place_synapses_no_axon(hyper_id,
                                         self.axon_voxels,
@@ -3420,8 +3771,7 @@ class SnuddaDetect(object):
         for x in range(0, self.axon_voxel_ctr.shape[0]):
             for y in range(0, self.axon_voxel_ctr.shape[1]):
                 for z in range(0, self.axon_voxel_ctr.shape[2]):
-                    for c in range(0, self.axon_voxel_ctr[x, y, z]):
-                        n_id = self.axon_voxels[x, y, z, c]
+                    for n_id in self.get_voxel_neuron_id(x, y, z, voxel_type="axon"):
                         if n_id in neuron_id:
                             axon_str += str(x) + "," + str(y) + "," + str(z) \
                                         + ",cube,axon," + str(n_id) + "\n"
@@ -3429,8 +3779,7 @@ class SnuddaDetect(object):
         for x in range(0, self.dend_voxel_ctr.shape[0]):
             for y in range(0, self.dend_voxel_ctr.shape[1]):
                 for z in range(0, self.dend_voxel_ctr.shape[2]):
-                    for c in range(0, self.dend_voxel_ctr[x, y, z]):
-                        n_id = self.dend_voxels[x, y, z, c]
+                    for n_id in self.get_voxel_neuron_id(x, y, z, voxel_type="dend"):
                         if n_id in neuron_id:
                             dend_str += str(x) + "," + str(y) + "," + str(z) \
                                         + ",cube,dend," + str(n_id) + "\n"
@@ -3506,8 +3855,7 @@ class SnuddaDetect(object):
         for ix in range(0, self.axon_voxel_ctr.shape[0]):
             for iy in range(0, self.axon_voxel_ctr.shape[1]):
                 for iz in range(0, self.axon_voxel_ctr.shape[2]):
-                    for ic in range(0, self.axon_voxel_ctr[ix, iy, iz]):
-                        n_id = self.axon_voxels[ix, iy, iz, ic]
+                    for n_id in self.get_voxel_neuron_id(ix, iy, iz, voxel_type="axon"):
                         if n_id in neuron_id:
                             colours[ix, iy, iz, 0:3] = neuron_colour_lookup[n_id]
                             colours[ix, iy, iz, 3] = alpha_axon_lookup[n_id]
@@ -3516,8 +3864,7 @@ class SnuddaDetect(object):
         for ix in range(0, self.dend_voxel_ctr.shape[0]):
             for iy in range(0, self.dend_voxel_ctr.shape[1]):
                 for iz in range(0, self.dend_voxel_ctr.shape[2]):
-                    for ic in range(0, self.dend_voxel_ctr[ix, iy, iz]):
-                        n_id = self.dend_voxels[ix, iy, iz, ic]
+                    for n_id in self.get_voxel_neuron_id(ix, iy, iz, voxel_type="dend"):
                         if n_id in neuron_id:
                             colours[ix, iy, iz, 0:3] = neuron_colour_lookup[n_id]
                             colours[ix, iy, iz, 3] = alpha_dend_lookup[n_id]
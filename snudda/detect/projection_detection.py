@@ -270,11 +270,22 @@ class ProjectionDetection:
                                                             voxel_coords < self.snudda_detect.hyper_voxel_size),
                                              axis=1) == 3)[0]
 
+                if self.snudda_detect.sparse_voxels:
+                    # Same neuron can be added repeatedly to a voxel here, as with the dense voxels
+                    self.snudda_detect.axon_voxel_store.add_items(voxel_coords[inside_idx, 0],
+                                                                  voxel_coords[inside_idx, 1],
+                                                                  voxel_coords[inside_idx, 2],
+                                                                  neuron_id=neuron_id,
+                                                                  soma_dist=axon_dist,
+                                                                  skip_repeats=False)
+                    continue
+
                 for x, y, z in voxel_coords[inside_idx, :]:
-                    if self.snudda_detect.axon_voxel_ctr[x, y, z] < self.snudda_detect.max_axon:
-                        self.snudda_detect.axon_voxels[x, y, z, self.snudda_detect.axon_voxel_ctr[x, y, z]] = neuron_id
+                    v_ctr = self.snudda_detect.axon_voxel_ctr[x, y, z]
+                    if v_ctr < self.snudda_detect.max_axon:
+                        self.snudda_detect.axon_voxels[x, y, z, v_ctr] = neuron_id
+                        self.snudda_detect.axon_soma_dist[x, y, z, v_ctr] = axon_dist  # This is an underestimation
                         self.snudda_detect.axon_voxel_ctr[x, y, z] += 1
-                        self.snudda_detect.axon_soma_dist[x, y, z] = axon_dist  # This is an underestimation
                     else:
                         self.snudda_detect.voxel_overflow_counter += 1
 
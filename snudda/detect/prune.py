@@ -22,7 +22,6 @@
 
 import collections
 import glob
-import heapq  # Priority queue
 import json
 import math
 import os
@@ -36,6 +35,7 @@ import numpy as np
 import scipy
 from numba import jit
 
+from snudda.detect.synapse_writer import SynapseWriter
 from snudda.utils import SnuddaLoad
 from snudda.utils.numpy_encoder import NumpyEncoder
 
@@ -69,7 +69,8 @@ class SnuddaPrune(object):
                  h5libver="latest",
                  random_seed=None,
                  keep_files=False,  # If True then you can redo pruning multiple times without reruning detect
-                 all_neuron_pair_synapses_share_parameter_id=True):
+                 all_neuron_pair_synapses_share_parameter_id=True,
+                 compress_synapses=True):
 
         """
         Constructor.
@@ -92,6 +93,9 @@ class SnuddaPrune(object):
             all_neuron_pair_synapses_share_parameter_id (bool): Instead of each synapse having a unique parameter_id
                                                                 all synapses between the same neuron pair will have
                                                                 the same parameter id.
+            compress_synapses (bool): Compress synapse and gap junction matrices (lzf), default True.
+                                      Uncompressed matrices take more disk space, but can be memory mapped
+                                      by SnuddaLoad(..., lazy=True).
         """
 
         self.rc = rc
@@ -147,13 +151,12 @@ class SnuddaPrune(object):
         # Parameters for the HDF5 writing, this affects write speed
         self.synapse_chunk_size = 10000
         self.gap_junction_chunk_size = 10000
-        self.h5compression = "lzf"
+        self.compress_synapses = compress_synapses
+        self.h5compression = "lzf" if compress_synapses else None
 
-        # These are for the merge code
-        self.synapse_write_buffer = None
+        # These are for the merge code (synapse_buffer_size is also the write buffer size when pruning)
+        self.merge_writer = None
         self.synapse_buffer_size = 100000
-        self.next_buffer_write_pos = 0
-        self.next_file_write_pos = 0
         self.buffer_out_file = None
         self.file_list = []
         self.file_buffers = []
@@ -1007,8 +1010,8 @@ class SnuddaPrune(object):
 
         self.next_merge_file_id += 1
 
-        # Reset the position for the merge file
-        self.next_file_write_pos = 0
+        # Reset the writer for the merge file
+        self.merge_writer = None
 
         return out_file, outfile_name
 
@@ -1339,11 +1342,13 @@ class SnuddaPrune(object):
         d_view.scatter('logfile_name', engine_log_file, block=True)
         d_view.push({"network_path": self.network_path,
                      "random_seed": self.random_seed,
-                     "config_file": self.config_file}, block=True)
+                     "config_file": self.config_file,
+                     "compress_synapses": self.compress_synapses}, block=True)
 
         cmd_str = ("sp = SnuddaPrune(network_path=network_path, logfile_name=logfile_name[0],"
                    "                 config_file=config_file,"
-                   "                 role='worker',random_seed=random_seed)")
+                   "                 role='worker',random_seed=random_seed,"
+                   "                 compress_synapses=compress_synapses)")
         d_view.execute(cmd_str, block=True)
 
         self.write_log(f"Workers setup: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())}")
@@ -1387,51 +1392,23 @@ class SnuddaPrune(object):
 
         """
 
-        if self.synapse_write_buffer is None:
-            # First time run
-            if synapses is not None:
-                buffer_width = synapses.shape[1]
-            else:
-                assert False, "buffer_merge_write: Unable to guess width of matrix"
-
-            self.synapse_write_buffer = np.zeros((self.synapse_buffer_size,
-                                                  buffer_width),
-                                                 dtype=np.int32)
-            self.next_buffer_write_pos = 0
+        if self.merge_writer is None:
+            # First time run, the merge file is preallocated in setup_merge_file
+            self.merge_writer = SynapseWriter(dataset=self.buffer_out_file[synapse_matrix_loc],
+                                              buffer_size=self.synapse_buffer_size)
 
         if synapses is not None:
-
-            # Is buffer almost full?
-            if synapses.shape[0] + self.next_buffer_write_pos >= self.synapse_buffer_size:
-                # Flush buffer first
-                end_file_idx = self.next_file_write_pos + self.next_buffer_write_pos
-                self.buffer_out_file[synapse_matrix_loc][self.next_file_write_pos:end_file_idx, :] \
-                    = self.synapse_write_buffer[0:self.next_buffer_write_pos, :]
-
-                self.next_file_write_pos += self.next_buffer_write_pos
-                self.next_buffer_write_pos = 0
-                # Ok, now we have clean buffer, back to normal program
-
-            end_buf_idx = self.next_buffer_write_pos + synapses.shape[0]
-            self.synapse_write_buffer[self.next_buffer_write_pos:end_buf_idx, :] = synapses
-            self.next_buffer_write_pos += synapses.shape[0]
+            self.merge_writer.write(synapses)
 
         if flush:
             self.write_log(f"Flushing {self.buffer_out_file.filename} data: {synapse_matrix_loc}")
-            end_file_idx = self.next_file_write_pos + self.next_buffer_write_pos
-            self.buffer_out_file[synapse_matrix_loc][self.next_file_write_pos:end_file_idx, :] \
-                = self.synapse_write_buffer[0:self.next_buffer_write_pos, :]
-
-            self.next_file_write_pos += self.next_buffer_write_pos
-            self.next_buffer_write_pos = 0
 
             # Resize matrix to fit data
-            w = self.buffer_out_file[synapse_matrix_loc].shape[1]
-            self.buffer_out_file[synapse_matrix_loc].resize((end_file_idx, w))
-            self.write_log(f"{synapse_matrix_loc} new size {(end_file_idx, w)}")
+            self.merge_writer.close()
+            self.write_log(f"{synapse_matrix_loc} new size {self.buffer_out_file[synapse_matrix_loc].shape}")
 
             # Remove buffer
-            self.synapse_write_buffer = None
+            self.merge_writer = None
 
     ############################################################################
 
@@ -1468,11 +1445,7 @@ class SnuddaPrune(object):
             self.setup_parallel(d_view=self.d_view)
 
             n_workers = len(self.d_view)
-            neuron_ranges = []
-            range_borders = np.linspace(0, num_neurons, n_workers + 1).astype(int)
-
-            for idx in range(0, n_workers):
-                neuron_ranges.append((range_borders[idx], range_borders[idx + 1]))
+            neuron_ranges = self.get_merge_neuron_ranges(num_workers=n_workers)
 
             assert neuron_ranges[-1][-1] == num_neurons, \
                 "gather_neuron_synapses: Problem with neuron_ranges, last element incorrect"
@@ -1520,6 +1493,50 @@ class SnuddaPrune(object):
 
     ############################################################################
 
+    def get_merge_neuron_ranges(self, num_workers):
+
+        """
+        Splits the neurons into num_workers consecutive ranges, with approximately the same number of
+        synapses to merge in each range. The number of synapses of each neuron is estimated from the hyper voxels,
+        where the synapses of a hyper voxel are split evenly between the neurons in it.
+
+        Args:
+            num_workers (int) : Number of workers
+
+        Returns:
+            neuron_ranges : List of (start, end) tuples, end is exclusive
+        """
+
+        num_neurons = self.hist_file["network/neurons/neuron_id"].shape[0]
+        n_hv = int(self.hist_file["num_completed"][0])
+
+        hyper_voxel_synapses = dict(zip(self.hist_file["completed"][:n_hv],
+                                        self.hist_file["num_hypervoxel_synapses"][:n_hv]))
+
+        hyper_voxels = json.loads(self.hist_file["hyper_voxels"][()])
+
+        # Every neuron has a small base load, so neurons without synapses are also spread out
+        neuron_load = np.ones((num_neurons,))
+
+        for hid, hyper_voxel in hyper_voxels.items():
+            hv_neurons = np.array([int(x) for x in hyper_voxel["neurons"].keys()], dtype=int)
+            n_syn = hyper_voxel_synapses.get(int(hid), 0)
+
+            if n_syn > 0 and len(hv_neurons) > 0:
+                neuron_load[hv_neurons] += n_syn / len(hv_neurons)
+
+        cum_load = np.cumsum(neuron_load)
+        range_borders = np.searchsorted(cum_load, np.linspace(0, cum_load[-1], num_workers + 1)[1:-1], side="right")
+        range_borders = np.concatenate(([0], range_borders, [num_neurons])).astype(int)
+
+        neuron_ranges = [(range_borders[idx], range_borders[idx + 1]) for idx in range(0, num_workers)]
+
+        self.write_log(f"Merge neuron ranges: {neuron_ranges}")
+
+        return neuron_ranges
+
+    ############################################################################
+
     #    We need to find all the hypervoxels that might contain synapses.
     #    During touch detection we generated a list for each hypervoxel with
     #    all the neurons that had any part of it within that hypervoxel.
@@ -1580,10 +1597,9 @@ class SnuddaPrune(object):
             # Locations of data within the file
             h5_syn_mat, h5_hyp_syn_n, h5_syn_n, h5_syn_lookup = self.data_loc[merge_data_type]
 
-            synapse_heap = []
             file_list = dict([])
-            file_mat_iterator = dict([])
-            chunk_size = 10000
+            file_lookup = dict([])
+            chunk_size = 1000000
 
             # Next we need to open all the relevant files
             h_file_name_mask = os.path.join(self.network_path, "voxels", "network-putative-synapses-%s.hdf5")
@@ -1639,29 +1655,20 @@ class SnuddaPrune(object):
                         self.max_channel_type = file_list[h_id]["network/max_channel_type_id"][()]
                         self.write_log(f"Setting max_channel_type to {self.max_channel_type} from h_id={h_id}")
 
-                    lookup_iterator = \
-                        self.file_row_lookup_iterator_subset(h5mat_lookup=file_list[h_id][h5_syn_lookup],
-                                                             min_dest_id=neuron_range[0],
-                                                             max_dest_id=neuron_range[1],
-                                                             chunk_size=chunk_size)
-
-                    file_mat_iterator[h_id] \
-                        = self.synapse_set_iterator(h5mat_lookup=file_list[h_id][h5_syn_lookup],
-                                                    h5mat=file_list[h_id][h5_syn_mat],
-                                                    chunk_size=chunk_size,
-                                                    lookup_iterator=lookup_iterator)
-
-                    syn_set, unique_id = next(file_mat_iterator[h_id], (None, None))
+                    lookup_iterator = self.read_lookup_subset(h5mat_lookup=file_list[h_id][h5_syn_lookup],
+                                                              min_dest_id=neuron_range[0],
+                                                              max_dest_id=neuron_range[1],
+                                                              chunk_size=chunk_size)
+                    lookup_chunk = next(lookup_iterator, None)
 
-                    if syn_set is None:
+                    if lookup_chunk is None:
                         # There were synapses in the hyper voxel, but none relevant to our
-                        # selected files. Clear file List and fileMatIterator for this worker
+                        # selected files. Close file for this worker
+                        file_list[h_id].close()
                         del file_list[h_id]
-                        del file_mat_iterator[h_id]
                         continue
 
-                    # Create a heap containing the first subset of all files
-                    heapq.heappush(synapse_heap, (unique_id, h_id, syn_set))
+                    file_lookup[h_id] = (lookup_iterator, lookup_chunk)
 
                     # This is so we can optimize the axon/dend voxelCtr and size
                     if "max_axon_voxel_ctr" in file_list[h_id]["meta"]:
@@ -1699,27 +1706,18 @@ class SnuddaPrune(object):
                     n_total += file_list[proj_connection]["network/num_synapses"][()]
 
                     lookup_iterator = \
-                        self.file_row_lookup_iterator_subset(h5mat_lookup=file_list[proj_connection][h5_syn_lookup],
-                                                             min_dest_id=neuron_range[0],
-                                                             max_dest_id=neuron_range[1],
-                                                             chunk_size=chunk_size)
-
-                    file_mat_iterator[proj_connection] \
-                        = self.synapse_set_iterator(h5mat_lookup=file_list[proj_connection][h5_syn_lookup],
-                                                    h5mat=file_list[proj_connection][h5_syn_mat],
-                                                    chunk_size=chunk_size,
-                                                    lookup_iterator=lookup_iterator)
+                        self.read_lookup_subset(h5mat_lookup=file_list[proj_connection][h5_syn_lookup],
+                                                min_dest_id=neuron_range[0],
+                                                max_dest_id=neuron_range[1],
+                                                chunk_size=chunk_size)
+                    lookup_chunk = next(lookup_iterator, None)
 
-                    syn_set, unique_id = next(file_mat_iterator[proj_connection], (None, None))
-
-                    if syn_set is None:
+                    if lookup_chunk is None:
                         # No synapse in our range, let this worker skip the file
-                        # Clear file List and fileMatIterator for this worker
+                        file_list[proj_connection].close()
                         del file_list[proj_connection]
-                        del file_mat_iterator[proj_connection]
                     else:
-                        # Create a heap containing the first subset of all files
-                        heapq.heappush(synapse_heap, (unique_id, proj_connection, syn_set))
+                        file_lookup[proj_connection] = (lookup_iterator, lookup_chunk)
 
                 else:
                     # No synapses in file, close it.
@@ -1752,53 +1750,17 @@ class SnuddaPrune(object):
                 self.buffer_out_file["meta"].create_dataset("max_dend_voxel_ctr", data=max_dend_voxel_ctr)
                 self.write_log(f"max_dend_voxel_ctr = {max_dend_voxel_ctr}")
 
-            # Take the first (smallest uniqueID) element from the heap
-            if len(synapse_heap) > 0:
-                # Get the first file to read synapses from
-                (unique_id, h_id, syn_set) = heapq.heappop(synapse_heap)
-            else:
+            if len(file_lookup) == 0:
                 # No synapses at all, return
                 self.clean_up_merge_read_buffers()
                 return None, neuron_range, 0
 
-            # Store synapse
-            self.buffer_merge_write(h5_syn_mat, syn_set)
-            syn_ctr = syn_set.shape[0]
-
-            loop_ctr = 0
-            done = False
-
-            while not done:
-
-                old_unique_id = unique_id
-
-                if loop_ctr % 1000000 == 0 and n_total > 1000000:
-                    self.write_log(f"Worker synapses: {syn_ctr}/{n_total} (heap size: {len(synapse_heap)})",
-                                   force_print=True)
-
-                # Get the next set of synapses from this file from the iterator
-                next_row_set = next(file_mat_iterator[h_id], None)
+            self.write_log(f"Merging neuron pairs from {len(file_list)} files")
 
-                if next_row_set is not None:
-                    # More synapses in file, push next pair to heap, and pop top pair
-                    syn_set, unique_id = next_row_set
-                    (unique_id, h_id, syn_set) = heapq.heappushpop(synapse_heap, (unique_id, h_id, syn_set))
-                elif len(synapse_heap) > 0:
-                    (unique_id, h_id, syn_set) = heapq.heappop(synapse_heap)
-
-                else:
-                    done = True
-                    continue
-
-                assert unique_id >= old_unique_id, "unique_id should be increasing in file"
-
-                self.buffer_merge_write(h5_syn_mat, syn_set)
-                syn_ctr += syn_set.shape[0]
-                loop_ctr += 1
-
-            if n_total > 1000000:
-                self.write_log(f"Worker {merge_data_type}: {syn_ctr}/{n_total} (heap size: {len(synapse_heap)})",
-                               force_print=True)
+            # The lookup tables are read and merged chunk by chunk, only the current chunk of each file is in memory
+            syn_ctr = self.merge_synapse_ranges(file_list=file_list, h5_syn_mat=h5_syn_mat,
+                                                merge_blocks=self.merge_lookup_blocks(file_lookup),
+                                                n_total=n_total)
 
             self.write_log(f"Read {syn_ctr} out of total {n_total} {merge_data_type}", force_print=True)
 
@@ -1826,6 +1788,177 @@ class SnuddaPrune(object):
 
     ############################################################################
 
+    def merge_synapse_ranges(self, file_list, h5_syn_mat, merge_blocks, n_total, block_size=None):
+
+        """
+        Copies the synapse rows of the neuron pairs in merge_blocks, in order, to the merge file.
+
+        The pairs are processed in blocks of at most block_size synapse rows (one pair can exceed it). For each
+        block every file involved is read once, as one contiguous row range, and the rows are copied in bulk.
+
+        Args:
+            file_list (dict) : h_id --> open hyper voxel file
+            h5_syn_mat (str) : Location of synapse matrix in files
+            merge_blocks : Iterable of (merge_h_id, merge_lookup), where merge_h_id is the h_id of the file each
+                           neuron pair is in, and merge_lookup the lookup rows (unique_id, start_row, end_row)
+                           of the neuron pairs, in merge order (see merge_lookup_blocks)
+            n_total (int) : Total number of synapses, used for progress reporting
+            block_size (int) : Number of synapse rows per block, default half of synapse_buffer_size
+
+        Returns:
+            syn_ctr (int) : Number of synapses written
+        """
+
+        if block_size is None:
+            block_size = max(1, self.synapse_buffer_size // 2)
+
+        syn_ctr = 0
+
+        for merge_h_id, merge_lookup in merge_blocks:
+
+            num_rows = merge_lookup[:, 2] - merge_lookup[:, 1]
+            row_cumsum = np.cumsum(num_rows)
+
+            merge_syn_ctr = 0
+            block_start = 0
+            num_pairs = merge_lookup.shape[0]
+
+            while block_start < num_pairs:
+                block_end = max(block_start + 1,
+                                int(np.searchsorted(row_cumsum, merge_syn_ctr + block_size, side="right")))
+
+                block_h_id = merge_h_id[block_start:block_end]
+                block_lookup = merge_lookup[block_start:block_end, :]
+                block_num_rows = num_rows[block_start:block_end]
+
+                # Position in output block of the first synapse of each pair
+                out_start = np.concatenate(([0], np.cumsum(block_num_rows)[:-1]))
+                block_synapses = None
+
+                for h_id in np.unique(block_h_id):
+                    pair_idx = np.flatnonzero(block_h_id == h_id)
+                    h5mat = file_list[h_id][h5_syn_mat]
+
+                    # Within a file the pairs are stored consecutively, so read them as one range
+                    read_start = block_lookup[pair_idx[0], 1]
+                    read_end = block_lookup[pair_idx[-1], 2]
+                    file_synapses = h5mat[read_start:read_end, :]
+
+                    if block_synapses is None:
+                        block_synapses = np.zeros((np.sum(block_num_rows), h5mat.shape[1]), dtype=h5mat.dtype)
+
+                    src_idx = self.expand_ranges(block_lookup[pair_idx, 1] - read_start, block_num_rows[pair_idx])
+                    dest_idx = self.expand_ranges(out_start[pair_idx], block_num_rows[pair_idx])
+                    block_synapses[dest_idx, :] = file_synapses[src_idx, :]
+
+                self.buffer_merge_write(h5_syn_mat, block_synapses)
+                merge_syn_ctr += block_synapses.shape[0]
+                syn_ctr += block_synapses.shape[0]
+                block_start = block_end
+
+                if n_total > 1000000:
+                    self.write_log(f"Worker synapses: {syn_ctr}/{n_total}", force_print=True)
+
+        return syn_ctr
+
+    ############################################################################
+
+    @staticmethod
+    def merge_lookup_blocks(file_lookup):
+
+        """
+        Generator, merges the lookup tables of several files in unique_id order, one block at a time.
+        Pairs with the same unique_id (from different hyper voxels) are ordered by h_id, projection
+        synapses (h_id = -1) first. Each lookup table must be sorted on unique_id.
+
+        Args:
+            file_lookup (dict) : h_id --> (lookup_iterator, lookup_chunk), where lookup_chunk is the current
+                                 chunk of the file's lookup table, and lookup_iterator yields the remaining
+                                 chunks (see read_lookup_subset)
+
+        Yields:
+            (merge_h_id, merge_lookup) : h_id of the file and lookup row of each neuron pair in the block
+        """
+
+        lookup_iterators = {h_id: lookup_iterator for h_id, (lookup_iterator, _) in file_lookup.items()}
+        lookup_chunks = {h_id: lookup_chunk for h_id, (_, lookup_chunk) in file_lookup.items()}
+
+        while len(lookup_chunks) > 0:
+
+            # All rows up to the smallest last unique_id of the current chunks can be merged,
+            # the remaining chunks only contain larger unique_id
+            merge_limit = min(lookup_chunk[-1, 0] for lookup_chunk in lookup_chunks.values())
+
+            block_h_id = []
+            block_lookup = []
+
+            for h_id in list(lookup_chunks.keys()):
+                lookup_chunk = lookup_chunks[h_id]
+                num_merge = int(np.searchsorted(lookup_chunk[:, 0], merge_limit, side="right"))
+
+                block_h_id.append(np.full((num_merge,), h_id, dtype=int))
+                block_lookup.append(lookup_chunk[:num_merge, :])
+
+                if num_merge < lookup_chunk.shape[0]:
+                    lookup_chunks[h_id] = lookup_chunk[num_merge:, :]
+                else:
+                    next_chunk = next(lookup_iterators[h_id], None)
+
+                    if next_chunk is None:
+                        del lookup_chunks[h_id]
+                    else:
+                        lookup_chunks[h_id] = next_chunk
+
+            merge_h_id = np.concatenate(block_h_id)
+            merge_lookup = np.concatenate(block_lookup)
+
+            merge_order = np.lexsort((merge_h_id, merge_lookup[:, 0]))
+
+            yield merge_h_id[merge_order], merge_lookup[merge_order, :]
+
+    ############################################################################
+
+    @staticmethod
+    def expand_ranges(start, num):
+
+        """ Returns the concatenation of the ranges start[i]:start[i]+num[i]. """
+
+        offset = np.concatenate(([0], np.cumsum(num)[:-1]))
+
+        return np.repeat(start - offset, num) + np.arange(np.sum(num))
+
+    ############################################################################
+
+    def read_lookup_subset(self, h5mat_lookup, min_dest_id, max_dest_id, chunk_size=1000000):
+
+        """
+        Generator, reads the lookup table rows (unique_id, start_row, end_row) of the neuron pairs with
+        min_dest_id <= dest_id < max_dest_id. The table is read in blocks of chunk_size rows, and the
+        relevant rows of each block are yielded (blocks without relevant rows are skipped).
+
+        Args:
+            h5mat_lookup : Synapse lookup table
+            min_dest_id : Minimum neuron destination ID for synapses (inclusive)
+            max_dest_id : Maximum neuron destination ID for synapses (exclusive)
+            chunk_size : Number of rows to read at a time
+        """
+
+        num_neurons = self.hist_file["network/neurons/neuron_id"].shape[0]
+
+        assert self.max_channel_type is not None, "max_channel_type should not be None"
+
+        min_unique_id = min_dest_id * num_neurons * self.max_channel_type
+        max_unique_id = max_dest_id * num_neurons * self.max_channel_type
+
+        for start_idx in range(0, h5mat_lookup.shape[0], chunk_size):
+            lookup = h5mat_lookup[start_idx:start_idx + chunk_size, :]
+            keep_idx = np.logical_and(min_unique_id <= lookup[:, 0], lookup[:, 0] < max_unique_id)
+
+            if np.any(keep_idx):
+                yield lookup[keep_idx, :]
+
+    ############################################################################
+
     def prune_synapses(self, synapse_file, output_filename,
                        merge_data_type, row_range=None,
                        close_input_file=True,
@@ -1896,6 +2029,13 @@ class SnuddaPrune(object):
 
             self.setup_output_file(output_filename)  # Sets self.outFile
 
+            # At most num_syn synapses are kept, preallocate space for them and trim at the end
+            synapse_writer = SynapseWriter(dataset=self.out_file[h5_syn_mat],
+                                           start_pos=self.out_file[f"network/{h5_syn_n}"][()],
+                                           max_rows=num_syn,
+                                           buffer_size=self.synapse_buffer_size,
+                                           counter=self.out_file[f"network/{h5_syn_n}"])
+
             num_syn_kept = 0
 
             for synRange in block_ranges:
@@ -1903,7 +2043,10 @@ class SnuddaPrune(object):
 
                 synapses = synapse_file[h5_syn_mat][synRange[0]:synRange[-1]]
                 num_syn_kept += self.prune_synapses_helper(synapses=synapses, output_file=self.out_file,
-                                                           merge_data_type=merge_data_type)
+                                                           merge_data_type=merge_data_type,
+                                                           synapse_writer=synapse_writer)
+
+            synapse_writer.close()
 
             # Close synapse input file
             if close_input_file:
@@ -1925,7 +2068,7 @@ class SnuddaPrune(object):
 
     ############################################################################
 
-    def prune_synapses_helper(self, synapses, output_file, merge_data_type):
+    def prune_synapses_helper(self, synapses, output_file, merge_data_type, synapse_writer=None):
 
         """
         Helper function to prunes synapses. It takes a subset of the synapse matrix as input, as it needs to keep
@@ -1935,222 +2078,273 @@ class SnuddaPrune(object):
             synapses: subset of synapse matrix that fits in memory
             output_file: where to write synapses, assumed to already exist
             merge_data_type : "synapses" or "gap_junctions"
+            synapse_writer : SynapseWriter for output_file, if None the synapses are written directly
 
         """
-        # Tried to use numba, but dictionaries and h5py._hl.files.File not supported
-
         h5_syn_mat, h5_hyp_syn_n, h5_syn_n, h5_syn_loc = self.data_loc[merge_data_type]
 
-        keep_row_flag = np.zeros((synapses.shape[0],), dtype=bool)
+        keep_row_flag = self.get_keep_row_flag(synapses=synapses, merge_data_type=merge_data_type)
+        n_keep_tot = np.count_nonzero(keep_row_flag)
 
-        next_read_pos = 0
-        read_end_of_range = synapses.shape[0]
+        if synapse_writer is None:
+            writer = SynapseWriter(dataset=output_file[h5_syn_mat],
+                                   start_pos=output_file[f"network/{h5_syn_n}"][()],
+                                   max_rows=n_keep_tot,
+                                   buffer_size=self.synapse_buffer_size,
+                                   counter=output_file[f"network/{h5_syn_n}"])
+        else:
+            writer = synapse_writer
 
-        # Random seeds for reproducability
-        neuron_seeds = self.get_neuron_random_seeds()
-        previous_post_synaptic_neuron_id = None
-        post_rng = None
+        # Write is buffered, the synapses end up in the file when the writer is flushed or closed
+        writer.write(synapses[keep_row_flag, :])
 
-        old_pos = -1
+        if synapse_writer is None:
+            writer.close()
 
-        cluster_voxel_distance = self.cluster_distance / self.voxel_size
+        return n_keep_tot
 
-        while next_read_pos < read_end_of_range:
+    ############################################################################
 
-            assert old_pos != next_read_pos, "prune_synapses_helper: Stuck in a loop."
-            old_pos = next_read_pos
+    def get_keep_row_flag(self, synapses, merge_data_type):
 
-            # How many lines contain synapses between this pair of neurons
-            read_end_idx = next_read_pos + 1
+        """
+        Prunes synapses, all neuron pairs in the subset at once.
 
-            if merge_data_type == "gap_junctions":
-                while (read_end_idx < read_end_of_range and
-                       (synapses[next_read_pos, 0:2] == synapses[read_end_idx, 0:2]).all()):
-                    read_end_idx += 1
-            else:
-                while (read_end_idx < read_end_of_range and
-                       (synapses[next_read_pos, 0:2] == synapses[read_end_idx, 0:2]).all()  # Same neuron pair
-                       and synapses[next_read_pos, 6] == synapses[read_end_idx, 6]):  # Same synapse type
-                    read_end_idx += 1
+        The synapses are split into groups (all synapses between a neuron pair, of the same synapse type)
+        using np.diff on the sort key. The pruning rules (a3, f1, dist_pruning, soft_max, mu2) are evaluated for
+        all groups at once using segment reductions, and dist_pruning is evaluated once per expression.
+        The random numbers are drawn from a generator per post synaptic neuron (seeded by
+        get_neuron_random_seeds), n_pair_synapses*3 + 2 numbers per neuron pair in order.
 
-                if self.all_neuron_pair_synapses_share_parameter_id:
-                    # Make all synapses between a particular pair of neurons have the same parameter ID
-                    synapses[next_read_pos:read_end_idx, 12] = synapses[next_read_pos, 12]
+        Args:
+            synapses: subset of synapse matrix, all synapses onto a neuron must be included
+            merge_data_type : "synapses" or "gap_junctions"
 
-            # Temp check
-            assert ((synapses[next_read_pos:read_end_idx, 0] == synapses[next_read_pos, 0]).all()
-                    and (synapses[next_read_pos:read_end_idx, 1] == synapses[next_read_pos, 1]).all()), \
-                "prune_synapses_helper: Internal error, more than one neuron pair"
+        Returns:
+            keep_row_flag : Boolean array, True for the synapses that are kept
+        """
 
-            n_pair_synapses = read_end_idx - next_read_pos
+        num_rows = synapses.shape[0]
+        keep_row_flag = np.zeros((num_rows,), dtype=bool)
 
-            src_id = synapses[next_read_pos, 0]
-            dest_id = synapses[next_read_pos, 1]
+        if num_rows == 0:
+            return keep_row_flag
 
-            if dest_id != previous_post_synaptic_neuron_id:
-                # New post synaptic cell, reseed random generator
-                post_rng = np.random.default_rng(neuron_seeds[dest_id])
-                previous_post_synaptic_neuron_id = dest_id
+        # Find groups, all synapses between a pair of neurons (of same synapse type) are consecutive rows
+        if merge_data_type == "gap_junctions":
+            key_columns = [0, 1]
+        else:
+            key_columns = [0, 1, 6]
 
-            if merge_data_type == "gap_junctions":
-                # All are gap junctions
-                synapse_type = 3
-            else:
-                synapse_type = synapses[next_read_pos, 6]
+        new_group_flag = np.any(np.diff(synapses[:, key_columns], axis=0) != 0, axis=1)
+        group_start = np.concatenate(([0], np.flatnonzero(new_group_flag) + 1))
+        group_size = np.diff(np.concatenate((group_start, [num_rows])))
+        num_groups = group_start.shape[0]
 
-                assert (synapses[next_read_pos:read_end_idx, 6] == synapse_type).all(), \
-                    (f"More than one synapse type connecting "
-                     f"{self.hist_file['network/neurons/name'][synapses[next_read_pos, 0]]}  "
-                     f"(ID {synapses[next_read_pos, 0]}) and "
-                     f"{self.hist_file['network/neurons/name'][synapses[next_read_pos, 1]]} "
-                     f"(ID {synapses[next_read_pos, 1]})")
+        # Group index, and position within group, for each row
+        row_group = np.repeat(np.arange(num_groups), group_size)
+        row_pos = np.arange(num_rows) - group_start[row_group]
 
-            con_id = (self.type_id_list[src_id], self.type_id_list[dest_id], synapse_type)
+        if merge_data_type != "gap_junctions" and self.all_neuron_pair_synapses_share_parameter_id:
+            # Make all synapses between a particular pair of neurons have the same parameter ID
+            synapses[:, 12] = synapses[group_start, 12][row_group]
 
-            if con_id in self.connectivity_distributions:
+        src_id = synapses[group_start, 0]
+        dest_id = synapses[group_start, 1]
 
-                # We have the option to separate between connections within a
-                # population unit or not. If conInfo[1] != None then first
-                # tuple is connection info within a population unit, and second item
-                # is connection info between different population units
-                con_info = self.connectivity_distributions[con_id]
+        if merge_data_type == "gap_junctions":
+            # All are gap junctions
+            synapse_type = np.full((num_groups,), 3)
+        else:
+            synapse_type = synapses[group_start, 6]
+
+        # Pruning parameters, looked up once for each connection type
+        type_id_list = np.array(self.type_id_list)
+        con_key = np.stack((type_id_list[src_id], type_id_list[dest_id], synapse_type,
+                            self.population_unit_id[src_id] == self.population_unit_id[dest_id]), axis=1)
+        unique_con_key, group_con_idx = np.unique(con_key, axis=0, return_inverse=True)
+        group_con_idx = group_con_idx.reshape(-1)
+
+        num_con = unique_con_key.shape[0]
+        con_valid = np.zeros((num_con,), dtype=bool)
+        con_f1 = np.ones((num_con,))
+        con_soft_max = np.full((num_con,), np.nan)
+        con_mu2 = np.full((num_con,), np.nan)
+        con_a3 = np.full((num_con,), np.nan)
+        con_cluster_flag = np.zeros((num_con,), dtype=bool)
+        con_dist_p = [None] * num_con
+
+        for idx, (pre_type, post_type, syn_type, same_population_unit) in enumerate(unique_con_key):
+            con_id = (pre_type, post_type, syn_type)
+
+            if con_id not in self.connectivity_distributions:
+                # Not listed in connectivityDistribution, neuron pairs are pruned
+                continue
 
-                #
-                if con_info[1] is None or self.population_unit_id[src_id] == self.population_unit_id[dest_id]:
-                    # All or within population unit pruning parameters
-                    c_info = con_info[0]
-                else:
-                    # Between population unit pruning parameters
-                    c_info = con_info[1]
+            con_info = self.connectivity_distributions[con_id]
 
-                # These will always exist thanks to complete_pruning_info function
+            if con_info[1] is None or same_population_unit:
+                # All or within population unit pruning parameters
+                c_info = con_info[0]
+            else:
+                # Between population unit pruning parameters
+                c_info = con_info[1]
 
-                dist_p = c_info["dist_pruning"]  # Dist dep pruning
-                f1 = c_info["f1"]
-                soft_max = c_info["soft_max"]
-                mu2 = c_info["mu2"]
-                a3 = c_info["a3"]
+            con_valid[idx] = True
+            con_f1[idx] = c_info["f1"]
+            con_cluster_flag[idx] = c_info["cluster_pruning"]
+            con_dist_p[idx] = c_info["dist_pruning"]
 
-                # If cluster_flag is set, then the synapses furthest from their companion synapses are removed first
-                cluster_flag = c_info["cluster_pruning"]
+            for con_array, param in [(con_soft_max, "soft_max"), (con_mu2, "mu2"), (con_a3, "a3")]:
+                if c_info[param] is not None:
+                    con_array[idx] = c_info[param]
 
-            else:
-                # Not listed in connectivityDistribution, skip neuron pair
-                next_read_pos = read_end_idx
-                # No need to update keepRowFlag since default set to 0
+            assert con_dist_p[idx] is None or syn_type != 3, \
+                "Distance dependent pruning currently only supported for synapses, not gap junctions"
 
-                continue
+        group_valid = con_valid[group_con_idx]
 
-            # Lets get all cell pairs random numbers in one go, total: n_pair_synapses*3 + 2
-            # f1        :n_pair_synapses
-            # p         n_pair_synapses:2*n_pair_synapses
-            # soft_max  2*n_pair_synapses:3*n_pair_synapses
-            # a3       -1
-            # p_mu     -2
+        # Each neuron pair uses n_pair_synapses*3 + 2 random numbers (f1, p, soft_max, p_mu, a3), the random
+        # numbers are drawn from the generator of the post synaptic neuron, the generator is reseeded
+        # whenever the post synaptic neuron changes
+        num_random = np.where(group_valid, 3 * group_size + 2, 0)
+        group_random_start = np.concatenate(([0], np.cumsum(num_random)[:-1]))
+        random_pool = np.zeros((np.sum(num_random),))
 
-            random_pool = post_rng.random(n_pair_synapses * 3 + 2)
+        dest_start = np.concatenate(([0], np.flatnonzero(np.diff(dest_id) != 0) + 1, [num_groups]))
+        neuron_seeds = self.get_neuron_random_seeds()
 
-            # 3. This is the last step of pruning, but we move it to the top
-            # since there is no point doing the other steps if we going to
-            # throw them away anyway
+        for start_group, end_group in zip(dest_start[:-1], dest_start[1:]):
+            n_rand = np.sum(num_random[start_group:end_group])
 
-            if a3 is not None and random_pool[-1] > a3:
-                # Prune all synapses between pair, do not add to synapse file
-                next_read_pos = read_end_idx
-                # No need to update keepRowFlag since default set to 0
+            if n_rand > 0:
+                pool_start = group_random_start[start_group]
+                post_rng = np.random.default_rng(neuron_seeds[dest_id[start_group]])
+                random_pool[pool_start:pool_start + n_rand] = post_rng.random(n_rand)
 
-                continue
+        # Only rows (and groups) with pruning info have random numbers
+        row_valid = group_valid[row_group]
+        row_random_idx = np.where(row_valid, group_random_start[row_group] + row_pos, 0)
+        row_size = np.where(row_valid, group_size[row_group], 0)
+        group_random_end = np.where(group_valid, group_random_start + num_random, 2)
 
-            if dist_p is not None:
-                assert synapse_type != 3, \
-                    "Distance dependent pruning currently only supported for synapses, not gap junctions"
-                # Distance dependent pruning, used for e.g. FS->MS connections
+        # 3. a3, prune all synapses between pair, this is done first since then the other steps can be skipped
+        a3_flag = np.logical_and(~np.isnan(con_a3[group_con_idx]),
+                                 random_pool[group_random_end - 1] > con_a3[group_con_idx])
+        group_keep = np.logical_and(group_valid, ~a3_flag)
 
-                # distP contains d (variable for distance to soma)
-                d = synapses[next_read_pos:read_end_idx, 8] * 1e-6  # dendrite distance d, used in eval below
-                p = numexpr.evaluate(dist_p)
+        # f1, and distance dependent pruning (e.g. FS->MS connections)
+        keep_row_flag = np.logical_and(group_keep[row_group],
+                                       random_pool[row_random_idx] < con_f1[group_con_idx][row_group])
 
-                frac_flag = random_pool[:n_pair_synapses] < f1
-                dist_flag = random_pool[n_pair_synapses:2 * n_pair_synapses] < p
+        dist_flag = np.ones((num_rows,), dtype=bool)
+        row_con_idx = group_con_idx[row_group]
 
-                keep_row_flag[next_read_pos:read_end_idx] = np.logical_and(frac_flag, dist_flag)
+        for dist_p in set(x for x in con_dist_p if x is not None):
+            dist_con_idx = [idx for idx, x in enumerate(con_dist_p) if x == dist_p]
+            dist_rows = np.flatnonzero(np.logical_and(np.isin(row_con_idx, dist_con_idx), group_keep[row_group]))
 
-            else:
-                keep_row_flag[next_read_pos:read_end_idx] = random_pool[:n_pair_synapses] < f1
-                dist_flag = None
+            # distP contains d (variable for distance to soma)
+            d = synapses[dist_rows, 8] * 1e-6  # dendrite distance d, used in eval below
+            p = numexpr.evaluate(dist_p)
 
-            # Check if too many synapses, trim it down a bit
-            n_keep = np.sum(keep_row_flag[next_read_pos:read_end_idx])
+            dist_flag[dist_rows] = random_pool[row_random_idx[dist_rows] + row_size[dist_rows]] < p
 
-            if soft_max is not None and n_keep > soft_max:
-                soft_max = float(soft_max)
-                p_keep = np.divide(2 * soft_max, (1 + np.exp(-(n_keep - soft_max) / 5)) * n_keep)
+        keep_row_flag = np.logical_and(keep_row_flag, dist_flag)
+        n_keep = np.add.reduceat(keep_row_flag.astype(int), group_start)
 
-                keep_row_flag[next_read_pos:read_end_idx] = \
-                    np.logical_and(p_keep > random_pool[2 * n_pair_synapses:3 * n_pair_synapses],
-                                   keep_row_flag[next_read_pos:read_end_idx])
+        # Check if too many synapses, trim it down a bit
+        group_soft_max = con_soft_max[group_con_idx]
+        soft_max_idx = np.flatnonzero(np.logical_and(group_keep, n_keep > group_soft_max))
 
-                n_keep = np.sum(keep_row_flag[next_read_pos:read_end_idx])
+        if soft_max_idx.size > 0:
+            soft_max = group_soft_max[soft_max_idx]
+            p_keep = np.ones((num_groups,))
+            p_keep[soft_max_idx] = np.divide(2 * soft_max,
+                                             (1 + np.exp(-(n_keep[soft_max_idx] - soft_max) / 5))
+                                             * n_keep[soft_max_idx])
 
-            # If too few synapses, remove all synapses
-            if mu2 is not None:
-                # Markram et al, Cell 2015
-                p_mu = 1.0 / (1.0 + np.exp(-8.0 / mu2 * (n_keep - mu2)))
+            soft_max_rows = np.isin(row_group, soft_max_idx)
+            keep_row_flag[soft_max_rows] = np.logical_and(
+                p_keep[row_group[soft_max_rows]]
+                > random_pool[row_random_idx[soft_max_rows] + 2 * row_size[soft_max_rows]],
+                keep_row_flag[soft_max_rows])
 
-                if p_mu < random_pool[-2]:
-                    # Too few synapses, remove all -- need to update keepRowFlag
-                    keep_row_flag[next_read_pos:read_end_idx] = 0
-                    next_read_pos = read_end_idx
+            n_keep = np.add.reduceat(keep_row_flag.astype(int), group_start)
 
-                    continue
+        # If too few synapses, remove all synapses
+        group_mu2 = con_mu2[group_con_idx]
+        mu2_idx = np.flatnonzero(np.logical_and(group_keep, ~np.isnan(group_mu2)))
 
-            # This code remaps which synapses are kept, such that synapses in a cluster are more likely to be kept
-            if cluster_flag and n_keep > 0:
-                # The rows that passed distance dependent pruning are: dist_flag
+        if mu2_idx.size > 0:
+            # Markram et al, Cell 2015
+            p_mu = 1.0 / (1.0 + np.exp(-8.0 / group_mu2[mu2_idx] * (n_keep[mu2_idx] - group_mu2[mu2_idx])))
+            group_keep[mu2_idx[p_mu < random_pool[group_random_end[mu2_idx] - 2]]] = False
 
-                # 1. Calculate distance between all synapses, smallest total distance (sum to all neighbours) kept
-                synapse_coords = synapses[next_read_pos:read_end_idx, 2:5]
+        keep_row_flag = np.logical_and(keep_row_flag, group_keep[row_group])
 
-                if dist_flag is not None:
-                    # If dist_flag is set, we need to pick a subset from the ones that passed distance dependent pruning
-                    synapse_coords = synapse_coords[dist_flag, :]
-                    lookup_idx = np.where(dist_flag)[0]
-                else:
-                    lookup_idx = None
+        # This code remaps which synapses are kept, such that synapses in a cluster are more likely to be kept
+        cluster_idx = np.flatnonzero(np.logical_and.reduce((group_keep, n_keep > 0,
+                                                            con_cluster_flag[group_con_idx])))
+
+        cluster_voxel_distance = self.cluster_distance / self.voxel_size
+
+        for group_id in cluster_idx:
+            start_idx = group_start[group_id]
+            end_idx = start_idx + group_size[group_id]
+
+            if con_dist_p[group_con_idx[group_id]] is not None:
+                group_dist_flag = dist_flag[start_idx:end_idx]
+            else:
+                group_dist_flag = None
 
-                # pdist faster, but does not give full distance matrix
-                synapse_dist = scipy.spatial.distance.cdist(synapse_coords, synapse_coords)
-                # synapse_tot_dist = np.sum(synapse_dist, axis=0)
-                # synapse_priority = np.argsort(synapse_tot_dist)
-                synapse_cluster_size = np.sum(synapse_dist < cluster_voxel_distance, axis=0)
-                synapse_priority = np.argsort(-synapse_cluster_size)
+            keep_idx = self.get_cluster_keep_idx(synapse_coords=synapses[start_idx:end_idx, 2:5],
+                                                 dist_flag=group_dist_flag, n_keep=n_keep[group_id],
+                                                 cluster_voxel_distance=cluster_voxel_distance)
 
-                keep_idx = synapse_priority[:n_keep]
-                if dist_flag is not None:
-                    keep_idx = lookup_idx[keep_idx]
+            keep_row_flag[start_idx:end_idx] = 0
+            keep_row_flag[start_idx + keep_idx] = 1
 
-                keep_row_flag[next_read_pos:read_end_idx] = 0
-                keep_row_flag[next_read_pos + keep_idx] = 1
+        return keep_row_flag
 
-            next_read_pos = read_end_idx
+    ############################################################################
 
-        # Time to write synapses to file
-        n_keep_tot = sum(keep_row_flag)
-        write_start_pos = int(output_file[f"network/{h5_syn_n}"][()])
-        write_end_pos = write_start_pos + n_keep_tot
+    @staticmethod
+    def get_cluster_keep_idx(synapse_coords, dist_flag, n_keep, cluster_voxel_distance):
 
-        if n_keep_tot > 0:
-            output_file[h5_syn_mat].resize((write_end_pos, output_file[h5_syn_mat].shape[1]))
-            output_file[h5_syn_mat][write_start_pos:write_end_pos] = synapses[keep_row_flag, :]
+        """
+        Picks which synapses between a neuron pair to keep, synapses in a cluster are more likely to be kept.
+
+        Args:
+            synapse_coords : Voxel coordinates of synapses between neuron pair
+            dist_flag : Synapses that passed distance dependent pruning (or None), only these can be kept
+            n_keep : Number of synapses to keep
+            cluster_voxel_distance : Max distance (in voxels) between synapses in a cluster
 
-            # Update counters
-            output_file[f"network/{h5_syn_n}"][()] = write_end_pos
+        Returns:
+            keep_idx : Index of synapses to keep
+        """
 
+        # 1. Calculate distance between all synapses, smallest total distance (sum to all neighbours) kept
+        if dist_flag is not None:
+            # If dist_flag is set, we need to pick a subset from the ones that passed distance dependent pruning
+            synapse_coords = synapse_coords[dist_flag, :]
+            lookup_idx = np.where(dist_flag)[0]
         else:
-            self.write_log("No synapses kept, resizing")
-            output_file[h5_syn_mat].resize((write_end_pos, output_file[h5_syn_mat].shape[1]))
+            lookup_idx = None
 
-        return n_keep_tot
+        # pdist faster, but does not give full distance matrix
+        synapse_dist = scipy.spatial.distance.cdist(synapse_coords, synapse_coords)
+        # synapse_tot_dist = np.sum(synapse_dist, axis=0)
+        # synapse_priority = np.argsort(synapse_tot_dist)
+        synapse_cluster_size = np.sum(synapse_dist < cluster_voxel_distance, axis=0)
+        synapse_priority = np.argsort(-synapse_cluster_size)
+
+        keep_idx = synapse_priority[:n_keep]
+        if dist_flag is not None:
+            keep_idx = lookup_idx[keep_idx]
+
+        return keep_idx
 
     ############################################################################
 
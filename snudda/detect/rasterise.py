@@ -0,0 +1,442 @@
+import numpy as np
+from numba import jit
+
+
+class SegmentTable:
+
+    """
+    Flattened table of morphology sections, for several neurons. All sections added are rasterised
+    in one compiled pass by rasterise_segment_table, instead of one helper call per section.
+
+    The points of the sections are stored consecutively, section i has points
+    section_start[i] to section_start[i+1]-1. Each section also has a neuron_id, sec_id and an order key,
+    the order key is copied to the voxel items so that items from several tables can be merged in order.
+    """
+
+    def __init__(self):
+
+        self.geometry = []
+        self.section_x = []
+        self.num_points = []
+        self.neuron_id = []
+        self.sec_id = []
+        self.order = []
+
+        # Section layouts, keyed on (id(section_data), section_type), clones of a morphology share section_data
+        self.layout_cache = dict()
+
+    def add_sections(self, morphology_data, section_type, section_id=None, neuron_id=0, order=0):
+
+        """
+        Adds sections to table.
+
+        Args:
+            morphology_data : MorphologyData the sections belong to
+            section_type (int) : 2 = axon, 3 = dend
+            section_id : Iterable of section IDs to add, in order (default all sections of section_type)
+            neuron_id (int) : ID of neuron the sections belong to
+            order (int) : Order key for the voxel items from these sections
+        """
+
+        if section_id is None:
+            section_id = list(morphology_data.sections[section_type].keys())
+
+        section_id = np.asarray(section_id, dtype=np.int64).reshape(-1)
+
+        if section_id.size == 0:
+            return
+
+        cache_key = (id(morphology_data.section_data), section_type)
+
+        if cache_key not in self.layout_cache:
+            layout = self.get_section_layout(morphology_data.section_data, section_type)
+
+            # Section IDs within a section type are 0, 1, 2, ...
+            lookup = np.full((np.max(layout[0], initial=-1) + 1,), -1, dtype=np.int64)
+            lookup[layout[0]] = np.arange(layout[0].shape[0])
+
+            # section_data is kept in the cache, so that its id is not reused
+            self.layout_cache[cache_key] = (morphology_data.section_data, lookup, layout)
+
+        _, lookup, (_, layout_start, layout_num_points, layout_point_idx) = self.layout_cache[cache_key]
+
+        if (section_id < 0).any() or (section_id >= lookup.shape[0]).any() or (lookup[section_id] < 0).any():
+            raise ValueError(f"Unknown section_id for section_type {section_type} in {morphology_data.swc_file}")
+
+        section_idx = lookup[section_id]
+        num_points = layout_num_points[section_idx]
+        section_start = np.concatenate(([0], np.cumsum(num_points)[:-1]))
+
+        # Gather the points of the selected sections, in order
+        all_point_idx = layout_point_idx[np.repeat(layout_start[section_idx] - section_start, num_points)
+                                         + np.arange(np.sum(num_points))]
+
+        section_x = morphology_data.section_data[all_point_idx, 1] * 1e-3  # Stored as section_x*1000 (since int)
+        section_x[section_start] = 0
+
+        self.geometry.append(morphology_data.geometry[all_point_idx, :])
+        self.section_x.append(section_x)
+        self.num_points.extend(num_points)
+        self.neuron_id.extend([neuron_id] * len(section_id))
+
+        # Use section id from last point for section as first point has parent's section id
+        self.sec_id.extend(morphology_data.section_data[all_point_idx[section_start + num_points - 1], 0])
+        self.order.extend([order] * len(section_id))
+
+    @staticmethod
+    def get_section_layout(section_data, section_type):
+
+        """
+        Returns the points of all sections of section_type, the same points as SectionMetaData.point_idx,
+        computed without iterating over the sections. The first point of a section is its parent point,
+        unless the parent is of another type (e.g. soma).
+
+        Args:
+            section_data : MorphologyData.section_data (section_id, section_x, section_type, parent_point_id)
+            section_type (int) : Section type
+
+        Returns:
+            section_id, start, num_points, point_idx : Section section_id[i] has points
+                                                       point_idx[start[i]:start[i]+num_points[i]]
+        """
+
+        type_idx = np.flatnonzero(section_data[:, 2] == section_type)
+
+        if type_idx.size == 0:
+            empty_int = np.zeros((0,), dtype=np.int64)
+            return empty_int, empty_int, empty_int, empty_int
+
+        # The points of a section are consecutive
+        group_start = np.flatnonzero(np.concatenate(([True], np.diff(section_data[type_idx, 0]) != 0)))
+        group_end = np.append(group_start[1:], type_idx.size)
+
+        first_point = type_idx[group_start]
+        parent_point = section_data[first_point, 3]
+        has_parent = parent_point >= 0
+        has_parent[has_parent] = section_data[parent_point[has_parent], 2] == section_type
+
+        point_idx = np.insert(type_idx, group_start[has_parent], parent_point[has_parent])
+        num_points = group_end - group_start + has_parent
+        start = np.concatenate(([0], np.cumsum(num_points)[:-1]))
+
+        return section_data[first_point, 0].astype(np.int64), start, num_points, point_idx
+
+    def rasterise(self, hyper_voxel_origo, voxel_size, num_bins, step_multiplier, method="step"):
+
+        """
+        Rasterises all sections in the table.
+
+        Args:
+            hyper_voxel_origo : Origo of hyper voxel
+            voxel_size : Width of voxel
+            num_bins : Number of voxels along each side of the hyper voxel
+            step_multiplier : Steps per voxel width along segment (only used by method "step")
+            method : "step" (sample the segments, same as fill_voxels_dend_helper)
+                     or "dda" (3-D DDA, marks each voxel the segments pass through exactly once)
+
+        Returns:
+            vx, vy, vz, neuron_id, sec_id, sec_x, soma_dist, order : arrays, one value per voxel item
+        """
+
+        if method not in ["step", "dda"]:
+            raise ValueError(f"Unknown rasterise method {method}, must be 'step' or 'dda'")
+
+        if len(self.num_points) == 0:
+            empty_int = np.zeros((0,), dtype=np.int64)
+            return (empty_int, empty_int, empty_int, empty_int, empty_int,
+                    np.zeros((0,), dtype=np.float64), empty_int, empty_int)
+
+        section_start = np.concatenate(([0], np.cumsum(self.num_points))).astype(np.int64)
+
+        vx, vy, vz, item_section, sec_x, soma_dist = \
+            rasterise_segment_table(geometry=np.concatenate(self.geometry),
+                                    section_x=np.concatenate(self.section_x),
+                                    section_start=section_start,
+                                    section_neuron_id=np.array(self.neuron_id, dtype=np.int64),
+                                    hyper_voxel_origo=hyper_voxel_origo,
+                                    voxel_size=voxel_size,
+                                    num_bins=num_bins,
+                                    step_multiplier=step_multiplier,
+                                    use_dda=(method == "dda"))
+
+        neuron_id = np.array(self.neuron_id, dtype=np.int64)[item_section]
+        sec_id = np.array(self.sec_id, dtype=np.int64)[item_section]
+        order = np.array(self.order, dtype=np.int64)[item_section]
+
+        return vx, vy, vz, neuron_id, sec_id, sec_x, soma_dist, order
+
+
+# Only "contract" (fused multiply-add) of the fastmath flags, so the stepping gives bit identical section x
+# and voxels to the old vectorised per section helper (the other fastmath flags change rounding)
+@jit(nopython=True, fastmath={"contract"}, cache=True)
+def rasterise_segment_table(geometry, section_x, section_start, section_neuron_id,
+                            hyper_voxel_origo, voxel_size, num_bins, step_multiplier, use_dda):
+
+    """
+    Rasterises all sections in a flattened segment table in one pass, and returns the voxels within the
+    hyper voxel the sections pass through (in order), together with section index, section x and
+    soma distance (micrometers) for each voxel item. Consecutive points in a section form a line segment.
+
+    With use_dda=False each segment is sampled at ceil(length * step_multiplier) + 1 evenly spaced points,
+    giving the same voxels as the old per section stepping (a voxel can appear repeatedly). Only segments
+    with an end point within the hyper voxel, including a padding of one voxel, are rasterised.
+
+    With use_dda=True the segments are clipped to the hyper voxel and traversed using a 3-D DDA
+    (Amanatides & Woo, 1987), which marks every voxel a segment passes through exactly once.
+    Section x and soma distance are evaluated at the middle of the part of the segment inside the voxel.
+
+    Args:
+        geometry : Section points (x, y, z, r, soma_dist), section i is section_start[i]:section_start[i+1]
+        section_x : Section x of each point
+        section_start : Index of first point of each section, last element is total number of points
+        section_neuron_id : Neuron ID of each section (used in error message)
+        hyper_voxel_origo : Origo of hyper voxel
+        voxel_size : Width of voxel
+        num_bins : Number of voxels along each side of the hyper voxel
+        step_multiplier : Steps per voxel width along segment (use_dda=False)
+        use_dda : Use 3-D DDA traversal
+
+    Returns:
+        vp_x, vp_y, vp_z, item_section, s_x, soma_dist
+    """
+
+    num_sections = section_start.shape[0] - 1
+    num_points = geometry.shape[0]
+
+    # We use padding to include line segments where both points are outside, but their
+    # line intersect the hypervoxel.
+    padding = 1
+
+    voxel_coords = np.zeros((num_points, 3))
+    point_inside = np.zeros((num_points,), dtype=np.bool_)
+    for p in range(0, num_points):
+        inside = True
+        for dim in range(0, 3):
+            voxel_coords[p, dim] = (geometry[p, dim] - hyper_voxel_origo[dim]) / voxel_size
+            if not (-padding <= voxel_coords[p, dim] < num_bins[dim] + padding):
+                inside = False
+        point_inside[p] = inside
+
+    # Number of steps for each segment (index of first point), and upper bound on number of items
+    num_steps = np.zeros((num_points,), dtype=np.int64)
+    max_items = 0
+
+    for sec_idx in range(0, num_sections):
+        for p in range(section_start[sec_idx], section_start[sec_idx + 1] - 1):
+            dx = voxel_coords[p + 1, 0] - voxel_coords[p, 0]
+            dy = voxel_coords[p + 1, 1] - voxel_coords[p, 1]
+            dz = voxel_coords[p + 1, 2] - voxel_coords[p, 2]
+            num_steps[p] = np.int64(np.ceil(np.sqrt(dx ** 2 + dy ** 2 + dz ** 2) * step_multiplier))
+
+            # Remove this check later... should be done in morphology_data
+            if num_steps[p] <= 0:
+                print(f"Found zero length segment in neuron_id {section_neuron_id[sec_idx]}")
+                # Numba does not allow variables in exceptions...
+                raise ValueError(f"Found zero length segment (please check morphologies).")
+
+            if use_dda:
+                max_items += np.int64(np.abs(dx) + np.abs(dy) + np.abs(dz)) + 4
+            elif point_inside[p] or point_inside[p + 1]:
+                max_items += num_steps[p] + 1
+
+    vp_x = np.zeros((max_items,), dtype=np.int64)
+    vp_y = np.zeros((max_items,), dtype=np.int64)
+    vp_z = np.zeros((max_items,), dtype=np.int64)
+    item_section = np.zeros((max_items,), dtype=np.int64)
+    s_x = np.zeros((max_items,), dtype=np.float64)
+    soma_dist = np.zeros((max_items,), dtype=np.int64)
+    item_ctr = 0
+
+    p_start = np.zeros((3,))
+    p_delta = np.zeros((3,))
+    voxel = np.zeros((3,), dtype=np.int64)
+    voxel_step = np.zeros((3,), dtype=np.int64)
+    t_next = np.zeros((3,))
+    t_delta = np.zeros((3,))
+
+    for sec_idx in range(0, num_sections):
+        for p in range(section_start[sec_idx], section_start[sec_idx + 1] - 1):
+
+            scaled_soma_dist = geometry[p, 4] * 1e6  # Dist to soma
+            dd = geometry[p + 1, 4] * 1e6 - scaled_soma_dist
+            ds = section_x[p + 1] - section_x[p]
+
+            if not use_dda:
+
+                if not (point_inside[p] or point_inside[p + 1]):
+                    continue
+
+                n_steps = num_steps[p]
+                dv_x = (voxel_coords[p + 1, 0] - voxel_coords[p, 0]) / n_steps
+                dv_y = (voxel_coords[p + 1, 1] - voxel_coords[p, 1]) / n_steps
+                dv_z = (voxel_coords[p + 1, 2] - voxel_coords[p, 2]) / n_steps
+                ds_step = ds / n_steps
+                dd_step = dd / n_steps
+
+                for step in range(0, n_steps + 1):
+                    # OBS! np.floor below is crucial -- np.floor(-0.2) = -1, vs int(-0.2) = 0
+                    x = np.int64(np.floor(voxel_coords[p, 0] + dv_x * step))
+                    y = np.int64(np.floor(voxel_coords[p, 1] + dv_y * step))
+                    z = np.int64(np.floor(voxel_coords[p, 2] + dv_z * step))
+
+                    # max_items counts every step, so no need to check for space here
+                    if 0 <= x < num_bins[0] and 0 <= y < num_bins[1] and 0 <= z < num_bins[2]:
+                        vp_x[item_ctr] = x
+                        vp_y[item_ctr] = y
+                        vp_z[item_ctr] = z
+                        item_section[item_ctr] = sec_idx
+                        s_x[item_ctr] = section_x[p] + ds_step * step
+                        soma_dist[item_ctr] = np.int64(np.floor(scaled_soma_dist + dd_step * step))
+                        item_ctr += 1
+
+                continue
+
+            # 3-D DDA, first clip segment to hyper voxel: p_start + t * p_delta, t_min <= t <= t_max
+            t_min = 0.0
+            t_max = 1.0
+
+            for dim in range(0, 3):
+                p_start[dim] = voxel_coords[p, dim]
+                p_delta[dim] = voxel_coords[p + 1, dim] - voxel_coords[p, dim]
+
+                if p_delta[dim] == 0:
+                    if p_start[dim] < 0 or p_start[dim] >= num_bins[dim]:
+                        t_max = -1.0  # Parallel to side, and outside
+                else:
+                    t0 = (0 - p_start[dim]) / p_delta[dim]
+                    t1 = (num_bins[dim] - p_start[dim]) / p_delta[dim]
+                    t_min = max(t_min, min(t0, t1))
+                    t_max = min(t_max, max(t0, t1))
+
+            if t_min > t_max:
+                # Segment does not intersect the hyper voxel
+                continue
+
+            for dim in range(0, 3):
+                voxel[dim] = np.int64(np.floor(p_start[dim] + t_min * p_delta[dim]))
+                voxel[dim] = min(max(voxel[dim], 0), num_bins[dim] - 1)
+
+                if p_delta[dim] > 0:
+                    voxel_step[dim] = 1
+                    t_next[dim] = (voxel[dim] + 1 - p_start[dim]) / p_delta[dim]
+                    t_delta[dim] = 1 / p_delta[dim]
+                elif p_delta[dim] < 0:
+                    voxel_step[dim] = -1
+                    t_next[dim] = (voxel[dim] - p_start[dim]) / p_delta[dim]
+                    t_delta[dim] = -1 / p_delta[dim]
+                else:
+                    voxel_step[dim] = 0
+                    t_next[dim] = np.inf
+                    t_delta[dim] = np.inf
+
+            t_enter = t_min
+
+            while True:
+                # Which side of the voxel do we exit through
+                exit_dim = 0
+                if t_next[1] < t_next[exit_dim]:
+                    exit_dim = 1
+                if t_next[2] < t_next[exit_dim]:
+                    exit_dim = 2
+
+                t_exit = min(t_next[exit_dim], t_max)
+                t_mid = 0.5 * (t_enter + t_exit)
+
+                # max_items is an upper bound, but rounding in t_next could in theory give extra steps
+                if item_ctr >= vp_x.shape[0]:
+                    vp_x, vp_y, vp_z = grow_array(vp_x), grow_array(vp_y), grow_array(vp_z)
+                    item_section, s_x = grow_array(item_section), grow_array(s_x)
+                    soma_dist = grow_array(soma_dist)
+
+                vp_x[item_ctr] = voxel[0]
+                vp_y[item_ctr] = voxel[1]
+                vp_z[item_ctr] = voxel[2]
+                item_section[item_ctr] = sec_idx
+                s_x[item_ctr] = section_x[p] + ds * t_mid
+                soma_dist[item_ctr] = np.int64(np.floor(scaled_soma_dist + dd * t_mid))
+                item_ctr += 1
+
+                if t_next[exit_dim] >= t_max:
+                    break
+
+                voxel[exit_dim] += voxel_step[exit_dim]
+
+                if voxel[exit_dim] < 0 or voxel[exit_dim] >= num_bins[exit_dim]:
+                    break
+
+                t_enter = t_next[exit_dim]
+                t_next[exit_dim] += t_delta[exit_dim]
+
+    return (vp_x[:item_ctr], vp_y[:item_ctr], vp_z[:item_ctr],
+            item_section[:item_ctr], s_x[:item_ctr], soma_dist[:item_ctr])
+
+
+@jit(nopython=True, cache=True)
+def grow_array(array):
+
+    """ Returns a copy of 1-D array with twice the length (at least 16), the new elements are zero. """
+
+    new_array = np.zeros((max(2 * array.shape[0], 16),), dtype=array.dtype)
+    new_array[:array.shape[0]] = array
+    return new_array
+
+
+@jit(nopython=True, fastmath=True, cache=True)
+def rasterise_section(point_idx, geometry, section_x, neuron_id,
+                      hyper_voxel_origo, voxel_size, num_bins, step_multiplier):
+
+    """
+    Steps along the line segments of a single section, and returns the voxels within the hyper voxel
+    it passes through (in order, a voxel can appear repeatedly), together with section x and soma distance
+    (micrometers) at each step. Used by the fill_voxels_dend and fill_voxels_axon helpers.
+
+    Returns:
+        vp_x, vp_y, vp_z, s_x, soma_dist
+    """
+
+    section_start = np.array([0, len(point_idx)], dtype=np.int64)
+    section_neuron_id = np.array([neuron_id], dtype=np.int64)
+
+    vp_x, vp_y, vp_z, item_section, s_x, soma_dist = \
+        rasterise_segment_table(geometry[point_idx, :], section_x, section_start, section_neuron_id,
+                                hyper_voxel_origo, voxel_size, num_bins, step_multiplier, False)
+
+    return vp_x, vp_y, vp_z, s_x, soma_dist
+
+
+@jit(nopython=True, cache=True)
+def write_dense_voxel_items(voxel_space, voxel_space_ctr, voxel_sec_id, voxel_sec_x, voxel_soma_dist,
+                            vx, vy, vz, neuron_id, sec_id, sec_x, soma_dist):
+
+    """
+    Writes voxel items to the dense voxel matrices (n x n x n x k), an item is skipped if the last item
+    in the voxel already belongs to the same neuron. voxel_sec_id and voxel_sec_x can be None (axon voxels).
+
+    Returns:
+        voxel_overflow_counter : Number of items that did not fit
+    """
+
+    voxel_overflow_counter = 0
+    max_items = voxel_space.shape[3]
+
+    for i in range(0, vx.shape[0]):
+        x, y, z = vx[i], vy[i], vz[i]
+        v_ctr = voxel_space_ctr[x, y, z]
+
+        if v_ctr > 0 and voxel_space[x, y, z, v_ctr - 1] == neuron_id[i]:
+            # Voxel already contains neuron_id, skip
+            continue
+
+        if v_ctr < max_items:
+            voxel_space[x, y, z, v_ctr] = neuron_id[i]
+            if voxel_sec_id is not None:
+                voxel_sec_id[x, y, z, v_ctr] = sec_id[i]
+            if voxel_sec_x is not None:
+                voxel_sec_x[x, y, z, v_ctr] = sec_x[i]
+            voxel_soma_dist[x, y, z, v_ctr] = soma_dist[i]
+            voxel_space_ctr[x, y, z] += 1
+        else:
+            # Overflow, not enough space to store info
+            voxel_overflow_counter += 1
+
+    return voxel_overflow_counter
@@ -0,0 +1,188 @@
+import numpy as np
+from numba import jit
+
+
+class SparseVoxels:
+
+    """
+    Sparse voxel occupancy for a hyper voxel, alternative to the dense
+    (num_bins x num_bins x num_bins x max_items) voxel matrices used by SnuddaDetect.
+
+    Every item placed in a voxel (neuron_id, section_id, section_x, soma_dist) is appended to flat item
+    arrays, so a voxel can hold any number of items and there is no voxel overflow. Memory used scales with
+    the number of occupied voxel items, instead of with num_bins**3 * max_items. Only the per voxel counters
+    (voxel_ctr) and the ID of the last neuron added to each voxel are kept as dense num_bins**3 arrays.
+
+    When all items are added, finalise() sorts the items by voxel (stable sort, so the items within a voxel
+    keep their insertion order, same as in the dense matrices). After that the items of each voxel are
+    a contiguous range in the item arrays, see get_item_range.
+    """
+
+    def __init__(self, num_bins, capacity=100000):
+
+        """
+        Constructor.
+
+        Args:
+            num_bins (int, int, int): Number of voxels along each side of the hyper voxel
+            capacity (int): Initial number of items allocated, grows automatically when needed
+        """
+
+        self.num_bins = np.array(num_bins, dtype=int)
+
+        # How many items does each voxel hold
+        self.voxel_ctr = np.zeros(self.num_bins, dtype=np.int32)
+
+        # Neuron ID of the last item added to each voxel (-1 if empty), used to avoid duplicates
+        self.last_neuron_id = np.full(self.num_bins, -1, dtype=np.int32)
+
+        self.item_voxel = np.zeros((capacity,), dtype=np.int64)  # Linear voxel index
+        self.item_neuron_id = np.zeros((capacity,), dtype=np.int32)
+        self.item_sec_id = np.zeros((capacity,), dtype=np.int32)
+        self.item_sec_x = np.zeros((capacity,), dtype=np.float64)
+        self.item_soma_dist = np.zeros((capacity,), dtype=np.int32)
+
+        self.num_items = 0
+        self.is_finalised = False
+
+    def clear(self):
+
+        """ Removes all items, keeps the allocated memory. """
+
+        self.voxel_ctr[:] = 0
+        self.last_neuron_id[:] = -1
+        self.num_items = 0
+        self.is_finalised = False
+
+    def reserve(self, num_new_items):
+
+        """ Makes sure there is space for num_new_items additional items. """
+
+        required = self.num_items + num_new_items
+
+        if required <= self.item_voxel.shape[0]:
+            return
+
+        new_capacity = max(int(np.ceil(1.5 * self.item_voxel.shape[0])), required)
+
+        for name in ["item_voxel", "item_neuron_id", "item_sec_id", "item_sec_x", "item_soma_dist"]:
+            old_array = getattr(self, name)
+            new_array = np.zeros((new_capacity,), dtype=old_array.dtype)
+            new_array[:self.num_items] = old_array[:self.num_items]
+            setattr(self, name, new_array)
+
+    def add_items(self, vx, vy, vz, neuron_id, sec_id=0, sec_x=0.0, soma_dist=0, skip_repeats=True):
+
+        """
+        Adds items to voxels (vx, vy, vz).
+
+        Args:
+            vx, vy, vz : Voxel coordinates (within hyper voxel), must be inside the hyper voxel
+            neuron_id (int or np.array) : Neuron ID of items
+            sec_id (int or np.array) : Section ID of items
+            sec_x (float or np.array) : Section X of items (0-1)
+            soma_dist (int or np.array) : Distance to soma (micrometers)
+            skip_repeats (bool) : Skip item if the last item in the voxel already belongs to neuron_id
+        """
+
+        assert not self.is_finalised, "SparseVoxels: Can not add items after finalise"
+
+        vx = np.asarray(vx, dtype=np.int64)
+        vy = np.asarray(vy, dtype=np.int64)
+        vz = np.asarray(vz, dtype=np.int64)
+
+        num_new = vx.shape[0]
+
+        if num_new == 0:
+            return
+
+        neuron_id = np.broadcast_to(neuron_id, (num_new,)).astype(np.int64)
+        sec_id = np.broadcast_to(sec_id, (num_new,)).astype(np.int64)
+        sec_x = np.broadcast_to(sec_x, (num_new,)).astype(np.float64)
+        soma_dist = np.broadcast_to(soma_dist, (num_new,)).astype(np.int64)
+
+        self.reserve(num_new)
+
+        self.num_items = add_sparse_voxel_items_helper(voxel_ctr=self.voxel_ctr,
+                                                       last_neuron_id=self.last_neuron_id,
+                                                       item_voxel=self.item_voxel,
+                                                       item_neuron_id=self.item_neuron_id,
+                                                       item_sec_id=self.item_sec_id,
+                                                       item_sec_x=self.item_sec_x,
+                                                       item_soma_dist=self.item_soma_dist,
+                                                       num_items=self.num_items,
+                                                       vx=vx, vy=vy, vz=vz,
+                                                       neuron_id=neuron_id, sec_id=sec_id,
+                                                       sec_x=sec_x, soma_dist=soma_dist,
+                                                       skip_repeats=skip_repeats)
+
+    def finalise(self):
+
+        """ Sorts items by voxel, needs to be called before get_item_range and get_items. """
+
+        if self.is_finalised:
+            return
+
+        n = self.num_items
+        sort_idx = np.argsort(self.item_voxel[:n], kind="stable")
+
+        for item_array in [self.item_voxel, self.item_neuron_id, self.item_sec_id,
+                           self.item_sec_x, self.item_soma_dist]:
+            item_array[:n] = item_array[:n][sort_idx]
+
+        self.is_finalised = True
+
+    def get_item_range(self, vx, vy, vz):
+
+        """
+        Returns start index and number of items for voxels (vx, vy, vz), the items of
+        voxel i are item_neuron_id[start[i]:start[i]+ctr[i]] etc.
+        """
+
+        assert self.is_finalised, "SparseVoxels: finalise must be called before get_item_range"
+
+        linear_idx = np.ravel_multi_index((vx, vy, vz), self.num_bins)
+        start = np.searchsorted(self.item_voxel[:self.num_items], linear_idx)
+        ctr = self.voxel_ctr[vx, vy, vz]
+
+        return start, ctr
+
+    def get_items(self, vx, vy, vz):
+
+        """ Returns neuron_id, sec_id, sec_x, soma_dist for all items in voxel (vx, vy, vz). """
+
+        start, ctr = self.get_item_range(vx, vy, vz)
+        item_range = slice(start, start + ctr)
+
+        return (self.item_neuron_id[item_range], self.item_sec_id[item_range],
+                self.item_sec_x[item_range], self.item_soma_dist[item_range])
+
+
+@jit(nopython=True, cache=True)
+def add_sparse_voxel_items_helper(voxel_ctr, last_neuron_id,
+                                  item_voxel, item_neuron_id, item_sec_id, item_sec_x, item_soma_dist,
+                                  num_items, vx, vy, vz, neuron_id, sec_id, sec_x, soma_dist, skip_repeats):
+
+    """ Helper function for SparseVoxels.add_items, item arrays must have space for all new items. """
+
+    num_bins_y = voxel_ctr.shape[1]
+    num_bins_z = voxel_ctr.shape[2]
+
+    for i in range(0, vx.shape[0]):
+        x, y, z = vx[i], vy[i], vz[i]
+
+        if skip_repeats and last_neuron_id[x, y, z] == neuron_id[i]:
+            # Voxel already contains neuron_id, skip
+            continue
+
+        item_voxel[num_items] = (x * num_bins_y + y) * num_bins_z + z
+        item_neuron_id[num_items] = neuron_id[i]
+        item_sec_id[num_items] = sec_id[i]
+        item_sec_x[num_items] = sec_x[i]
+        item_soma_dist[num_items] = soma_dist[i]
+
+        voxel_ctr[x, y, z] += 1
+        last_neuron_id[x, y, z] = neuron_id[i]
+        num_items += 1
+
+    return num_items
@@ -0,0 +1,135 @@
+import numpy as np
+
+
+class SynapseWriter:
+
+    """
+    Buffered, append only writer for synapse (or gap junction) matrices in HDF5 files.
+
+    Rows are collected in a write buffer, and written to the dataset when the buffer is full. The buffer
+    ends on a chunk boundary of the dataset, so every write (except the first and the last) covers whole
+    HDF5 chunks. Writes larger than the buffer skip it and go directly to file.
+
+    The dataset can be preallocated from a known upper bound on the number of rows (max_rows), so it does
+    not have to be resized for every write. At close() the dataset is trimmed to the rows written, and
+    the counter dataset (e.g. network/num_synapses) is updated.
+    """
+
+    def __init__(self, dataset, start_pos=0, max_rows=None, buffer_size=100000, counter=None):
+
+        """
+        Constructor.
+
+        Args:
+            dataset : HDF5 dataset to write to
+            start_pos (int) : Row to start writing at (e.g. number of rows already in dataset)
+            max_rows (int) : Upper bound on number of rows to write, dataset is preallocated to fit them
+            buffer_size (int) : Number of rows in write buffer (flush size), rounded up to whole chunks
+            counter : HDF5 dataset (scalar), set to number of rows in dataset at close (optional)
+        """
+
+        self.dataset = dataset
+        self.counter = counter
+        self.start_pos = int(start_pos)
+        self.file_pos = int(start_pos)
+
+        if dataset.chunks is not None and buffer_size >= dataset.chunks[0]:
+            self.chunk_rows = dataset.chunks[0]
+        else:
+            self.chunk_rows = 1
+
+        self.buffer_size = int(np.ceil(max(1, buffer_size) / self.chunk_rows)) * self.chunk_rows
+        self.buffer = None
+        self.buffer_pos = 0
+
+        if max_rows is not None:
+            self.reserve(self.start_pos + max_rows)
+
+    ############################################################################
+
+    def reserve(self, num_rows):
+
+        """ Makes sure the dataset has at least num_rows rows, resizes it if needed. """
+
+        if self.dataset.shape[0] < num_rows:
+            self.dataset.resize((num_rows, self.dataset.shape[1]))
+
+    ############################################################################
+
+    def get_flush_pos(self):
+
+        """ Returns file position where the buffer ends, which is on a chunk boundary. """
+
+        return (self.file_pos // self.chunk_rows) * self.chunk_rows + self.buffer_size
+
+    ############################################################################
+
+    def write(self, synapses):
+
+        """
+        Appends synapses to dataset.
+
+        Args:
+            synapses : Synapse matrix rows to write
+        """
+
+        num_rows = synapses.shape[0]
+        idx = 0
+
+        while idx < num_rows:
+            capacity = self.get_flush_pos() - self.file_pos - self.buffer_pos
+
+            if self.buffer_pos == 0 and num_rows - idx >= capacity:
+                # Buffer empty, and the data fills it, write whole chunks directly to file
+                n = capacity + ((num_rows - idx - capacity) // self.chunk_rows) * self.chunk_rows
+                self.reserve(self.file_pos + n)
+                self.dataset[self.file_pos:self.file_pos + n, :] = synapses[idx:idx + n, :]
+                self.file_pos += n
+
+            else:
+                if self.buffer is None:
+                    self.buffer = np.zeros((self.buffer_size, self.dataset.shape[1]), dtype=self.dataset.dtype)
+
+                n = min(capacity, num_rows - idx)
+                self.buffer[self.buffer_pos:self.buffer_pos + n, :] = synapses[idx:idx + n, :]
+                self.buffer_pos += n
+
+                if n == capacity:
+                    self.flush()
+
+            idx += n
+
+    ############################################################################
+
+    def flush(self):
+
+        """ Writes the content of the buffer to file. """
+
+        if self.buffer_pos > 0:
+            end_pos = self.file_pos + self.buffer_pos
+            self.reserve(end_pos)
+            self.dataset[self.file_pos:end_pos, :] = self.buffer[:self.buffer_pos, :]
+            self.file_pos = end_pos
+            self.buffer_pos = 0
+
+    ############################################################################
+
+    def close(self):
+
+        """
+        Flushes buffer, trims dataset to the rows written, and updates the counter.
+
+        Returns:
+            num_rows (int) : Number of rows written by this writer
+        """
+
+        self.flush()
+        self.buffer = None
+
+        if self.dataset.shape[0] != self.file_pos:
+            self.dataset.resize((self.file_pos, self.dataset.shape[1]))
+
+        if self.counter is not None:
+            self.counter[()] = self.file_pos
+
+        return self.file_pos - self.start_pos
@@ -25,6 +25,7 @@ import numexpr
 import re
 import numpy as np
 import copy
+import itertools
 
 from snudda.neurons import NeuronMorphologyExtended
 from snudda.utils.snudda_path import get_snudda_data
@@ -32,6 +33,7 @@ from snudda.input.time_varying_input import TimeVaryingInput
 from snudda.neurons.neuron_prototype import NeuronPrototype
 from snudda.utils.load import SnuddaLoad
 from snudda.utils.snudda_path import snudda_parse_path
+from snudda.utils.input_spikes import get_input_spike_trains
 
 nl = None
 
@@ -57,7 +59,10 @@ class SnuddaInput(object):
                  time_interval_overlap_warning=True,
                  logfile=None,
                  verbose=False,
-                 use_meta_input=True):
+                 use_meta_input=True,
+                 spike_format="dense",
+                 stream_output=False,
+                 stream_chunk_size=1000):
 
         """
         Constructor.
@@ -76,6 +81,13 @@ class SnuddaInput(object):
             time_interval_overlap_warning (bool): Warn if input intervals specified overlap
             logfile (str): Log file
             verbose (bool): Print logging
+            use_meta_input (bool): Use meta.json input information
+            spike_format (str): Layout of spikes in the output file, "dense" (padded spike matrix) or
+                                "csr" (concatenated spike times with offsets), see snudda.utils.input_spikes
+            stream_output (bool): Write the input for each neuron to file as soon as it is generated, and then free
+                                  it, to bound the memory used by the master process. The spikes are then not kept
+                                  in self.neuron_input after generate.
+            stream_chunk_size (int): When streaming in parallel, maximal number of inputs queued on the workers at a time
         """
 
         if type(logfile) == str:
@@ -146,6 +158,12 @@ class SnuddaInput(object):
 
         self.use_meta_input = use_meta_input
 
+        assert spike_format in ["dense", "csr"], f"Unknown spike_format {spike_format}, use 'dense' or 'csr'"
+        self.spike_format = spike_format
+
+        self.stream_output = stream_output
+        self.stream_chunk_size = stream_chunk_size
+
         self.neuron_id = []
         self.neuron_name = []
         self.neuron_type = []
@@ -169,6 +187,9 @@ class SnuddaInput(object):
 
         self.neuron_cache = dict([])
 
+        # Bend morphologies are unique per neuron, only the most recently used one is kept
+        self.bend_morphology_cache = None
+
         self.is_master = is_master
 
     def load_network(self, hdf5_network_file=None):
@@ -212,15 +233,19 @@ class SnuddaInput(object):
             # Generate the actual input spikes, and the locations
             # stored in self.neuronInput dictionary
 
-            self.make_neuron_input_parallel()
+            if self.stream_output:
+                # Spikes are written to disk and checked as they are generated, then freed
+                self.make_neuron_input_parallel(stream_output=True)
+            else:
+                self.make_neuron_input_parallel()
 
-            # Write spikes to disk, HDF5 format
-            self.write_hdf5()
+                # Write spikes to disk, HDF5 format
+                self.write_hdf5()
 
-            # Verify correlation --- THIS IS VERY VERY SLOW
-            # self.verifyCorrelation()
+                # Verify correlation --- THIS IS VERY VERY SLOW
+                # self.verifyCorrelation()
 
-            self.check_sorted()
+                self.check_sorted()
 
         # 1. Define what the within correlation, and between correlation should be
         #    for each neuron type. Also what input frequency should we have for each
@@ -250,6 +275,18 @@ class SnuddaInput(object):
 
         """ Writes input spikes to HDF5 file. """
 
+        out_file = self.create_hdf5()
+
+        for neuron_id in self.neuron_input:
+            for input_type in self.neuron_input[neuron_id]:
+                self.write_neuron_input_hdf5(out_file=out_file, neuron_id=neuron_id, input_type=input_type)
+
+        out_file.close()
+
+    def create_hdf5(self):
+
+        """ Creates HDF5 input spike file, with a group for each neuron. Returns the open file. """
+
         self.write_log(f"Writing spikes to {self.spike_data_filename}", force_print=True)
 
         out_file = h5py.File(self.spike_data_filename, 'w', libver=self.h5libver)
@@ -257,182 +294,243 @@ class SnuddaInput(object):
         input_group = out_file.create_group("input")
 
         for neuron_id in self.neuron_input:
+            input_group.create_group(str(neuron_id))
 
-            nid_group = input_group.create_group(str(neuron_id))
+        return out_file
 
-            neuron_type = self.neuron_type[neuron_id]
+    def write_neuron_input_hdf5(self, out_file, neuron_id, input_type):
 
-            for input_type in self.neuron_input[neuron_id]:
+        """
+        Writes input spikes for neuron_id and input_type to HDF5 file.
 
-                if input_type[0] == '!':
-                    self.write_log(f"Disabling input {input_type} for neuron {neuron_id} "
-                                   f" (input_type was commented with ! before name)")
-                    continue
+        Args:
+            out_file: Open HDF5 file, see create_hdf5
+            neuron_id (int): Neuron ID
+            input_type (str): Input type
+        """
 
-                if input_type.lower() != "virtual_neuron".lower():
+        if input_type[0] == '!':
+            self.write_log(f"Disabling input {input_type} for neuron {neuron_id} "
+                           f" (input_type was commented with ! before name)")
+            return
 
-                    neuron_in = self.neuron_input[neuron_id][input_type]
+        nid_group = out_file["input"][str(neuron_id)]
+        neuron_type = self.neuron_type[neuron_id]
 
-                    spike_mat, num_spikes = self.create_spike_matrix(neuron_in["spikes"])
+        if input_type.lower() != "virtual_neuron".lower():
 
-                    if np.sum(num_spikes) == 0:
-                        # No spikes to save, do not write input to file
-                        continue
+            neuron_in = self.neuron_input[neuron_id][input_type]
+
+            # Spikes are stored in CSR format (spike_times, spike_offset)
+            spike_times, spike_offset = neuron_in["spikes"]
 
-                    it_group = nid_group.create_group(input_type)
-                    spike_set = it_group.create_dataset("spikes", data=spike_mat, compression="gzip", dtype=np.float32)
-                    spike_set.attrs["num_spikes"] = num_spikes
+            if self.spike_format == "csr":
+                num_spikes = np.diff(spike_offset)
+            else:
+                spike_mat, num_spikes = self.create_spike_matrix(spike_times, spike_offset)
 
-                    it_group.attrs["section_id"] = neuron_in["location"][1].astype(np.int16)
-                    it_group.attrs["section_x"] = neuron_in["location"][2].astype(np.float16)
-                    it_group.attrs["distance_to_soma"] = neuron_in["location"][3].astype(np.float16)
+            if np.sum(num_spikes) == 0:
+                # No spikes to save, do not write input to file
+                return
 
-                    if "freq" in neuron_in:
-                        spike_set.attrs["freq"] = neuron_in["freq"]
+            it_group = nid_group.create_group(input_type)
 
-                    if "correlation" in neuron_in:
-                        spike_set.attrs["correlation"] = neuron_in["correlation"]
+            input_info = {"section_id": neuron_in["location"][1].astype(np.int16),
+                          "section_x": neuron_in["location"][2].astype(np.float16),
+                          "distance_to_soma": neuron_in["location"][3].astype(np.float16),
+                          "parameter_id": neuron_in["parameter_id"].astype(np.int32)}
 
-                    if "jitter" in neuron_in and neuron_in["jitter"]:
-                        spike_set.attrs["jitter"] = neuron_in["jitter"]
+            if self.spike_format == "csr":
+                # No padding, and no compression so the spikes are fast to read
+                spike_set = it_group.create_dataset("spike_times", data=spike_times, dtype=np.float32)
+                it_group.create_dataset("spike_offset", data=spike_offset, dtype=np.int64)
 
-                    if "synapse_density" in neuron_in and neuron_in["synapse_density"]:
-                        it_group.attrs["synapse_density"] = neuron_in["synapse_density"]
+                # Per input data as datasets, to avoid the attribute size limit
+                for info_name, info_data in input_info.items():
+                    it_group.create_dataset(info_name, data=info_data)
+            else:
+                spike_set = it_group.create_dataset("spikes", data=spike_mat, compression="gzip",
+                                                    dtype=np.float32)
+                spike_set.attrs["num_spikes"] = num_spikes
 
-                    if "start" in neuron_in:
-                        spike_set.attrs["start"] = neuron_in["start"]
+                for info_name, info_data in input_info.items():
+                    it_group.attrs[info_name] = info_data
 
-                    if "end" in neuron_in:
-                        spike_set.attrs["end"] = neuron_in["end"]
+            if "freq" in neuron_in:
+                spike_set.attrs["freq"] = neuron_in["freq"]
 
-                    it_group.attrs["conductance"] = neuron_in["conductance"]
+            if "correlation" in neuron_in:
+                spike_set.attrs["correlation"] = neuron_in["correlation"]
 
-                    if "population_unit_id" in neuron_in:
-                        population_unit_id = int(neuron_in["population_unit_id"])
-                        it_group.attrs["population_unit_id"] = population_unit_id
-                    else:
-                        population_unit_id = None
+            if "jitter" in neuron_in and neuron_in["jitter"]:
+                spike_set.attrs["jitter"] = neuron_in["jitter"]
 
-                    # population_unit_id = 0 means not population unit membership, so no population spikes available
-                    if neuron_type in self.population_unit_spikes \
-                            and population_unit_id is not None and population_unit_id > 0 \
-                            and input_type in self.population_unit_spikes[neuron_type]:
+            if "synapse_density" in neuron_in and neuron_in["synapse_density"]:
+                it_group.attrs["synapse_density"] = neuron_in["synapse_density"]
 
-                        chan_spikes = self.population_unit_spikes[neuron_type][input_type][population_unit_id]
+            if "start" in neuron_in:
+                spike_set.attrs["start"] = neuron_in["start"]
 
-                        it_group.create_dataset("population_unit_spikes", data=chan_spikes, compression="gzip",
-                                                dtype=np.float32)
+            if "end" in neuron_in:
+                spike_set.attrs["end"] = neuron_in["end"]
 
-                    spike_set.attrs["generator"] = neuron_in["generator"]
+            it_group.attrs["conductance"] = neuron_in["conductance"]
 
-                    it_group.attrs["mod_file"] = neuron_in["mod_file"]
+            if "population_unit_id" in neuron_in:
+                population_unit_id = int(neuron_in["population_unit_id"])
+                it_group.attrs["population_unit_id"] = population_unit_id
+            else:
+                population_unit_id = None
 
-                    if "parameter_file" in neuron_in and neuron_in["parameter_file"]:
-                        it_group.attrs["parameter_file"] = neuron_in["parameter_file"]
+            # population_unit_id = 0 means not population unit membership, so no population spikes available
+            if neuron_type in self.population_unit_spikes \
+                    and population_unit_id is not None and population_unit_id > 0 \
+                    and input_type in self.population_unit_spikes[neuron_type]:
 
-                    # We need to convert this to string to be able to save it
-                    if "parameter_list" in neuron_in and neuron_in["parameter_list"] is not None:
-                        # We only need to save the synapse parameters in the file
-                        syn_par_list = [x["synapse"] for x in neuron_in["parameter_list"] if "synapse" in x]
-                        if len(syn_par_list) > 0:
-                            it_group.attrs["parameter_list"] = json.dumps(syn_par_list)
+                chan_spikes = self.population_unit_spikes[neuron_type][input_type][population_unit_id]
 
-                    it_group.attrs["parameter_id"] = neuron_in["parameter_id"].astype(np.int32)
+                it_group.create_dataset("population_unit_spikes", data=chan_spikes, compression="gzip",
+                                        dtype=np.float32)
 
-                else:
+            spike_set.attrs["generator"] = neuron_in["generator"]
 
-                    # Input is activity of a virtual neuron
-                    a_group = nid_group.create_group("activity")
+            it_group.attrs["mod_file"] = neuron_in["mod_file"]
 
-                    try:
-                        if "spike_file" in self.neuron_input[neuron_id][input_type]:
-                            spike_file = self.neuron_input[neuron_id][input_type]["spike_file"]
-                    except:
-                        import traceback
-                        print(traceback.format_exc())
-                        import pdb
-                        pdb.set_trace()
+            if "parameter_file" in neuron_in and neuron_in["parameter_file"]:
+                it_group.attrs["parameter_file"] = neuron_in["parameter_file"]
 
-                    if "row_id" in self.neuron_input[neuron_id][input_type]:
-                        spike_row = self.neuron_input[neuron_id][input_type]["row_id"]
-                    else:
-                        spike_row = None
+            # We need to convert this to string to be able to save it
+            if "parameter_list" in neuron_in and neuron_in["parameter_list"] is not None:
+                # We only need to save the synapse parameters in the file
+                syn_par_list = [x["synapse"] for x in neuron_in["parameter_list"] if "synapse" in x]
+                if len(syn_par_list) > 0:
+                    it_group.attrs["parameter_list"] = json.dumps(syn_par_list)
 
-                    if spike_row is None:
+        else:
 
-                        if "row_mapping_file" in self.neuron_input[neuron_id][input_type]\
-                          and "row_mapping_data" not in self.neuron_input[neuron_id][input_type]:
+            # Input is activity of a virtual neuron
+            a_group = nid_group.create_group("activity")
+            neuron_in = self.neuron_input[neuron_id][input_type]
 
-                            row_mapping_file = self.neuron_input[neuron_id][input_type]["row_mapping_file"]
-                            row_mapping_data = np.loadtxt(row_mapping_file, dtype=int)
-                            row_mapping = dict()
-                            for nid, rowid in row_mapping_data:
-                                if nid in row_mapping:
-                                    print(f"Warning neuron_id {nid} appears twice in {row_mapping_file}")
-                                row_mapping[nid] = rowid
+            if "spike_file" in neuron_in:
+                spikes = self.read_virtual_neuron_spikes(neuron_id=neuron_id, input_type=input_type)
 
-                            # Save row mapping so we dont have to generate it next iteration
-                            self.neuron_input[neuron_id][input_type]["row_mapping_data"] = row_mapping
+                # Save spikes, so check_sorted and plot_spikes can use them (freed again when streaming)
+                neuron_in["spikes"] = spikes
 
-                        if "row_mapping_data" in self.neuron_input[neuron_id][input_type]\
-                            and neuron_id in self.neuron_input[neuron_id][input_type]["row_mapping_data"]:
-                            spike_row = self.neuron_input[neuron_id][input_type]["row_mapping_data"][neuron_id]
-                        else:
-                            spike_row = neuron_id
+            elif "spikes" in neuron_in:
+                spikes = neuron_in["spikes"]
+            else:
+                raise ValueError(f"No activity for virtual neuron {neuron_id} ({input_type}), "
+                                 f"specify spike_file in the input config")
+
+            activity_spikes = a_group.create_dataset("spikes", data=spikes, compression="gzip")
+            # generator = self.neuron_input[neuron_id][input_type]["generator"]
+            # activity_spikes.attrs["generator"] = generator
+
+    def read_virtual_neuron_spikes(self, neuron_id, input_type):
 
-                    if "spike_data" not in self.neuron_input[neuron_id][input_type]:
-                        float_pattern = re.compile(r'^[-+]?[0-9]*\.?[0-9]+$')
+        """
+        Reads spikes of virtual neuron neuron_id from spike_file (one row of spike times per neuron).
+        The row used is row_id if given, otherwise it is looked up in row_mapping_file, or is neuron_id.
+
+        Args:
+            neuron_id (int): Neuron ID of virtual neuron
+            input_type (str): Input type
 
-                        s_data = []
-                        with open(spike_file, "rt") as f:
-                            for row in f:
-                                s_data.append(np.array([float(x) for x in row.split(" ")
-                                                        if len(x) > 0 and float_pattern.match(x)]))
+        Returns:
+            spikes (np.array): Spike times of virtual neuron
+        """
 
-                        self.neuron_input[neuron_id][input_type]["spike_data"] = s_data
+        neuron_in = self.neuron_input[neuron_id][input_type]
+        spike_file = neuron_in["spike_file"]
 
-                    try:
-                        spikes = self.neuron_input[neuron_id][input_type]["spike_data"][spike_row]
-                    except:
-                        import traceback
-                        print(traceback.format_exc())
-                        import pdb
-                        pdb.set_trace()
+        if "row_id" in neuron_in:
+            spike_row = neuron_in["row_id"]
+        else:
+            spike_row = None
 
-                    # Save spikes, so check sorted can verify them.
-                    # TODO: Should we skip this, if there are MANY virtual neurons -- and we run out of memory?
-                    self.neuron_input[neuron_id][input_type]["spikes"] = spikes
+        if spike_row is None:
 
-                    if spikes is None and "spikes" in self.neuron_input[neuron_id][input_type]:
-                        spikes = self.neuron_input[neuron_id][input_type]["spikes"]
+            if "row_mapping_file" in neuron_in and "row_mapping_data" not in neuron_in:
 
-                    activity_spikes = a_group.create_dataset("spikes", data=spikes, compression="gzip")
-                    # generator = self.neuron_input[neuron_id][input_type]["generator"]
-                    # activity_spikes.attrs["generator"] = generator
+                row_mapping_file = neuron_in["row_mapping_file"]
+                row_mapping_data = np.loadtxt(row_mapping_file, dtype=int)
+                row_mapping = dict()
+                for nid, rowid in row_mapping_data:
+                    if nid in row_mapping:
+                        print(f"Warning neuron_id {nid} appears twice in {row_mapping_file}")
+                    row_mapping[nid] = rowid
 
-        out_file.close()
+                # Save row mapping so we dont have to generate it next iteration
+                neuron_in["row_mapping_data"] = row_mapping
+
+            if "row_mapping_data" in neuron_in and neuron_id in neuron_in["row_mapping_data"]:
+                spike_row = neuron_in["row_mapping_data"][neuron_id]
+            else:
+                spike_row = neuron_id
+
+        if "spike_data" not in neuron_in:
+            float_pattern = re.compile(r'^[-+]?[0-9]*\.?[0-9]+$')
+
+            if not os.path.isfile(spike_file):
+                raise FileNotFoundError(f"Virtual neuron {neuron_id} ({input_type}): "
+                                        f"spike_file {spike_file} not found")
+
+            s_data = []
+            with open(spike_file, "rt") as f:
+                for row in f:
+                    s_data.append(np.array([float(x) for x in row.split(" ")
+                                            if len(x) > 0 and float_pattern.match(x)]))
+
+            neuron_in["spike_data"] = s_data
+
+        if not 0 <= spike_row < len(neuron_in["spike_data"]):
+            raise ValueError(f"Virtual neuron {neuron_id} ({input_type}): row {spike_row} not in "
+                             f"spike_file {spike_file} ({len(neuron_in['spike_data'])} rows)")
+
+        spikes = neuron_in["spike_data"][spike_row]
+
+        if not (np.diff(spikes) >= 0).all():
+            raise ValueError(f"Virtual neuron {neuron_id} ({input_type}): spikes in row {spike_row} of "
+                             f"spike_file {spike_file} must be in order")
+
+        return spikes
 
     ############################################################################
 
     @staticmethod
-    def create_spike_matrix(spikes):
+    def create_spike_matrix(spike_times, spike_offset):
 
-        """ Creates a spike matrix from a list of spikes. """
+        """ Creates a spike matrix, padded with -1, from spikes in CSR format (see create_spike_csr). """
 
-        if len(spikes) == 0:
-            return np.zeros((0, 0)), 0
+        num_spikes = np.diff(spike_offset)
+
+        if len(num_spikes) == 0:
+            return np.zeros((0, 0)), num_spikes
 
-        num_input_trains = len(spikes)
-        num_spikes = np.array([len(x) for x in spikes])
-        max_len = max(num_spikes)
+        train_idx = np.repeat(np.arange(len(num_spikes)), num_spikes)
+        spike_idx = np.arange(len(spike_times)) - np.repeat(spike_offset[:-1], num_spikes)
 
-        spike_mat = -1 * np.ones((num_input_trains, max_len))
-        for idx, st in enumerate(spikes):
-            n = st.shape[0]
-            spike_mat[idx, :n] = st
+        spike_mat = -1 * np.ones((len(num_spikes), np.max(num_spikes)))
+        spike_mat[train_idx, spike_idx] = spike_times
 
         return spike_mat, num_spikes
 
+    @staticmethod
+    def create_spike_csr(spikes):
+
+        """ Concatenates a list of spike trains, returns spike_times and offset, where spike train i is
+            spike_times[offset[i]:offset[i+1]]. """
+
+        num_spikes = np.array([len(x) for x in spikes], dtype=int)
+        offset = np.concatenate([[0], np.cumsum(num_spikes)]).astype(int)
+
+        if len(spikes) == 0:
+            return np.zeros((0,)), offset
+
+        return np.concatenate(spikes), offset
+
     ############################################################################
 
     # Reads from self.inputConfigFile
@@ -602,9 +700,14 @@ class SnuddaInput(object):
 
     ############################################################################
 
-    def make_neuron_input_parallel(self):
+    def make_neuron_input_parallel(self, stream_output=False):
 
-        """ Generate input, able to run in parallel if rc (Remote Client) has been provided at initialisation."""
+        """
+        Generate input, able to run in parallel if rc (Remote Client) has been provided at initialisation.
+
+        Args:
+            stream_output (bool): Write each input to the spike file as soon as it is generated, then free the spikes
+        """
 
         self.write_log("Running make_neuron_input_parallel")
 
@@ -797,7 +900,7 @@ class SnuddaInput(object):
                     csv_spikes = self.import_csv_spikes(csv_file=csv_file)
                     num_spike_trains = len(csv_spikes)
 
-                    self.neuron_input[neuron_id][input_type]["spikes"] = csv_spikes
+                    self.neuron_input[neuron_id][input_type]["spikes"] = self.create_spike_csr(csv_spikes)
                     self.neuron_input[neuron_id][input_type]["num_spikes"] = np.array([len(x) for x in csv_spikes])
 
                     self.neuron_input[neuron_id][input_type]["conductance"] = input_inf["conductance"]
@@ -1046,6 +1149,9 @@ class SnuddaInput(object):
 
         amr = None
 
+        if stream_output:
+            out_file = self.create_hdf5()
+
         assert len(neuron_id_list) == len(input_type_list) == len(freq_list)\
             == len(start_list) == len(end_list) == len(synapse_density_list) == len(num_inputs_list)\
             == len(num_inputs_list) == len(population_unit_spikes_list) == len(jitter_dt_list)\
@@ -1088,19 +1194,23 @@ class SnuddaInput(object):
                                   population_unit_fraction_list,
                                   num_soma_synapses_list))
 
-            self.d_view.scatter("input_list", input_list, block=True)
-            cmd_str = "inpt = list(map(nl.make_input_helper_parallel,input_list))"
+            if stream_output:
+                # Results are written as they arrive, at most stream_chunk_size are pending at a time
+                amr = self.make_input_parallel_stream(input_list=input_list, max_outstanding=self.stream_chunk_size)
+            else:
+                self.d_view.scatter("input_list", input_list, block=True)
+                cmd_str = "inpt = list(map(nl.make_input_helper_parallel,input_list))"
 
-            self.write_log("Calling workers to generate input in parallel")
-            self.d_view.execute(cmd_str, block=True)
-            self.d_view.execute("nl.write_log('Execution done on workers')")
+                self.write_log("Calling workers to generate input in parallel")
+                self.d_view.execute(cmd_str, block=True)
+                self.d_view.execute("nl.write_log('Execution done on workers')")
 
-            self.write_log("Execution done")
+                self.write_log("Execution done")
 
-            # On this line it stalls... WHY?
-            # inpt = self.d_view["inpt"]
-            amr = self.d_view.gather("inpt", block=True)
-            self.write_log("Results received")
+                # On this line it stalls... WHY?
+                # inpt = self.d_view["inpt"]
+                amr = self.d_view.gather("inpt", block=True)
+                self.write_log("Results received")
 
         else:
             # If no lbView then we run it in serial
@@ -1160,8 +1270,56 @@ class SnuddaInput(object):
             self.neuron_input[neuron_id][input_type]["parameter_list"] = param_list
             self.neuron_input[neuron_id][input_type]["parameter_id"] = param_id
 
+            if stream_output:
+                self.stream_neuron_input(out_file=out_file, neuron_id=neuron_id, input_type=input_type)
+
+        if stream_output:
+            # Inputs generated on the master (csv input, virtual neurons) are written last
+            for neuron_id in self.neuron_input:
+                for input_type in self.neuron_input[neuron_id]:
+                    if not self.neuron_input[neuron_id][input_type].get("written", False):
+                        self.stream_neuron_input(out_file=out_file, neuron_id=neuron_id, input_type=input_type)
+
+            out_file.close()
+
         return self.neuron_input
 
+    def stream_neuron_input(self, out_file, neuron_id, input_type):
+
+        """ Writes input for neuron_id and input_type to out_file, checks it, and then frees the spikes. """
+
+        self.write_neuron_input_hdf5(out_file=out_file, neuron_id=neuron_id, input_type=input_type)
+        self.check_sorted_input(neuron_id=neuron_id, input_type=input_type)
+
+        for key in ["spikes", "spike_data", "location", "parameter_id"]:
+            self.neuron_input[neuron_id][input_type].pop(key, None)
+
+        self.neuron_input[neuron_id][input_type]["written"] = True
+
+    def make_input_parallel_stream(self, input_list, max_outstanding):
+
+        """
+        Generator, sends input_list to the workers (load balanced) and yields each result as soon as it is done.
+        At most max_outstanding inputs are queued on the workers, this bounds the memory used on the master,
+        while keeping the workers busy.
+
+        Args:
+            input_list (list): List of arguments to make_input_helper_parallel
+            max_outstanding (int): Maximal number of inputs being generated on the workers at a time
+        """
+
+        from ipyparallel import Reference
+
+        self.write_log(f"Calling workers to generate {len(input_list)} inputs (streaming results)")
+
+        lb_view = self.rc.load_balanced_view()
+
+        # Reference("nl") is the SnuddaInput object on each worker, created by setup_parallel
+        yield from lb_view.imap(SnuddaInput.make_input_helper_parallel, itertools.repeat(Reference("nl")), input_list,
+                                ordered=False, max_outstanding=max_outstanding)
+
+        self.write_log("Results received")
+
     ############################################################################
 
     def generate_spikes_helper(self, frequency, time_range, rng, input_generator=None):
@@ -1247,7 +1405,7 @@ class SnuddaInput(object):
             assert not freq < 0, "Negative frequency specified."
             return np.array([])
 
-    def generate_spikes_function_helper(self, frequencies, time_ranges, rng, dt, p_keep=1):
+    def generate_spikes_function_helper(self, frequencies, time_ranges, rng, dt, p_keep=1, n_spike_trains=None):
 
         """
         Generates spike trains with given frequencies within time_ranges, using rng stream.
@@ -1257,6 +1415,8 @@ class SnuddaInput(object):
              time_ranges (list): List of tuples with start and end time for each frequency range
              rng: Numpy random stream
              dt: timestep
+             n_spike_trains (int): Number of spike trains, if None a single spike train is returned,
+                                   otherwise the spike trains in CSR format (spike_times, offset)
         """
 
         if np.size(frequencies) == np.size(time_ranges[0]):
@@ -1272,7 +1432,18 @@ class SnuddaInput(object):
         t_spikes = []
 
         for freq, t_start, t_end, p_k in zip(frequency_list, time_ranges[0], time_ranges[1], p_keep_list):
-            t_spikes.append(self.generate_spikes_function(freq, (t_start, t_end), rng=rng, dt=dt, p_keep=p_k))
+            t_spikes.append(self.generate_spikes_function(freq, (t_start, t_end), rng=rng, dt=dt, p_keep=p_k,
+                                                          n_spike_trains=n_spike_trains))
+
+        if n_spike_trains is not None:
+            # Merge the time ranges for each spike train
+            spike_times = np.concatenate([st for st, _ in t_spikes])
+            train_id = np.concatenate([np.repeat(np.arange(n_spike_trains), np.diff(offset))
+                                       for _, offset in t_spikes])
+            sort_idx = np.lexsort((spike_times, train_id))
+            offset = np.concatenate([[0], np.cumsum(np.bincount(train_id, minlength=n_spike_trains))]).astype(int)
+
+            return spike_times[sort_idx], offset
 
         try:
             spikes = np.sort(np.concatenate(t_spikes))
@@ -1285,9 +1456,7 @@ class SnuddaInput(object):
         # Double check correct dimension
         return spikes
 
-    def generate_spikes_function(self, frequency_function, time_range, rng, dt=1e-4, p_keep=1):
-
-        # TODO: Replace this with the code in time_varying_input.py
+    def generate_spikes_function(self, frequency_function, time_range, rng, dt=1e-4, p_keep=1, n_spike_trains=None):
 
         """
         Generates frequency based on frequency_function.
@@ -1300,12 +1469,16 @@ class SnuddaInput(object):
             time_range: Interval of time to generate spikes for
             rng: Numpy rng object
             dt: timestep
+            n_spike_trains (int): Number of spike trains to generate, all are generated in one pass.
+                                  If None (default) a single spike train is returned, otherwise the spike trains
+                                  are returned in CSR format (spike_times, offset), see create_spike_csr.
         """
 
         if np.size(time_range[0]) > 1:
             return self.generate_spikes_function_helper(frequencies=frequency_function,
                                                         time_ranges=time_range,
-                                                        rng=rng, dt=dt, p_keep=p_keep)
+                                                        rng=rng, dt=dt, p_keep=p_keep,
+                                                        n_spike_trains=n_spike_trains)
 
         assert 0 <= p_keep <= 1, \
             f"Error: p_keep = {p_keep}, valid range 0-1. If p_keep is a list, " \
@@ -1323,12 +1496,25 @@ class SnuddaInput(object):
                 import pdb
                 pdb.set_trace()
 
-        # TODO: Utilise the n_spike trains better
-        spikes = TimeVaryingInput.generate_spikes(frequency_function=func,
-                                                  start_time=time_range[0], end_time=time_range[1],
-                                                  n_spike_trains=1, rng=rng)[0].T
+        # The stretched time table only depends on the frequency function and p_keep, so neurons sharing
+        # the same input definition can reuse it
+        cache_key = (frequency_function, p_keep)
 
-        return spikes
+        try:
+            hash(cache_key)
+        except TypeError:
+            cache_key = None
+
+        spike_times, offset = \
+            TimeVaryingInput.generate_spikes_csr(frequency_function=func,
+                                                 start_time=time_range[0], end_time=time_range[1],
+                                                 n_spike_trains=1 if n_spike_trains is None else n_spike_trains,
+                                                 rng=rng, cache_key=cache_key)
+
+        if n_spike_trains is None:
+            return spike_times
+
+        return spike_times, offset
 
     ############################################################################
 
@@ -1505,6 +1691,9 @@ class SnuddaInput(object):
                                         if true returns (spikes, population unit spikes)
             jitter_dt (float): amount to jitter all spikes
             input_generator (str) : "poisson" (default) or "frequency_functon"
+
+        Returns:
+            spikes : (spike_times, offset) in CSR format, spike train i is spike_times[offset[i]:offset[i+1]]
         """
 
         assert np.all(np.logical_and(0 <= p_keep, p_keep <= 1)), f"p_keep = {p_keep} should be between 0 and 1"
@@ -1512,37 +1701,152 @@ class SnuddaInput(object):
         if population_unit_spikes is None:
             population_unit_spikes = self.generate_spikes_helper(freq, time_range, rng=rng,
                                                                  input_generator=input_generator)
-        spike_trains = []
 
         if input_generator == "poisson":
-            pop_freq = np.multiply(freq, 1 - p_keep)
-        elif input_generator == "frequency_function":
-            pop_freq = freq
-        else:
-            assert False, f"Unknown input_generator {input_generator}"
+            # All spike trains are generated at once
+            spikes = self.make_correlated_spikes_csr(freq=freq, time_range=time_range,
+                                                     num_spike_trains=num_spike_trains,
+                                                     p_keep=p_keep, rng=rng,
+                                                     population_unit_spikes=population_unit_spikes,
+                                                     jitter_dt=jitter_dt)
+
+            if ret_pop_unit_spikes:
+                return spikes, population_unit_spikes
+            else:
+                return spikes
 
-        # TODO: For frequency_functions we can skip parts of the loop and directly request n_spike_trains
-        #       That would speed up the frequency_function generation call
+        assert input_generator == "frequency_function", f"Unknown input_generator {input_generator}"
 
-        for i in range(0, num_spike_trains):
-            t_unique = self.generate_spikes_helper(frequency=pop_freq, time_range=time_range, rng=rng,
-                                                   input_generator=input_generator)
-            t_population_unit = self.cull_spikes(spikes=population_unit_spikes,
+        # All unique spike trains are generated in one pass, then mixed with the shared spikes
+        unique_spikes = self.generate_spikes_function(frequency_function=freq, time_range=time_range,
+                                                      rng=rng, n_spike_trains=num_spike_trains)
+
+        spikes = self.make_correlated_spikes_csr(freq=freq, time_range=time_range,
+                                                 num_spike_trains=num_spike_trains,
                                                  p_keep=p_keep, rng=rng,
-                                                 time_range=time_range)
+                                                 population_unit_spikes=population_unit_spikes,
+                                                 jitter_dt=jitter_dt, unique_spikes=unique_spikes)
 
-            spike_trains.append(SnuddaInput.mix_spikes([t_unique, t_population_unit]))
+        if ret_pop_unit_spikes:
+            return spikes, population_unit_spikes
+        else:
+            return spikes
 
-        # if(False):
-        #      self.verifyCorrelation(spikeTrains=spikeTrains) # THIS STEP IS VERY VERY SLOW
+    ############################################################################
 
-        if jitter_dt is not None:
-            spike_trains = self.jitter_spikes(spike_trains, jitter_dt, time_range=time_range, rng=rng)
+    def make_correlated_spikes_csr(self, freq, time_range, num_spike_trains, p_keep, rng,
+                                   population_unit_spikes, jitter_dt=None, block_size=10000000,
+                                   unique_spikes=None):
 
-        if ret_pop_unit_spikes:
-            return spike_trains, population_unit_spikes
+        """
+        Make correlated Poisson spike trains, all spike trains are generated at once. Same as
+        make_correlated_spikes (with input_generator="poisson"), but returns the spike trains in CSR format.
+
+        Each spike train has its own unique Poisson spikes, with frequency freq * (1 - p_keep), and each spike
+        in population_unit_spikes is included with probability p_keep.
+
+        Args:
+            freq (float or list of floats): frequency of spike train (one per time range)
+            time_range (tuple): start time, end time of spike train (or start times, end times)
+            num_spike_trains (int): number of spike trains to generate
+            p_keep (float or list of floats): fraction of shared spikes to include in spike train
+            rng: Numpy random number stream
+            population_unit_spikes (np.array): shared spikes
+            jitter_dt (float): amount to jitter all spikes
+            block_size (int): maximum number of random numbers drawn at a time when culling shared spikes
+            unique_spikes (tuple): unique spikes of each spike train in CSR format (spike_times, offset),
+                                   if given these are used instead of generating Poisson spikes (freq is ignored)
+
+        Returns:
+            spike_times, offset : Spike train i is spike_times[offset[i]:offset[i+1]], sorted
+        """
+
+        start_times = np.atleast_1d(np.asarray(time_range[0], dtype=float))
+        end_times = np.atleast_1d(np.asarray(time_range[1], dtype=float))
+        p_keep_range = np.broadcast_to(np.asarray(p_keep, dtype=float), start_times.shape)
+
+        assert (end_times > start_times).all(), \
+            f"Start time = {start_times} and end time = {end_times} incorrect (duration > 0 required)"
+
+        if self.time_interval_overlap_warning:
+            assert (start_times[1:] - end_times[:-1] >= 0).all(), \
+                f"Time range should not overlap: start: {time_range[0]}, end: {time_range[1]}"
+
+        spike_times = []
+        train_id = []
+
+        if unique_spikes is not None:
+            spike_times.append(unique_spikes[0])
+            train_id.append(np.repeat(np.arange(num_spike_trains), np.diff(unique_spikes[1])))
         else:
-            return spike_trains
+            frequency = np.broadcast_to(np.asarray(freq, dtype=float), start_times.shape)
+            assert not (frequency < 0).any(), "Negative frequency specified."
+
+            # Unique spikes: Poisson distributed spike count for each spike train, with uniformly distributed times
+            for start, end, f, p_k in zip(start_times, end_times, frequency, p_keep_range):
+                num_spikes = rng.poisson(f * (1 - p_k) * (end - start), size=num_spike_trains)
+                spike_times.append(start + rng.random(np.sum(num_spikes)) * (end - start))
+                train_id.append(np.repeat(np.arange(num_spike_trains), num_spikes))
+
+        # Shared spikes: each spike train keeps each population unit spike with probability p_keep
+        population_unit_spikes = np.asarray(population_unit_spikes, dtype=float).flatten()
+        p_keep_spikes = self.get_spike_p_keep(spikes=population_unit_spikes, p_keep=p_keep, time_range=time_range)
+
+        if population_unit_spikes.size > 0 and num_spike_trains > 0:
+            trains_per_block = max(1, int(block_size // population_unit_spikes.size))
+
+            for block_start in range(0, num_spike_trains, trains_per_block):
+                num_trains = min(trains_per_block, num_spike_trains - block_start)
+                keep_train, keep_spike = np.nonzero(rng.random((num_trains, population_unit_spikes.size))
+                                                    < p_keep_spikes)
+                spike_times.append(population_unit_spikes[keep_spike])
+                train_id.append(keep_train + block_start)
+
+        spike_times = np.concatenate(spike_times)
+        train_id = np.concatenate(train_id)
+
+        if jitter_dt is not None:
+            spike_times = spike_times + rng.normal(0, jitter_dt, spike_times.shape)
+
+            # No modulo time jittering if list of times specified, see jitter_spikes
+            if np.size(time_range[0]) == 1:
+                spike_times = np.mod(spike_times - start_times[0], end_times[0] - start_times[0]) + start_times[0]
+
+            # Remove any spikes that happened to go negative
+            keep_idx = spike_times >= 0
+            spike_times, train_id = spike_times[keep_idx], train_id[keep_idx]
+
+        sort_idx = np.lexsort((spike_times, train_id))
+        offset = np.concatenate([[0], np.cumsum(np.bincount(train_id, minlength=num_spike_trains))]).astype(int)
+
+        return spike_times[sort_idx], offset
+
+    @staticmethod
+    def get_spike_p_keep(spikes, p_keep, time_range=None):
+
+        """
+        Returns the probability to keep each spike, see cull_spikes.
+
+        Args:
+            spikes: Spike train
+            p_keep: Probability to keep each spike
+            time_range: If p_keep is vector, this specifies which part of those ranges each p_keep is for
+        """
+
+        if time_range is None:
+            assert np.size(p_keep) == 1, f"If not time_range is given then p_keep must be a scalar. p_keep = {p_keep}"
+            return np.full(spikes.shape, p_keep, dtype=float)
+
+        start_times = np.atleast_1d(time_range[0])
+        end_times = np.atleast_1d(time_range[1])
+        p_keep = np.broadcast_to(p_keep, start_times.shape)
+
+        p_keep_spikes = np.zeros(spikes.shape)
+
+        for p_k, start, end in zip(p_keep, start_times, end_times):
+            p_keep_spikes[np.logical_and(start <= spikes, spikes <= end)] = p_k
+
+        return p_keep_spikes
 
     ############################################################################
 
@@ -1814,15 +2118,21 @@ class SnuddaInput(object):
                 f"input: neuron_path not in morphology_path, expected 'modified_morphologies' " \
                 f"in path: {morphology_path = }, {neuron_path = }"
 
-            # Bend morphologies are unique, need to load it separately
-            morphology = NeuronMorphologyExtended(name=neuron_name,
-                                                  position=None,  # This is set further down when using clone
-                                                  rotation=None,
-                                                  swc_filename=morphology_path,
-                                                  snudda_data=self.snudda_data,
-                                                  parameter_key=parameter_key,
-                                                  morphology_key=morphology_key,
-                                                  modulation_key=modulation_key)
+            # Bend morphologies are unique, need to load it separately. Only the current neuron's morphology
+            # is cached (on morphology_path), so that its other input types reuse the morphology (and its input
+            # location samplers) without keeping every bend morphology in the network in memory
+            if self.bend_morphology_cache is not None and self.bend_morphology_cache[0] == morphology_path:
+                morphology = self.bend_morphology_cache[1]
+            else:
+                morphology = NeuronMorphologyExtended(name=neuron_name,
+                                                      position=None,  # This is set further down when using clone
+                                                      rotation=None,
+                                                      swc_filename=morphology_path,
+                                                      snudda_data=self.snudda_data,
+                                                      parameter_key=parameter_key,
+                                                      morphology_key=morphology_key,
+                                                      modulation_key=modulation_key)
+                self.bend_morphology_cache = (morphology_path, morphology)
 
         elif neuron_name in self.neuron_cache:
             self.write_log(f"About to clone cache of {neuron_name}.")
@@ -1940,7 +2250,7 @@ class SnuddaInput(object):
                        f", use_meta_input={self.use_meta_input}"
                        f", verbose={self.verbose}"
                        f", time_interval_overlap_warning={self.time_interval_overlap_warning}"
-                       f", time={self.time}, logfile='{log_filename[0]}')")
+                       f", time={self.time}, logfile='{engine_logfile[0]}')")
 
         cmd_str = ("global nl; nl = SnuddaInput(network_path=network_path, "
                    "snudda_data=snudda_data, "
@@ -1972,15 +2282,31 @@ class SnuddaInput(object):
 
         for neuron_id in self.neuron_input:
             for input_type in self.neuron_input[neuron_id]:
-                if input_type == "virtual_neuron":
-                    s = self.neuron_input[neuron_id][input_type]["spikes"]
-                    assert (np.diff(s) >= 0).all(), \
-                        str(neuron_id) + " " + input_type + ": Spikes must be in order"
-                else:
-                    for spikes in self.neuron_input[neuron_id][input_type]["spikes"]:
-                        assert len(spikes) == 0 or spikes[0] >= 0
-                        assert (np.diff(spikes) >= 0).all(), \
-                            str(neuron_id) + " " + input_type + ": Spikes must be in order"
+                self.check_sorted_input(neuron_id=neuron_id, input_type=input_type)
+
+    def check_sorted_input(self, neuron_id, input_type):
+
+        """ Checks that spikes for neuron_id and input_type are in chronological order. """
+
+        if "spikes" not in self.neuron_input[neuron_id][input_type]:
+            # Already streamed to file and freed, or disabled input
+            return
+
+        if input_type == "virtual_neuron":
+            s = self.neuron_input[neuron_id][input_type]["spikes"]
+            assert (np.diff(s) >= 0).all(), \
+                str(neuron_id) + " " + input_type + ": Spikes must be in order"
+        else:
+            spike_times, spike_offset = self.neuron_input[neuron_id][input_type]["spikes"]
+
+            # Spike differences between the last spike of a train and the first spike of the next are ignored
+            within_train = np.ones((max(len(spike_times) - 1, 0),), dtype=bool)
+            train_end = spike_offset[1:-1] - 1
+            within_train[train_end[np.logical_and(0 <= train_end, train_end < len(within_train))]] = False
+
+            assert (spike_times >= 0).all()
+            assert (np.diff(spike_times)[within_train] >= 0).all(), \
+                str(neuron_id) + " " + input_type + ": Spikes must be in order"
 
     ############################################################################
 
@@ -1994,11 +2320,32 @@ class SnuddaInput(object):
             neuron_id = self.neuron_input
 
         spike_times = []
+        spike_file = None
 
         for nID in neuron_id:
             for inputType in self.neuron_input[nID]:
-                for spikes in self.neuron_input[nID][inputType]["spikes"]:
-                    spike_times.append(spikes)
+                if "spikes" in self.neuron_input[nID][inputType]:
+                    spikes = self.neuron_input[nID][inputType]["spikes"]
+
+                    if inputType.lower() == "virtual_neuron":
+                        spike_times.append(spikes)
+                    else:
+                        spike_times += np.split(spikes[0], spikes[1][1:-1])
+
+                elif self.neuron_input[nID][inputType].get("written", False):
+                    # Spikes were streamed to file, read them back
+                    if spike_file is None:
+                        spike_file = h5py.File(self.spike_data_filename, "r")
+
+                    input_group = spike_file["input"][str(nID)]
+                    if inputType.lower() == "virtual_neuron":
+                        if "activity" in input_group:
+                            spike_times.append(input_group["activity/spikes"][()])
+                    elif inputType in input_group:
+                        spike_times += get_input_spike_trains(input_group[inputType])
+
+        if spike_file is not None:
+            spike_file.close()
 
         self.raster_plot(spike_times)
 
@@ -2128,14 +2475,14 @@ class SnuddaInput(object):
             p_keep = np.sqrt(correlation)
 
             # !!! Pass the input_generator
-            spikes = self.make_correlated_spikes(freq=freq,
-                                                 time_range=time_range,
-                                                 num_spike_trains=1,
-                                                 p_keep=p_keep,
-                                                 population_unit_spikes=population_unit_spikes,
-                                                 jitter_dt=jitter_dt,
-                                                 rng=rng,
-                                                 input_generator=input_generator)
+            spikes, _ = self.make_correlated_spikes(freq=freq,
+                                                    time_range=time_range,
+                                                    num_spike_trains=1,
+                                                    p_keep=p_keep,
+                                                    population_unit_spikes=population_unit_spikes,
+                                                    jitter_dt=jitter_dt,
+                                                    rng=rng,
+                                                    input_generator=input_generator)
         else:
 
             if dendrite_location:
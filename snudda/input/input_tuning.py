@@ -22,6 +22,7 @@ from snudda.place.create_cube_mesh import create_cube_mesh
 from snudda.simulate.simulate import SnuddaSimulate
 from snudda.utils import SnuddaLoadNetworkSimulation
 from snudda.utils.load import SnuddaLoad
+from snudda.utils.input_spikes import get_input_info, get_input_spike_csr, get_num_inputs
 from snudda.utils.snudda_path import snudda_isdir, snudda_parse_path, snudda_simplify_path, get_snudda_data
 
 
@@ -677,7 +678,7 @@ class InputTuning(object):
             n_inputs = 0
 
             for input_type in first_input_data[neuron_label]:
-                n_inputs += first_input_data[neuron_label][input_type]["spikes"].shape[0]
+                n_inputs += get_num_inputs(first_input_data[neuron_label][input_type])
 
             n_inputs_lookup[neuron_id] = n_inputs
 
@@ -1722,15 +1723,14 @@ class InputTuning(object):
 
             for nid in neuron_id[neuron_idx]:
                 for input_type in input_spike_data["input"][str(nid)]:
-                    spikes = input_spike_data["input"][str(nid)][input_type]["spikes"][:].ravel()
-                    spikes = spikes[spikes >= 0]  # Negative -1 is filler values, remove them.
+                    spikes, _ = get_input_spike_csr(input_spike_data["input"][str(nid)][input_type])
                     ax.hist(spikes, num_bins, histtype="step")
 
                     if input_type not in distance_to_soma:
                         distance_to_soma[input_type] = []
 
                     distance_to_soma[input_type].append(
-                        input_spike_data["input"][str(nid)][input_type]["distance_to_soma"][:])
+                        get_input_info(input_spike_data["input"][str(nid)][input_type], "distance_to_soma"))
 
             plt.title(f"Input to {nt}")
             plt.xlabel("Time (s)")
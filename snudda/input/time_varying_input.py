@@ -1,3 +1,5 @@
+from collections import OrderedDict
+
 import numpy as np
 
 
@@ -7,24 +9,41 @@ class TimeVaryingInput:
 
         pass
 
+    # Stretched time tables, keyed on (cache_key, start_time, end_time, dt, check_positive, start_at_zero)
+    stretch_time_cache = OrderedDict()
+    stretch_time_cache_size = 1000
+
     @staticmethod
-    def get_stretch_time(frequency_function, end_time, start_time=0, dt=0.001, check_positive=True, start_at_zero=True):
+    def get_stretch_time_table(frequency_function, end_time, start_time=0, dt=0.001, check_positive=True,
+                               start_at_zero=True, cache_key=None):
 
-        """ We want to stretch the time, so that a Poisson process with frequency 1Hz will result in a time varying
-            Poisson process with the instantaneous frequency_function from 0 to end_time, with time resolution dt.
+        """ Returns the time and the corresponding stretched time, see get_stretch_time.
 
-            Any frequency values < 0 are treated as 0.
+            If cache_key is given the table is cached, so that all spike trains using the same frequency function
+            and time range can reuse it. The cache_key must uniquely identify frequency_function.
 
             Args:
                 frequency_function : a numpy compatible function that takes an array and returns an array
                 end_time : end time of the valid time range
                 start_time : start_time that function is defined for
                 dt : time resolution of the sampling of the frequency function
+                check_positive (bool) : Treat frequency values < 0 as 0
                 start_at_zero (bool) : If start_at_zero is True, then the frequency function is f(t=0)
                                        at the start of each interval, if False the simulation time is used.
+                cache_key : hashable key identifying frequency_function, None disables caching
+
+            Returns:
+                time, stretched_time : numpy arrays
 
         """
 
+        if cache_key is not None:
+            table_key = (cache_key, float(start_time), float(end_time), dt, check_positive, start_at_zero)
+
+            if table_key in TimeVaryingInput.stretch_time_cache:
+                TimeVaryingInput.stretch_time_cache.move_to_end(table_key)
+                return TimeVaryingInput.stretch_time_cache[table_key]
+
         time = np.arange(start_time, end_time, dt)
 
         if start_at_zero:
@@ -35,21 +54,50 @@ class TimeVaryingInput:
         frequency = frequency_function(func_time)
 
         # If frequency was a scalar, extend it to be that frequency in entire time range
-        if frequency.size == 1:
+        if np.size(frequency) == 1:
             frequency = np.full(time.shape, frequency)
 
         if check_positive:
             frequency[frequency <= 0] = 0
 
-        try:
-            stretched_time = np.cumsum(frequency*dt) - frequency[0]*dt  # We want stretched time to start at 0
-            func = lambda t, stretched_time=stretched_time, time=time: np.interp(t, stretched_time, time)
-            stretch_end_time = stretched_time[-1]
-        except:
-            import traceback
-            print(traceback.format_exc())
-            import pdb
-            pdb.set_trace()
+        stretched_time = np.cumsum(frequency*dt) - frequency[0]*dt  # We want stretched time to start at 0
+
+        if cache_key is not None:
+            TimeVaryingInput.stretch_time_cache[table_key] = (time, stretched_time)
+
+            while len(TimeVaryingInput.stretch_time_cache) > TimeVaryingInput.stretch_time_cache_size:
+                TimeVaryingInput.stretch_time_cache.popitem(last=False)
+
+        return time, stretched_time
+
+    @staticmethod
+    def get_stretch_time(frequency_function, end_time, start_time=0, dt=0.001, check_positive=True, start_at_zero=True,
+                         cache_key=None):
+
+        """ We want to stretch the time, so that a Poisson process with frequency 1Hz will result in a time varying
+            Poisson process with the instantaneous frequency_function from 0 to end_time, with time resolution dt.
+
+            Any frequency values < 0 are treated as 0.
+
+            Args:
+                frequency_function : a numpy compatible function that takes an array and returns an array
+                end_time : end time of the valid time range
+                start_time : start_time that function is defined for
+                dt : time resolution of the sampling of the frequency function
+                start_at_zero (bool) : If start_at_zero is True, then the frequency function is f(t=0)
+                                       at the start of each interval, if False the simulation time is used.
+                cache_key : hashable key identifying frequency_function, None disables caching
+
+        """
+
+        time, stretched_time = TimeVaryingInput.get_stretch_time_table(frequency_function=frequency_function,
+                                                                       end_time=end_time, start_time=start_time,
+                                                                       dt=dt, check_positive=check_positive,
+                                                                       start_at_zero=start_at_zero,
+                                                                       cache_key=cache_key)
+
+        func = lambda t, stretched_time=stretched_time, time=time: np.interp(t, stretched_time, time)
+        stretch_end_time = stretched_time[-1]
 
         return func, stretch_end_time
 
@@ -72,7 +120,8 @@ class TimeVaryingInput:
         return np.concatenate(t_spikes)
 
     @staticmethod
-    def generate_spikes(frequency_function, end_time, rng, start_time=0, n_spike_trains=1, start_at_zero=True):
+    def generate_spikes(frequency_function, end_time, rng, start_time=0, n_spike_trains=1, start_at_zero=True,
+                        cache_key=None):
 
         """
             Generates spikes with frequency f(t) where f is specified by frequency_function.
@@ -85,18 +134,51 @@ class TimeVaryingInput:
                 start_at_zero (bool) : Is t=0 at the start of the time interval the function is active within?
                                        Default True. If set to False the simulation t is sent directly to the
                                        frequency_function.
+                cache_key : hashable key identifying frequency_function, used to cache the stretched time table
+
+            Returns:
+                List with n_spike_trains spike trains
         """
 
-        stretch_func, stretched_end_time = TimeVaryingInput.get_stretch_time(frequency_function=frequency_function,
-                                                                             start_time=start_time, end_time=end_time,
-                                                                             start_at_zero=start_at_zero)
-        spike_trains = []
+        spike_times, offset = TimeVaryingInput.generate_spikes_csr(frequency_function=frequency_function,
+                                                                   end_time=end_time, rng=rng,
+                                                                   start_time=start_time,
+                                                                   n_spike_trains=n_spike_trains,
+                                                                   start_at_zero=start_at_zero,
+                                                                   cache_key=cache_key)
 
-        for idx in range(0, n_spike_trains):
-            t_spike = TimeVaryingInput._poisson_helper(end_time=stretched_end_time, rng=rng)
-            spike_trains.append(stretch_func(t_spike))  # Stretch the spike times
+        return np.split(spike_times, offset[1:-1])
 
-        return spike_trains
+    @staticmethod
+    def generate_spikes_csr(frequency_function, end_time, rng, start_time=0, n_spike_trains=1, start_at_zero=True,
+                            cache_key=None):
+
+        """
+            Generates n_spike_trains spike trains with frequency f(t) in one pass, see generate_spikes.
+
+            In stretched time the spikes are a 1 Hz Poisson process, so the number of spikes in each train is
+            Poisson distributed and the spike times are uniformly distributed. All spike times are then mapped
+            back to real time with a single interpolation.
+
+            Returns:
+                spike_times, offset : Spike train i is spike_times[offset[i]:offset[i+1]], sorted
+        """
+
+        time, stretched_time = TimeVaryingInput.get_stretch_time_table(frequency_function=frequency_function,
+                                                                       start_time=start_time, end_time=end_time,
+                                                                       start_at_zero=start_at_zero,
+                                                                       cache_key=cache_key)
+        stretched_end_time = stretched_time[-1]
+
+        num_spikes = rng.poisson(stretched_end_time, size=n_spike_trains)
+        train_id = np.repeat(np.arange(n_spike_trains), num_spikes)
+        t_spike = rng.random(train_id.size) * stretched_end_time
+
+        sort_idx = np.lexsort((t_spike, train_id))
+        spike_times = np.interp(t_spike[sort_idx], stretched_time, time)  # Stretch the spike times
+        offset = np.concatenate([[0], np.cumsum(num_spikes)]).astype(int)
+
+        return spike_times, offset
 
     @staticmethod
     def test_spike_frequency():
@@ -104,10 +186,8 @@ class TimeVaryingInput:
         func = lambda t: 5*np.cos(10*2*np.pi*t) + 6 + 10*t
         rng = np.random.default_rng()
 
-        spikes = TimeVaryingInput.generate_spikes(frequency_function=func, start_time=1, end_time=3,
-                                                  n_spike_trains=10000, rng=rng)
-
-        all_spikes = np.concatenate(spikes)
+        all_spikes, _ = TimeVaryingInput.generate_spikes_csr(frequency_function=func, start_time=1, end_time=3,
+                                                             n_spike_trains=10000, rng=rng)
 
         import matplotlib.pyplot as plt
         plt.figure()
@@ -41,6 +41,7 @@ class SnuddaSimulateNeuromodulationSynapse(SnuddaSimulate):
         self.neuromodulation = dict()
         self.current_cell = None
         self.syn_gpcrs = list()
+        self.gpcr_net_con_list = list()
         self.inplace_gpcrs = list()
         self.cell_modulator = dict()
         self.neuromodulation_weight = neuromodulator_description['weight']
@@ -297,10 +298,7 @@ class SnuddaSimulateNeuromodulationSynapse(SnuddaSimulate):
                             nc.delay = self.synapse_delay
                             nc.threshold = self.spike_threshold
 
-                            #self.net_con_list.append(nc)
-                            self.synapse_dict.update({("neuromodulation_nc", 0): nc})
-                    self.synapse_dict.update({("neuromodulation", 0): synapse_gpcr})
-                    #self.synapse_list.append(syn)
+                            self.gpcr_net_con_list.append(nc)
 
                     if sec in added_synapses.keys() and str(seg.x) in added_synapses[sec].keys():
 
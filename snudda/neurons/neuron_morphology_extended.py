@@ -5,6 +5,7 @@ import numexpr
 import numpy as np
 
 from snudda.neurons.morphology_data import MorphologyData, SectionMetaData
+from snudda.utils.alias_sampler import AliasSampler
 from snudda.utils.snudda_path import snudda_parse_path
 
 
@@ -58,6 +59,9 @@ class NeuronMorphologyExtended:
 
         self.morphology_data = dict()
 
+        # Expected synapses per compartment and sampler for each synapse density string, see get_input_location_sampler
+        self.input_location_cache = dict()
+
         # Can we remove these:
         self.axon_density_type = None
         # self.dend_density = None
@@ -200,6 +204,9 @@ class NeuronMorphologyExtended:
         new_neuron.position = position.copy() if position is not None else None
         new_neuron.rotation = rotation.copy() if rotation is not None else None
 
+        # Synapse density only depends on the morphology, not on the position or rotation, so the cache is shared
+        new_neuron.input_location_cache = self.input_location_cache
+
         # Copy over old morphology data
         for md_key, md_value in self.morphology_data.items():
             if md_key == "neuron":
@@ -393,12 +400,27 @@ class NeuronMorphologyExtended:
 
         return synapse_density, dend_idx
 
-    def dendrite_input_locations(self, synapse_density_str, rng, num_locations,
-                                 cluster_size=None, cluster_spread=20e-6):
+    def get_input_location_sampler(self, synapse_density_str):
+
+        """
+        Returns expected number of synapses in each compartment, dendrite compartment indexes and
+        an alias sampler picking dendrite compartments proportionally to their expected synapses.
+
+        The result only depends on the morphology and synapse_density_str, so it is cached and reused
+        by all neurons sharing this morphology and all input types with the same synapse density.
+
+        Args:
+            synapse_density_str (str): Synapse density as a function of soma distance d, e.g. "(d > 100e-6)*1"
+
+        Returns:
+            expected_synapses, dend_idx, sampler
+        """
+
+        if synapse_density_str in self.input_location_cache:
+            return self.input_location_cache[synapse_density_str]
 
         synapse_density, dend_idx = self.get_weighted_synapse_density(synapse_density_str=synapse_density_str)
 
-        # Iterate over all dendrites.
         geometry = self.morphology_data["neuron"].geometry
         section_data = self.morphology_data["neuron"].section_data
         soma_dist = geometry[:, 4]
@@ -419,25 +441,30 @@ class NeuronMorphologyExtended:
         if expected_sum <= 0:
             raise ValueError(f"All compartments have zero synapse density: {synapse_density_str}")
 
+        sampler = AliasSampler(values=dend_idx, weights=expected_synapses[dend_idx])
+
+        self.input_location_cache[synapse_density_str] = (expected_synapses, dend_idx, sampler)
+
+        return expected_synapses, dend_idx, sampler
+
+    def dendrite_input_locations(self, synapse_density_str, rng, num_locations,
+                                 cluster_size=None, cluster_spread=20e-6):
+
+        expected_synapses, dend_idx, sampler = self.get_input_location_sampler(synapse_density_str=synapse_density_str)
+
+        # Iterate over all dendrites.
+        geometry = self.morphology_data["neuron"].geometry
+        section_data = self.morphology_data["neuron"].section_data
+        parent_idx = section_data[:, 3]
+
         if num_locations is not None:
-            try:
-                if cluster_size is not None:
-                    unique_locations = int(np.ceil(num_locations / cluster_size))
-                else:
-                    unique_locations = num_locations
+            if cluster_size is not None:
+                unique_locations = int(np.ceil(num_locations / cluster_size))
+            else:
+                unique_locations = num_locations
 
-                # Cluster synapses are placed around these unique locations with cluster_spread*2
-                syn_idx = rng.choice(a=dend_idx, size=unique_locations, replace=True,
-                                     p=expected_synapses[dend_idx] / expected_sum)
-            except:
-                print(f"dend_idx={dend_idx}\n"
-                      f"num_locations={num_locations}\n"
-                      f"unique_locations={unique_locations}\n"
-                      f"p={expected_synapses[dend_idx] / expected_sum}")
-                import traceback
-                self.write_log(traceback.format_exc(), is_error=True)
-                import pdb
-                pdb.set_trace()
+            # Cluster synapses are placed around these unique locations with cluster_spread*2
+            syn_idx = sampler.sample(rng=rng, size=unique_locations)
         else:
             if not (cluster_size is None or cluster_size == 1):
                 raise ValueError(f"If cluster_size is set, then num_locations must be set.")
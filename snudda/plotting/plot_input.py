@@ -7,6 +7,7 @@ import matplotlib.pyplot as plt
 from matplotlib import cm
 
 from snudda.utils.load import SnuddaLoad
+from snudda.utils.input_spikes import get_input_spike_matrix
 
 
 class PlotInput(object):
@@ -50,7 +51,7 @@ class PlotInput(object):
             for input_type in self.input_data["input"][input_target]:
                 input_info = self.input_data["input"][input_target][input_type]
 
-                data[input_type] = input_info["spikes"][()]
+                data[input_type], _ = get_input_spike_matrix(input_info)
 
         return data
     
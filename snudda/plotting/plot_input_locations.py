@@ -6,6 +6,7 @@ import json
 from snudda.utils.snudda_path import get_snudda_data
 from snudda.utils.snudda_path import snudda_parse_path
 from snudda.utils import SnuddaLoad
+from snudda.utils.input_spikes import get_input_info
 from snudda.neurons.neuron_morphology_extended import NeuronMorphologyExtended
 from snudda.neurons.neuron_prototype import NeuronPrototype
 import matplotlib.pyplot as plt
@@ -187,8 +188,9 @@ class SnuddaPlotInputLocations:
             if input_type and input_name != input_type:
                 continue
 
-            section_id = section_id + list(self.input_data["input"][str(neuron_id)][input_name].attrs["section_id"])
-            section_x = section_x + list(self.input_data["input"][str(neuron_id)][input_name].attrs["section_x"])
+            input_group = self.input_data["input"][str(neuron_id)][input_name]
+            section_id = section_id + list(get_input_info(input_group, "section_id"))
+            section_x = section_x + list(get_input_info(input_group, "section_x"))
 
         return np.array(section_id), np.array(section_x)
 
@@ -197,7 +199,8 @@ class SnuddaPlotInputLocations:
         distance_to_soma = []
 
         if input_name in self.input_data["input"][str(neuron_id)]:
-            distance_to_soma += list(self.input_data["input"][str(neuron_id)][input_name].attrs["distance_to_soma"])
+            distance_to_soma += list(get_input_info(self.input_data["input"][str(neuron_id)][input_name],
+                                                    "distance_to_soma"))
 
         return np.array(distance_to_soma)
 
@@ -8,6 +8,7 @@ import h5py
 import numpy as np
 from snudda.utils.load import SnuddaLoad
 from snudda.utils.load_network_simulation import SnuddaLoadNetworkSimulation
+from snudda.utils.input_spikes import get_num_inputs
 import matplotlib.pyplot as plt
 
 import re
@@ -239,7 +240,7 @@ class PlotTraces:
         if title is None and self.input_info is not None and len(trace_id) == 1:
             n_inputs = 0
             for input_type in self.input_info["input"][str(trace_id[0])]:
-                n_inputs += self.input_info["input"][str(trace_id[0])][input_type]["spikes"].shape[0]
+                n_inputs += get_num_inputs(self.input_info["input"][str(trace_id[0])][input_type])
 
             title = f"{self.network_info.data['neurons'][trace_id[0]]['name']} receiving {n_inputs} inputs"
 
@@ -383,7 +384,7 @@ class PlotTraces:
             if title is None and self.input_info is not None and len(trace_id) == 1:
                 n_inputs = 0
                 for input_type in self.input_info["input"][str(trace_id[0])]:
-                    n_inputs += self.input_info["input"][str(trace_id[0])][input_type]["spikes"].shape[0]
+                    n_inputs += get_num_inputs(self.input_info["input"][str(trace_id[0])][input_type])
 
                 title = f"{self.network_info.data['neurons'][trace_id[0]]['name']} receiving {n_inputs} synaptic inputs"
             title = f"{self.network_info.data['neurons'][trace_id[r]]['name']}"
@@ -4,6 +4,8 @@ import numpy as np
 from mpi4py import MPI  # This must be imported before neuron, to run parallel
 from neuron import h  # , gui
 
+from snudda.utils.load_network_simulation import SnuddaLoadNetworkSimulation
+
 
 """
 
@@ -109,6 +111,7 @@ class SynapseData:
         self.synapse_type = []
         self.presynaptic_id = []
         self.cond = []
+        self.num_flushed = 0  # Number of time steps already written to disk, see SnuddaSaveNetworkRecordings.flush
 
     def append(self, data, synapse_type, presynaptic_id, sec_id, sec_x, cond):
         self.data.append(data)
@@ -144,6 +147,7 @@ class CompartmentData:
         self.data = []
         self.sec_id = []
         self.sec_x = []
+        self.num_flushed = 0  # Number of time steps already written to disk, see SnuddaSaveNetworkRecordings.flush
 
     def append(self, data, sec_id, sec_x):
         # !!! Issue (?): The same compartment can hold several recordings now.
@@ -180,13 +184,36 @@ class SnuddaSaveNetworkRecordings:
 
     # TODO: Add saving of simulation_config file (and experiment_config_file for pair recording)
 
-    def __init__(self, output_file, network_data=None, sample_dt=None):
+    def __init__(self, output_file, network_data=None, sample_dt=None, shard_output=False, shard_merge_mode="virtual"):
+
+        """
+        Constructor
+
+        Args:
+            output_file (str): Path to output file
+            network_data (dict): Network data, from SnuddaLoad
+            sample_dt (float): Sample time step for time series (in seconds), None means every time step is saved
+            shard_output (bool): Each worker writes its recordings to its own shard file (see write_shard),
+                                 instead of the workers taking turns writing to output_file
+            shard_merge_mode (str): How shards are presented in output_file, "virtual" (HDF5 virtual datasets
+                                    pointing to the shard files, which must be kept) or "copy" (data is copied
+                                    into output_file, and the shard files are removed)
+        """
+
+        assert shard_merge_mode in ["virtual", "copy"], \
+            f"Unknown shard_merge_mode {shard_merge_mode}, use 'virtual' or 'copy'"
+
         self.output_file = output_file
         self.network_data = network_data
         self.header_exists = False
         self.neuron_activities = dict()
         self.time = None
+        self.time_flushed = 0
         self.sample_dt = sample_dt
+        self.sample_step = None
+        self.flushed = False
+        self.shard_output = shard_output
+        self.shard_merge_mode = shard_merge_mode
 
         self.units = dict()
 
@@ -195,6 +222,7 @@ class SnuddaSaveNetworkRecordings:
     def set_new_output_file(self, output_file):
         self.output_file = output_file
         self.header_exists = False
+        self.flushed = False
 
     def add_unit(self, data_type, target_unit, conversion_factor):
         # Units reference chart: https://www.neuron.yale.edu/neuron/static/docs/units/unitchart.html
@@ -309,71 +337,372 @@ class SnuddaSaveNetworkRecordings:
 
         if self.sample_dt is None:
             return None
-        else:
+        elif self.sample_step is None:
+            # Computed once, after a flush the time vector only holds the latest time window
             converted_time = np.array(self.time) * self.get_conversion("time")
             dt = converted_time[1] - converted_time[0]
-            sample_step = int(np.round(self.sample_dt / dt))
-            return sample_step
+            self.sample_step = int(np.round(self.sample_dt / dt))
+
+        return self.sample_step
+
+    @staticmethod
+    def get_samples(data, num_flushed, sample_step):
+
+        """
+        Returns the samples to save from a time series, data has one column per time step. The first column of
+        data is time step num_flushed of the simulation, only every sample_step time step (counted from the start
+        of the simulation) is kept.
+        """
+
+        if sample_step is None:
+            return data
+
+        return data[..., (-num_flushed) % sample_step::sample_step]
+
+    @staticmethod
+    def append_data(group, name, data, resizable, compression="gzip"):
+
+        """
+        Writes data to dataset name in group. If the dataset already exists the data is appended
+        along the last axis (time steps, or spikes).
+
+        Args:
+            group: HDF5 group
+            name (str): Name of dataset
+            data (np.ndarray): Data to write
+            resizable (bool): Create dataset so that it can be appended to later
+            compression (str): Compression used when creating dataset
+
+        Returns:
+            HDF5 dataset
+        """
+
+        if name not in group:
+            if resizable:
+                return group.create_dataset(name, data=data, maxshape=data.shape[:-1] + (None,),
+                                            chunks=True, compression=compression)
+            else:
+                return group.create_dataset(name, data=data, compression=compression)
+
+        data_set = group[name]
+        old_size = data_set.shape[-1]
+        data_set.resize(old_size + data.shape[-1], axis=data_set.ndim - 1)
+        data_set[..., old_size:] = data
+
+        return data_set
+
+    @staticmethod
+    def clear_recording(m):
+
+        """ Clears the NEURON vectors of measurement m, NEURON keeps appending to them during the simulation. """
+
+        if len(m.data) > 0:
+            m.num_flushed += int(m.data[0].size())
+
+        for d in m.data:
+            d.resize(0)
+
+    def flush(self):
+
+        """
+        Appends the data recorded since the last flush to the output file, and clears the NEURON vectors,
+        so that memory use stays bounded during long simulations and partial results are kept if a run crashes.
+        Call flush between consecutive NEURON runs (e.g. pc.psolve), write() writes the remaining data at the end.
+        Must be called on all workers.
+        """
+
+        self.write(flush=True)
 
-    def write(self):
+    def write(self, flush=False):
+
+        """
+        Writes recorded data to output file. If flush() has been called before, the remaining data is
+        appended to the existing datasets.
+
+        Args:
+            flush (bool): Clear the NEURON vectors after writing, and create resizable datasets (see flush)
+        """
 
         self.write_header()
 
         sample_step = self.get_sample_step()
+        resizable = flush or self.flushed
 
-        if int(self.pc.id()) == 0:
+        if int(self.pc.id()) == 0 and self.time is not None:
 
             # TODO: We need to save max time even if we do not save the soma voltage(!)
-            out_file = h5py.File(self.output_file, "a")
-            if "time" not in out_file and self.time is not None:
-                print(f"Using sample dt = {self.sample_dt} (sample step size {sample_step})")
-                try:
-                    out_file.create_dataset("time", data=np.array(self.time)[::sample_step] * self.get_conversion("time"))
-                    out_file.close()
-                except:
-                    import traceback
-                    print(f"self.time={self.time}")
-                    print(f"{traceback.format_exc()}", flush=True)
-                    import pdb
-                    pdb.set_trace()
+            with h5py.File(self.output_file, "a") as out_file:
+                if resizable or "time" not in out_file:
+                    if "time" not in out_file:
+                        print(f"Using sample dt = {self.sample_dt} (sample step size {sample_step})")
 
-        for i in range(int(self.pc.nhost())):
+                    time = self.get_samples(np.array(self.time), self.time_flushed, sample_step)
+                    self.append_data(group=out_file, name="time", data=time * self.get_conversion("time"),
+                                     resizable=resizable, compression=None)
 
+        if self.shard_output:
+            self.write_shard(sample_step=sample_step, flush=flush)
             self.pc.barrier()
 
-            if int(self.pc.id()) == i:
-                print(f"Worker {i+1}/{int(self.pc.nhost())} writing data to {self.output_file}")
+            if not flush and int(self.pc.id()) == 0:
+                self.merge_shards(virtual=self.shard_merge_mode == "virtual")
+
+        else:
+            for i in range(int(self.pc.nhost())):
+
+                self.pc.barrier()
+
+                if int(self.pc.id()) == i:
+                    if not flush:
+                        print(f"Worker {i+1}/{int(self.pc.nhost())} writing data to {self.output_file}")
+
+                    out_file = h5py.File(self.output_file, "a")
+
+                    for na in self.neuron_activities.values():
+                        neuron_id_str = str(na.neuron_id)
+                        if neuron_id_str not in out_file["neurons"]:
+                            out_file["neurons"].create_group(neuron_id_str)
 
-                out_file = h5py.File(self.output_file, "a")
+                        for m in na.data.values():
 
-                for na in self.neuron_activities.values():
-                    neuron_id_str = str(na.neuron_id)
-                    if neuron_id_str not in out_file["neurons"]:
-                        out_file["neurons"].create_group(neuron_id_str)
+                            conversion_factor = self.get_conversion(m.data_type)
 
-                    for m in na.data.values():
+                            if isinstance(m, SpikeData):
+                                # Spike data is not a time series, and should never be downsampled
+                                data = m.to_numpy()
+                            else:
+                                data = self.get_samples(m.to_numpy(), m.num_flushed, sample_step)
 
-                        conversion_factor = self.get_conversion(m.data_type)
+                            data_set = self.append_data(group=out_file["neurons"][neuron_id_str], name=m.data_type,
+                                                        data=data * conversion_factor, resizable=resizable)
 
-                        if isinstance(m, SpikeData):
-                            # Spike data is not a time series, and should never be downsampled
-                            data_sample_step = None
-                        else:
-                            data_sample_step = sample_step
+                            data_set.attrs["sec_id"] = np.array(m.sec_id)
+                            data_set.attrs["sec_x"] = np.array(m.sec_x)
 
-                        data_set = out_file["neurons"][neuron_id_str].create_dataset(m.data_type,
-                                                                                     data=m.to_numpy()[:, ::data_sample_step]*conversion_factor,
-                                                                                     compression="gzip")
+                            if isinstance(m, SynapseData):
+                                data_set.attrs["synapse_type"] = np.array(m.synapse_type)
+                                data_set.attrs["presynaptic_id"] = np.array(m.presynaptic_id)
+                                data_set.attrs["cond"] = np.array(m.cond)
 
-                        data_set.attrs["sec_id"] = np.array(m.sec_id)
-                        data_set.attrs["sec_x"] = np.array(m.sec_x)
+                    out_file.close()
+
+        self.pc.barrier()
+
+        if flush:
+            if self.time is not None:
+                self.time_flushed += int(self.time.size())
+                self.time.resize(0)
 
-                        if isinstance(m, SynapseData):
-                            data_set.attrs["synapse_type"] = np.array(m.synapse_type)
-                            data_set.attrs["presynaptic_id"] = np.array(m.presynaptic_id)
-                            data_set.attrs["cond"] = np.array(m.cond)
+            for na in self.neuron_activities.values():
+                for m in na.data.values():
+                    self.clear_recording(m)
 
-                out_file.close()
+            self.flushed = True
+
+        elif int(self.pc.id()) == 0:
+            self.write_spike_table()
 
         self.pc.barrier()
 
+    def write_spike_table(self):
+
+        """
+        Writes columnar spike table (see SnuddaLoadNetworkSimulation.create_spike_table) to the "spike_table" group
+        in the output file, using the spikes already written to neurons/neuron_id/spikes.
+        This lets readers load all spikes with a few reads, instead of one read per neuron.
+        """
+
+        with h5py.File(self.output_file, "a") as out_file:
+
+            spike_data = dict()
+            for neuron_id_str, neuron_group in out_file["neurons"].items():
+                if "spikes" in neuron_group:
+                    spike_data[int(neuron_id_str)] = neuron_group["spikes"][()]
+
+            if "meta_data/id" in out_file:
+                num_neurons = len(out_file["meta_data/id"])
+            else:
+                num_neurons = max(spike_data.keys(), default=-1) + 1
+
+            spike_table = SnuddaLoadNetworkSimulation.create_spike_table(spike_data=spike_data,
+                                                                         num_neurons=num_neurons)
+
+            if "spike_table" in out_file:
+                del out_file["spike_table"]
+
+            spike_group = out_file.create_group("spike_table")
+
+            for name, data in spike_table.items():
+                spike_group.create_dataset(name, data=data, compression="gzip")
+
+    def get_shard_file(self, worker_id=None):
+
+        """ Returns path to shard file of worker (default current worker), e.g. output-shard-3.hdf5 """
+
+        if worker_id is None:
+            worker_id = int(self.pc.id())
+
+        return f"{os.path.splitext(self.output_file)[0]}-shard-{worker_id}.hdf5"
+
+    def write_shard(self, sample_step=None, flush=False):
+
+        """
+        Writes the recordings of this worker to its shard file (see get_shard_file). All recordings of a data type
+        are written as one matrix, one row per recording (neuron by neuron, sorted on neuron ID).
+        Spikes are concatenated into a single row, since spike trains differ in length.
+
+        Shard file layout, for each data type (e.g. "voltage", "spikes"):
+            data_type/data : Matrix with recordings
+            data_type/neuron_id : Neuron ID of the neurons in the shard
+            data_type/offset : Neuron neuron_id[i] has rows offset[i]:offset[i+1]
+                               (for spikes, see below)
+            data_type/sec_id, data_type/sec_x (and synapse_type, presynaptic_id, cond for synapse data) :
+                One value per recording, neuron_id[i] has values attribute_offset[i]:attribute_offset[i+1]
+
+        Spikes are appended as one block per write (flush() or the final write()). The spike offset is a matrix
+        with one column per block, in block b neuron_id[i] has columns offset[i, b]:offset[i+1, b] of data.
+
+        If flush() has been called before, the data is appended to the existing data matrices.
+
+        Args:
+            sample_step (int): Only save every sample_step time step for time series
+            flush (bool): Create resizable datasets, so that later writes can append to them
+        """
+
+        shard_file = self.get_shard_file()
+        resizable = flush or self.flushed
+
+        if not flush:
+            print(f"Worker {int(self.pc.id()) + 1}/{int(self.pc.nhost())} writing data to {shard_file}")
+
+        # Group the recordings by data type
+        measurements = dict()
+
+        for neuron_id in sorted(self.neuron_activities.keys()):
+            for m in self.neuron_activities[neuron_id].data.values():
+                if m.data_type not in measurements:
+                    measurements[m.data_type] = []
+
+                measurements[m.data_type].append(m)
+
+        with h5py.File(shard_file, "a" if self.flushed else "w") as out_file:
+
+            for data_type, m_list in measurements.items():
+
+                conversion_factor = self.get_conversion(data_type)
+                is_spike_data = isinstance(m_list[0], SpikeData)
+
+                if is_spike_data:
+                    # Spike data is not a time series, and should never be downsampled
+                    data = [m.to_numpy().reshape(1, -1) for m in m_list]
+                    num_items = [d.shape[1] for d in data]
+                    data = np.hstack(data) if len(data) > 0 else np.zeros((1, 0))
+                else:
+                    data = [self.get_samples(m.to_numpy(), m.num_flushed, sample_step) for m in m_list]
+                    num_items = [d.shape[0] for d in data]
+                    data = np.vstack(data)
+
+                offset = np.concatenate([[0], np.cumsum(num_items)]).astype(int)
+
+                if data_type in out_file:
+                    if is_spike_data:
+                        # Spike block is placed after the spikes already written
+                        self.append_data(group=out_file[data_type], name="offset",
+                                         data=offset.reshape(-1, 1) + out_file[data_type]["data"].shape[1],
+                                         resizable=True, compression=None)
+
+                    self.append_data(group=out_file[data_type], name="data", data=data * conversion_factor,
+                                     resizable=True)
+                    continue
+
+                data_group = out_file.create_group(data_type)
+                self.append_data(group=data_group, name="data", data=data * conversion_factor,
+                                 resizable=resizable, compression=None)
+                data_group.create_dataset("neuron_id", data=np.array([m.neuron_id for m in m_list], dtype=int))
+
+                if is_spike_data:
+                    self.append_data(group=data_group, name="offset", data=offset.reshape(-1, 1),
+                                     resizable=resizable, compression=None)
+                else:
+                    data_group.create_dataset("offset", data=offset)
+
+                data_group.create_dataset("attribute_offset",
+                                          data=np.concatenate([[0], np.cumsum([len(m.sec_id) for m in m_list])])
+                                          .astype(int))
+
+                for attr_name in ["sec_id", "sec_x", "synapse_type", "presynaptic_id", "cond"]:
+                    if hasattr(m_list[0], attr_name):
+                        data_group.create_dataset(attr_name,
+                                                  data=np.concatenate([np.array(getattr(m, attr_name))
+                                                                       for m in m_list]))
+
+    def merge_shards(self, virtual=True):
+
+        """
+        Presents the data in the shard files in output_file, using the same layout as the serial writer
+        (neurons/neuron_id/data_type), so that it can be read by SnuddaLoadNetworkSimulation.
+
+        Args:
+            virtual (bool): If True the datasets in output_file are HDF5 virtual datasets pointing to the shards,
+                            and the shard files must be kept next to output_file. If False the data is copied
+                            into output_file and the shard files are removed.
+        """
+
+        shard_files = [self.get_shard_file(worker_id) for worker_id in range(int(self.pc.nhost()))]
+
+        with h5py.File(self.output_file, "a") as out_file:
+
+            for shard_file in shard_files:
+                with h5py.File(shard_file, "r") as shard:
+
+                    for data_type, data_group in shard.items():
+
+                        is_spike_data = data_type == "spikes"
+                        shard_data = data_group["data"]
+                        offset = data_group["offset"][()]
+                        attribute_offset = data_group["attribute_offset"][()]
+
+                        if virtual:
+                            # Relative path, the shard files are located next to the output file
+                            v_source = h5py.VirtualSource(os.path.basename(shard_file), shard_data.name,
+                                                          shape=shard_data.shape, dtype=shard_data.dtype)
+
+                        for idx, neuron_id in enumerate(data_group["neuron_id"]):
+
+                            neuron_id_str = str(neuron_id)
+                            if neuron_id_str not in out_file["neurons"]:
+                                out_file["neurons"].create_group(neuron_id_str)
+
+                            if is_spike_data:
+                                # One block of spikes per write, see write_shard
+                                block_start, block_end = offset[idx, :], offset[idx + 1, :]
+                                block_pos = np.concatenate([[0], np.cumsum(block_end - block_start)])
+                                data_shape = (1, block_pos[-1])
+                                data_slices = [(np.s_[:, pos:pos + end - start], np.s_[:, start:end])
+                                               for pos, start, end in zip(block_pos, block_start, block_end)
+                                               if end > start]
+                            else:
+                                start_idx, end_idx = offset[idx], offset[idx + 1]
+                                data_shape = (end_idx - start_idx, shard_data.shape[1])
+                                data_slices = [(np.s_[:, :], np.s_[start_idx:end_idx, :])]
+
+                            if virtual and np.prod(data_shape) > 0:
+                                layout = h5py.VirtualLayout(shape=data_shape, dtype=shard_data.dtype)
+                                for layout_slice, data_slice in data_slices:
+                                    layout[layout_slice] = v_source[data_slice]
+                                data_set = out_file["neurons"][neuron_id_str].create_virtual_dataset(data_type,
+                                                                                                    layout)
+                            else:
+                                data = np.zeros(data_shape, dtype=shard_data.dtype)
+                                for layout_slice, data_slice in data_slices:
+                                    data[layout_slice] = shard_data[data_slice]
+                                data_set = out_file["neurons"][neuron_id_str].create_dataset(
+                                    data_type, data=data, compression="gzip")
+
+                            for attr_name in ["sec_id", "sec_x", "synapse_type", "presynaptic_id", "cond"]:
+                                if attr_name in data_group:
+                                    data_set.attrs[attr_name] = \
+                                        data_group[attr_name][attribute_offset[idx]:attribute_offset[idx + 1]]
+
+                if not virtual:
+                    os.remove(shard_file)
@@ -37,7 +37,9 @@ from snudda.neurons.neuron_model_extended import NeuronModel
 from snudda.simulate.nrn_simulator_parallel import NrnSimulatorParallel
 # If simulationConfig is set, those values override other values
 from snudda.utils.load import SnuddaLoad
+from snudda.utils.input_spikes import get_input_info, get_input_spike_csr
 from snudda.simulate.save_network_recording import SnuddaSaveNetworkRecordings
+from snudda.simulate.synapse_registry import SynapseRegistry
 
 
 # !!! Need to gracefully handle the situation where there are more workers than
@@ -59,7 +61,11 @@ class SnuddaSimulate(object):
                  disable_synapses=None,
                  disable_gap_junctions=None,
                  sample_dt=None,
-                 simulation_config=None):
+                 simulation_config=None,
+                 distribution_strategy=None,
+                 shard_output=None,
+                 flush_interval=None,
+                 share_spike_sources=None):
 
         """
         Constructor
@@ -75,6 +81,15 @@ class SnuddaSimulate(object):
             disable_gap_junctions (bool): Disable gap junctions, default False
             disable_synapses (bool): Disable synapses, default False
             simulation_config (str, optional): Path to config file with simulation info (including network_path)
+            distribution_strategy (str, optional): How neurons are distributed between workers, "round_robin"
+                                                   (default), "contiguous" or "load_balanced", see distribute_neurons
+            shard_output (bool, optional): Each worker writes output to its own shard file, which are then presented
+                                           as one file using HDF5 virtual datasets, see SnuddaSaveNetworkRecordings
+            flush_interval (float, optional): Run the simulation in time windows of flush_interval (in seconds),
+                                              writing recorded data to disk and clearing the recordings after
+                                              each window, default None (data is written at the end)
+            share_spike_sources (bool, optional): Inputs with identical spike trains onto a neuron share a single
+                                                  VecStim, see add_external_input, default False
 
         """
 
@@ -116,6 +131,7 @@ class SnuddaSimulate(object):
         self.snudda_loader = None
         self.network_info = None
         self.synapses = None
+        self.synapse_groups = None
         self.gap_junctions = None
         self.num_neurons = None
         self.config_file = None
@@ -124,6 +140,7 @@ class SnuddaSimulate(object):
         self.neuron_id = None
         self.neuron_id_on_node = None
         self.synapse_parameters = None
+        self.synapse_parameter_cache = dict()
 
         self.sim_start_time = 0
         self.fih_time = None
@@ -136,6 +153,10 @@ class SnuddaSimulate(object):
 
         self.disable_synapses = False
         self.disable_gap_junctions = False
+        self.distribution_strategy = "round_robin"
+        self.shard_output = False
+        self.flush_interval = None
+        self.share_spike_sources = False
 
         if simulation_config:
 
@@ -176,6 +197,18 @@ class SnuddaSimulate(object):
             if "verbose" in self.sim_info:
                 self.verbose = self.sim_info["verbose"]
 
+            if "distribution_strategy" in self.sim_info:
+                self.distribution_strategy = self.sim_info["distribution_strategy"]
+
+            if "shard_output" in self.sim_info:
+                self.shard_output = self.sim_info["shard_output"]
+
+            if "flush_interval" in self.sim_info:
+                self.flush_interval = self.sim_info["flush_interval"]
+
+            if "share_spike_sources" in self.sim_info:
+                self.share_spike_sources = self.sim_info["share_spike_sources"]
+
             if "snudda_data" in self.sim_info:
                 # Do not change this unless you know what you are doing
                 self.snudda_data = self.sim_info["snudda_data"]
@@ -216,6 +249,18 @@ class SnuddaSimulate(object):
         if disable_gap_junctions is not None:
             self.disable_gap_junctions = disable_gap_junctions
 
+        if distribution_strategy is not None:
+            self.distribution_strategy = distribution_strategy
+
+        if shard_output is not None:
+            self.shard_output = shard_output
+
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+
+        if share_spike_sources is not None:
+            self.share_spike_sources = share_spike_sources
+
         self.synapse_type_lookup = {1: "GABA", 2: "AMPA_NMDA", 3: "gap_junction"}
 
         self.neurons = {}
@@ -224,9 +269,7 @@ class SnuddaSimulate(object):
 
         self.virtual_neurons = {}
 
-        self.net_con_list = []  # Avoid premature garbage collection -- todo: THIS WILL BE REMOVED
-        self.synapse_list = []  # todo: THIS WILL BE REMOVED, replaced by synapse_dict
-        self.synapse_dict = dict()
+        self.synapse_registry = SynapseRegistry()  # Avoid premature garbage collection of synapses and NetCons
         self.i_stim = []
         self.v_clamp_list = []
         self.gap_junction_list = []
@@ -253,13 +296,30 @@ class SnuddaSimulate(object):
         self.load_network_info(self.network_file)
 
         self.record = SnuddaSaveNetworkRecordings(output_file=self.output_file, network_data=self.network_info,
-                                                  sample_dt=self.sample_dt)
+                                                  sample_dt=self.sample_dt, shard_output=self.shard_output)
         self.record.add_unit(data_type="voltage", target_unit="V", conversion_factor=1e-3)
         self.record.add_unit(data_type="synaptic_current", target_unit="A", conversion_factor=1e-9)
         self.record.add_unit(data_type="spikes", target_unit="s", conversion_factor=1e-3)
         self.record.add_unit(data_type="time", target_unit="s", conversion_factor=1e-3)
         # TODO: Add more units as needed https://www.neuron.yale.edu/neuron/static/docs/units/unitchart.html
 
+    ############################################################################
+
+    # Kept for backwards compatibility, the synapses are stored in self.synapse_registry
+
+    @property
+    def synapse_dict(self):
+        """ Read only dictionary (source_id, dest_id) -> list of (syn, nc, synapse_type_id, section_id). """
+        return self.synapse_registry
+
+    @property
+    def synapse_list(self):
+        return self.synapse_registry.synapses
+
+    @property
+    def net_con_list(self):
+        return self.synapse_registry.net_cons
+
     # def __del__(self):
     #     print("Destructor called -- explicitly deleting neurons from NEURON")
     #     for n in self.neurons.values():
@@ -355,11 +415,14 @@ class SnuddaSimulate(object):
         self.write_log(f"Worker {int(self.pc.id())} : Loading network from {network_file}")
 
         from snudda.utils.load import SnuddaLoad
-        self.snudda_loader = SnuddaLoad(network_file)
+
+        # Synapses are kept on file, each worker only reads the rows of its own neurons (see find_synapse_ranges)
+        self.snudda_loader = SnuddaLoad(network_file, load_synapses=False)
         self.network_info = self.snudda_loader.data
 
         self.synapses = self.network_info["synapses"]
-        self.gap_junctions = self.network_info["gap_junctions"]
+        self.synapse_groups = None
+        self.gap_junctions = self.network_info["gap_junctions"][()]
 
         # We are only passed information about neurons on our node if
         # SplitConnectionFile was run, so need to use nNeurons to know
@@ -393,30 +456,136 @@ class SnuddaSimulate(object):
         """
         Distribute neurons between workers.
         This code is run on all workers, will generate different lists on each
+
+        The distribution strategy (self.distribution_strategy) is one of:
+            "round_robin" : neuron i is placed on worker i % num_workers
+            "contiguous" : each worker gets a contiguous block of neuron IDs, of (almost) equal size
+            "load_balanced" : each worker gets a contiguous block of neuron IDs, with (almost) equal load,
+                              see get_neuron_load
+
+        With contiguous blocks each worker only needs a contiguous part of the synapse matrix, since the
+        synapses are sorted on destination neuron ID.
         """
 
         # This code is run on all workers, will generate different lists on each
-        self.write_log("Distributing neurons.")
+        self.write_log(f"Distributing neurons ({self.distribution_strategy}).")
 
         assert self.num_neurons >= int(self.pc.nhost()), \
             f"Do not allocate more workers ({int(self.pc.nhost())}) than there are neurons ({self.num_neurons})."
 
-        self.neuron_id = range(int(self.pc.id()), self.num_neurons, int(self.pc.nhost()))
+        self.neuron_nodes = self.get_neuron_nodes(num_workers=int(self.pc.nhost()),
+                                                  strategy=self.distribution_strategy)
+
+        self.neuron_id_on_node = self.neuron_nodes == int(self.pc.id())
+        self.neuron_id = np.flatnonzero(self.neuron_id_on_node)
+
+    def get_neuron_nodes(self, num_workers, strategy="round_robin"):
+
+        """
+        Returns the worker of each neuron.
+
+        Args:
+            num_workers (int): Number of workers
+            strategy (str): "round_robin", "contiguous" or "load_balanced", see distribute_neurons
+
+        Returns:
+            neuron_nodes (np.array): Worker for each neuron
+        """
+
+        if strategy == "round_robin":
+            return np.arange(0, self.num_neurons) % num_workers
+
+        if strategy == "contiguous":
+            range_borders = np.linspace(0, self.num_neurons, num_workers + 1).astype(int)
+        elif strategy == "load_balanced":
+            range_borders = self.partition_load(load=self.get_neuron_load(), num_workers=num_workers)
+        else:
+            raise ValueError(f"Unknown distribution strategy {strategy}, "
+                             f"use 'round_robin', 'contiguous' or 'load_balanced'")
+
+        return np.repeat(np.arange(0, num_workers), np.diff(range_borders))
+
+    def get_neuron_load(self):
+
+        """
+        Estimates the simulation load of each neuron, as the number of compartments (approximated by the number
+        of points in the morphology) plus the number of incoming synapses. Virtual neurons have load 1.
+
+        Returns:
+            load (np.array): Estimated load for each neuron
+        """
+
+        num_points = dict()
+        load = np.ones((self.num_neurons,), dtype=np.int64)
+
+        for neuron_id, neuron_info in enumerate(self.network_info["neurons"]):
+            if neuron_info["virtual_neuron"]:
+                continue
+
+            if neuron_info.get("morphology") is None:
+                continue
+
+            morph = snudda_parse_path(neuron_info["morphology"], self.snudda_data)
+
+            if morph not in num_points:
+                num_points[morph] = self.count_morphology_points(morph)
+
+            load[neuron_id] = max(num_points[morph], 1)
+
+        dest_id, start_row, end_row = self.get_synapse_groups()
+        load[dest_id] += (end_row - start_row) * ~self.is_virtual_neuron[dest_id]
+
+        return load
+
+    @staticmethod
+    def count_morphology_points(morphology_file):
+
+        """ Returns number of points in SWC morphology file, or 1 if the file can not be read. """
+
+        if not os.path.isfile(morphology_file):
+            return 1
+
+        with open(morphology_file, "r") as f:
+            return sum(1 for line in f if line.strip() and not line.lstrip().startswith("#"))
+
+    @staticmethod
+    def partition_load(load, num_workers):
+
+        """
+        Splits the neurons into num_workers contiguous blocks with (almost) equal total load.
+        Each block contains at least one neuron.
+
+        Args:
+            load (np.array): Load of each neuron
+            num_workers (int): Number of workers
+
+        Returns:
+            range_borders (np.array): Worker i gets neurons range_borders[i]:range_borders[i+1]
+        """
+
+        num_neurons = len(load)
+        assert num_neurons >= num_workers, f"More workers ({num_workers}) than neurons ({num_neurons})"
 
-        self.neuron_id_on_node = np.zeros((self.num_neurons,), dtype=bool)
-        self.neuron_id_on_node[self.neuron_id] = True
+        cum_load = np.cumsum(load)
 
-        # TODO: Change to these ranges: range_borders = np.linspace(0, num_neurons, n_workers + 1).astype(int)
-        #       will be faster, because of new numbering of neurons.
+        # Place each border where the cumulative load is closest to the worker's share of total load
+        target_load = cum_load[-1] * np.arange(1, num_workers) / num_workers
+        border_idx = np.searchsorted(cum_load, target_load)
+        border_idx -= (border_idx > 0) & (np.abs(cum_load[np.maximum(border_idx - 1, 0)] - target_load)
+                                          < np.abs(cum_load[border_idx] - target_load))
 
-        range_borders = np.linspace(0, self.num_neurons, self.pc.nhost() + 1).astype(int)
-        start_pos = range_borders[0]
-        neuron_nodes = []
-        for idx, end_pos in enumerate(range_borders[1:]):
-            neuron_nodes += [idx] * (end_pos - start_pos)
-            start_pos = end_pos
+        range_borders = np.zeros((num_workers + 1,), dtype=int)
+        range_borders[1:-1] = border_idx + 1
+        range_borders[-1] = num_neurons
 
-        self.neuron_nodes = neuron_nodes
+        # Make sure every worker has at least one neuron
+        for idx in range(1, num_workers):
+            range_borders[idx] = max(range_borders[idx], range_borders[idx - 1] + 1)
+
+        for idx in range(num_workers - 1, 0, -1):
+            range_borders[idx] = min(range_borders[idx], range_borders[idx + 1] - 1)
+
+        return range_borders
 
     ############################################################################
 
@@ -430,6 +599,7 @@ class SnuddaSimulate(object):
 
         # We need to load all the synapse parameters
         self.synapse_parameters = dict()
+        self.synapse_parameter_cache = dict()
 
         for (preType, postType) in self.network_info["connectivity_distributions"]:
 
@@ -702,98 +872,90 @@ class SnuddaSimulate(object):
 
         self.write_log("connect_network_synapses")
 
-        # This loops through all the synapses, and connects the relevant ones
-        next_row = 0
-        next_row_set = self.find_next_synapse_group(next_row)
-
+        # This loops through the synapses onto neurons on the worker, and connects them
         synapse_count = 0
 
-        while next_row_set is not None:
+        for start_row, end_row in zip(*self.find_synapse_ranges()):
             # Add the synapses to the neuron
-            synapse_count += self.connect_neuron_synapses(start_row=next_row_set[0], end_row=next_row_set[1])
-
-            # Find the next group of synapses
-            next_row = next_row_set[1]  # 2nd number was not included in range
-            next_row_set = self.find_next_synapse_group(next_row)
+            synapse_count += self.connect_neuron_synapses(start_row=start_row, end_row=end_row)
 
         return synapse_count
 
     ############################################################################
 
-    # This function starts at next_row, then returns all synapses onto a neuron which is located on the worker
+    def get_synapse_groups(self):
 
-    # This works for synapses, but it will not work for gap junctions, because
-    # we need to connect the gap junctions from both sides
+        """
+        Synapses are sorted by destination neuron, returns the rows of the synapse matrix for each destination neuron.
+        Uses the synapse index (see SnuddaLoad.build_index) if available, otherwise column 1 (dest_id) is read.
 
-    # --- perhaps rewrite this as an iterator
-    # --- also, see comment in loop below, to use boolean array to be faster
+        Returns:
+            (tuple):
+                dest_id (np.array): Destination neuron ID (only neurons with synapses)
+                start_row (np.array): First row of the synapses onto dest_id
+                end_row (np.array): Row after last row of the synapses onto dest_id
+        """
 
-    def find_next_synapse_group(self, next_row=0):
+        if self.synapse_groups is None:
 
-        """
-        Synapses are sorted by destination neuron (and then source neuron), this method starts from next_row
-        and find the next range of synapses that have the same source and destination.
+            if self.snudda_loader.index is None:
+                self.snudda_loader.index = self.snudda_loader.load_index()
 
-        Args:
-            next_row (int): Row in the synapse matrix to start from
-        """
+            if self.snudda_loader.index is not None:
+                post_offset = self.snudda_loader.index["synapses"]["post_offset"]
+                dest_id = np.flatnonzero(np.diff(post_offset) > 0)
+                start_row, end_row = post_offset[dest_id], post_offset[dest_id + 1]
 
-        synapses = self.synapses
+            elif self.synapses.shape[0] > 0:
+                dest_id, start_row, num_rows = np.unique(self.synapses[:, 1], return_index=True, return_counts=True)
+                end_row = start_row + num_rows
 
-        try:
-            num_syn_rows = synapses.shape[0]
-        except:
-            import traceback
-            tstr = traceback.format_exc()
-            self.write_log(tstr, is_error=True)
+            else:
+                dest_id, start_row, end_row = [np.zeros((0,), dtype=int) for _ in range(3)]
 
-            assert False, ("find_next_synapse_group: If synapses was not loaded into memory, your problem is probably "
-                           "that the HDF5 file that holds the synapses were closed. Sorry.")
+            self.synapse_groups = dest_id, start_row, end_row
 
-        if next_row >= num_syn_rows:
-            # No more synapses to get
-            return None
+        return self.synapse_groups
 
-        # The synapse matrix is sorted on dest_id, ascending order
-        # We also assume that self.neuron_id is sorted in ascending order
+    def find_synapse_ranges(self):
 
-        start_row = None
-        our_id = None
-        not_our_id = None  # used in the loop below, despite what pycharm thinks
+        """
+        Returns the ranges of rows in the synapse matrix that have a destination neuron located on the worker.
 
-        while start_row is None:
+        Returns:
+            (tuple):
+                start_row (np.array): First row of each range
+                end_row (np.array): Row after last row of each range
+        """
 
-            # What is the next destination ID
-            next_id = synapses[next_row, 1]
+        dest_id, start_row, end_row = self.get_synapse_groups()
+        on_node = self.neuron_id_on_node[dest_id]
 
-            # Is the next ID ours?
-            # TODO: This can be speed up by instead having a bool array with 1 if neuron is in self.neuron_id and 0
-            #       otherwise. That would prevent us from having to search in self.neuron_id
-            # if next_id in self.neuron_id: -- OLD if statement, replaced with bool lookup below
-            if self.neuron_id_on_node[next_id]:
-                start_row = next_row
-                our_id = next_id
-                continue
-            else:
-                not_our_id = next_id
+        return start_row[on_node], end_row[on_node]
+
+    def find_next_synapse_group(self, next_row=0):
+
+        """
+        Synapses are sorted by destination neuron (and then source neuron), this method starts from next_row
+        and find the next range of synapses that have the same destination, located on the worker.
 
-            # This loop just skips all synapses targeting not_our_id so we then can check next id
-            while (next_row < num_syn_rows and
-                   synapses[next_row, 1] == not_our_id):
-                next_row += 1
+        Args:
+            next_row (int): Row in the synapse matrix to start from
 
-            if next_row >= num_syn_rows:
-                # No more synapses to get
-                return None
+        Returns:
+            (start_row, end_row), or None if there are no more synapses onto neurons on the worker
+        """
 
-        # Next find the last of the rows with this ID
-        end_row = start_row
+        start_row, end_row = self.find_synapse_ranges()
 
-        while (end_row < num_syn_rows
-               and synapses[end_row, 1] == our_id):
-            end_row += 1
+        # First range that ends after next_row
+        idx = np.searchsorted(end_row, next_row, side="right")
 
-        return start_row, end_row
+        if idx >= len(start_row):
+            # No more synapses to get
+            return None
+
+        return max(start_row[idx], next_row), end_row[idx]
 
     ############################################################################
 
@@ -818,25 +980,27 @@ class SnuddaSimulate(object):
 
         """
 
-        source_id_list = self.synapses[start_row:end_row, 0]
-        source_id =self.synapses[start_row, 0]
-        dest_id = self.synapses[start_row, 1]
-        assert (self.synapses[start_row:end_row, 1] == dest_id).all()
+        # Read all the rows at once, if synapses are on file this is a single slice read
+        synapses = self.synapses[start_row:end_row, :]
+
+        source_id_list = synapses[:, 0]
+        dest_id = synapses[0, 1]
+        assert (synapses[:, 1] == dest_id).all()
 
         # Double check mapping (skip any synapses onto virtual neurons)
         assert self.is_virtual_neuron[dest_id] or self.pc.gid2cell(dest_id) == self.neurons[dest_id].icell, \
             f"GID mismatch: {self.pc.gid2cell(dest_id)} != {self.neurons[dest_id].icell}"
 
-        synapse_type_id = self.synapses[start_row:end_row, 6]
-        axon_distance = self.synapses[start_row:end_row, 7]  # Obs in micrometers
+        synapse_type_id = synapses[:, 6]
+        axon_distance = synapses[:, 7]  # Obs in micrometers
 
-        sec_id = self.synapses[start_row:end_row, 9]
-        sec_x = self.synapses[start_row:end_row, 10] / 1000.0  # Convert to number 0-1
+        sec_id = synapses[:, 9]
+        sec_x = synapses[:, 10] / 1000.0  # Convert to number 0-1
 
         # Conductances are stored in pS (because we use INTs), NEURON wants it in microsiemens
-        conductance = self.synapses[start_row:end_row, 11] * 1e-6
-        parameter_id = self.synapses[start_row:end_row, 12]
-        voxel_coords = self.synapses[start_row:end_row, 2:5]
+        conductance = synapses[:, 11] * 1e-6
+        parameter_id = synapses[:, 12]
+        voxel_coords = synapses[:, 2:5]
 
         if not self.is_virtual_neuron[dest_id]:
             dend_sections = self.neurons[dest_id].map_id_to_compartment(sec_id)
@@ -851,8 +1015,6 @@ class SnuddaSimulate(object):
 
         """ Connects the synapses present in the synapse matrix between start_row and end_row-1. """
 
-        synapse_count = 0
-
         source_id_list, dest_id, dend_sections, sec_id, sec_x, synapse_type_id, \
         axon_distance, conductance, parameter_id = self.get_synapse_info(start_row=start_row, end_row=end_row)
 
@@ -860,30 +1022,9 @@ class SnuddaSimulate(object):
             # Target neuron was a virtual neuron, skip it
             return 0
 
-        for (src_id, section, section_id, section_x, s_type_id, axon_dist, cond, p_id) \
-                in zip(source_id_list, dend_sections, sec_id, sec_x, synapse_type_id,
-                       axon_distance, conductance, parameter_id):
-
-            try:
-                self.add_synapse(cell_id_source=src_id,
-                                 cell_id_dest=dest_id,
-                                 dend_compartment=section,
-                                 section_id=section_id,
-                                 section_dist=section_x,
-                                 synapse_type_id=s_type_id,
-                                 axon_dist=axon_dist,
-                                 conductance=cond,
-                                 parameter_id=p_id)
-
-                synapse_count += 1
-            except:
-                import traceback
-                tstr = traceback.format_exc()
-                self.write_log(tstr, is_error=True)
-                import pdb
-                pdb.set_trace()
-
-        return synapse_count
+        return self.add_synapses(cell_id_source=source_id_list, cell_id_dest=dest_id, dend_compartment=dend_sections,
+                                 section_id=sec_id, section_dist=sec_x, conductance=conductance,
+                                 parameter_id=parameter_id, synapse_type_id=synapse_type_id, axon_dist=axon_distance)
 
     ############################################################################
 
@@ -1051,41 +1192,8 @@ class SnuddaSimulate(object):
         syn = self.get_synapse(channel_module, dend_compartment, section_dist)
 
         if par_data is not None:
-            # Picking one of the parameter sets stored in par_data
-            par_id = parameter_id % len(par_data)
-
-            par_set = par_data[par_id]
-            for par in par_set:
-                if par == "expdata" or par == "cond":
-                    # expdata is not a parameter, and cond we take from synapse matrix
-                    continue
-
-                try:
-                    # Can be value, or a tuple/list, if so second value is scale factor
-                    # for SI -> natural units conversion
-                    val = par_set[par]
-
-                    # Do we need to convert from SI to natural units?
-                    if type(val) == tuple or type(val) == list:
-                        val_orig = val
-                        val = val[0] * val[1]
-                    else:
-                        # If no list, we need to handle SI to natural units conversion automatically
-                        val_orig = val
-                        val = self.convert_to_natural_units(par, val)
-
-                    if par in ["tau", "tauR"] and ((val < 0.01) or (10000 < val)):
-                        self.write_log(f" !!! Warning: Converted from {val_orig} to {val} but expected "
-                                       f"a value within [0.01, 10000) for neuron id {cell_id_source}. ", is_error=True)
-
-                    setattr(syn, par, val)
-
-                except:
-                    import traceback
-                    tstr = traceback.format_exc()
-                    print(tstr)
-                    import pdb
-                    pdb.set_trace()
+            for par, val in self.get_synapse_parameters(synapse_type_id=synapse_type_id, parameter_id=parameter_id):
+                setattr(syn, par, val)
 
         if axon_dist is not None:
             # axon dist is in micrometer, want delay in ms
@@ -1093,24 +1201,160 @@ class SnuddaSimulate(object):
         else:
             synapse_delay = self.synapse_delay
 
-        # Prevent garbage collection in python
-        if (cell_id_source, cell_id_dest) not in self.synapse_dict:
-            self.synapse_dict[cell_id_source, cell_id_dest] = []
-
         nc = self.pc.gid_connect(cell_id_source, syn)
         nc.weight[0] = conductance
         nc.delay = synapse_delay
         nc.threshold = self.spike_threshold
 
         # This prevents garbage collection of syn and nc
-        self.synapse_dict[cell_id_source, cell_id_dest].append((syn, nc, synapse_type_id, section_id))
-
-        # TODO: Johanna promised to remove these when she is ready for it.
-        self.synapse_list.append(syn)
-        self.net_con_list.append(nc)
+        self.synapse_registry.add(syn=syn, nc=nc, source_id=cell_id_source, dest_id=cell_id_dest,
+                                  synapse_type_id=synapse_type_id, section_id=section_id)
 
         return syn
 
+    def add_synapses(self, cell_id_source, cell_id_dest, dend_compartment, section_id, section_dist, conductance,
+                     parameter_id, synapse_type_id, axon_dist):
+
+        """
+        Add several synapses onto the same postsynaptic neuron. Same as calling add_synapse for each synapse,
+        but the synapse parameters and delays are looked up once for the batch, the synapses are
+        created grouped by section, and they are added to the synapse registry in one call.
+
+        Args:
+            cell_id_source (np.array): Neuron ID of presynaptic neurons
+            cell_id_dest (int): Neuron ID of postsynaptic neuron
+            dend_compartment (list): Dendrite compartment of each synapse
+            section_id (np.array): Section ID of each synapse
+            section_dist (np.array): Section X of each synapse
+            conductance (np.array): Conductance of each synapse
+            parameter_id (np.array): Synapse parameter ID of each synapse
+            synapse_type_id (np.array): Synapse type ID of each synapse
+            axon_dist (np.array): Axon distance to presynaptic location of each synapse
+
+        Returns:
+            num_synapses (int): Number of synapses added
+        """
+
+        if self.is_virtual_neuron[cell_id_dest]:
+            # The target neuron is a virtual neuron, do not add synapses
+            return 0
+
+        # You can not locate a point process at endpoints (position 0.0 or 1.0) if it needs an ion
+        section_dist = np.where(section_dist == 0.0, 0.01, np.where(section_dist == 1.0, 0.99, section_dist))
+
+        # axon dist is in micrometer, want delay in ms
+        synapse_delay = (1e3 * 1e-6 * np.asarray(axon_dist)) / self.axon_speed + self.synapse_delay
+
+        # Synapse parameters for each (synapse_type_id, parameter_id) pair, None if channel module is missing
+        synapse_pars = dict()
+
+        for s_type_id, p_id in set(zip(synapse_type_id, parameter_id)):
+            (channel_module, par_data) = self.synapse_parameters[s_type_id]
+
+            if channel_module is None:
+                error_tag = ("channel_model_error", s_type_id)
+
+                if error_tag not in self.print_error_once:
+                    error_message = (f"Warning: No channel module for {s_type_id} "
+                                     f"onto neuron {cell_id_dest}, did you miss specifying a mod file?")
+
+                    self.print_error_once[error_tag] = error_message
+                    self.write_log(error_message, is_error=True)
+
+                synapse_pars[s_type_id, p_id] = None
+
+            elif par_data is not None:
+                synapse_pars[s_type_id, p_id] = \
+                    (channel_module, self.get_synapse_parameters(synapse_type_id=s_type_id, parameter_id=p_id))
+            else:
+                synapse_pars[s_type_id, p_id] = (channel_module, [])
+
+        # Add the synapses grouped by section, stable sort keeps the synapse matrix order within each section,
+        # synapses without a channel module are skipped
+        synapse_idx = np.array([idx for idx in np.argsort(section_id, kind="stable")
+                                if synapse_pars[synapse_type_id[idx], parameter_id[idx]] is not None], dtype=int)
+
+        synapses = []
+        net_cons = []
+
+        for idx in synapse_idx:
+            channel_module, par_list = synapse_pars[synapse_type_id[idx], parameter_id[idx]]
+
+            syn = self.get_synapse(channel_module, dend_compartment[idx], section_dist[idx])
+
+            for par, val in par_list:
+                setattr(syn, par, val)
+
+            nc = self.pc.gid_connect(cell_id_source[idx], syn)
+            nc.weight[0] = conductance[idx]
+            nc.delay = synapse_delay[idx]
+            nc.threshold = self.spike_threshold
+
+            synapses.append(syn)
+            net_cons.append(nc)
+
+        # This prevents garbage collection of syn and nc
+        self.synapse_registry.add_synapses(synapses=synapses, net_cons=net_cons,
+                                           source_id=np.asarray(cell_id_source)[synapse_idx], dest_id=cell_id_dest,
+                                           synapse_type_id=np.asarray(synapse_type_id)[synapse_idx],
+                                           section_id=np.asarray(section_id)[synapse_idx])
+
+        return len(synapses)
+
+    def get_synapse_parameters(self, synapse_type_id, parameter_id):
+
+        """
+        Returns the parameters to set for a synapse, converted to natural units. The conversion is done once
+        for each parameter set, and then cached.
+
+        Args:
+            synapse_type_id: Synapse type ID
+            parameter_id: Synapse parameter ID
+
+        Returns:
+            par_list (list): List of (parameter name, value) tuples
+        """
+
+        (channel_module, par_data) = self.synapse_parameters[synapse_type_id]
+
+        # Picking one of the parameter sets stored in par_data
+        par_id = parameter_id % len(par_data)
+
+        if (synapse_type_id, par_id) in self.synapse_parameter_cache:
+            return self.synapse_parameter_cache[synapse_type_id, par_id]
+
+        par_set = par_data[par_id]
+        par_list = []
+
+        for par in par_set:
+            if par == "expdata" or par == "cond":
+                # expdata is not a parameter, and cond we take from synapse matrix
+                continue
+
+            # Can be value, or a tuple/list, if so second value is scale factor
+            # for SI -> natural units conversion
+            val = par_set[par]
+
+            # Do we need to convert from SI to natural units?
+            if type(val) == tuple or type(val) == list:
+                val_orig = val
+                val = val[0] * val[1]
+            else:
+                # If no list, we need to handle SI to natural units conversion automatically
+                val_orig = val
+                val = self.convert_to_natural_units(par, val)
+
+            if par in ["tau", "tauR"] and ((val < 0.01) or (10000 < val)):
+                self.write_log(f" !!! Warning: Converted from {val_orig} to {val} but expected "
+                               f"a value within [0.01, 10000) for synapse type {synapse_type_id}, "
+                               f"parameter set {par_id}. ", is_error=True)
+
+            par_list.append((par, val))
+
+        self.synapse_parameter_cache[synapse_type_id, par_id] = par_list
+
+        return par_list
+
     ############################################################################
 
     # Add one gap junction to specific location
@@ -1164,9 +1408,23 @@ class SnuddaSimulate(object):
         """ Helper method to return channel_module(section(section_x)) """
         return channel_module(section(section_x))
 
-    def add_external_input(self, input_file=None):
+    def add_external_input(self, input_file=None, share_spike_sources=None):
+
+        """
+        Adds external input from input_file to network.
+
+        The spikes of each neuron and input type are read from file at once, and the synapse parameters are
+        converted to natural units once per parameter set.
 
-        """ Adds external input from input_file to network. """
+        Args:
+            input_file (str, optional): Path to input file, default self.input_file
+            share_spike_sources (bool, optional): Inputs with identical spike trains onto a neuron share a single
+                                                  VecStim (with one NetCon each), reduces the number of NEURON
+                                                  objects, default self.share_spike_sources
+        """
+
+        if share_spike_sources is None:
+            share_spike_sources = self.share_spike_sources
 
         if input_file is None:
             if self.input_file is None:
@@ -1179,6 +1437,8 @@ class SnuddaSimulate(object):
 
         self.input_data = h5py.File(input_file, 'r')
 
+        channel_modules = dict()
+
         for neuron_id, neuron in self.neurons.items():
 
             name = neuron.name
@@ -1187,48 +1447,59 @@ class SnuddaSimulate(object):
                 self.write_log(f"Warning - No input specified for {name}", is_error=True)
                 continue
 
+            spike_sources = dict()
+
             for input_type in self.input_data["input"][str(neuron_id)]:
 
                 self.external_stim[neuron_id, input_type] = []
 
                 neuron_input = self.input_data["input"][str(neuron_id)][input_type]
-                sections = self.neurons[neuron_id].map_id_to_compartment(neuron_input.attrs["section_id"])
+                sections = self.neurons[neuron_id].map_id_to_compartment(get_input_info(neuron_input, "section_id"))
                 mod_file = SnuddaLoad.to_str(neuron_input.attrs["mod_file"])
                 if "parameter_list" in neuron_input.attrs:
                     param_list = json.loads(neuron_input.attrs["parameter_list"], object_pairs_hook=OrderedDict)
                 else:
                     param_list = None
 
-                # TODO: Sanity check mod_file string
-                eval_str = f"self.sim.neuron.h.{mod_file}"
-                channel_module = eval(eval_str)
+                if mod_file not in channel_modules:
+                    # If this fails, check that NEURON modules are compiled
+                    channel_modules[mod_file] = getattr(self.sim.neuron.h, mod_file)
+
+                channel_module = channel_modules[mod_file]
+                conductance = neuron_input.attrs["conductance"][()] * 1e6  # Neurons needs microsiemens
 
-                for input_id, (section, section_x, param_id, n_spikes) \
-                        in enumerate(zip(sections,
-                                         neuron_input.attrs["section_x"],
-                                         neuron_input.attrs["parameter_id"],
-                                         neuron_input["spikes"].attrs["num_spikes"])):
+                spike_trains = self.read_input_spikes(neuron_input)
+                assert all((spikes >= 0).all() for spikes in spike_trains), \
+                    f"Negative spike times for neuron {neuron_id} {input_type}"
 
-                    # We need to find cellID (int) from neuronID (string, eg. MSD1_3)
+                # Synapse parameters in natural units, for each parameter set used
+                syn_param_cache = dict()
 
-                    idx = input_id
-                    spikes = neuron_input["spikes"][input_id, :n_spikes] * 1e3  # Neuron uses ms
-                    assert (spikes >= 0).all(), f"Negative spike times for neuron {neuron_id} {input_type}"
+                for section, section_x, param_id, spikes \
+                        in zip(sections, get_input_info(neuron_input, "section_x"),
+                               get_input_info(neuron_input, "parameter_id"), spike_trains):
 
-                    # Creating NEURON VecStim and vector
-                    # https://www.neuron.yale.edu/phpBB/viewtopic.php?t=3125
+                    spike_key = spikes.tobytes() if share_spike_sources else None
+
+                    if spike_key in spike_sources:
+                        v, vs = spike_sources[spike_key]
+                    else:
+                        # Creating NEURON VecStim and vector
+                        # https://www.neuron.yale.edu/phpBB/viewtopic.php?t=3125
 
-                    try:
-                        vs = h.VecStim()
-                        v = h.Vector(spikes.size)
-                        v.from_python(spikes)
-                        vs.play(v)
-                    except:
-                        import traceback
-                        tstr = traceback.format_exc()
-                        print(tstr)
+                        try:
+                            vs = h.VecStim()
+                            v = h.Vector(spikes)
+                            vs.play(v)
+                        except:
+                            import traceback
+                            tstr = traceback.format_exc()
+                            print(tstr)
 
-                        assert False, "!!! Make sure that vecevent.mod is included in nrnivmodl compilation"
+                            assert False, "!!! Make sure that vecevent.mod is included in nrnivmodl compilation"
+
+                        if share_spike_sources:
+                            spike_sources[spike_key] = (v, vs)
 
                     # NEURON: You can not locate a point process at position 0 or 1 if it needs an ion
                     if section_x == 0.0:
@@ -1240,36 +1511,79 @@ class SnuddaSimulate(object):
                     nc = h.NetCon(vs, syn)
 
                     nc.delay = 0.0
-                    nc.weight[0] = neuron_input.attrs["conductance"][()] * 1e6  # Neurons needs microsiemens
+                    nc.weight[0] = conductance
                     nc.threshold = 0.1
 
                     # Get the modifications of synapse parameters, specific to this synapse
                     if param_list is not None and len(param_list) > 0:
-                        syn_params = param_list[param_id % len(param_list)]  # No longer need to take ["synapse"], only that part saved in hdf5
-
-                        for par in syn_params:
-                            if par == "expdata":
-                                # Not a parameter
-                                continue
-
-                            if par == "cond":
-                                # Ignoring cond value specified for synapse, using the
-                                # one specified in the input information instead
-                                continue
-
-                            par_value = self.convert_to_natural_units(par, syn_params[par])
-
-                            if par in ["tau", "tauR"]:
-                                assert 0.01 <= par_value < 10000, \
-                                    (f"Converting {self.neurons[neuron_id].name} {par}={syn_params[par]} "
-                                     f"we get {par_value}, "
-                                     f"but expected >= 0.01 and < 10000")
-                            # print(f"Setting {par} to {par_value}.")
+                        par_id = param_id % len(param_list)
+
+                        if par_id not in syn_param_cache:
+                            # No longer need to take ["synapse"], only that part saved in hdf5
+                            syn_param_cache[par_id] = self.get_input_parameters(syn_params=param_list[par_id],
+                                                                                neuron_name=name)
+
+                        for par, par_value in syn_param_cache[par_id]:
                             setattr(syn, par, par_value)
 
                     # Need to save references, otherwise they will be freed
                     self.external_stim[neuron_id, input_type].append((v, vs, nc, syn, spikes))
 
+    @staticmethod
+    def read_input_spikes(neuron_input):
+
+        """
+        Reads all input spike trains for one neuron and input type from the input file.
+        Both the dense and the csr spike layout are supported, see snudda.utils.input_spikes.
+
+        Args:
+            neuron_input: HDF5 group with input for neuron and input type (input/neuron_id/input_type)
+
+        Returns:
+            List with one array of spike times (in ms) per input synapse
+        """
+
+        spike_times, offset = get_input_spike_csr(neuron_input)
+
+        return np.split(spike_times * 1e3, offset[1:-1])  # Neuron uses ms
+
+    def get_input_parameters(self, syn_params, neuron_name=None):
+
+        """
+        Converts synapse parameters for input synapses to natural units.
+
+        Args:
+            syn_params (dict): Synapse parameters
+            neuron_name (str): Name of neuron, used in error message
+
+        Returns:
+            List of (parameter name, value) tuples
+        """
+
+        par_list = []
+
+        for par in syn_params:
+            if par == "expdata":
+                # Not a parameter
+                continue
+
+            if par == "cond":
+                # Ignoring cond value specified for synapse, using the
+                # one specified in the input information instead
+                continue
+
+            par_value = self.convert_to_natural_units(par, syn_params[par])
+
+            if par in ["tau", "tauR"]:
+                assert 0.01 <= par_value < 10000, \
+                    (f"Converting {neuron_name} {par}={syn_params[par]} "
+                     f"we get {par_value}, "
+                     f"but expected >= 0.01 and < 10000")
+
+            par_list.append((par, par_value))
+
+        return par_list
+
     ############################################################################
 
     def set_resting_voltage(self, neuron_id, rest_volt=None):
@@ -1569,6 +1883,7 @@ class SnuddaSimulate(object):
                 hold_v = self.sim_info["hold_voltage"]
 
         self.setup_print_sim_time(t)
+        self.write_load_statistics()
 
         start_time = timeit.default_timer()
 
@@ -1592,13 +1907,51 @@ class SnuddaSimulate(object):
         # Make sure all processes are synchronised
         self.pc.barrier()
         self.write_log(f"Running simulation for {t / 1000} s", force_print=True)
-        self.sim.run(t, dt=0.025)
+
+        if self.flush_interval is None:
+            self.sim.run(t, dt=0.025)
+        else:
+            # Run in time windows, writing recorded data to disk in between to limit memory use
+            window_end = np.arange(self.flush_interval * 1e3, t, self.flush_interval * 1e3)
+            self.write_log(f"Flushing recordings to disk every {self.flush_interval} s")
+
+            self.sim.run(window_end[0] if len(window_end) > 0 else t, dt=0.025)
+
+            for t_end in np.append(window_end[1:], t) if len(window_end) > 0 else []:
+                self.pc.barrier()
+                self.flush_output()
+                self.pc.psolve(t_end)
+
+            self.sim.neuron.h.tstop = t
+
         self.pc.barrier()
         self.write_log("Simulation done.")
 
         end_time = timeit.default_timer()
         self.write_log(f"Simulation run time: {end_time - start_time:.1f} s", force_print=True)
 
+    def write_load_statistics(self):
+
+        """ Gathers number of neurons, compartments, synapses and gap junctions on each worker, and writes them to
+            the log on worker 0. Must be called on all workers. """
+
+        num_compartments = sum(sec.nseg for neuron in self.neurons.values() for sec in neuron.icell.all)
+        worker_load = np.array(self.pc.py_allgather([len(self.neuron_id), num_compartments,
+                                                     self.synapse_registry.num_synapses,
+                                                     len(self.gap_junction_list)]))
+
+        if self.pc.id() == 0:
+            self.write_log(f"Load per worker ({self.distribution_strategy} distribution):", force_print=True)
+
+            for worker_id, (n_neurons, n_compartments, n_synapses, n_gap_junctions) in enumerate(worker_load):
+                self.write_log(f"  Worker {worker_id}: {n_neurons} neurons, {n_compartments} compartments, "
+                               f"{n_synapses} synapses, {n_gap_junctions} gap junctions", force_print=True)
+
+            load = worker_load[:, 1] + worker_load[:, 2]
+            if np.mean(load) > 0:
+                self.write_log(f"  Load imbalance (max/mean of compartments + synapses): "
+                               f"{np.max(load) / np.mean(load):.2f}", force_print=True)
+
     ############################################################################
     # export_to_core_neuron contributed by Zhixin, email: 2001210624@pku.edu.cn
 
@@ -1794,6 +2147,16 @@ class SnuddaSimulate(object):
 
         self.record.write()
 
+    def flush_output(self):
+
+        """ Appends data recorded so far to the output file, and clears the recordings. Must be called on all
+            workers, between runs. write_output writes the remaining data at the end of the simulation. """
+
+        self.record.flush()
+
+        for _, id_spikes in self.check_id_recordings:
+            id_spikes.resize(0)
+
     ##############################################################################
 
     def write_log(self, text, flush=True, is_error=False, force_print=False):
@@ -2036,9 +2399,8 @@ class SnuddaSimulate(object):
         self.neuron_nodes = []  # Is this used?
         self.virtual_neurons = {}
 
-        self.net_con_list = []
-        self.synapse_list = []
-        self.synapse_dict = dict()
+        self.synapse_registry = SynapseRegistry()
+        self.synapse_parameter_cache = dict()
         self.i_stim = []
         self.v_clamp_list = []
         self.gap_junction_list = []
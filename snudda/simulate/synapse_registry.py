@@ -0,0 +1,179 @@
+import collections.abc
+
+import numpy as np
+
+
+class SynapseRegistry(collections.abc.Mapping):
+
+    """
+    Registry of the synapses added by SnuddaSimulate. Holds the NEURON synapse (point process) and NetCon objects,
+    which prevents them from being garbage collected, together with source ID, destination ID, synapse type ID and
+    section ID for each synapse, stored in numpy arrays that grow in blocks.
+
+    The registry can be used as a read only dictionary, registry[source_id, dest_id] returns a list of
+    (syn, nc, synapse_type_id, section_id) tuples, the same as the old SnuddaSimulate.synapse_dict.
+    """
+
+    def __init__(self, block_size=100000):
+
+        """
+        Constructor.
+
+        Args:
+            block_size (int) : Number of synapses the arrays are grown by when full
+        """
+
+        self.block_size = block_size
+
+        self.synapses = []
+        self.net_cons = []
+
+        self.num_synapses = 0
+        self.source_id = np.zeros((0,), dtype=np.int64)
+        self.dest_id = np.zeros((0,), dtype=np.int64)
+        self.synapse_type_id = np.zeros((0,), dtype=np.int32)
+        self.section_id = np.zeros((0,), dtype=np.int32)
+
+        # Maps (source_id, dest_id) to the registry rows of the pair, built when first needed,
+        # then kept up to date by add and add_synapses
+        self.pair_lookup = None
+
+    ############################################################################
+
+    def reserve(self, num_synapses):
+
+        """ Make sure there is room for num_synapses more synapses in the arrays. """
+
+        needed_size = self.num_synapses + num_synapses
+
+        if needed_size <= self.source_id.shape[0]:
+            return
+
+        new_size = self.block_size * int(np.ceil(needed_size / self.block_size))
+
+        for name in ["source_id", "dest_id", "synapse_type_id", "section_id"]:
+            old_data = getattr(self, name)
+            new_data = np.zeros((new_size,), dtype=old_data.dtype)
+            new_data[:self.num_synapses] = old_data[:self.num_synapses]
+            setattr(self, name, new_data)
+
+    def add(self, syn, nc, source_id, dest_id, synapse_type_id, section_id):
+
+        """
+        Add one synapse to registry.
+
+        Args:
+            syn : NEURON synapse object
+            nc : NEURON NetCon object
+            source_id (int) : Presynaptic neuron ID
+            dest_id (int) : Postsynaptic neuron ID
+            synapse_type_id (int) : Synapse type ID
+            section_id (int) : Section ID of synapse
+        """
+
+        self.reserve(1)
+
+        idx = self.num_synapses
+        self.source_id[idx] = source_id
+        self.dest_id[idx] = dest_id
+        self.synapse_type_id[idx] = synapse_type_id
+        self.section_id[idx] = section_id
+
+        self.synapses.append(syn)
+        self.net_cons.append(nc)
+
+        self.num_synapses += 1
+
+        if self.pair_lookup is not None:
+            self.pair_lookup.setdefault((int(source_id), int(dest_id)), []).append(idx)
+
+    def add_synapses(self, synapses, net_cons, source_id, dest_id, synapse_type_id, section_id):
+
+        """
+        Add several synapses to registry, all onto the same postsynaptic neuron.
+
+        Args:
+            synapses (list) : NEURON synapse objects
+            net_cons (list) : NEURON NetCon objects
+            source_id (np.array) : Presynaptic neuron ID of each synapse
+            dest_id (int) : Postsynaptic neuron ID
+            synapse_type_id (np.array) : Synapse type ID of each synapse
+            section_id (np.array) : Section ID of each synapse
+        """
+
+        num_new = len(synapses)
+        assert len(net_cons) == num_new == len(source_id) == len(synapse_type_id) == len(section_id), \
+            f"add_synapses: All arguments must have the same length"
+
+        if num_new == 0:
+            return
+
+        self.reserve(num_new)
+
+        start_idx, end_idx = self.num_synapses, self.num_synapses + num_new
+        self.source_id[start_idx:end_idx] = source_id
+        self.dest_id[start_idx:end_idx] = dest_id
+        self.synapse_type_id[start_idx:end_idx] = synapse_type_id
+        self.section_id[start_idx:end_idx] = section_id
+
+        self.synapses.extend(synapses)
+        self.net_cons.extend(net_cons)
+
+        self.num_synapses = end_idx
+
+        if self.pair_lookup is not None:
+            for idx, s_id in enumerate(source_id, start=start_idx):
+                self.pair_lookup.setdefault((int(s_id), int(dest_id)), []).append(idx)
+
+    ############################################################################
+
+    def get_pair_lookup(self):
+
+        """ Returns dictionary mapping (source_id, dest_id) to registry rows, in the order the pairs were added. """
+
+        if self.pair_lookup is None:
+            source_id = self.source_id[:self.num_synapses]
+            dest_id = self.dest_id[:self.num_synapses]
+
+            # lexsort is stable, so the first row of each group is the first time the pair was added
+            sort_idx = np.lexsort((source_id, dest_id))
+            pair_change = np.logical_or(np.diff(source_id[sort_idx]) != 0, np.diff(dest_id[sort_idx]) != 0)
+            group_start = np.concatenate([[0], np.flatnonzero(pair_change) + 1]) if self.num_synapses > 0 \
+                else np.zeros((0,), dtype=int)
+            group_end = np.append(group_start[1:], self.num_synapses)
+
+            self.pair_lookup = dict()
+
+            for g_idx in np.argsort(sort_idx[group_start], kind="stable"):
+                first_row = sort_idx[group_start[g_idx]]
+                self.pair_lookup[int(source_id[first_row]), int(dest_id[first_row])] \
+                    = sort_idx[group_start[g_idx]:group_end[g_idx]].tolist()
+
+        return self.pair_lookup
+
+    def get_synapses(self, source_id, dest_id):
+
+        """ Returns list of (syn, nc, synapse_type_id, section_id) for synapses between source_id and dest_id. """
+
+        return [(self.synapses[idx], self.net_cons[idx], self.synapse_type_id[idx], self.section_id[idx])
+                for idx in self.get_pair_lookup()[source_id, dest_id]]
+
+    ############################################################################
+
+    def __getitem__(self, key):
+        return self.get_synapses(*key)
+
+    def __contains__(self, key):
+        return key in self.get_pair_lookup()
+
+    def __iter__(self):
+        return iter(self.get_pair_lookup())
+
+    def __len__(self):
+        return len(self.get_pair_lookup())
+
+    def clear(self):
+
+        """ Remove all synapses from registry. """
+
+        self.__init__(block_size=self.block_size)
@@ -0,0 +1,89 @@
+import numpy as np
+from numba import jit
+
+
+@jit(nopython=True, cache=True)
+def build_alias_table(weights):
+
+    """
+    Builds alias table (Vose's method) for sampling index i with probability weights[i] / sum(weights).
+
+    Args:
+        weights (np.array): Non-negative weights, at least one must be positive
+
+    Returns:
+        prob, alias : Index i is kept with probability prob[i], otherwise alias[i] is used
+    """
+
+    n = weights.shape[0]
+    scaled = weights * (n / np.sum(weights))
+
+    prob = np.ones((n,))
+    alias = np.arange(n)
+
+    small = np.empty((n,), dtype=np.int64)
+    large = np.empty((n,), dtype=np.int64)
+    n_small = 0
+    n_large = 0
+
+    for idx in range(n):
+        if scaled[idx] < 1:
+            small[n_small] = idx
+            n_small += 1
+        else:
+            large[n_large] = idx
+            n_large += 1
+
+    while n_small > 0 and n_large > 0:
+        n_small -= 1
+        s = small[n_small]
+        l = large[n_large - 1]
+
+        prob[s] = scaled[s]
+        alias[s] = l
+
+        # The large entry gives away the probability mass that the small entry was missing
+        scaled[l] = (scaled[l] + scaled[s]) - 1
+
+        if scaled[l] < 1:
+            n_large -= 1
+            small[n_small] = l
+            n_small += 1
+
+    # Any remaining entries (due to rounding) are kept with probability 1, prob is initialised to 1
+
+    return prob, alias
+
+
+class AliasSampler:
+
+    """ Samples from a fixed discrete distribution in constant time per sample, using the alias method.
+        Building the table is O(n), after that it can be reused for any number of samples. """
+
+    def __init__(self, values, weights):
+
+        """
+        Constructor.
+
+        Args:
+            values (np.array): Values to sample from
+            weights (np.array): Weight of each value, does not need to be normalised
+        """
+
+        self.values = np.asarray(values)
+        weights = np.asarray(weights, dtype=float)
+
+        assert self.values.shape[0] == weights.shape[0], "values and weights must have the same length"
+        assert (weights >= 0).all() and np.sum(weights) > 0, \
+            "Weights must be non-negative, with at least one positive weight"
+
+        self.prob, self.alias = build_alias_table(weights)
+
+    def sample(self, rng, size):
+
+        """ Returns size values drawn with replacement, using numpy random stream rng. """
+
+        idx = rng.integers(0, self.prob.shape[0], size=size)
+        keep = rng.random(size) < self.prob[idx]
+
+        return self.values[np.where(keep, idx, self.alias[idx])]
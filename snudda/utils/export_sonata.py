@@ -18,6 +18,7 @@ import numpy as np
 
 from snudda.utils import snudda_parse_path
 from snudda.utils.conv_hurt import ConvHurt
+from snudda.utils.input_spikes import get_input_spike_csr
 from snudda import SnuddaLoad
 
 
@@ -287,15 +288,8 @@ class ExportSonata:
         for neuron_id in neuron_id_list:
 
             for input_type in input_hdf5[f"input/{neuron_id}"].keys():
-                neuron_spikes = []
-
-                spike_group = input_hdf5[f"input/{neuron_id}/{input_type}/spikes"]
-                n_spikes = spike_group.attrs["num_spikes"]
-
-                for idx, ns in enumerate(n_spikes):
-                    neuron_spikes.append(spike_group[idx, :ns])
-
-                input_spikes = np.array(sorted(np.concatenate(neuron_spikes)))
+                spike_times, _ = get_input_spike_csr(input_hdf5[f"input/{neuron_id}/{input_type}"])
+                input_spikes = np.sort(spike_times)
 
                 neuron_type = self.snudda_load.data["neurons"][neuron_id]["type"]
 
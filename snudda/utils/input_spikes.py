@@ -0,0 +1,101 @@
+import numpy as np
+
+# Input spike files (written by SnuddaInput) store the spikes for each neuron and input type in the group
+# input/<neuron_id>/<input_type>, using one of two layouts:
+#
+#   dense : "spikes" matrix (num_inputs x max_spikes) padded with -1, with attribute "num_spikes".
+#           section_id, section_x, distance_to_soma and parameter_id are attributes of the group.
+#
+#   csr   : "spike_times" with the concatenated spike times of all inputs, input i has the spikes
+#           spike_times[spike_offset[i]:spike_offset[i+1]]. section_id, section_x, distance_to_soma and
+#           parameter_id are datasets in the group.
+#
+# The functions below read both layouts.
+
+
+def is_csr_input(input_group):
+
+    """ Returns True if input_group uses the csr layout. """
+
+    return "spike_times" in input_group
+
+
+def get_spike_dataset(input_group):
+
+    """ Returns the dataset holding the spikes, spike generation info (freq, start, end, ...) are its attributes. """
+
+    if is_csr_input(input_group):
+        return input_group["spike_times"]
+
+    return input_group["spikes"]
+
+
+def get_num_inputs(input_group):
+
+    """ Returns number of inputs (synapses) in input_group. """
+
+    if is_csr_input(input_group):
+        return input_group["spike_offset"].shape[0] - 1
+
+    return input_group["spikes"].shape[0]
+
+
+def get_input_info(input_group, name):
+
+    """ Returns per input data (section_id, section_x, distance_to_soma, parameter_id) for input_group. """
+
+    if name in input_group.attrs:
+        return input_group.attrs[name]
+
+    return input_group[name][()]
+
+
+def get_input_spike_csr(input_group):
+
+    """
+    Returns spikes in input_group in csr format.
+
+    Returns:
+        spike_times, offset : Spikes for input i are spike_times[offset[i]:offset[i+1]]
+    """
+
+    if is_csr_input(input_group):
+        return input_group["spike_times"][()], input_group["spike_offset"][()]
+
+    spike_mat = input_group["spikes"][()]
+    num_spikes = input_group["spikes"].attrs["num_spikes"]
+
+    keep_mask = np.arange(spike_mat.shape[1]) < np.reshape(num_spikes, (-1, 1))
+    offset = np.concatenate([[0], np.cumsum(num_spikes)]).astype(int)
+
+    return spike_mat[keep_mask], offset
+
+
+def get_input_spike_trains(input_group):
+
+    """ Returns list with spike times for each input in input_group. """
+
+    spike_times, offset = get_input_spike_csr(input_group)
+
+    return np.split(spike_times, offset[1:-1])
+
+
+def get_input_spike_matrix(input_group):
+
+    """
+    Returns spikes in input_group as a matrix padded with -1 (dense format).
+
+    Returns:
+        spike_mat, num_spikes
+    """
+
+    if not is_csr_input(input_group):
+        return input_group["spikes"][()], input_group["spikes"].attrs["num_spikes"]
+
+    spike_times, offset = get_input_spike_csr(input_group)
+    num_spikes = np.diff(offset)
+
+    spike_mat = np.full((len(num_spikes), np.max(num_spikes, initial=0)), -1, dtype=spike_times.dtype)
+    spike_mat[np.arange(spike_mat.shape[1]) < np.reshape(num_spikes, (-1, 1))] = spike_times
+
+    return spike_mat, num_spikes
@@ -0,0 +1,232 @@
+import collections.abc
+
+import numpy as np
+
+
+class MemoryMappedMatrix:
+
+    """
+    Read only, memory mapped view of a 2D HDF5 dataset (e.g. network/synapses), used by SnuddaLoad(lazy=True).
+
+    The file is memory mapped once, and every HDF5 chunk (or the whole dataset, if it is contiguous) is a
+    numpy view into the mapping. Rows are only read from disk when they are accessed, and the data is not
+    copied or decompressed. This requires that the dataset is stored without filters (e.g. no compression),
+    see is_mappable. Chunks must span all columns of the dataset.
+
+    Indexing supports an int, a slice or an index array for the rows, optionally followed by a column index,
+    e.g. matrix[10:20, 0:2]. A slice within a single chunk returns a view, otherwise the rows are copied.
+    """
+
+    def __init__(self, dataset):
+
+        """
+        Constructor.
+
+        Args:
+            dataset : HDF5 dataset (2D) to memory map
+        """
+
+        assert self.is_mappable(dataset), f"Unable to memory map {dataset.name}, it is compressed or filtered"
+
+        self.name = dataset.name
+        self.shape = dataset.shape
+        self.dtype = dataset.dtype
+        self.ndim = len(self.shape)
+
+        num_rows, num_cols = self.shape
+
+        if dataset.chunks is None:
+            self.chunk_rows = max(1, num_rows)
+            chunk_offsets = {0: dataset.id.get_offset()}
+        else:
+            self.chunk_rows = dataset.chunks[0]
+            chunk_offsets = dict()
+
+            for idx in range(0, dataset.id.get_num_chunks()):
+                chunk_info = dataset.id.get_chunk_info(idx)
+                chunk_offsets[chunk_info.chunk_offset[0] // self.chunk_rows] = chunk_info.byte_offset
+
+        num_chunks = int(np.ceil(num_rows / self.chunk_rows))
+        chunk_bytes = self.chunk_rows * num_cols * self.dtype.itemsize
+
+        if num_rows > 0 and any(offset is not None for offset in chunk_offsets.values()):
+            self.file_map = np.memmap(dataset.file.filename, dtype=np.uint8, mode="r")
+        else:
+            self.file_map = None
+
+        # Chunks that were never written are not allocated in the file, they contain the fill value (0)
+        empty_chunk = np.zeros((self.chunk_rows, num_cols), dtype=self.dtype)
+        empty_chunk.flags.writeable = False
+        self.chunks = []
+
+        for chunk_idx in range(0, num_chunks):
+            offset = chunk_offsets.get(chunk_idx, None)
+
+            if offset is None:
+                self.chunks.append(empty_chunk)
+            else:
+                chunk_data = self.file_map[offset:offset + chunk_bytes].view(self.dtype)
+                self.chunks.append(chunk_data.reshape(self.chunk_rows, num_cols))
+
+    ############################################################################
+
+    @staticmethod
+    def is_mappable(dataset):
+
+        """ Returns True if the HDF5 dataset can be memory mapped (2D, no filters, chunks span all columns). """
+
+        return MemoryMappedMatrix.unmappable_reason(dataset) is None
+
+    @staticmethod
+    def unmappable_reason(dataset):
+
+        """ Returns why the HDF5 dataset can not be memory mapped, or None if it can be. """
+
+        if len(dataset.shape) != 2 or dataset.dtype.hasobject:
+            return f"shape {dataset.shape}, dtype {dataset.dtype} (requires 2D numeric matrix)"
+
+        if dataset.chunks is not None and dataset.chunks[1] != dataset.shape[1]:
+            return f"chunks {dataset.chunks} do not span all columns"
+
+        if dataset.id.get_create_plist().get_nfilters() > 0:
+            return f"compressed ({dataset.compression}), prune with compress_synapses=False to allow memory mapping"
+
+        return None
+
+    ############################################################################
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        for row_start in range(0, self.shape[0], self.chunk_rows):
+            yield from self.read_range(row_start, min(row_start + self.chunk_rows, self.shape[0]))
+
+    def __array__(self, dtype=None):
+        return np.asarray(self.read_range(0, self.shape[0]), dtype=dtype)
+
+    def __getitem__(self, key):
+
+        if isinstance(key, tuple):
+            row_key, col_key = key[0], key[1:]
+        else:
+            row_key, col_key = key, ()
+
+        if isinstance(row_key, (int, np.integer)):
+            row = row_key + self.shape[0] if row_key < 0 else row_key
+
+            if not 0 <= row < self.shape[0]:
+                raise IndexError(f"Row {row_key} out of range for {self.name} with {self.shape[0]} rows")
+
+            data = self.chunks[row // self.chunk_rows][row % self.chunk_rows]
+
+            if col_key:
+                data = data[col_key]
+
+        elif isinstance(row_key, slice):
+            start, stop, step = row_key.indices(self.shape[0])
+
+            if step == 1:
+                data = self.read_range(start, stop, col_key=col_key)
+            else:
+                data = self.read_rows(np.arange(start, stop, step))[(slice(None),) + col_key]
+
+        else:
+            row_key = np.asarray(row_key)
+
+            if row_key.dtype == bool:
+                row_key = np.flatnonzero(row_key)
+
+            data = self.read_rows(row_key)[(slice(None),) + col_key]
+
+        return data
+
+    ############################################################################
+
+    def read_range(self, row_start, row_end, col_key=()):
+
+        """
+        Returns rows row_start:row_end, a view if they are all in the same chunk.
+
+        Args:
+            row_start (int) : First row
+            row_end (int) : Row after last row
+            col_key (tuple) : Column index, applied to each chunk before the rows are concatenated
+        """
+
+        if row_end <= row_start:
+            return np.zeros((0, self.shape[1]), dtype=self.dtype)[(slice(None),) + col_key]
+
+        first_chunk = row_start // self.chunk_rows
+        last_chunk = (row_end - 1) // self.chunk_rows
+
+        chunk_data = [self.chunks[chunk_idx][max(row_start - chunk_idx * self.chunk_rows, 0):
+                                             row_end - chunk_idx * self.chunk_rows][(slice(None),) + col_key]
+                      for chunk_idx in range(first_chunk, last_chunk + 1)]
+
+        if len(chunk_data) == 1:
+            return chunk_data[0]
+
+        return np.concatenate(chunk_data)
+
+    def read_rows(self, rows):
+
+        """ Returns a copy of the rows with index in rows (int array). """
+
+        rows = np.where(rows < 0, rows + self.shape[0], rows)
+
+        if rows.size > 0 and (rows.min() < 0 or rows.max() >= self.shape[0]):
+            raise IndexError(f"Row index out of range for {self.name} with {self.shape[0]} rows")
+
+        data = np.zeros((rows.size, self.shape[1]), dtype=self.dtype)
+        chunk_idx = rows // self.chunk_rows
+
+        for idx in np.unique(chunk_idx):
+            mask = chunk_idx == idx
+            data[mask, :] = self.chunks[idx][rows[mask] - idx * self.chunk_rows, :]
+
+        return data
+
+
+class LazyNeuronList(collections.abc.Sequence):
+
+    """
+    List of neuron dictionaries (same as SnuddaLoad.extract_neurons returns), where the dictionary for a neuron
+    is only created the first time it is accessed. The neuron data is kept as one numpy array per field
+    (see SnuddaLoad.read_neuron_columns).
+    """
+
+    def __init__(self, neuron_columns, extra_axons, make_neuron):
+
+        """
+        Constructor.
+
+        Args:
+            neuron_columns (dict) : One array per neuron field, from SnuddaLoad.read_neuron_columns
+            extra_axons (dict) : Extra axons, from SnuddaLoad.gather_extra_axons
+            make_neuron : Function make_neuron(neuron_columns, idx, extra_axons) that creates neuron dictionary
+        """
+
+        self.neuron_columns = neuron_columns
+        self.extra_axons = extra_axons
+        self.make_neuron = make_neuron
+        self.neurons = dict()
+
+    def __len__(self):
+        return len(self.neuron_columns["neuron_id"])
+
+    def __getitem__(self, idx):
+
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+
+        if idx < 0:
+            idx += len(self)
+
+        if not 0 <= idx < len(self):
+            raise IndexError(f"Neuron index {idx} out of range ({len(self)} neurons)")
+
+        if idx not in self.neurons:
+            self.neurons[idx] = self.make_neuron(self.neuron_columns, idx, self.extra_axons)
+
+        return self.neurons[idx]
@@ -7,6 +7,7 @@ import timeit
 import numpy as np
 
 from snudda.neurons.neuron_prototype import NeuronPrototype
+from snudda.utils.lazy_load import LazyNeuronList, MemoryMappedMatrix
 from snudda.utils.numpy_encoder import NumpyEncoder
 import scipy.sparse as sparse
 from scipy.spatial import distance_matrix
@@ -19,7 +20,8 @@ class SnuddaLoad(object):
 
     ############################################################################
 
-    def __init__(self, network_file, snudda_data=None, load_synapses=True, verbose=False):
+    def __init__(self, network_file, snudda_data=None, load_synapses=True, build_index=False, lazy=False,
+                 verbose=False):
 
         """
         Constructor
@@ -28,6 +30,9 @@ class SnuddaLoad(object):
             network_file (str) : Data file to load
             snudda_data (str, optional) : Snudda Data path, if you want to override the one specified in the hdf5 file
             load_synapses (bool, optional) : Whether to read synapses into memory, or keep them on disk (this keeps file open)
+            build_index (bool, optional) : Build (or load) pre/post index for fast synapse queries, see build_index
+            lazy (bool, optional) : Lazy loading, synapses are memory mapped and neuron dictionaries are created
+                                    on access, see load_hdf5
             verbose (bool, optional) : Print more info during execution
 
         """
@@ -42,6 +47,9 @@ class SnuddaLoad(object):
         self.network_file = None
         self.snudda_data = snudda_data
 
+        # Pre/post index for synapses and gap junctions, see build_index
+        self.index = None
+
         if network_file:
             alt_file = os.path.join(network_file, "network-synapses.hdf5")
 
@@ -50,7 +58,10 @@ class SnuddaLoad(object):
                     raise ValueError(f"Network path {network_file} specified, but no file {alt_file}")
                 network_file = alt_file
 
-            self.data = self.load_hdf5(network_file, load_synapses)
+            self.data = self.load_hdf5(network_file, load_synapses, lazy=lazy)
+
+            if build_index and "synapses" in self.data:
+                self.build_index()
         else:
             self.data = None
 
@@ -95,7 +106,7 @@ class SnuddaLoad(object):
 
     ############################################################################
 
-    def load_hdf5(self, network_file, load_synapses=True, load_morph=False):
+    def load_hdf5(self, network_file, load_synapses=True, load_morph=False, lazy=False):
 
         """
         Load data from hdf5 file.
@@ -104,6 +115,11 @@ class SnuddaLoad(object):
             network_file (str) : Network file to load data from
             load_synapses (bool) : Load synapses into memory, or read on demand from file (keeps file open)
             load_morph
+            lazy (bool) : Lazy loading. The synapse and gap junction matrices are memory mapped read only
+                          (MemoryMappedMatrix), this requires that they are stored uncompressed, otherwise
+                          they are read on demand from file (as load_synapses=False). The neuron data is available
+                          as one array per field in "neuron_columns", and the neuron dictionaries in "neurons"
+                          are only created when accessed (LazyNeuronList).
 
         Returns:
             data (dictionary) : Dictionary with data.
@@ -233,14 +249,29 @@ class SnuddaLoad(object):
             else:
                 data["num_gap_junctions"] = f["network/gap_junctions"].shape[0]
 
-            if data["num_synapses"] > 100e6:
+            if data["num_synapses"] > 100e6 and not lazy:
                 print(f"Found {data['num_synapses']} synapses (too many!), not loading them into memory!")
                 load_synapses = False
 
             if "network/hyper_voxel_ids" in f:
                 data["hyper_voxel_ids"] = f["network/hyper_voxel_ids"][()]
 
-            if load_synapses:
+            if lazy:
+                # Memory map synapses and gap junctions, file is only kept open if they can not be memory mapped
+                load_synapses = True
+
+                for data_type in ["synapses", "gap_junctions"]:
+                    reason = MemoryMappedMatrix.unmappable_reason(f[f"network/{data_type}"])
+
+                    if reason is None:
+                        data[data_type] = MemoryMappedMatrix(f[f"network/{data_type}"])
+                    else:
+                        print(f"Unable to memory map {data_type} in {network_file}: {reason}. "
+                              f"Falling back to reading on demand from file.")
+                        data[data_type] = f[f"network/{data_type}"]
+                        load_synapses = False
+
+            elif load_synapses:
                 # 0: source_cell_id, 1: dest_cell_id, 2: voxel_x, 3: voxel_y, 4: voxel_z,
                 # 5: hyper_voxel_id, 6: channel_model_id,
                 # 7: source_axon_soma_dist (not SI scaled 1e6, micrometers),
@@ -309,7 +340,14 @@ class SnuddaLoad(object):
             if self.snudda_data is None:
                 self.snudda_data = data["snudda_data"]
 
-        data["neurons"] = self.extract_neurons(f)
+        data["neuron_columns"] = self.read_neuron_columns(f)
+
+        if lazy:
+            data["neurons"] = LazyNeuronList(neuron_columns=data["neuron_columns"],
+                                             extra_axons=self.gather_extra_axons(hdf5_file=f),
+                                             make_neuron=self.make_neuron)
+        else:
+            data["neurons"] = self.extract_neurons(f, neuron_columns=data["neuron_columns"])
 
         # This is for old format, update for new format
         if "parameters" in f:
@@ -393,98 +431,125 @@ class SnuddaLoad(object):
     ############################################################################
 
     @staticmethod
-    def extract_neurons(hdf5_file):
+    def read_neuron_columns(hdf5_file):
 
         """
-        Helper function to extract neuron data from hdf5 file and put it in a dictionary.
+        Reads neuron data from hdf5 file, one numpy array per field.
 
         Args:
             hdf5_file : hdf5 file object
 
         Returns:
-            List containing neurons as dictionary elements.
+            Dictionary with one array per field in network/neurons (e.g. "name", "neuron_id", "position")
 
         """
 
-        neurons = []
-        extra_axons = SnuddaLoad.gather_extra_axons(hdf5_file=hdf5_file)
+        column_names = ["name", "neuron_id", "hoc", "position", "rotation", "virtual_neuron", "volume_id",
+                        "axon_density_type", "axon_density", "axon_density_radius", "axon_density_bounds_xyz",
+                        "morphology", "neuron_path", "parameter_key", "morphology_key", "modulation_key",
+                        "population_unit_id"]
 
-        for name, neuron_id, hoc, pos, rot, virtual, vID, \
-            axon_density_type, axon_density, axon_density_radius, \
-            axon_density_bounds_xyz, \
-            morph, neuron_path, \
-            parameter_key, morphology_key, modulation_key, population_unit_id \
-                in zip(hdf5_file["network/neurons/name"][:],
-                       hdf5_file["network/neurons/neuron_id"][:],
-                       hdf5_file["network/neurons/hoc"][:],
-                       hdf5_file["network/neurons/position"][()],
-                       hdf5_file["network/neurons/rotation"][()],
-                       hdf5_file["network/neurons/virtual_neuron"][:],
-                       hdf5_file["network/neurons/volume_id"][:],
-                       hdf5_file["network/neurons/axon_density_type"][:],
-                       hdf5_file["network/neurons/axon_density"][:],
-                       hdf5_file["network/neurons/axon_density_radius"][:],
-                       hdf5_file["network/neurons/axon_density_bounds_xyz"][:],
-                       hdf5_file["network/neurons/morphology"][:],
-                       hdf5_file["network/neurons/neuron_path"][:],
-                       hdf5_file["network/neurons/parameter_key"][:],
-                       hdf5_file["network/neurons/morphology_key"][:],
-                       hdf5_file["network/neurons/modulation_key"][:],
-                       hdf5_file["network/neurons/population_unit_id"][:]
-                       ):
-
-            n = dict([])
-
-            n["name"] = SnuddaLoad.to_str(name)
-
-            if morph is not None:
-                n["morphology"] = SnuddaLoad.to_str(morph)
-
-            # Naming convention is TYPE_X, where XX is a number starting from 0
-            n["type"] = n["name"].split("_")[0]
-
-            n["neuron_id"] = neuron_id
-            n["volume_id"] = SnuddaLoad.to_str(vID)
-            n["hoc"] = SnuddaLoad.to_str(hoc)
-            n["neuron_path"] = SnuddaLoad.to_str(neuron_path)
-
-            n["position"] = pos.copy()
-            n["rotation"] = rot.copy().reshape(3, 3)
-            n["virtual_neuron"] = virtual
-
-            if len(axon_density_type) > 0:
-                n["axon_density_type"] = SnuddaLoad.to_str(axon_density_type)
-            else:
-                n["axon_density_type"] = None
+        return {name: hdf5_file[f"network/neurons/{name}"][()] for name in column_names}
 
-            if len(axon_density) > 0:
-                n["axon_density"] = SnuddaLoad.to_str(axon_density)
-            else:
-                n["axon_density"] = None
+    ############################################################################
 
-            if n["axon_density_type"] == "xyz":
-                n["axon_density_bounds_xyz"] = axon_density_bounds_xyz
-            else:
-                n["axon_density_bounds_xyz"] = None
+    @staticmethod
+    def make_neuron(neuron_columns, idx, extra_axons):
+
+        """
+        Creates dictionary with neuron data for one neuron.
+
+        Args:
+            neuron_columns (dict) : Neuron data, one array per field (see read_neuron_columns)
+            idx (int) : Index of neuron
+            extra_axons (dict) : Extra axons (see gather_extra_axons)
+
+        Returns:
+            Dictionary with neuron data.
+
+        """
+
+        n = dict([])
+
+        n["name"] = SnuddaLoad.to_str(neuron_columns["name"][idx])
+
+        morph = neuron_columns["morphology"][idx]
+        if morph is not None:
+            n["morphology"] = SnuddaLoad.to_str(morph)
+
+        # Naming convention is TYPE_X, where XX is a number starting from 0
+        n["type"] = n["name"].split("_")[0]
+
+        neuron_id = neuron_columns["neuron_id"][idx]
+
+        n["neuron_id"] = neuron_id
+        n["volume_id"] = SnuddaLoad.to_str(neuron_columns["volume_id"][idx])
+        n["hoc"] = SnuddaLoad.to_str(neuron_columns["hoc"][idx])
+        n["neuron_path"] = SnuddaLoad.to_str(neuron_columns["neuron_path"][idx])
+
+        n["position"] = neuron_columns["position"][idx].copy()
+        n["rotation"] = neuron_columns["rotation"][idx].copy().reshape(3, 3)
+        n["virtual_neuron"] = neuron_columns["virtual_neuron"][idx]
+
+        axon_density_type = neuron_columns["axon_density_type"][idx]
+        axon_density = neuron_columns["axon_density"][idx]
+
+        if len(axon_density_type) > 0:
+            n["axon_density_type"] = SnuddaLoad.to_str(axon_density_type)
+        else:
+            n["axon_density_type"] = None
+
+        if len(axon_density) > 0:
+            n["axon_density"] = SnuddaLoad.to_str(axon_density)
+        else:
+            n["axon_density"] = None
+
+        if n["axon_density_type"] == "xyz":
+            n["axon_density_bounds_xyz"] = neuron_columns["axon_density_bounds_xyz"][idx]
+        else:
+            n["axon_density_bounds_xyz"] = None
+
+        n["axon_density_radius"] = neuron_columns["axon_density_radius"][idx]
+
+        # If the code fails here, use snudda/utils/upgrade_old_network_file.py to upgrade your old data files
+        par_key = SnuddaLoad.to_str(neuron_columns["parameter_key"][idx])
+        morph_key = SnuddaLoad.to_str(neuron_columns["morphology_key"][idx])
+        mod_key = SnuddaLoad.to_str(neuron_columns["modulation_key"][idx])
+        n["parameter_key"] = par_key if len(par_key) > 0 else None
+        n["morphology_key"] = morph_key if len(morph_key) > 0 else None
+        n["modulation_key"] = mod_key if len(mod_key) > 0 else None
+
+        n["population_unit"] = neuron_columns["population_unit_id"][idx]
+
+        if neuron_id in extra_axons:
+            n["extra_axons"] = extra_axons[neuron_id].copy()
+
+        return n
+
+    ############################################################################
+
+    @staticmethod
+    def extract_neurons(hdf5_file, neuron_columns=None):
+
+        """
+        Helper function to extract neuron data from hdf5 file and put it in a dictionary.
 
-            n["axon_density_radius"] = axon_density_radius
+        Args:
+            hdf5_file : hdf5 file object
+            neuron_columns (dict, optional) : Neuron data already read with read_neuron_columns
 
-            # If the code fails here, use snudda/utils/upgrade_old_network_file.py to upgrade your old data files
-            par_key = SnuddaLoad.to_str(parameter_key)
-            morph_key = SnuddaLoad.to_str(morphology_key)
-            mod_key = SnuddaLoad.to_str(modulation_key)
-            n["parameter_key"] = par_key if len(par_key) > 0 else None
-            n["morphology_key"] = morph_key if len(morph_key) > 0 else None
-            n["modulation_key"] = mod_key if len(mod_key) > 0 else None
+        Returns:
+            List containing neurons as dictionary elements.
 
-            n["population_unit"] = population_unit_id
+        """
 
-            if neuron_id in extra_axons:
-                n["extra_axons"] = extra_axons[neuron_id].copy()
+        if neuron_columns is None:
+            neuron_columns = SnuddaLoad.read_neuron_columns(hdf5_file)
 
-            neurons.append(n)
+        extra_axons = SnuddaLoad.gather_extra_axons(hdf5_file=hdf5_file)
 
-        return neurons
+        return [SnuddaLoad.make_neuron(neuron_columns, idx, extra_axons)
+                for idx in range(0, len(neuron_columns["neuron_id"]))]
 
     ############################################################################
 
@@ -563,6 +628,193 @@ class SnuddaLoad(object):
 
     ############################################################################
 
+    def get_index_file(self):
+
+        """ Returns path to the index sidecar file, e.g. network-synapses-index.hdf5 """
+
+        return f"{os.path.splitext(self.network_file)[0]}-index.hdf5"
+
+    ############################################################################
+
+    def build_index(self, save=True):
+
+        """
+        Builds a CSR style index of the synapse and gap junction matrices, so that queries on pre_id or post_id
+        do not need to search the matrices.
+
+        The matrices are sorted on post_id (dest_id), then pre_id. For each data type the index contains:
+            "post_offset" : rows of post_id are post_offset[post_id]:post_offset[post_id+1]
+            "pre_order" : row permutation that sorts the matrix on pre_id (rows with same pre_id in matrix order)
+            "pre_offset" : rows of pre_id are pre_order[pre_offset[pre_id]:pre_offset[pre_id+1]]
+
+        The index is saved in a sidecar file (see get_index_file) next to the network file, and reused by later
+        calls if the network file has not been modified.
+
+        Args:
+            save (bool) : Save index to sidecar file
+        """
+
+        self.index = self.load_index()
+
+        if self.index is not None:
+            return
+
+        start_time = timeit.default_timer()
+
+        self.index = dict()
+        for data_type in ["synapses", "gap_junctions"]:
+            self.index[data_type] = self.create_index(self.data[data_type], self.data["num_neurons"])
+
+        if self.verbose:
+            print(f"Built synapse index: {timeit.default_timer() - start_time:.1f}s")
+
+        if save:
+            self.save_index()
+
+    ############################################################################
+
+    @staticmethod
+    def create_index(synapses, num_neurons):
+
+        """
+        Creates index for synapse (or gap junction) matrix, see build_index.
+
+        Args:
+            synapses : Synapse matrix (numpy array or HDF5 dataset), sorted on post_id
+            num_neurons (int) : Number of neurons in network
+
+        Returns:
+            Dictionary with "post_offset", "pre_order", "pre_offset"
+        """
+
+        neuron_id = np.arange(0, num_neurons + 1)
+
+        if synapses.shape[0] > 0:
+            pre_id = synapses[:, 0]
+            post_id = synapses[:, 1]
+        else:
+            pre_id = np.zeros((0,), dtype=int)
+            post_id = np.zeros((0,), dtype=int)
+
+        assert (np.diff(post_id) >= 0).all(), "create_index: Synapse matrix must be sorted on post_id"
+
+        pre_order = np.argsort(pre_id, kind="stable")
+
+        return {"post_offset": np.searchsorted(post_id, neuron_id),
+                "pre_order": pre_order,
+                "pre_offset": np.searchsorted(pre_id[pre_order], neuron_id)}
+
+    ############################################################################
+
+    def save_index(self):
+
+        """ Saves index to sidecar file, together with modification time of the network file. """
+
+        import h5py
+
+        index_file = self.get_index_file()
+
+        try:
+            with h5py.File(index_file, "w") as f:
+                f.attrs["network_file_mtime"] = os.path.getmtime(self.network_file)
+
+                for data_type, index in self.index.items():
+                    index_group = f.create_group(data_type)
+                    index_group.attrs["num_rows"] = self.data[data_type].shape[0]
+
+                    for name, values in index.items():
+                        index_group.create_dataset(name, data=values)
+
+        except OSError:
+            # For example if the network directory is read only, index is still kept in memory
+            print(f"Unable to write index file {index_file}")
+
+    ############################################################################
+
+    def load_index(self):
+
+        """
+        Loads index from sidecar file.
+
+        Returns:
+            index (dict), or None if there is no valid index file
+        """
+
+        import h5py
+
+        index_file = self.get_index_file()
+
+        if not os.path.isfile(index_file):
+            return None
+
+        with h5py.File(index_file, "r") as f:
+            if f.attrs["network_file_mtime"] != os.path.getmtime(self.network_file):
+                if self.verbose:
+                    print(f"Network file modified after index was created, ignoring {index_file}")
+                return None
+
+            index = dict()
+            for data_type in ["synapses", "gap_junctions"]:
+                if data_type not in f or f[data_type].attrs["num_rows"] != self.data[data_type].shape[0]:
+                    return None
+
+                index[data_type] = {name: f[data_type][name][()]
+                                    for name in ["post_offset", "pre_order", "pre_offset"]}
+
+        if self.verbose:
+            print(f"Loaded index from {index_file}")
+
+        return index
+
+    ############################################################################
+
+    def get_post_rows(self, post_id, data_type="synapses"):
+
+        """ Returns rows with post_id (int or list) as post synaptic neuron, uses index. """
+
+        post_offset = self.index[data_type]["post_offset"]
+        post_id = np.atleast_1d(post_id)
+
+        return self.expand_ranges(post_offset[post_id], post_offset[post_id + 1])
+
+    def get_pre_rows(self, pre_id, data_type="synapses"):
+
+        """ Returns rows with pre_id (int or list) as pre synaptic neuron, in matrix order, uses index. """
+
+        pre_offset = self.index[data_type]["pre_offset"]
+        pre_id = np.atleast_1d(pre_id)
+
+        return np.sort(self.index[data_type]["pre_order"][self.expand_ranges(pre_offset[pre_id],
+                                                                             pre_offset[pre_id + 1])])
+
+    @staticmethod
+    def expand_ranges(start, end):
+
+        """ Returns concatenation of np.arange(start[i], end[i]) for all i. """
+
+        num = end - start
+        offset = np.repeat(start - np.cumsum(num) + num, num)
+
+        return np.arange(np.sum(num)) + offset
+
+    def get_rows(self, rows, data_type="synapses"):
+
+        """ Returns rows (sorted) of synapse or gap junction matrix """
+
+        if len(rows) == 0:
+            return self.data[data_type][:0, :]
+
+        if isinstance(self.data[data_type], np.ndarray):
+            return self.data[data_type][rows, :]
+
+        if rows[-1] - rows[0] < 10 * len(rows):
+            # HDF5 dataset, read contiguous range and pick rows, avoids slow fancy indexing on file
+            return self.data[data_type][rows[0]:rows[-1] + 1, :][rows - rows[0], :]
+
+        return self.data[data_type][rows, :]
+
+    ############################################################################
+
     def find_synapses_slow(self, pre_id, n_max=1000000):
 
         """
@@ -628,6 +880,9 @@ class SnuddaLoad(object):
             else:
                 return None, None
 
+        if self.index is not None:
+            return self.find_synapses_index(pre_id=pre_id, post_id=post_id, return_index=return_index)
+
         if post_id is None:
             assert return_index is False, "You must specify pre_id and post_id if return_index is True"
             return self.find_synapses_slow(pre_id=pre_id)
@@ -720,6 +975,51 @@ class SnuddaLoad(object):
 
     ############################################################################
 
+    def find_synapses_index(self, pre_id=None, post_id=None, return_index=False):
+
+        """
+        Returns subset of synapses, uses index (see build_index).
+
+        Args:
+            pre_id (int) : Pre-synaptic neuron ID (can also be a list, if post_id is not given)
+            post_id (int) : Post-synaptic neuron ID
+            return_index (bool) : Also return row index of synapses
+
+        Returns:
+            Subset of synapse matrix, synapse coordinates (and row index)
+        """
+
+        assert pre_id is not None or post_id is not None, "Must specify pre_id or post_id"
+
+        if post_id is None:
+            rows = self.get_pre_rows(pre_id)
+
+        else:
+            rows = self.get_post_rows(post_id)
+
+            if pre_id is not None and len(rows) > 0:
+                # Within a post_id the synapses are sorted on pre_id
+                pre_col = self.data["synapses"][rows[0]:rows[-1] + 1, 0]
+                rows = rows[np.searchsorted(pre_col, pre_id, side="left"):np.searchsorted(pre_col, pre_id,
+                                                                                          side="right")]
+
+            if len(rows) == 0:
+                # No synapses found, same as find_synapses
+                if return_index:
+                    return None, None, None
+                else:
+                    return None, None
+
+        synapses = self.get_rows(rows)
+        synapse_coords = synapses[:, 2:5] * self.data["voxel_size"] + self.data["simulation_origo"]
+
+        if return_index:
+            return synapses, synapse_coords, rows
+        else:
+            return synapses, synapse_coords
+
+    ############################################################################
+
     def get_neuron_population_units(self, neuron_id=None, return_set=False):
 
         if neuron_id is not None:
@@ -925,6 +1225,17 @@ class SnuddaLoad(object):
         if self.verbose:
             print(f"Finding gap junctions connecting neuron {neuron_id}")
 
+        if self.index is not None:
+            gj_rows = np.union1d(self.get_pre_rows(neuron_id, data_type="gap_junctions"),
+                                 self.get_post_rows(neuron_id, data_type="gap_junctions"))[:n_max]
+            gap_junctions = self.get_rows(gj_rows, data_type="gap_junctions")
+            gj_coords = gap_junctions[:, 6:9] * self.data["voxel_size"] + self.data["simulation_origo"]
+
+            if return_index:
+                return gap_junctions, gj_coords, gj_rows
+            else:
+                return gap_junctions, gj_coords
+
         gap_junctions = np.zeros((n_max, 11), dtype=np.int32)
         gj_ctr = 0
         gj_index = 0
@@ -1013,11 +1324,16 @@ class SnuddaLoad(object):
 
     def find_neighbours(self, neuron_id, connection_matrix=None, exclude_parent=True):
 
-        if connection_matrix is None:
-            connection_matrix = self.create_connection_matrix(sparse_matrix=False, connection_type="synapses")
+        if connection_matrix is None and self.index is not None:
+            pre_neighbours = set(self.get_rows(self.get_post_rows(list(neuron_id)))[:, 0])
+            post_neighbours = set(self.get_rows(self.get_pre_rows(list(neuron_id)))[:, 1])
+
+        else:
+            if connection_matrix is None:
+                connection_matrix = self.create_connection_matrix(sparse_matrix=False, connection_type="synapses")
 
-        pre_neighbours = set(np.where(np.sum(connection_matrix[:, list(neuron_id)], axis=1))[0])
-        post_neighbours = set(np.where(np.sum(connection_matrix[list(neuron_id), :], axis=0))[0])
+            pre_neighbours = set(np.where(np.sum(connection_matrix[:, list(neuron_id)], axis=1))[0])
+            post_neighbours = set(np.where(np.sum(connection_matrix[list(neuron_id), :], axis=0))[0])
 
         if exclude_parent:
             parent_id = set(neuron_id)
@@ -1028,12 +1344,20 @@ class SnuddaLoad(object):
 
     def find_neighbours_gap_junctions(self, neuron_id, connection_matrix=None, exclude_parent=True):
 
-        if connection_matrix is None:
-            connection_matrix = self.create_connection_matrix(sparse_matrix=False, connection_type="gap_junctions")
+        if connection_matrix is None and self.index is not None:
+            pre_neighbours = set(self.get_rows(self.get_post_rows(list(neuron_id), data_type="gap_junctions"),
+                                               data_type="gap_junctions")[:, 0])
+            post_neighbours = set(self.get_rows(self.get_pre_rows(list(neuron_id), data_type="gap_junctions"),
+                                                data_type="gap_junctions")[:, 1])
+
+        else:
+            if connection_matrix is None:
+                connection_matrix = self.create_connection_matrix(sparse_matrix=False,
+                                                                  connection_type="gap_junctions")
 
-        # This matrix should be symmetric!
-        pre_neighbours = set(np.where(np.sum(connection_matrix[:, list(neuron_id)], axis=1))[0])
-        post_neighbours = set(np.where(np.sum(connection_matrix[list(neuron_id), :], axis=0))[0])
+            # This matrix should be symmetric!
+            pre_neighbours = set(np.where(np.sum(connection_matrix[:, list(neuron_id)], axis=1))[0])
+            post_neighbours = set(np.where(np.sum(connection_matrix[list(neuron_id), :], axis=0))[0])
 
         neighbours = pre_neighbours | post_neighbours
 
@@ -1119,6 +1443,21 @@ class SnuddaLoad(object):
     def count_incoming_connections(self, neuron_type):
 
         neuron_id = self.get_neuron_id_of_type(neuron_type)
+
+        if self.index is not None:
+            # Number of rows for each neuron is given by the offsets in the index
+            neuron_id = np.array(neuron_id, dtype=int)
+
+            def count_rows(data_type, offset_name):
+                offset = self.index[data_type][offset_name]
+                return np.sum(offset[neuron_id + 1] - offset[neuron_id])
+
+            synapse_count = count_rows("synapses", "post_offset")
+            gap_junction_count = (count_rows("gap_junctions", "pre_offset")
+                                  + count_rows("gap_junctions", "post_offset")) / 2
+
+            return synapse_count, gap_junction_count
+
         neuron_id_mask = np.zeros((self.data["num_neurons"],), dtype=bool)
         neuron_id_mask[neuron_id] = True
 
@@ -35,6 +35,7 @@ class SnuddaLoadNetworkSimulation:
 
         self.network_simulation_file = None
         self.depolarisation_block = None
+        self.spike_table = None
         self.test_data = do_test
 
         if self.network_simulation_output_file_name:
@@ -47,6 +48,7 @@ class SnuddaLoadNetworkSimulation:
 
         print(f"Loading {network_simulation_output_file}")
         self.network_simulation_file = h5py.File(network_simulation_output_file, "r")
+        self.spike_table = None
 
         if self.test_data:
             self.depolarisation_block = self.check_depolarisation_block(quiet=quiet)
@@ -55,6 +57,91 @@ class SnuddaLoadNetworkSimulation:
         if self.network_simulation_file:
             self.network_simulation_file.close()
             self.network_simulation_file = None
+            self.spike_table = None
+
+    @staticmethod
+    def create_spike_table(spike_data, num_neurons):
+
+        """ Creates columnar spike table from spike_data dictionary (neuron_id -> spike times).
+
+            Args:
+                spike_data : Dictionary with spike times for each neuron
+                num_neurons (int) : Number of neurons in network
+
+            Returns:
+                Dictionary with spike table:
+                    "time" : Spike times grouped by neuron (CSR), sorted on time within each neuron
+                    "offset" : Neuron neuron_id has spikes time[offset[neuron_id]:offset[neuron_id+1]]
+                    "sorted_time" : All spike times, sorted
+                    "sorted_neuron_id" : Neuron ID of each spike in sorted_time
+        """
+
+        num_spikes = np.zeros((num_neurons,), dtype=np.int64)
+        spike_list = [np.zeros((0,))] * num_neurons
+
+        for neuron_id, spikes in spike_data.items():
+            spike_list[int(neuron_id)] = np.sort(np.asarray(spikes, dtype=float).flatten())
+            num_spikes[int(neuron_id)] = spike_list[int(neuron_id)].size
+
+        time = np.concatenate(spike_list) if num_neurons > 0 else np.zeros((0,))
+        offset = np.concatenate([[0], np.cumsum(num_spikes)]).astype(np.int64)
+        neuron_id = np.repeat(np.arange(num_neurons), num_spikes)
+
+        order = np.argsort(time, kind="stable")
+
+        spike_table = {"time": time,
+                       "offset": offset,
+                       "sorted_time": time[order],
+                       "sorted_neuron_id": neuron_id[order]}
+
+        return spike_table
+
+    def get_spike_table(self):
+
+        """ Returns columnar spike table (see create_spike_table). The table is read from the "spike_table" group
+            in the output file, for older files it is created from the per neuron spike data. """
+
+        if self.spike_table is None:
+            if "spike_table" in self.network_simulation_file:
+                self.spike_table = {name: data[()] for name, data
+                                    in self.network_simulation_file["spike_table"].items()}
+            else:
+                spike_data = dict()
+                for nid, neuron_group in self.network_simulation_file["neurons"].items():
+                    if "spikes" in neuron_group:
+                        spike_data[int(nid)] = neuron_group["spikes"][()]
+
+                if "meta_data/id" in self.network_simulation_file:
+                    num_neurons = len(self.network_simulation_file["meta_data/id"])
+                else:
+                    num_neurons = max(spike_data.keys(), default=-1) + 1
+
+                self.spike_table = self.create_spike_table(spike_data=spike_data, num_neurons=num_neurons)
+
+        return self.spike_table
+
+    def get_spike_raster(self, time_range=None):
+
+        """ Returns spike times and neuron ID of all spikes, sorted on time. Without a time range
+            views of the spike table are returned, do not modify them.
+
+            Args:
+                time_range : Tuple (start_time, end_time), only spikes with start_time <= t < end_time are returned
+
+            Returns:
+                (spike_times, neuron_id)
+        """
+
+        spike_table = self.get_spike_table()
+        sorted_time = spike_table["sorted_time"]
+        sorted_neuron_id = spike_table["sorted_neuron_id"]
+
+        if time_range is None:
+            return sorted_time, sorted_neuron_id
+
+        start_idx, end_idx = np.searchsorted(sorted_time, time_range, side="left")
+
+        return sorted_time[start_idx:end_idx], sorted_neuron_id[start_idx:end_idx]
 
     def merge_spikes(self, spike_data=None):
 
@@ -66,7 +153,8 @@ class SnuddaLoadNetworkSimulation:
             """
 
         if spike_data is None:
-            spike_data = self.get_spikes()
+            sorted_time, sorted_neuron_id = self.get_spike_raster()
+            return np.column_stack([sorted_time, sorted_neuron_id.astype(float)])
 
         n_spikes = 0
         for spikes in spike_data.values():
@@ -90,48 +178,34 @@ class SnuddaLoadNetworkSimulation:
     def get_spikes(self, neuron_id=None):
 
         """ Returns the spikes for neuron_id. If neuron_id is an integer, spike times are returned as an array.
-            If neuron_id is a list or array, spike times are returned in a dictionary.
+            If neuron_id is a list or array, spike times are returned in a dictionary. Neurons without spikes
+            get an empty array.
 
         Args:
             neuron_id : Neuron ID, either integer or list / array
 
         """
 
-        if neuron_id is None:
-            spike_data = dict()
-            for nid in self.network_simulation_file["neurons"]:
+        spike_table = self.get_spike_table()
+        time = spike_table["time"]
+        offset = spike_table["offset"]
+        num_neurons = len(offset) - 1
 
-                if "spikes" in self.network_simulation_file[f"neurons/{nid}"]:
-                    spike_data[int(nid)] = self.network_simulation_file[f"neurons/{nid}/spikes"][()].copy()
+        def _get_neuron_spikes(nid):
+            if 0 <= nid < num_neurons and offset[nid + 1] > offset[nid]:
+                # Copy, so the caller can not modify the shared spike table
+                return time[offset[nid]:offset[nid + 1]].reshape(1, -1).copy()
+            else:
+                return np.array([])
 
-            # If all neuronID not represented, add empty
-            for nid in self.network_simulation_file["meta_data/id"]:
-                if nid not in spike_data:
-                    spike_data[nid] = np.array([])
+        if neuron_id is None:
+            spike_data = {nid: _get_neuron_spikes(nid) for nid in range(0, num_neurons)}
 
         elif np.issubdtype(type(neuron_id), np.integer):
-            if str(neuron_id) in self.network_simulation_file["neurons"] \
-                    and "spikes" in self.network_simulation_file[f"neurons/{neuron_id}"]:
-                spike_data = self.network_simulation_file[f"neurons/{neuron_id}/spikes"][()].copy()
-            else:
-                spike_data = np.array([])
+            spike_data = _get_neuron_spikes(neuron_id)
 
-        elif isinstance(neuron_id, np.ndarray) and neuron_id.size == 0:
-            spike_data = dict()
         else:
-            spike_data = dict()
-            try:
-                for nid in neuron_id:
-                    if str(nid) in self.network_simulation_file["neurons"] \
-                            and "spikes" in self.network_simulation_file[f"neurons/{nid}"]:
-                        spike_data[nid] = self.network_simulation_file[f"neurons/{nid}/spikes"][()].copy()
-                    else:
-                        spike_data[nid] = np.array([])
-            except:
-                import traceback
-                print(traceback.format_exc())
-                import pdb
-                pdb.set_trace()
+            spike_data = {nid: _get_neuron_spikes(nid) for nid in neuron_id}
 
         return spike_data
 
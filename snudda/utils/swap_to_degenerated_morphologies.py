@@ -9,6 +9,7 @@ from argparse import ArgumentParser, RawTextHelpFormatter
 
 from snudda.neurons.neuron_prototype import NeuronPrototype
 from snudda.utils.load import SnuddaLoad
+from snudda.utils.input_spikes import get_input_info, get_input_spike_matrix, get_spike_dataset
 from snudda.utils.snudda_path import snudda_simplify_path, snudda_parse_path
 
 
@@ -507,10 +508,17 @@ class SwapToDegeneratedMorphologies:
                 #       it does not handle the virtual neuron case here.
                 old_input_data = old_input["input"][neuron][input_type]
 
+                # Old input file can use either dense or csr spike layout, the new file is written in dense layout
+                old_spike_set = get_spike_dataset(old_input_data)
+                old_spikes, old_num_spikes = get_input_spike_matrix(old_input_data)
+                old_sec_id = get_input_info(old_input_data, "section_id")
+                old_parameter_id = get_input_info(old_input_data, "parameter_id")
+                old_distance_to_soma = get_input_info(old_input_data, "distance_to_soma")
+
                 keep_idx, new_sec_id, new_sec_x \
                     = self.remap_sections_helper(neuron_id=int(neuron),
-                                                 old_sec_id=old_input_data.attrs["section_id"],
-                                                 old_sec_x=old_input_data.attrs["section_x"])
+                                                 old_sec_id=old_sec_id,
+                                                 old_sec_x=get_input_info(old_input_data, "section_x"))
 
                 if len(keep_idx) == 0 and not (remap_removed_input and remapped_fraction > 0):
                     continue
@@ -523,8 +531,8 @@ class SwapToDegeneratedMorphologies:
                     morph = self.get_morphology(neuron_id=int(neuron), hdf5=self.new_hdf5,
                                                 snudda_data=self.new_snudda_data_dir)
 
-                    n_remap = len(old_input_data.attrs["section_id"]) - len(keep_idx)
-                    idx_remap = sorted(list(set(np.arange(0, len(old_input_data.attrs["section_id"]))) - set(keep_idx)))
+                    n_remap = len(old_sec_id) - len(keep_idx)
+                    idx_remap = sorted(list(set(np.arange(0, len(old_sec_id))) - set(keep_idx)))
 
                     if remapped_fraction < 1.0:
                         n_remap = int(np.round(len(idx_remap) * remapped_fraction))
@@ -544,16 +552,16 @@ class SwapToDegeneratedMorphologies:
                                                                                       cluster_size=1,
                                                                                       cluster_spread=None)
 
-                    old_n += old_input_data['spikes'].shape[0]
+                    old_n += len(old_num_spikes)
                     new_n += len(keep_idx)
                     remap_n += len(idx_remap)
 
                     keep_idx2 = sorted(list(set(keep_idx).union(set(idx_remap))))
 
                     # Same spikes as before
-                    spike_set = input_group.create_dataset("spikes", data=old_input_data["spikes"][keep_idx2, :],
+                    spike_set = input_group.create_dataset("spikes", data=old_spikes[keep_idx2, :],
                                                            compression="gzip", dtype=np.float32)
-                    spike_set.attrs["num_spikes"] = old_input_data["spikes"].attrs["num_spikes"][keep_idx2].astype(np.int32)
+                    spike_set.attrs["num_spikes"] = old_num_spikes[keep_idx2].astype(np.int32)
 
                     # New locations for the remapped synapses
                     new_sec_id[idx_remap] = sec_id
@@ -562,9 +570,9 @@ class SwapToDegeneratedMorphologies:
                     new_sec_x[idx_remap] = sec_x
                     input_group.attrs["section_x"] = new_sec_x[keep_idx2].astype(np.float16)
 
-                    input_group.attrs["parameter_id"] = old_input_data.attrs["parameter_id"][keep_idx2].astype(np.int)
+                    input_group.attrs["parameter_id"] = old_parameter_id[keep_idx2].astype(np.int)
 
-                    updated_dist = old_input_data.attrs["distance_to_soma"].copy()
+                    updated_dist = old_distance_to_soma.copy()
                     updated_dist[idx_remap] = dist_to_soma
                     input_group.attrs["distance_to_soma"] = updated_dist[keep_idx2].astype(np.float16)
 
@@ -574,19 +582,19 @@ class SwapToDegeneratedMorphologies:
 
                         if data_name in old_input_data.attrs:
                             input_group.attrs[data_name] = old_input_data.attrs[data_name]
-                        elif data_name in old_input_data["spikes"].attrs:
-                            input_group["spikes"].attrs[data_name] = old_input_data["spikes"].attrs[data_name]
+                        elif data_name in old_spike_set.attrs:
+                            input_group["spikes"].attrs[data_name] = old_spike_set.attrs[data_name]
                         elif data_name in old_input_data:
                             old_input_data.copy(source=old_input_data[data_name], dest=input_group)
 
                 else:
-                    input_group.create_dataset("spikes", data=old_input_data["spikes"][keep_idx, :],
+                    input_group.create_dataset("spikes", data=old_spikes[keep_idx, :],
                                                compression="gzip", dtype=np.float32)
-                    input_group["spikes"].attrs["num_spikes"] = old_input_data["spikes"].attrs["num_spikes"][keep_idx]
+                    input_group["spikes"].attrs["num_spikes"] = old_num_spikes[keep_idx]
                     input_group.attrs["section_id"] = new_sec_id[keep_idx]
                     input_group.attrs["section_x"] = new_sec_x[keep_idx]
-                    input_group.attrs["parameter_id"] = old_input_data.attrs["parameter_id"][keep_idx]
-                    input_group.attrs["distance_to_soma"] = old_input_data.attrs["distance_to_soma"][keep_idx]
+                    input_group.attrs["parameter_id"] = old_parameter_id[keep_idx]
+                    input_group.attrs["distance_to_soma"] = old_distance_to_soma[keep_idx]
 
                     for data_name in ["freq", "correlation", "jitter", "synapse_density", "start", "end", "conductance",
                                       "population_unit_id", "population_unit_spikes", "generator",
@@ -594,12 +602,12 @@ class SwapToDegeneratedMorphologies:
 
                         if data_name in old_input_data.attrs:
                             input_group.attrs[data_name] = old_input_data.attrs[data_name]
-                        elif data_name in old_input_data["spikes"].attrs:
-                            input_group["spikes"].attrs[data_name] = old_input_data["spikes"].attrs[data_name]
+                        elif data_name in old_spike_set.attrs:
+                            input_group["spikes"].attrs[data_name] = old_spike_set.attrs[data_name]
                         elif data_name in old_input_data:
                             old_input_data.copy(source=old_input_data[data_name], dest=input_group)
 
-                    old_n += old_input_data['spikes'].shape[0]
+                    old_n += len(old_num_spikes)
                     new_n += len(keep_idx)
 
             print(f"Processed input to {self.old_data['neurons'][int(neuron)]['name']} ({neuron}), "
@@ -0,0 +1,39 @@
+import unittest
+
+import numpy as np
+
+from snudda.utils.alias_sampler import AliasSampler
+
+
+class TestAliasSampler(unittest.TestCase):
+
+    def test_sample(self):
+
+        rng = np.random.default_rng(1234)
+        num_samples = 1000000
+
+        for weights in [np.array([1.0, 2.0, 3.0, 4.0]),
+                        np.array([0.0, 5.0, 0.0, 1e-3, 10.0]),
+                        rng.random(200),
+                        np.array([7.0])]:
+
+            with self.subTest(num_values=len(weights)):
+                values = np.arange(len(weights)) + 100
+                sampler = AliasSampler(values=values, weights=weights)
+
+                self.assertTrue(((0 <= sampler.prob) & (sampler.prob <= 1 + 1e-12)).all())
+
+                samples = sampler.sample(rng=rng, size=num_samples)
+                self.assertEqual(samples.shape, (num_samples,))
+                self.assertTrue(np.isin(samples, values).all())
+
+                # Values with zero weight are never sampled
+                self.assertTrue(np.isin(samples, values[weights > 0]).all())
+
+                freq = np.bincount(samples - 100, minlength=len(weights)) / num_samples
+                expected_freq = weights / np.sum(weights)
+                self.assertTrue((np.abs(freq - expected_freq) <= 5 * np.sqrt(expected_freq / num_samples) + 1e-12).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
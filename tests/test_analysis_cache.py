@@ -0,0 +1,97 @@
+import os
+import tempfile
+import time
+import unittest
+
+import numpy as np
+import scipy.sparse as sps
+
+from snudda.analyse.analysis_cache import SnuddaAnalysisCache
+
+
+class TestAnalysisCache(unittest.TestCase):
+
+    def setUp(self):
+
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.network_file = os.path.join(self.temp_dir.name, "network-synapses.hdf5")
+
+        with open(self.network_file, "wb") as f:
+            f.write(b"network data")
+
+        self.num_calls = 0
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def compute(self, size, offset=0):
+        self.num_calls += 1
+        con_mat = sps.random(size, size, density=0.2, format="csr", random_state=size) * 10
+        return con_mat, {"counts": np.arange(size) + offset, "name": np.array(["dSPN", "iSPN"])}
+
+    def test_pack(self):
+
+        value = (sps.random(20, 30, density=0.1, format="csr", random_state=1),
+                 [np.arange(5), {"a": np.ones((2, 3)), "b": np.array(3.5)}],
+                 np.array(["FS", "LTS"]))
+
+        packed = SnuddaAnalysisCache.pack(value)
+        unpacked = SnuddaAnalysisCache.unpack(packed)
+
+        self.assertIsInstance(unpacked, tuple)
+        self.assertTrue((unpacked[0] != value[0]).nnz == 0)
+        self.assertTrue((unpacked[1][0] == value[1][0]).all())
+        self.assertTrue((unpacked[1][1]["a"] == value[1][1]["a"]).all())
+        self.assertEqual(unpacked[1][1]["b"], 3.5)
+        self.assertEqual(list(unpacked[2]), ["FS", "LTS"])
+
+    def test_memoise(self):
+
+        cache = SnuddaAnalysisCache(network_file=self.network_file, verbose=False)
+
+        with self.subTest(stage="miss-and-hit"):
+            ref_mat, ref_info = cache.memoise("test", self.compute, size=10)
+            con_mat, info = cache.memoise("test", self.compute, size=10)
+
+            self.assertEqual(self.num_calls, 1)
+            self.assertTrue(np.allclose(ref_mat.toarray(), con_mat.toarray()))
+            self.assertTrue((ref_info["counts"] == info["counts"]).all())
+
+        with self.subTest(stage="arguments-in-key"):
+            cache.memoise("test", self.compute, size=10, offset=1)
+            cache.memoise("test", self.compute, size=10, extra_key={"volume_type": "full"})
+            self.assertEqual(self.num_calls, 3)
+
+        with self.subTest(stage="network-changed"):
+            with open(self.network_file, "ab") as f:
+                f.write(b"more network data")
+
+            cache.memoise("test", self.compute, size=10)
+            self.assertEqual(self.num_calls, 4)
+
+    def test_eviction(self):
+
+        cache = SnuddaAnalysisCache(network_file=self.network_file, verbose=False)
+
+        cache.memoise("test", self.compute, size=100)
+        file_size = os.path.getsize(cache.get_cache_file("test", size=100))
+
+        # Room for two results, the least recently used one is evicted
+        cache.max_size = 2.5 * file_size
+
+        cache.memoise("test", self.compute, size=100, offset=1)
+        time.sleep(0.01)
+        cache.memoise("test", self.compute, size=100)
+        time.sleep(0.01)
+        cache.memoise("test", self.compute, size=100, offset=2)
+
+        self.assertTrue(os.path.isfile(cache.get_cache_file("test", size=100)))
+        self.assertTrue(os.path.isfile(cache.get_cache_file("test", size=100, offset=2)))
+        self.assertFalse(os.path.isfile(cache.get_cache_file("test", size=100, offset=1)))
+
+        cache.clear()
+        self.assertEqual(len(os.listdir(cache.cache_dir)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import unittest
+
+import numpy as np
+import scipy.sparse as sps
+
+from snudda.analyse.analyse import SnuddaAnalyse
+
+
+class TestConnectionProbability(unittest.TestCase):
+
+    def setUp(self):
+
+        rng = np.random.default_rng(1234)
+        self.num_neurons = 60
+
+        self.analyse = SnuddaAnalyse.__new__(SnuddaAnalyse)
+        self.analyse.debug = False
+        self.analyse.positions = rng.uniform(0, 500e-6, (self.num_neurons, 3))
+
+        con_mat = rng.integers(0, 3, (self.num_neurons, self.num_neurons)) * (rng.random((self.num_neurons,
+                                                                                       self.num_neurons)) < 0.2)
+        self.analyse.connection_matrix = sps.csr_matrix(con_mat, dtype=np.int16)
+        self.analyse.connection_matrix_gj = sps.csr_matrix(con_mat.T, dtype=np.int16)
+
+        self.pre_id = np.arange(0, 40)
+        self.post_id = np.arange(20, self.num_neurons)
+
+    def reference_count(self, con_mat, num_bins, dist_3d):
+
+        dist = np.linspace(0.0, 1700.0e-6, num=num_bins)
+        count_con = np.zeros((num_bins, 1))
+        count_all = np.zeros((num_bins, 1))
+
+        for x in self.pre_id:
+            for y in self.post_id:
+                if x == y:
+                    continue
+
+                if dist_3d:
+                    d = np.linalg.norm(self.analyse.positions[x, :] - self.analyse.positions[y, :])
+                else:
+                    d = np.linalg.norm(self.analyse.positions[x, 0:2] - self.analyse.positions[y, 0:2])
+                    if np.abs(self.analyse.positions[x, 2] - self.analyse.positions[y, 2]) > 70e-6:
+                        continue
+
+                idx = int(np.floor(d / (dist[1] - dist[0])))
+                count_con[idx] += con_mat[x, y] > 0
+                count_all[idx] += 1
+
+        return count_con, count_all
+
+    def test_connection_probability(self):
+
+        for dist_3d in [True, False]:
+            for connection_type in ["synapses", "gap_junctions"]:
+                with self.subTest(dist_3d=dist_3d, connection_type=connection_type):
+
+                    con_mat = self.analyse.connection_matrix if connection_type == "synapses" \
+                        else self.analyse.connection_matrix_gj
+                    ref_con, ref_all = self.reference_count(con_mat=con_mat.toarray(), num_bins=86, dist_3d=dist_3d)
+
+                    # Small block size, so that several blocks are used
+                    for exact in [True, False]:
+                        dist, p_con, count_con, count_all = \
+                            self.analyse.connection_probability(pre_id=self.pre_id, post_id=self.post_id,
+                                                                dist_3d=dist_3d, connection_type=connection_type,
+                                                                exact=exact, block_size=100,
+                                                                num_points=len(self.pre_id) * len(self.post_id))
+
+                        self.assertEqual(count_con.shape, (86, 1))
+                        self.assertTrue((count_con == ref_con).all())
+                        self.assertTrue((count_all == ref_all).all())
+
+        with self.subTest(stage="sampled"):
+            _, _, _, count_all = self.analyse.connection_probability(pre_id=self.pre_id, post_id=self.post_id,
+                                                                     num_points=200, block_size=50)
+
+            # Self connections are not counted, so there can be slightly fewer pairs than requested
+            self.assertTrue(150 <= np.sum(count_all) <= 250)
+
+    def test_connection_pair_blocks(self):
+
+        np.random.seed(1234)
+
+        for num_points, block_size in [(480, 100), (800, 10000), (40 * 40, 100)]:
+            with self.subTest(num_points=num_points, block_size=block_size):
+                blocks = list(SnuddaAnalyse.get_connection_pair_blocks(pre_id=self.pre_id, post_id=self.post_id,
+                                                                       num_points=num_points,
+                                                                       block_size=block_size))
+                pre_block = np.concatenate([x for x, _ in blocks])
+                post_block = np.concatenate([y for _, y in blocks])
+
+                # Each presynaptic neuron gets num_points / len(pre_id) postsynaptic neurons, without replacement
+                num_per_pre = np.bincount(pre_block, minlength=len(self.pre_id))[self.pre_id]
+                self.assertEqual(len(pre_block), num_points)
+                self.assertTrue((num_per_pre == num_points // len(self.pre_id)).all())
+                self.assertEqual(len(set(zip(pre_block, post_block))), len(pre_block))
+                self.assertTrue(np.isin(post_block, self.post_id).all())
+
+                # Postsynaptic neurons are picked uniformly
+                if num_points < len(self.pre_id) * len(self.post_id):
+                    post_count = np.bincount(post_block - self.post_id[0])
+                    self.assertTrue(np.max(post_count) < 2 * num_points / len(self.post_id))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,11 +4,213 @@ import unittest
 import numpy as np
 
 from snudda.detect.detect import SnuddaDetect
+from snudda.detect.rasterise import SegmentTable
 from snudda.place.create_cube_mesh import create_cube_mesh
 from snudda.place.place import SnuddaPlace
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
 
+from test_rasterise import reference_rasterise
+
+
+def reference_place_touch_synapses(sd, x_syn, y_syn, z_syn):
+    """
+    Reference Python version of SnuddaDetect.place_touch_synapses, adds synapses for all
+    axon-dendrite overlaps in the voxels x_syn, y_syn, z_syn to sd.hyper_voxel_synapses.
+    Handles cluster synapses (dense voxels only).
+
+    Args:
+        sd : SnuddaDetect object
+        x_syn, y_syn, z_syn : Voxel coordinates (within hyper voxel) that contain both axon and dendrites
+    """
+
+    for x, y, z in zip(x_syn, y_syn, z_syn):
+        axon_id_list = sd.axon_voxels[x, y, z, :sd.axon_voxel_ctr[x, y, z]]
+        dend_id_list = sd.dend_voxels[x, y, z, :sd.dend_voxel_ctr[x, y, z]]
+
+        axon_dist = sd.axon_soma_dist[x, y, z, :sd.axon_voxel_ctr[x, y, z]]
+        dend_dist = sd.dend_soma_dist[x, y, z, :sd.dend_voxel_ctr[x, y, z]]
+
+        dend_sec_id = sd.dend_sec_id[x, y, z, :sd.dend_voxel_ctr[x, y, z]]
+        dend_sec_x = sd.dend_sec_x[x, y, z, :sd.dend_voxel_ctr[x, y, z]]
+
+        # Maybe make dendrite loop outer, since it has more variables?
+        # speedup??
+        for (ax_id, ax_dist) in zip(axon_id_list, axon_dist):
+            for (d_id, d_sec_id, d_sec_x, d_dist) \
+                    in zip(dend_id_list, dend_sec_id, dend_sec_x, dend_dist):
+
+                if ax_id == d_id:
+                    # Avoid self connections
+                    continue
+
+                pre_type = sd.neurons[ax_id]["type"]
+                post_type = sd.neurons[d_id]["type"]
+
+                if (pre_type, post_type) in sd.connectivity_distributions:
+
+                    con_dict = sd.connectivity_distributions[pre_type, post_type]
+
+                    # We need to loop over conDict in case there are multiple
+                    # types of synapses from this neuron
+                    for con_type in con_dict:
+                        if con_type == "gap_junction":
+                            # This part detects only axon-dend synapses, skip gap junctions
+                            continue
+
+                        synapse_mu, synapse_sigma = con_dict[con_type]["lognormal_mu_sigma"]
+                        mean_synapse_cond, std_synapse_cond = con_dict[con_type]["conductance"]
+                        channel_model_id = con_dict[con_type]["channel_model_id"]
+
+                        # Should we add just one synapse, or a cluster of synapses
+                        cluster_size = con_dict[con_type]["cluster_size"]
+
+                        if isinstance(cluster_size, (np.ndarray, list)):
+                            cluster_size = round(sd.hyper_voxel_rng.normal(loc=cluster_size[0],
+                                                                             scale=cluster_size[1]))
+
+                        if cluster_size > 1:
+                            cluster_spread = con_dict[con_type]["cluster_spread"]
+
+                            if cluster_spread is None:
+                                raise ValueError(f"cluster_spread ({cluster_spread}) must be a distance (in meters), e.g. 10e-6. ")
+
+                            if isinstance(cluster_spread, (np.ndarray, list)):
+                                cluster_spread = np.maximum(np.abs(sd.hyper_voxel_rng.normal(loc=cluster_spread[0],
+                                                                                               scale=cluster_spread[1])),
+                                                            5e-6)
+
+                            # This uses clone in neuron_prototype which should be cached (not anymore, but will be cached for 2nd hit)
+                            neuron = sd.load_neuron(sd.neurons[d_id])
+
+                            cluster_sec_x, syn_coords, soma_dist \
+                                = neuron.cluster_synapses(sec_id=d_sec_id, sec_x=d_sec_x,
+                                                          count=cluster_size, distance=cluster_spread,
+                                                          rng=sd.hyper_voxel_rng)
+
+                            if sd.hyper_voxel_synapse_ctr + cluster_size >= sd.max_synapses:
+                                sd.resize_hyper_voxel_synapses_matrix()
+
+                            cluster_cond = sd.hyper_voxel_rng.lognormal(synapse_mu, synapse_sigma, cluster_size)
+                            cluster_cond = np.maximum(cluster_cond, mean_synapse_cond * 0.1)
+                            cluster_param_id = sd.hyper_voxel_rng.integers(1000000, size=cluster_size)
+
+                            # We need to convert coords to hyper voxel coords, to fit with other coords
+                            coords_all = np.floor((syn_coords - sd.hyper_voxel_origo)/sd.voxel_size).astype(int)
+
+                            # Separate loop variables, so the touch voxel and section x are not overwritten
+                            for syn_sec_x, syn_x, syn_y, syn_z, syn_dist, cond, param_id \
+                                    in zip(cluster_sec_x, coords_all[:, 0], coords_all[:, 1], coords_all[:, 2],
+                                           soma_dist * 1e6, cluster_cond, cluster_param_id):
+                                assert cond > 0, f"Conductance should be larger than 0. cond = {cond}"
+
+                                sd.hyper_voxel_synapses[sd.hyper_voxel_synapse_ctr, :] = \
+                                    [ax_id, d_id, syn_x, syn_y, syn_z, sd.hyper_voxel_id, channel_model_id,
+                                     ax_dist, syn_dist, d_sec_id, syn_sec_x * 1000, cond * 1e12, param_id]
+
+                                # !!! OBS, dSegX is a value between 0 and 1, multiplied by 1000
+                                # need to divide by 1000 later
+
+                                sd.hyper_voxel_synapse_ctr += 1
+
+                        else:
+                            # We can not do pruning at this stage, since we only see
+                            # synapses within hyper voxel, and pruning depends on
+                            # all synapses between two connected cells.
+
+                            # Do we have enough space allocated?
+                            if sd.hyper_voxel_synapse_ctr >= sd.max_synapses:
+                                sd.resize_hyper_voxel_synapses_matrix()
+
+                            # Synapse conductance varies between synapses
+                            # cond = sd.hyper_voxel_rng.normal(mean_synapse_cond, std_synapse_cond)
+
+                            # lognormal distribution -- https://www.nature.com/articles/nrn3687
+                            # https://en.wikipedia.org/wiki/Log-normal_distribution
+                            cond = sd.hyper_voxel_rng.lognormal(synapse_mu, synapse_sigma)
+
+                            # Need to make sure the conductance is not negative,
+                            # set lower cap at 10% of mean value
+                            cond = np.maximum(cond, mean_synapse_cond * 0.1)
+                            assert cond > 0, f"Conductance should be larger than 0. cond = {cond}"
+
+                            param_id = sd.hyper_voxel_rng.integers(1000000)
+
+                            # Add synapse
+                            sd.hyper_voxel_synapses[sd.hyper_voxel_synapse_ctr, :] = \
+                                [ax_id, d_id, x, y, z, sd.hyper_voxel_id, channel_model_id,
+                                 ax_dist, d_dist, d_sec_id, d_sec_x * 1000, cond * 1e12, param_id]
+
+                            # !!! OBS, dSegX is a value between 0 and 1, multiplied by 1000
+                            # need to divide by 1000 later
+
+                            sd.hyper_voxel_synapse_ctr += 1
+
+
+def reference_create_lookup_table(data, n_rows, data_type, num_neurons, max_synapse_type):
+    """
+    This creates a lookup table where all synapses in the hyper voxel
+    between the same pair of neurons are grouped together in the synapse matrix.
+    Returns a matrix where first column is a UID = srcID*nNeurons + destID
+    and the following two columns are start row and end row (-1) in matrix
+
+    Reference implementation for SnuddaDetect.create_lookup_table, one row at a time.
+
+    Args:
+        data : either synapse matrix, or gap junction matrix
+        n_rows : number of rows in matrix that are used (matrix itself can be larger)
+        data_type : "synapses" or "gap_junctions"
+        num_neurons : number of neurons
+        max_synapse_type : the synapse types are numbered, this number must not be too small.
+
+
+    Returns a matrix where first column is a UID = src_ID*num_neurons + dest_ID
+    and the following two columns are start row and end row (-1) in matrix
+    """
+
+    # self.write_log("Create lookup table")
+    # nRows = data.shape[0] -- zero padded, cant use shape
+    lookup_table = np.zeros((data.shape[0], 3), dtype=int)
+
+    next_idx = 0
+    start_idx = 0
+
+    lookup_idx = 0
+    # num_neurons = len(self.neurons)
+
+    if data_type == "synapses":
+        hardcoded_synapse_type = None
+    elif data_type == "gap_junctions":
+        hardcoded_synapse_type = 3  # Hardcoded for gap junctions
+    else:
+        assert False, f"Unknown data_type {data_type}, should be 'synapses' or ' gap_junctions'"
+
+    # max_synapse_type = self.next_channel_model_id   # This needs to be saved in HDF5 file
+
+    while next_idx < n_rows:
+        src_id = data[next_idx, 0]
+        dest_id = data[next_idx, 1]
+
+        if hardcoded_synapse_type:
+            synapse_type = hardcoded_synapse_type
+        else:
+            synapse_type = data[next_idx, 6]
+
+        next_idx += 1
+
+        while (next_idx < n_rows
+               and data[next_idx, 0] == src_id
+               and data[next_idx, 1] == dest_id):
+            next_idx += 1
+
+        lookup_table[lookup_idx, :] = [(dest_id * num_neurons + src_id) * max_synapse_type + synapse_type,
+                                       start_idx, next_idx]
+
+        start_idx = next_idx
+        lookup_idx += 1
+
+    return lookup_table[:lookup_idx, :]
+
 
 class TestDetect(unittest.TestCase):
 
@@ -91,6 +293,11 @@ class TestDetect(unittest.TestCase):
 
         self.sd.detect(restart_detection_flag=True)
 
+        dense_synapses = self.sd.hyper_voxel_synapses[:self.sd.hyper_voxel_synapse_ctr, :].copy()
+        dense_gap_junctions = self.sd.hyper_voxel_gap_junctions[:self.sd.hyper_voxel_gap_junction_ctr, :].copy()
+        dense_dend_voxel_ctr = self.sd.dend_voxel_ctr.copy()
+        dense_axon_voxel_ctr = self.sd.axon_voxel_ctr.copy()
+
         synapse_voxel_loc = self.sd.hyper_voxel_synapses[:self.sd.hyper_voxel_synapse_ctr, 2:5]
         synapse_coords = synapse_voxel_loc * self.sd.voxel_size + self.sd.hyper_voxel_origo
 
@@ -137,6 +344,25 @@ class TestDetect(unittest.TestCase):
             gj_order = gj[:, 1] * len(self.sd.neurons) + gj[:, 0]
             self.assertTrue((np.diff(gj_order) >= 0).all())
 
+        with self.subTest(stage="lookup_table_check"):
+            # Vectorised lookup table must be identical to the row by row version
+            rng = np.random.default_rng(1234)
+            random_synapses = np.zeros((1200, 13), dtype=np.int32)
+            random_synapses[:1000, :2] = np.sort(rng.integers(0, 30, size=(1000, 2)), axis=0)
+            random_synapses[:1000, 6] = rng.integers(0, 12, size=1000)
+
+            for data, n_rows, data_type in [(self.sd.hyper_voxel_synapses, self.sd.hyper_voxel_synapse_ctr, "synapses"),
+                                            (self.sd.hyper_voxel_gap_junctions, self.sd.hyper_voxel_gap_junction_ctr,
+                                             "gap_junctions"),
+                                            (random_synapses, 1000, "synapses"),
+                                            (random_synapses, 0, "synapses")]:
+                lookup = self.sd.create_lookup_table(data=data, n_rows=n_rows, data_type=data_type,
+                                                     num_neurons=len(self.sd.neurons), max_synapse_type=12)
+                ref_lookup = reference_create_lookup_table(data=data, n_rows=n_rows, data_type=data_type,
+                                                         num_neurons=len(self.sd.neurons), max_synapse_type=12)
+                self.assertEqual(lookup.shape, ref_lookup.shape)
+                self.assertTrue((lookup == ref_lookup).all())
+
         with self.subTest(stage="synapse_conductance_check"):
             cond = self.sd.hyper_voxel_synapses[:self.sd.hyper_voxel_synapse_ctr, 11] * 1e-12
             self.assertTrue(0.8e-9 < np.mean(cond) < 1.4e-9)  # mean 1.1e-9
@@ -161,6 +387,70 @@ class TestDetect(unittest.TestCase):
             # Check new rows are empty
             self.assertTrue((self.sd.hyper_voxel_synapses[old.shape[0]:, :] == 0).all())
 
+        with self.subTest(stage="compiled_synapse_placement_check"):
+            # The compiled synapse placement must give identical synapses to the Python version
+            x_syn, y_syn, z_syn = np.where(np.bitwise_and(self.sd.dend_voxel_ctr > 0, self.sd.axon_voxel_ctr > 0))
+
+            self.sd.hyper_voxel_rng = np.random.default_rng(1234)
+            self.sd.hyper_voxel_synapse_ctr = 0
+            reference_place_touch_synapses(self.sd, x_syn=x_syn, y_syn=y_syn, z_syn=z_syn)
+            slow_synapses = self.sd.hyper_voxel_synapses[:self.sd.hyper_voxel_synapse_ctr, :].copy()
+
+            self.sd.hyper_voxel_rng = np.random.default_rng(1234)
+            self.sd.hyper_voxel_synapse_ctr = 0
+            self.sd.place_touch_synapses(x_syn=x_syn, y_syn=y_syn, z_syn=z_syn)
+            fast_synapses = self.sd.hyper_voxel_synapses[:self.sd.hyper_voxel_synapse_ctr, :]
+
+            self.assertEqual(slow_synapses.shape[0], 101)
+            self.assertTrue((slow_synapses == fast_synapses).all())
+
+        with self.subTest(stage="sparse_voxel_check"):
+            # Sparse voxel storage must give the same voxel counts, synapses and gap junctions as dense storage
+            self.sd.sparse_voxels = True
+            self.sd.detect(restart_detection_flag=True)
+
+            self.assertTrue((self.sd.dend_voxel_ctr == dense_dend_voxel_ctr).all())
+            self.assertTrue((self.sd.axon_voxel_ctr == dense_axon_voxel_ctr).all())
+            self.assertEqual(self.sd.hyper_voxel_synapse_ctr, dense_synapses.shape[0])
+            self.assertTrue((self.sd.hyper_voxel_synapses[:self.sd.hyper_voxel_synapse_ctr, :]
+                             == dense_synapses).all())
+            self.assertEqual(self.sd.hyper_voxel_gap_junction_ctr, dense_gap_junctions.shape[0])
+            self.assertTrue((self.sd.hyper_voxel_gap_junctions[:self.sd.hyper_voxel_gap_junction_ctr, :]
+                             == dense_gap_junctions).all())
+
+        with self.subTest(stage="dda_rasterise_check"):
+            # DDA must mark exactly the voxels the segments pass through, compare with reference rasteriser
+            self.sd.rasterise_method = "dda"
+            self.sd.detect(restart_detection_flag=True)
+            self.sd.rasterise_method = "step"
+
+            ref_dend_voxels = set()
+            ref_axon_voxels = set()
+
+            for neuron_id, neuron_info in self.sd.hyper_voxels[self.sd.hyper_voxel_id]["neurons"].items():
+                neuron = self.sd.load_neuron(self.sd.neurons[neuron_id], use_cache=False)
+
+                if "soma" in neuron_info:
+                    ref_dend_voxels |= set(zip(*self.sd.get_soma_voxels(neuron=neuron, neuron_id=neuron_id)))
+
+                tables = [(ref_dend_voxels, "neuron", 3, neuron_info["dend"])] if "dend" in neuron_info else []
+                tables += [(ref_axon_voxels, subtree, 2, section_id)
+                           for section_id, subtree in neuron_info.get("axon", [])]
+
+                for ref_voxels, subtree, section_type, section_id in tables:
+                    table = SegmentTable()
+                    table.add_sections(neuron.morphology_data[subtree], section_type=section_type,
+                                       section_id=section_id)
+                    section_start = np.concatenate(([0], np.cumsum(table.num_points)))
+                    ref_voxels |= {v[1:] for v in reference_rasterise(np.concatenate(table.geometry), section_start,
+                                                                      self.sd.hyper_voxel_origo,
+                                                                      self.sd.voxel_size, self.sd.num_bins)}
+
+            self.assertTrue(len(ref_dend_voxels) > 0 and len(ref_axon_voxels) > 0)
+            self.assertEqual(set(zip(*np.nonzero(self.sd.dend_voxel_ctr))), ref_dend_voxels)
+            self.assertEqual(set(zip(*np.nonzero(self.sd.axon_voxel_ctr))), ref_axon_voxels)
+            self.assertTrue(self.sd.hyper_voxel_synapse_ctr > 0)
+
         # These test drawing not essential to Snudda, quite slow.
         if False:
             with self.subTest(stage="export_voxel_vis"):
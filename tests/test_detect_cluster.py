@@ -11,6 +11,8 @@ from scipy.spatial.distance import pdist
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
 
+from test_detect import reference_place_touch_synapses
+
 
 class TestDetectSynapseCluster(unittest.TestCase):
 
@@ -105,6 +107,24 @@ class TestDetectSynapseCluster(unittest.TestCase):
             self.assertTrue(0 <= self.get_synapse_spread(4, 2) <= 25e-6 + error_margin)
             self.assertTrue(0 <= self.get_synapse_spread(4, 3) <= 25e-6 + error_margin)
 
+        with self.subTest(stage="compiled-cluster-placement"):
+            # The compiled cluster synapse placement must give identical synapses to the Python version
+            x_syn, y_syn, z_syn = np.where(np.bitwise_and(self.sd.dend_voxel_ctr > 0, self.sd.axon_voxel_ctr > 0))
+
+            self.sd.hyper_voxel_rng = np.random.default_rng(1234)
+            self.sd.hyper_voxel_synapse_ctr = 0
+            reference_place_touch_synapses(self.sd, x_syn=x_syn, y_syn=y_syn, z_syn=z_syn)
+            slow_synapses = self.sd.hyper_voxel_synapses[:self.sd.hyper_voxel_synapse_ctr, :].copy()
+
+            self.sd.hyper_voxel_rng = np.random.default_rng(1234)
+            self.sd.hyper_voxel_synapse_ctr = 0
+            self.sd.place_touch_synapses(x_syn=x_syn, y_syn=y_syn, z_syn=z_syn)
+            fast_synapses = self.sd.hyper_voxel_synapses[:self.sd.hyper_voxel_synapse_ctr, :]
+
+            self.assertTrue(slow_synapses.shape[0] > 0)
+            self.assertEqual(slow_synapses.shape, fast_synapses.shape)
+            self.assertTrue((slow_synapses == fast_synapses).all())
+
         # Lägg till tester som kollar positionerna på synapserna
         # import pdb
         # pdb.set_trace()
@@ -0,0 +1,121 @@
+import unittest
+
+import numpy as np
+
+from snudda.simulate.simulate import SnuddaSimulate
+
+
+class WorkerContext:
+
+    """ Stands in for NEURON's ParallelContext on worker worker_id, out of num_workers. """
+
+    def __init__(self, worker_id, num_workers):
+        self.worker_id = worker_id
+        self.num_workers = num_workers
+
+    def id(self):
+        return self.worker_id
+
+    def nhost(self):
+        return self.num_workers
+
+    def gid_clear(self):
+        pass
+
+
+class TestDistributeNeurons(unittest.TestCase):
+
+    @staticmethod
+    def get_worker_neurons(strategy, num_workers, num_neurons=10):
+
+        """ Runs distribute_neurons on each worker, returns the neuron_id list of each worker. """
+
+        # Neurons 0 and 1 receive 29 synapses each, the virtual neuron 3 receives 50 synapses
+        is_virtual_neuron = np.zeros((num_neurons,), dtype=bool)
+        is_virtual_neuron[3] = True
+
+        worker_neurons = []
+
+        for worker_id in range(0, num_workers):
+            sim = SnuddaSimulate.__new__(SnuddaSimulate)
+            sim.pc = WorkerContext(worker_id=worker_id, num_workers=num_workers)
+            sim.num_neurons = num_neurons
+            sim.distribution_strategy = strategy
+            sim.network_info = {"neurons": [{"virtual_neuron": bool(v), "morphology": None}
+                                            for v in is_virtual_neuron]}
+            sim.is_virtual_neuron = is_virtual_neuron
+            sim.synapse_groups = (np.array([0, 1, 3]), np.array([0, 29, 58]), np.array([29, 58, 108]))
+            sim.snudda_data = None
+            sim.log_file = None
+            sim.verbose = False
+
+            sim.distribute_neurons()
+
+            assert (sim.neuron_id == np.flatnonzero(sim.neuron_id_on_node)).all()
+            worker_neurons.append(list(sim.neuron_id))
+
+        return worker_neurons
+
+    def test_distribute_neurons(self):
+
+        with self.subTest(stage="round-robin"):
+            self.assertEqual(self.get_worker_neurons("round_robin", num_workers=3),
+                             [[0, 3, 6, 9], [1, 4, 7], [2, 5, 8]])
+
+        with self.subTest(stage="contiguous"):
+            self.assertEqual(self.get_worker_neurons("contiguous", num_workers=3),
+                             [[0, 1, 2], [3, 4, 5], [6, 7, 8, 9]])
+
+        with self.subTest(stage="load-balanced"):
+            # Loads are 30, 30 and 1 for the other neurons, synapses onto the virtual neuron do not add load
+            self.assertEqual(self.get_worker_neurons("load_balanced", num_workers=2),
+                             [[0], [1, 2, 3, 4, 5, 6, 7, 8, 9]])
+
+        with self.subTest(stage="all-neurons-once"):
+            for strategy in ["round_robin", "contiguous", "load_balanced"]:
+                for num_workers in [1, 4, 10]:
+                    worker_neurons = self.get_worker_neurons(strategy, num_workers=num_workers)
+                    self.assertTrue(all(len(n) > 0 for n in worker_neurons))
+                    self.assertEqual(sorted(sum(worker_neurons, [])), list(range(0, 10)))
+
+        with self.subTest(stage="bad-strategy"):
+            with self.assertRaises(ValueError):
+                self.get_worker_neurons("random", num_workers=2)
+
+        with self.subTest(stage="too-many-workers"):
+            with self.assertRaises(AssertionError):
+                self.get_worker_neurons("round_robin", num_workers=11)
+
+    def test_partition_load(self):
+
+        with self.subTest(stage="equal-load"):
+            range_borders = SnuddaSimulate.partition_load(load=np.ones((100,)), num_workers=4)
+            self.assertEqual(list(range_borders), [0, 25, 50, 75, 100])
+
+        with self.subTest(stage="unequal-load"):
+            # First half of the neurons are ten times as heavy
+            load = np.concatenate([np.full((50,), 10), np.ones((50,))])
+            range_borders = SnuddaSimulate.partition_load(load=load, num_workers=2)
+            self.assertEqual(list(range_borders), [0, 28, 100])
+
+        with self.subTest(stage="random-load"):
+            rng = np.random.default_rng(1234)
+
+            for _ in range(0, 100):
+                num_neurons = rng.integers(1, 50)
+                num_workers = rng.integers(1, num_neurons + 1)
+                load = rng.integers(1, 1000, num_neurons)
+
+                # Single very heavy neuron, the other workers must still get at least one neuron each
+                load[rng.integers(0, num_neurons)] = 1000000
+
+                range_borders = SnuddaSimulate.partition_load(load=load, num_workers=num_workers)
+
+                self.assertEqual(len(range_borders), num_workers + 1)
+                self.assertEqual(range_borders[0], 0)
+                self.assertEqual(range_borders[-1], num_neurons)
+                self.assertTrue((np.diff(range_borders) >= 1).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
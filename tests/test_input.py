@@ -1,12 +1,36 @@
 import unittest
 import os
+import shutil
+import time
 import h5py
 import json
 import numpy as np
 
 from snudda.detect.detect import SnuddaDetect
 from snudda.input.input import SnuddaInput
+from snudda.input.time_varying_input import TimeVaryingInput
 from snudda.detect.prune import SnuddaPrune
+from snudda.simulate.simulate import SnuddaSimulate
+from snudda.utils.snudda_path import snudda_parse_path
+from snudda.utils.input_spikes import is_csr_input, get_num_inputs, get_input_info, get_input_spike_matrix, \
+    get_spike_dataset
+
+
+def generate_spikes_reference(frequency_function, end_time, rng, start_time=0, n_spike_trains=1, start_at_zero=True):
+
+    """ Reference for TimeVaryingInput.generate_spikes_csr, generates one spike train at a time
+        by stretching a 1 Hz Poisson process. """
+
+    stretch_func, stretched_end_time = TimeVaryingInput.get_stretch_time(frequency_function=frequency_function,
+                                                                         start_time=start_time, end_time=end_time,
+                                                                         start_at_zero=start_at_zero)
+    spike_trains = []
+
+    for idx in range(0, n_spike_trains):
+        t_spike = TimeVaryingInput._poisson_helper(end_time=stretched_end_time, rng=rng)
+        spike_trains.append(stretch_func(t_spike))  # Stretch the spike times
+
+    return spike_trains
 
 
 class InputTestCase(unittest.TestCase):
@@ -93,6 +117,254 @@ class InputTestCase(unittest.TestCase):
 
         self.assertTrue((np.abs(spike_times - jittered_spikes[0]) < 4*jitter_dt).all())
 
+        with self.subTest("Batched correlated spike generation"):
+            num_trains = 200
+            population_unit_spikes = si2.generate_poisson_spikes(freq=freq, time_range=t_range, rng=rng)
+            csr_spikes, offset = si2.make_correlated_spikes_csr(freq=freq, time_range=t_range,
+                                                                num_spike_trains=num_trains, p_keep=p_keep2,
+                                                                rng=rng, population_unit_spikes=population_unit_spikes,
+                                                                block_size=1000)
+
+            self.assertEqual(len(offset), num_trains + 1)
+            self.assertEqual(offset[-1], len(csr_spikes))
+
+            for st, et, pk, f in zip(start_times, end_times, p_keep2, freq):
+                n_spikes = np.sum(np.logical_and(st <= csr_spikes, csr_spikes <= et))
+                n_expected = (et - st) * f * num_trains
+                self.assertTrue(0.9 * n_expected <= n_spikes <= 1.1 * n_expected,
+                                f"Found {n_spikes}, expected {n_expected} (+/- 10%)")
+
+                # Fraction of spikes from the shared population unit spike train
+                pop_spikes = population_unit_spikes[np.logical_and(st <= population_unit_spikes,
+                                                                    population_unit_spikes <= et)]
+                n_shared = np.sum(np.isin(csr_spikes, pop_spikes))
+                n_shared_expected = len(pop_spikes) * pk * num_trains
+                self.assertTrue(0.9 * n_shared_expected <= n_shared <= 1.1 * n_shared_expected)
+
+            spike_times, offset = si2.make_correlated_spikes(freq=freq, time_range=t_range,
+                                                             num_spike_trains=num_trains,
+                                                             p_keep=p_keep2, rng=rng, jitter_dt=1e-3,
+                                                             population_unit_spikes=population_unit_spikes,
+                                                             input_generator="poisson")
+
+            self.assertEqual(len(offset), num_trains + 1)
+            self.assertEqual(offset[-1], len(spike_times))
+
+            for spike_train in np.split(spike_times, offset[1:-1]):
+                self.assertTrue((np.diff(spike_train) >= 0).all())
+                self.assertTrue((spike_train >= 0).all())
+
+    def test_spike_format(self):
+
+        input_config = os.path.join(self.network_path, "input-test-1.json")
+        spike_files = dict()
+
+        for spike_format in ["dense", "csr"]:
+            spike_files[spike_format] = os.path.join(self.network_path, f"input-spikes-{spike_format}.hdf5")
+            si = SnuddaInput(input_config_file=input_config, hdf5_network_file=self.network_file,
+                             spike_data_filename=spike_files[spike_format], time=2, random_seed=1234,
+                             spike_format=spike_format)
+            si.generate()
+
+        with h5py.File(spike_files["dense"], "r") as dense_data, h5py.File(spike_files["csr"], "r") as csr_data:
+
+            self.assertEqual(list(dense_data["input"].keys()), list(csr_data["input"].keys()))
+
+            for neuron_id_str in dense_data["input"].keys():
+                for input_type in dense_data[f"input/{neuron_id_str}"].keys():
+                    dense_input = dense_data[f"input/{neuron_id_str}/{input_type}"]
+                    csr_input = csr_data[f"input/{neuron_id_str}/{input_type}"]
+
+                    with self.subTest(neuron_id=neuron_id_str, input_type=input_type):
+                        self.assertFalse(is_csr_input(dense_input))
+                        self.assertTrue(is_csr_input(csr_input))
+                        self.assertNotIn("section_id", csr_input.attrs)
+
+                        self.assertEqual(get_num_inputs(dense_input), get_num_inputs(csr_input))
+
+                        for info_name in ["section_id", "section_x", "distance_to_soma", "parameter_id"]:
+                            self.assertTrue((get_input_info(dense_input, info_name)
+                                             == get_input_info(csr_input, info_name)).all())
+
+                        for attr_name in ["freq", "start", "end", "generator"]:
+                            self.assertTrue(np.all(get_spike_dataset(dense_input).attrs[attr_name]
+                                                   == get_spike_dataset(csr_input).attrs[attr_name]))
+
+                        dense_spikes = SnuddaSimulate.read_input_spikes(dense_input)
+                        csr_spikes = SnuddaSimulate.read_input_spikes(csr_input)
+                        self.assertEqual(len(dense_spikes), len(csr_spikes))
+
+                        for dense_train, csr_train in zip(dense_spikes, csr_spikes):
+                            self.assertTrue(np.array_equal(dense_train, csr_train))
+
+                        dense_mat, dense_num_spikes = get_input_spike_matrix(dense_input)
+                        csr_mat, csr_num_spikes = get_input_spike_matrix(csr_input)
+                        self.assertTrue(np.array_equal(dense_mat, csr_mat))
+                        self.assertTrue(np.array_equal(dense_num_spikes, csr_num_spikes))
+
+    def test_stream_output(self):
+
+        input_config = os.path.join(self.network_path, "input-test-1.json")
+        spike_files = dict()
+
+        for stream_output in [False, True]:
+            spike_files[stream_output] = os.path.join(self.network_path, f"input-spikes-stream-{stream_output}.hdf5")
+            si = SnuddaInput(input_config_file=input_config, hdf5_network_file=self.network_file,
+                             spike_data_filename=spike_files[stream_output], time=2, random_seed=1234,
+                             stream_output=stream_output)
+            si.generate()
+
+            if stream_output:
+                # Spikes are freed once they are written to file
+                for neuron_id in si.neuron_input:
+                    for input_type in si.neuron_input[neuron_id]:
+                        self.assertNotIn("spikes", si.neuron_input[neuron_id][input_type])
+                        self.assertTrue(si.neuron_input[neuron_id][input_type]["written"])
+
+        self.compare_spike_files(spike_files[False], spike_files[True])
+
+    def test_stream_output_parallel(self):
+
+        input_config = os.path.join(self.network_path, "input-test-1.json")
+        ref_spike_file = os.path.join(self.network_path, "input-spikes-serial.hdf5")
+        stream_spike_file = os.path.join(self.network_path, "input-spikes-stream-parallel.hdf5")
+
+        si = SnuddaInput(input_config_file=input_config, hdf5_network_file=self.network_file,
+                         spike_data_filename=ref_spike_file, time=2, random_seed=1234)
+        si.generate()
+
+        os.environ["IPYTHONDIR"] = os.path.join(os.path.abspath(os.getcwd()), ".ipython")
+        os.environ["IPYTHON_PROFILE"] = "default"
+        os.system("ipcluster start -n 2 --profile=$IPYTHON_PROFILE --ip=127.0.0.1&")
+        time.sleep(15)
+
+        try:
+            from ipyparallel import Client
+            u_file = os.path.join(".ipython", "profile_default", "security", "ipcontroller-client.json")
+            rc = Client(url_file=u_file, timeout=120, debug=False)
+
+            # Small stream_chunk_size, so that the workers get new inputs while the master writes
+            si = SnuddaInput(input_config_file=input_config, hdf5_network_file=self.network_file,
+                             spike_data_filename=stream_spike_file, time=2, random_seed=1234,
+                             stream_output=True, stream_chunk_size=3, rc=rc)
+            si.generate()
+
+            for neuron_id in si.neuron_input:
+                for input_type in si.neuron_input[neuron_id]:
+                    self.assertTrue(si.neuron_input[neuron_id][input_type]["written"])
+
+            rc.close()
+        finally:
+            os.system("ipcluster stop")
+
+        self.compare_spike_files(ref_spike_file, stream_spike_file)
+
+    def compare_spike_files(self, ref_spike_file, spike_file):
+
+        """ Checks that the two input spike files have the same content, the order of the groups may differ. """
+
+        def compare_items(name, ref_item):
+            item = data[name]
+
+            with self.subTest(name=name):
+                self.assertEqual(dict(ref_item.attrs).keys(), dict(item.attrs).keys())
+
+                for attr_name, attr_value in ref_item.attrs.items():
+                    self.assertTrue(np.all(attr_value == item.attrs[attr_name]))
+
+                if isinstance(ref_item, h5py.Group):
+                    self.assertEqual(sorted(ref_item.keys()), sorted(item.keys()))
+                else:
+                    self.assertTrue(np.array_equal(ref_item[()], item[()]))
+
+        with h5py.File(ref_spike_file, "r") as ref_data, h5py.File(spike_file, "r") as data:
+            ref_data.visititems(compare_items)
+
+    def test_virtual_neuron_spikes(self):
+
+        spike_file = os.path.join(self.network_path, "virtual-neuron-spikes.txt")
+        with open(spike_file, "wt") as f:
+            f.write("0.1 0.2 0.3\n")
+            f.write("0.5 0.4\n")
+
+        si = SnuddaInput(verbose=True)
+        si.neuron_input = {0: {"virtual_neuron": {"spike_file": spike_file}},
+                           1: {"virtual_neuron": {"spike_file": spike_file}},
+                           2: {"virtual_neuron": {"spike_file": spike_file, "row_id": 0}},
+                           3: {"virtual_neuron": {"spike_file": "missing-spike-file.txt"}}}
+
+        with self.subTest(stage="row-neuron-id"):
+            spikes = si.read_virtual_neuron_spikes(neuron_id=0, input_type="virtual_neuron")
+            self.assertTrue(np.allclose(spikes, [0.1, 0.2, 0.3]))
+
+        with self.subTest(stage="unsorted"):
+            with self.assertRaisesRegex(ValueError, "Virtual neuron 1 .* must be in order"):
+                si.read_virtual_neuron_spikes(neuron_id=1, input_type="virtual_neuron")
+
+        with self.subTest(stage="bad-row"):
+            si.neuron_input[2]["virtual_neuron"]["row_id"] = 5
+            with self.assertRaisesRegex(ValueError, "Virtual neuron 2 .* row 5"):
+                si.read_virtual_neuron_spikes(neuron_id=2, input_type="virtual_neuron")
+
+        with self.subTest(stage="missing-file"):
+            with self.assertRaisesRegex(FileNotFoundError, "Virtual neuron 3 .* missing-spike-file.txt"):
+                si.read_virtual_neuron_spikes(neuron_id=3, input_type="virtual_neuron")
+
+        with self.subTest(stage="write-keeps-spikes"):
+            # Without streaming the spikes are kept after writing, so check_sorted can verify them
+            si.neuron_input = {0: {"virtual_neuron": {"spike_file": spike_file}},
+                               1: {"virtual_neuron": {"spike_file": spike_file, "row_id": 0}}}
+            si.neuron_type = {0: "dSPN", 1: "dSPN"}
+            si.input_info = dict()
+            si.spike_data_filename = os.path.join(self.network_path, "virtual-neuron-input.hdf5")
+
+            out_file = si.create_hdf5()
+            si.write_neuron_input_hdf5(out_file=out_file, neuron_id=0, input_type="virtual_neuron")
+            self.assertTrue(np.allclose(si.neuron_input[0]["virtual_neuron"]["spikes"], [0.1, 0.2, 0.3]))
+            si.check_sorted()
+
+            # When streaming, the spikes are freed once written and checked
+            si.stream_neuron_input(out_file=out_file, neuron_id=1, input_type="virtual_neuron")
+            self.assertNotIn("spikes", si.neuron_input[1]["virtual_neuron"])
+            self.assertTrue(np.allclose(out_file["input/1/activity/spikes"][()], [0.1, 0.2, 0.3]))
+            out_file.close()
+
+    def test_bend_morphology_cache(self):
+
+        input_config = os.path.join(self.network_path, "input-test-1.json")
+        si = SnuddaInput(input_config_file=input_config, hdf5_network_file=self.network_file, time=2,
+                         random_seed=1234)
+        si.read_network_config_file()
+
+        # Pretend neurons 0 and 1 have bend morphologies, these are stored outside the neuron_path
+        bend_paths = []
+        for neuron_id in [0, 1]:
+            morphology_path = snudda_parse_path(si.neuron_info[neuron_id]["morphology"], si.snudda_data)
+            bend_path = os.path.join(self.network_path, "modified_morphologies", f"bend-{neuron_id}.swc")
+            os.makedirs(os.path.dirname(bend_path), exist_ok=True)
+            shutil.copy(morphology_path, bend_path)
+            si.neuron_info[neuron_id]["morphology"] = bend_path
+            bend_paths.append(bend_path)
+
+        rng = np.random.default_rng(1234)
+        input_loc = si.dendrite_input_locations(neuron_id=0, rng=rng, num_spike_trains=20)
+        self.assertEqual(len(input_loc[0]), 20)
+
+        # The bend morphology is loaded once, and reused by the neuron's other input types
+        self.assertEqual(si.bend_morphology_cache[0], bend_paths[0])
+        bend_morphology = si.bend_morphology_cache[1]
+
+        input_loc = si.dendrite_input_locations(neuron_id=0, rng=rng, num_spike_trains=10)
+        self.assertEqual(len(input_loc[0]), 10)
+        self.assertIs(si.bend_morphology_cache[1], bend_morphology)
+
+        # Only the current neuron's bend morphology is kept, and they do not end up in neuron_cache
+        si.dendrite_input_locations(neuron_id=1, rng=rng, num_spike_trains=10)
+        self.assertEqual(si.bend_morphology_cache[0], bend_paths[1])
+        self.assertIsNot(si.bend_morphology_cache[1], bend_morphology)
+        self.assertNotIn(bend_paths[0], si.neuron_cache)
+        self.assertNotIn(bend_paths[1], si.neuron_cache)
+
     def test_input_1(self):
 
         # This tests Poisson inputs
@@ -147,6 +419,14 @@ class InputTestCase(unittest.TestCase):
                     #     for ctr in range(0, cluster_size-1):
                     #         self.assertTrue(np.all(np.diff(input_info["section_id"])[ctr::cluster_size] == 0))
 
+                with self.subTest("Reading input spikes for simulation"):
+                    spike_trains = SnuddaSimulate.read_input_spikes(input_info)
+                    self.assertEqual(len(spike_trains), n_traces)
+
+                    for trace, n_spikes, spike_train in zip(spikes, input_info["spikes"].attrs["num_spikes"],
+                                                            spike_trains):
+                        self.assertTrue(np.allclose(spike_train, trace[:n_spikes] * 1e3))
+
                 max_len = 1
                 if type(start_time) is np.ndarray:
                     max_len = np.maximum(max_len, len(start_time))
@@ -326,6 +606,58 @@ class InputTestCase(unittest.TestCase):
                                     f"Found frequency {freq} Hz at {t_check}s, expected {t_check*100} Hz")
 
 
+        with self.subTest("Batch of spike trains"):
+            TimeVaryingInput.stretch_time_cache.clear()
+            rng = np.random.default_rng(113)
+            n_trains = 200
+
+            spike_times, offset = si_empty.generate_spikes_function(frequency_function=func_str, time_range=[1, 3],
+                                                                    dt=1e-4, rng=rng, n_spike_trains=n_trains)
+            spike_trains = np.split(spike_times, offset[1:-1])
+            self.assertEqual(len(spike_trains), n_trains)
+            self.assertEqual(len(TimeVaryingInput.stretch_time_cache), 1)
+
+            # The stretched time table is reused by the next call with the same frequency function
+            si_empty.generate_spikes_function(frequency_function=func_str, time_range=[1, 3], dt=1e-4, rng=rng)
+            self.assertEqual(len(TimeVaryingInput.stretch_time_cache), 1)
+
+            for spikes in spike_trains:
+                self.assertTrue((np.diff(spikes) >= 0).all())
+                self.assertTrue(((1 <= spikes) & (spikes <= 3)).all())
+
+            # Expected number of spikes per train is integral of 100*t from 0 to 2, i.e. 200
+            all_spikes = np.concatenate(spike_trains)
+            self.assertTrue(0.95 * 200 * n_trains <= len(all_spikes) <= 1.05 * 200 * n_trains)
+
+            for t_check in [1.5, 2.5]:
+                freq = np.sum(np.abs(all_spikes - t_check) <= 0.1) / (0.2 * n_trains)
+                expected_freq = (t_check - 1) * 100
+                self.assertTrue(0.9 * expected_freq <= freq <= 1.1 * expected_freq,
+                                f"Found frequency {freq} Hz at {t_check}s, expected {expected_freq} Hz")
+
+        with self.subTest("Same statistics as reference generator"):
+            func = lambda t: 5 * np.cos(10 * 2 * np.pi * t) + 6 + 10 * t
+            n_trains = 2000
+
+            spike_times, offset = TimeVaryingInput.generate_spikes_csr(frequency_function=func, start_time=1,
+                                                                       end_time=3, n_spike_trains=n_trains,
+                                                                       rng=np.random.default_rng(114))
+            ref_spike_trains = generate_spikes_reference(frequency_function=func, start_time=1, end_time=3,
+                                                         n_spike_trains=n_trains, rng=np.random.default_rng(115))
+            ref_spike_times = np.concatenate(ref_spike_trains)
+            num_spikes = np.diff(offset)
+            ref_num_spikes = np.array([len(x) for x in ref_spike_trains])
+
+            # Spike count per train is Poisson, mean = variance = integral of f from 0 to 2, i.e. 32
+            self.assertTrue(abs(np.mean(num_spikes) - np.mean(ref_num_spikes)) < 0.5)
+            self.assertTrue(0.85 < np.var(num_spikes) / np.var(ref_num_spikes) < 1.15)
+
+            # Same time course of the frequency, compared in 20 ms bins
+            bins = np.arange(1, 3.0001, 0.02)
+            hist = np.histogram(spike_times, bins=bins)[0] / (0.02 * n_trains)
+            ref_hist = np.histogram(ref_spike_times, bins=bins)[0] / (0.02 * n_trains)
+            self.assertTrue(np.max(np.abs(hist - ref_hist)) < 5)
+
     def test_arbitrary_function_range(self):
 
         func_lambda = lambda t: t*100
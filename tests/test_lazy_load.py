@@ -0,0 +1,77 @@
+import os
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+from snudda.utils.lazy_load import MemoryMappedMatrix
+
+
+class TestLazyLoad(unittest.TestCase):
+
+    def setUp(self):
+
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.file_name = os.path.join(self.temp_dir.name, "lazy-load-test.hdf5")
+
+        rng = np.random.default_rng(1234)
+        self.synapses = rng.integers(0, 1000, size=(53, 13), dtype=np.int32)
+
+        with h5py.File(self.file_name, "w") as f:
+            f.create_dataset("chunked", data=self.synapses, chunks=(7, 13), maxshape=(None, 13))
+            f.create_dataset("contiguous", data=self.synapses)
+            f.create_dataset("compressed", data=self.synapses, chunks=(7, 13), compression="lzf")
+            f.create_dataset("empty", shape=(0, 13), dtype=np.int32)
+
+            # Only some chunks written, the rest are never allocated
+            partial = f.create_dataset("partial", shape=(53, 13), dtype=np.int32, chunks=(7, 13))
+            partial[10:20, :] = self.synapses[10:20, :]
+
+        self.h5_file = h5py.File(self.file_name, "r")
+
+    def tearDown(self):
+        self.h5_file.close()
+        self.temp_dir.cleanup()
+
+    def test_memory_mapped_matrix(self):
+
+        partial_synapses = np.zeros(self.synapses.shape, dtype=self.synapses.dtype)
+        partial_synapses[10:20, :] = self.synapses[10:20, :]
+
+        keys = [5, -1, (3, 1), (slice(None), 1), slice(3, 5), slice(5, 40), (slice(5, 40), slice(0, 2)),
+                slice(0, 53, 3), np.array([0, 52, 6, 7, 8]), (np.array([2, 30]), 5),
+                np.arange(53) % 4 == 0, slice(20, 10)]
+
+        for name, ref_data in [("chunked", self.synapses), ("contiguous", self.synapses),
+                               ("partial", partial_synapses)]:
+            with self.subTest(dataset=name):
+                mat = MemoryMappedMatrix(self.h5_file[name])
+
+                self.assertEqual(mat.shape, ref_data.shape)
+                self.assertEqual(len(mat), ref_data.shape[0])
+                self.assertTrue((np.array(mat) == ref_data).all())
+                self.assertTrue((np.array([row for row in mat]) == ref_data).all())
+
+                for key in keys:
+                    self.assertTrue((mat[key] == ref_data[key]).all())
+
+                with self.assertRaises(IndexError):
+                    mat[53]
+
+                # Data is read only
+                with self.assertRaises(ValueError):
+                    mat[1:3][0, 0] = 1
+
+        with self.subTest(dataset="empty"):
+            mat = MemoryMappedMatrix(self.h5_file["empty"])
+            self.assertEqual(mat[:, 0].shape, (0,))
+            self.assertEqual(len(list(mat)), 0)
+
+        with self.subTest(dataset="compressed"):
+            self.assertFalse(MemoryMappedMatrix.is_mappable(self.h5_file["compressed"]))
+            self.assertTrue(MemoryMappedMatrix.is_mappable(self.h5_file["chunked"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
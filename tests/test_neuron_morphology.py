@@ -45,6 +45,12 @@ class NeuronMorphologyExtendedTestCase(unittest.TestCase):
         # 3e-6 due to compartment length sampled at 3 micrometers
         self.assertTrue((dist_to_soma < 200e-6 + 3e-6).all())
 
+        # The synapse density and sampler are cached, and shared with clones
+        self.assertIn(synapse_density, self.nm.input_location_cache)
+        sampler = self.nm.get_input_location_sampler(synapse_density_str=synapse_density)[2]
+        new_nm = self.nm.clone()
+        self.assertIs(new_nm.get_input_location_sampler(synapse_density_str=synapse_density)[2], sampler)
+
 #   -- rand_rotation is now moved to rotation.py
 #
 #     def test_rand_rotation(self, stage="rand_rotation"):
@@ -1,8 +1,13 @@
 import os
+import shutil
 import unittest
 
+import h5py
+import numexpr
+
 from snudda.place.create_cube_mesh import create_cube_mesh
 from snudda.detect.detect import SnuddaDetect
+from snudda.utils.lazy_load import MemoryMappedMatrix
 from snudda.utils.load import SnuddaLoad
 from snudda.neurons.neuron_morphology_extended import NeuronMorphologyExtended
 from snudda.place.place import SnuddaPlace
@@ -11,6 +16,200 @@ import numpy as np
 from snudda.detect.prune import SnuddaPrune
 
 
+def reference_get_keep_row_flag(sp, synapses, merge_data_type):
+    """
+    Prunes synapses, one neuron pair at a time. Reference implementation for SnuddaPrune.get_keep_row_flag.
+
+    Args:
+        sp : SnuddaPrune object
+        synapses: subset of synapse matrix, all synapses onto a neuron must be included
+        merge_data_type : "synapses" or "gap_junctions"
+
+    Returns:
+        keep_row_flag : Boolean array, True for the synapses that are kept
+    """
+
+    # Tried to use numba, but dictionaries and h5py._hl.files.File not supported
+
+    keep_row_flag = np.zeros((synapses.shape[0],), dtype=bool)
+
+    next_read_pos = 0
+    read_end_of_range = synapses.shape[0]
+
+    # Random seeds for reproducability
+    neuron_seeds = sp.get_neuron_random_seeds()
+    previous_post_synaptic_neuron_id = None
+    post_rng = None
+
+    old_pos = -1
+
+    cluster_voxel_distance = sp.cluster_distance / sp.voxel_size
+
+    while next_read_pos < read_end_of_range:
+
+        assert old_pos != next_read_pos, "prune_synapses_helper: Stuck in a loop."
+        old_pos = next_read_pos
+
+        # How many lines contain synapses between this pair of neurons
+        read_end_idx = next_read_pos + 1
+
+        if merge_data_type == "gap_junctions":
+            while (read_end_idx < read_end_of_range and
+                   (synapses[next_read_pos, 0:2] == synapses[read_end_idx, 0:2]).all()):
+                read_end_idx += 1
+        else:
+            while (read_end_idx < read_end_of_range and
+                   (synapses[next_read_pos, 0:2] == synapses[read_end_idx, 0:2]).all()  # Same neuron pair
+                   and synapses[next_read_pos, 6] == synapses[read_end_idx, 6]):  # Same synapse type
+                read_end_idx += 1
+
+            if sp.all_neuron_pair_synapses_share_parameter_id:
+                # Make all synapses between a particular pair of neurons have the same parameter ID
+                synapses[next_read_pos:read_end_idx, 12] = synapses[next_read_pos, 12]
+
+        # Temp check
+        assert ((synapses[next_read_pos:read_end_idx, 0] == synapses[next_read_pos, 0]).all()
+                and (synapses[next_read_pos:read_end_idx, 1] == synapses[next_read_pos, 1]).all()), \
+            "prune_synapses_helper: Internal error, more than one neuron pair"
+
+        n_pair_synapses = read_end_idx - next_read_pos
+
+        src_id = synapses[next_read_pos, 0]
+        dest_id = synapses[next_read_pos, 1]
+
+        if dest_id != previous_post_synaptic_neuron_id:
+            # New post synaptic cell, reseed random generator
+            post_rng = np.random.default_rng(neuron_seeds[dest_id])
+            previous_post_synaptic_neuron_id = dest_id
+
+        if merge_data_type == "gap_junctions":
+            # All are gap junctions
+            synapse_type = 3
+        else:
+            synapse_type = synapses[next_read_pos, 6]
+
+            assert (synapses[next_read_pos:read_end_idx, 6] == synapse_type).all(), \
+                (f"More than one synapse type connecting "
+                 f"{sp.hist_file['network/neurons/name'][synapses[next_read_pos, 0]]}  "
+                 f"(ID {synapses[next_read_pos, 0]}) and "
+                 f"{sp.hist_file['network/neurons/name'][synapses[next_read_pos, 1]]} "
+                 f"(ID {synapses[next_read_pos, 1]})")
+
+        con_id = (sp.type_id_list[src_id], sp.type_id_list[dest_id], synapse_type)
+
+        if con_id in sp.connectivity_distributions:
+
+            # We have the option to separate between connections within a
+            # population unit or not. If conInfo[1] != None then first
+            # tuple is connection info within a population unit, and second item
+            # is connection info between different population units
+            con_info = sp.connectivity_distributions[con_id]
+
+            #
+            if con_info[1] is None or sp.population_unit_id[src_id] == sp.population_unit_id[dest_id]:
+                # All or within population unit pruning parameters
+                c_info = con_info[0]
+            else:
+                # Between population unit pruning parameters
+                c_info = con_info[1]
+
+            # These will always exist thanks to complete_pruning_info function
+
+            dist_p = c_info["dist_pruning"]  # Dist dep pruning
+            f1 = c_info["f1"]
+            soft_max = c_info["soft_max"]
+            mu2 = c_info["mu2"]
+            a3 = c_info["a3"]
+
+            # If cluster_flag is set, then the synapses furthest from their companion synapses are removed first
+            cluster_flag = c_info["cluster_pruning"]
+
+        else:
+            # Not listed in connectivityDistribution, skip neuron pair
+            next_read_pos = read_end_idx
+            # No need to update keepRowFlag since default set to 0
+
+            continue
+
+        # Lets get all cell pairs random numbers in one go, total: n_pair_synapses*3 + 2
+        # f1        :n_pair_synapses
+        # p         n_pair_synapses:2*n_pair_synapses
+        # soft_max  2*n_pair_synapses:3*n_pair_synapses
+        # a3       -1
+        # p_mu     -2
+
+        random_pool = post_rng.random(n_pair_synapses * 3 + 2)
+
+        # 3. This is the last step of pruning, but we move it to the top
+        # since there is no point doing the other steps if we going to
+        # throw them away anyway
+
+        if a3 is not None and random_pool[-1] > a3:
+            # Prune all synapses between pair, do not add to synapse file
+            next_read_pos = read_end_idx
+            # No need to update keepRowFlag since default set to 0
+
+            continue
+
+        if dist_p is not None:
+            assert synapse_type != 3, \
+                "Distance dependent pruning currently only supported for synapses, not gap junctions"
+            # Distance dependent pruning, used for e.g. FS->MS connections
+
+            # distP contains d (variable for distance to soma)
+            d = synapses[next_read_pos:read_end_idx, 8] * 1e-6  # dendrite distance d, used in eval below
+            p = numexpr.evaluate(dist_p)
+
+            frac_flag = random_pool[:n_pair_synapses] < f1
+            dist_flag = random_pool[n_pair_synapses:2 * n_pair_synapses] < p
+
+            keep_row_flag[next_read_pos:read_end_idx] = np.logical_and(frac_flag, dist_flag)
+
+        else:
+            keep_row_flag[next_read_pos:read_end_idx] = random_pool[:n_pair_synapses] < f1
+            dist_flag = None
+
+        # Check if too many synapses, trim it down a bit
+        n_keep = np.sum(keep_row_flag[next_read_pos:read_end_idx])
+
+        if soft_max is not None and n_keep > soft_max:
+            soft_max = float(soft_max)
+            p_keep = np.divide(2 * soft_max, (1 + np.exp(-(n_keep - soft_max) / 5)) * n_keep)
+
+            keep_row_flag[next_read_pos:read_end_idx] = \
+                np.logical_and(p_keep > random_pool[2 * n_pair_synapses:3 * n_pair_synapses],
+                               keep_row_flag[next_read_pos:read_end_idx])
+
+            n_keep = np.sum(keep_row_flag[next_read_pos:read_end_idx])
+
+        # If too few synapses, remove all synapses
+        if mu2 is not None:
+            # Markram et al, Cell 2015
+            p_mu = 1.0 / (1.0 + np.exp(-8.0 / mu2 * (n_keep - mu2)))
+
+            if p_mu < random_pool[-2]:
+                # Too few synapses, remove all -- need to update keepRowFlag
+                keep_row_flag[next_read_pos:read_end_idx] = 0
+                next_read_pos = read_end_idx
+
+                continue
+
+        # This code remaps which synapses are kept, such that synapses in a cluster are more likely to be kept
+        if cluster_flag and n_keep > 0:
+            # The rows that passed distance dependent pruning are: dist_flag
+
+            keep_idx = sp.get_cluster_keep_idx(synapse_coords=synapses[next_read_pos:read_end_idx, 2:5],
+                                                 dist_flag=dist_flag, n_keep=n_keep,
+                                                 cluster_voxel_distance=cluster_voxel_distance)
+
+            keep_row_flag[next_read_pos:read_end_idx] = 0
+            keep_row_flag[next_read_pos + keep_idx] = 1
+
+        next_read_pos = read_end_idx
+
+    return keep_row_flag
+
+
 class TestPrune(unittest.TestCase):
     
     def setUp(self):
@@ -183,6 +382,67 @@ class TestPrune(unittest.TestCase):
             for cid in cell_id_perm:
                 self.assertTrue(cid in cell_id)
 
+        with self.subTest(stage="load-index"):
+            sl = SnuddaLoad(pruned_output)
+            sl_index = SnuddaLoad(pruned_output, build_index=True)
+            self.assertTrue(os.path.isfile(sl_index.get_index_file()))
+
+            for neuron_id in range(0, sl.data["num_neurons"]):
+                for pre_id, post_id in [(None, neuron_id), (neuron_id, None), (14, neuron_id)]:
+                    syn, syn_coords = sl.find_synapses(pre_id=pre_id, post_id=post_id)
+                    syn_index, syn_coords_index = sl_index.find_synapses(pre_id=pre_id, post_id=post_id)
+
+                    if syn is None:
+                        self.assertTrue(syn_index is None)
+                    else:
+                        self.assertTrue((syn == syn_index).all())
+                        self.assertTrue((syn_coords == syn_coords_index).all())
+
+                self.assertTrue((sl.find_gap_junctions(neuron_id)[0]
+                                 == sl_index.find_gap_junctions(neuron_id)[0]).all())
+                self.assertEqual(sl.find_neighbours([neuron_id]), sl_index.find_neighbours([neuron_id]))
+
+            self.assertEqual(sl.count_incoming_connections("ballanddoublestick"),
+                             sl_index.count_incoming_connections("ballanddoublestick"))
+
+            # Index is read from the sidecar file the second time
+            sl_index = SnuddaLoad(pruned_output, build_index=True, load_synapses=False)
+            self.assertTrue((sl_index.find_synapses(post_id=3)[0] == sl.find_synapses(post_id=3)[0]).all())
+            sl_index.close()
+
+        with self.subTest(stage="load-lazy"):
+            # Prune writes compressed synapse matrices by default, these can not be memory mapped
+            compressed_file = os.path.join(self.network_path, "network-synapses-compressed.hdf5")
+            sp = SnuddaPrune(network_path=self.network_path, config_file=None, keep_files=True, random_seed=1234)
+            sp.prune()
+            sp = []
+            shutil.copy(pruned_output, compressed_file)
+
+            sp = SnuddaPrune(network_path=self.network_path, config_file=None, keep_files=True, random_seed=1234,
+                             compress_synapses=False)
+            sp.prune()
+            sp = []
+
+            with h5py.File(pruned_output, "r") as f:
+                self.assertIsNone(f["network/synapses"].compression)
+
+            sl = SnuddaLoad(compressed_file)
+
+            for network_file, memory_mapped in [(compressed_file, False), (pruned_output, True)]:
+                sl_lazy = SnuddaLoad(network_file, lazy=True)
+
+                self.assertEqual(type(sl_lazy.data["synapses"]) == MemoryMappedMatrix, memory_mapped)
+                self.assertTrue((sl_lazy.data["synapses"][:] == sl.data["synapses"]).all())
+                self.assertTrue((sl_lazy.data["gap_junctions"][:] == sl.data["gap_junctions"]).all())
+                self.assertTrue((sl_lazy.data["neuron_columns"]["neuron_id"] == sl.data["neuron_id"]).all())
+                self.assertTrue((sl_lazy.find_synapses(post_id=3)[0] == sl.find_synapses(post_id=3)[0]).all())
+
+                self.assertEqual(len(sl_lazy.data["neurons"]), len(sl.data["neurons"]))
+                for neuron, lazy_neuron in zip(sl.data["neurons"], sl_lazy.data["neurons"]):
+                    np.testing.assert_equal(neuron, lazy_neuron)
+
+                sl_lazy.close()
+
         # It is important merge file has synapses sorted with dest_id, source_id as sort order since during pruning
         # we assume this to be able to quickly find all synapses on post synaptic cell.
         # TODO: Also include the ChannelModelID in sorting check
@@ -205,6 +465,52 @@ class TestPrune(unittest.TestCase):
                     gj_order = gj[:, 1] * len(self.sd.neurons) + gj[:, 0]
                     self.assertTrue((np.diff(gj_order) >= 0).all())
 
+        with self.subTest("merge-small-blocks"):
+            # Merging in many small blocks must give the same merge file
+            merge_file = os.path.join(self.network_path, "temp", "synapses-for-neurons-0-to-28-MERGE-ME.hdf5")
+            ref_synapses = SnuddaLoad(merge_file).data["synapses"].copy()
+
+            sp = SnuddaPrune(network_path=self.network_path, config_file=None, keep_files=True)
+            sp.synapse_buffer_size = 7
+            merge_file, neuron_range, syn_ctr = sp.big_merge_helper(neuron_range=np.array([0, 28]),
+                                                                    merge_data_type="synapses")
+
+            self.assertEqual(syn_ctr, ref_synapses.shape[0])
+            self.assertTrue((SnuddaLoad(merge_file).data["synapses"] == ref_synapses).all())
+
+            neuron_ranges = sp.get_merge_neuron_ranges(num_workers=3)
+            self.assertEqual(len(neuron_ranges), 3)
+            self.assertEqual(neuron_ranges[0][0], 0)
+            self.assertEqual(neuron_ranges[-1][1], 28)
+            self.assertTrue(all(r1[1] == r2[0] for r1, r2 in zip(neuron_ranges[:-1], neuron_ranges[1:])))
+
+            self.assertTrue((sp.expand_ranges(np.array([5, 0, 20]), np.array([2, 0, 3]))
+                             == np.array([5, 6, 20, 21, 22])).all())
+
+            # Merging the lookup tables chunk by chunk must give the same order as merging them in one go
+            rng = np.random.default_rng(1234)
+            file_lookup = dict()
+            ref_h_id, ref_lookup = [], []
+
+            for h_id, num_pairs in [(-1, 7), (3, 40), (5, 0), (8, 25)]:
+                unique_id = np.sort(rng.choice(100, size=num_pairs, replace=False))
+                lookup = np.stack((unique_id, np.arange(num_pairs), np.arange(1, num_pairs + 1)), axis=1)
+                chunks = iter([lookup[i:i + 6, :] for i in range(0, num_pairs, 6)])
+                first_chunk = next(chunks, None)
+                if first_chunk is not None:
+                    file_lookup[h_id] = (chunks, first_chunk)
+                ref_h_id.append(np.full((num_pairs,), h_id))
+                ref_lookup.append(lookup)
+
+            ref_h_id = np.concatenate(ref_h_id)
+            ref_lookup = np.concatenate(ref_lookup)
+            ref_order = np.lexsort((ref_h_id, ref_lookup[:, 0]))
+
+            merge_blocks = list(sp.merge_lookup_blocks(file_lookup))
+            self.assertTrue(len(merge_blocks) > 1)
+            self.assertTrue((np.concatenate([b[0] for b in merge_blocks]) == ref_h_id[ref_order]).all())
+            self.assertTrue((np.concatenate([b[1] for b in merge_blocks]) == ref_lookup[ref_order, :]).all())
+
         with self.subTest("synapse-f1"):
             # Test of f1
             testing_config_file = os.path.join(self.network_path, "network-config-test-1.json")
@@ -322,6 +628,25 @@ class TestPrune(unittest.TestCase):
             # a3=0.7 means 30% chance to remove all synapses between a pair
             self.assertTrue(64*0.7 - 10 < sl.data["num_gap_junctions"] < 64*0.7 + 10)
 
+        with self.subTest("segmented-pruning-same-as-reference"):
+            # The segmented pruning kernel must keep exactly the same synapses as the one pair at a time version
+            for config_id in range(1, 10):
+                testing_config_file = os.path.join(self.network_path, f"network-config-test-{config_id}.json")
+                sp = SnuddaPrune(network_path=self.network_path, config_file=testing_config_file, keep_files=True)
+
+                for merge_data_type in ["synapses", "gap_junctions"]:
+                    merge_file = os.path.join(self.network_path, "temp",
+                                              f"{merge_data_type}-for-neurons-0-to-28-MERGE-ME.hdf5")
+                    synapses = SnuddaLoad(merge_file).data[merge_data_type]
+                    ref_synapses = synapses.copy()
+
+                    keep_row_flag = sp.get_keep_row_flag(synapses=synapses, merge_data_type=merge_data_type)
+                    ref_keep_row_flag = reference_get_keep_row_flag(sp, synapses=ref_synapses,
+                                                                   merge_data_type=merge_data_type)
+
+                    self.assertTrue((keep_row_flag == ref_keep_row_flag).all())
+                    self.assertTrue((synapses == ref_synapses).all())
+
         if False:  # Distance dependent pruning currently not implemented for gap junctions
             with self.subTest("gap-junction-distance-dependent-pruning"):
                 # Testing distance dependent pruning
@@ -0,0 +1,227 @@
+import os
+import unittest
+
+import numpy as np
+
+from snudda.detect.rasterise import SegmentTable, rasterise_section, rasterise_segment_table
+from snudda.neurons.neuron_morphology_extended import NeuronMorphologyExtended
+from snudda.place.rotation import SnuddaRotate
+
+
+def reference_rasterise(geometry, section_start, hyper_voxel_origo, voxel_size, num_bins):
+
+    """
+    Reference rasteriser, returns the set of (section index, x, y, z) of all voxels within the hyper voxel
+    that the line segments pass through. Checks every voxel in the bounding box of each segment using
+    the slab test, a voxel counts if the part of the segment inside it has non-zero length.
+    """
+
+    voxels = set()
+    all_voxel_coords = (geometry[:, :3] - hyper_voxel_origo) / voxel_size
+
+    for sec_idx in range(0, len(section_start) - 1):
+        for p in range(section_start[sec_idx], section_start[sec_idx + 1] - 1):
+            start, end = all_voxel_coords[p], all_voxel_coords[p + 1]
+            lo = np.maximum(np.floor(np.minimum(start, end)).astype(int), 0)
+            hi = np.minimum(np.floor(np.maximum(start, end)).astype(int), num_bins - 1)
+
+            if (lo > hi).any():
+                continue
+
+            grid = np.stack(np.meshgrid(*[np.arange(l, h + 1) for l, h in zip(lo, hi)], indexing="ij"),
+                            axis=-1).reshape(-1, 3)
+            delta = end - start
+
+            with np.errstate(divide="ignore", invalid="ignore"):
+                t0 = (grid - start) / delta
+                t1 = (grid + 1 - start) / delta
+
+            # Dimensions the segment is parallel to, t is unrestricted if inside the slab, otherwise empty
+            parallel = delta == 0
+            inside_slab = (grid <= start) & (start < grid + 1)
+            t0[:, parallel] = np.where(inside_slab[:, parallel], -np.inf, np.inf)
+            t1[:, parallel] = np.where(inside_slab[:, parallel], np.inf, -np.inf)
+
+            t_enter = np.maximum(np.max(np.minimum(t0, t1), axis=1), 0)
+            t_exit = np.minimum(np.min(np.maximum(t0, t1), axis=1), 1)
+
+            for x, y, z in grid[t_enter < t_exit]:
+                voxels.add((sec_idx, x, y, z))
+
+    return voxels
+
+
+class TestRasterise(unittest.TestCase):
+
+    def setUp(self):
+
+        self.voxel_size = 3e-6
+        self.num_bins = np.array([50, 50, 50])
+        self.hyper_voxel_origo = np.zeros((3,))
+        self.step_multiplier = 2
+
+        neuron_file = os.path.join(os.path.dirname(__file__), "validation", "striatum-var", "dspn",
+                                   "str-dspn-e150602_c1_D1-mWT-0728MSN01-v20211026", "morphology",
+                                   "WT-0728MSN01-cor-rep-ax-res3-var8.swc")
+
+        rng = np.random.default_rng(1234)
+        centre_pos = self.num_bins * self.voxel_size / 2
+
+        self.neurons = []
+        for neuron_id in range(0, 3):
+            neuron = NeuronMorphologyExtended(name="dspn", swc_filename=neuron_file)
+            self.neurons.append(neuron.clone(position=centre_pos + rng.uniform(-20e-6, 20e-6, size=3),
+                                             rotation=SnuddaRotate.rand_rotation_matrix(rng=rng)))
+
+    def rasterise_table(self, table, method):
+        return table.rasterise(hyper_voxel_origo=self.hyper_voxel_origo, voxel_size=self.voxel_size,
+                               num_bins=self.num_bins, step_multiplier=self.step_multiplier, method=method)
+
+    def test_step_same_as_section_helper(self):
+
+        for section_type in [2, 3]:
+            with self.subTest(section_type=section_type):
+
+                table = SegmentTable()
+                ref_items = []
+
+                for neuron_id, neuron in enumerate(self.neurons):
+                    sections = list(neuron.section_iterator_selective(section_type=section_type, section_id=None))
+                    table.add_sections(neuron.morphology_data["neuron"], section_type=section_type,
+                                       neuron_id=neuron_id, order=neuron_id)
+
+                    for section in sections:
+                        section_x = section.morphology_data.section_data[section.point_idx, 1] * 1e-3
+                        section_x[0] = 0
+
+                        vp_x, vp_y, vp_z, s_x, soma_dist = \
+                            rasterise_section(section.point_idx, section.morphology_data.geometry, section_x,
+                                              neuron_id, self.hyper_voxel_origo, self.voxel_size,
+                                              self.num_bins, self.step_multiplier)
+                        ref_items.append((vp_x, vp_y, vp_z, np.full(vp_x.shape, neuron_id), s_x, soma_dist))
+
+                vx, vy, vz, neuron_id, sec_id, sec_x, soma_dist, order = self.rasterise_table(table, method="step")
+                ref_vx, ref_vy, ref_vz, ref_neuron_id, ref_sec_x, ref_soma_dist = \
+                    [np.concatenate(x) for x in zip(*ref_items)]
+
+                self.assertTrue(vx.size > 0)
+                self.assertTrue((vx == ref_vx).all())
+                self.assertTrue((vy == ref_vy).all())
+                self.assertTrue((vz == ref_vz).all())
+                self.assertTrue((neuron_id == ref_neuron_id).all())
+                self.assertTrue((sec_x == ref_sec_x).all())
+                self.assertTrue((soma_dist == ref_soma_dist).all())
+                self.assertTrue((order == neuron_id).all())
+
+    def test_dda(self):
+
+        with self.subTest(stage="straight_line"):
+            # Line along x-axis, from middle of voxel 2 to middle of voxel 12, should mark voxels 2-12 once
+            geometry = np.array([[2.5, 4.5, 5.5, 1, 0], [12.5, 4.5, 5.5, 1, 10]]) * self.voxel_size
+            vx, vy, vz, item_section, s_x, soma_dist = \
+                rasterise_segment_table(geometry, np.array([0, 1.0]), np.array([0, 2]), np.array([0]),
+                                        self.hyper_voxel_origo, self.voxel_size, self.num_bins,
+                                        self.step_multiplier, True)
+
+            self.assertTrue((vx == np.arange(2, 13)).all())
+            self.assertTrue((vy == 4).all())
+            self.assertTrue((vz == 5).all())
+            self.assertTrue((np.diff(s_x) > 0).all())
+            self.assertTrue(0 <= s_x[0] and s_x[-1] <= 1)
+
+        with self.subTest(stage="clip_to_hyper_voxel"):
+            # Line starting and ending outside the hyper voxel
+            geometry = np.array([[-10.5, 3.5, 3.5, 1, 0], [60.5, 3.5, 3.5, 1, 0]]) * self.voxel_size
+            vx, vy, vz, item_section, s_x, soma_dist = \
+                rasterise_segment_table(geometry, np.array([0, 1.0]), np.array([0, 2]), np.array([0]),
+                                        self.hyper_voxel_origo, self.voxel_size, self.num_bins,
+                                        self.step_multiplier, True)
+
+            self.assertTrue((vx == np.arange(0, self.num_bins[0])).all())
+
+        with self.subTest(stage="morphology"):
+            table = SegmentTable()
+            for neuron_id, neuron in enumerate(self.neurons):
+                table.add_sections(neuron.morphology_data["neuron"], section_type=3, neuron_id=neuron_id)
+
+            vx, vy, vz, neuron_id, sec_id, sec_x, soma_dist, order = self.rasterise_table(table, method="dda")
+            step_vx, step_vy, step_vz, step_neuron_id, _, _, _, _ = self.rasterise_table(table, method="step")
+
+            self.assertTrue((0 <= vx).all() and (vx < self.num_bins[0]).all())
+            self.assertTrue((0 <= sec_x).all() and (sec_x <= 1).all())
+
+            # Traversal moves one voxel at a time, larger jumps only where a new section or neuron starts
+            voxel_step = np.abs(np.diff(np.vstack((vx, vy, vz)), axis=1)).sum(axis=0)
+            self.assertTrue(np.mean(voxel_step <= 1) > 0.95)
+
+            # DDA marks every voxel the segments pass through, step mode samples points on the same segments
+            dda_voxels = set(zip(neuron_id, vx, vy, vz))
+            step_voxels = set(zip(step_neuron_id, step_vx, step_vy, step_vz))
+            self.assertTrue(len(step_voxels - dda_voxels) <= 0.001 * len(step_voxels))
+            self.assertTrue(len(dda_voxels) >= len(step_voxels))
+
+        with self.subTest(stage="reference_rasteriser"):
+            # DDA must mark exactly the voxels the segments pass through
+            table = SegmentTable()
+            for neuron_id, neuron in enumerate(self.neurons):
+                table.add_sections(neuron.morphology_data["neuron"], section_type=3, neuron_id=neuron_id)
+
+            vx, vy, vz, neuron_id, sec_id, sec_x, soma_dist, order = self.rasterise_table(table, method="dda")
+            section_start = np.concatenate(([0], np.cumsum(table.num_points)))
+            ref_voxels = reference_rasterise(np.concatenate(table.geometry), section_start,
+                                             self.hyper_voxel_origo, self.voxel_size, self.num_bins)
+
+            # Map item back to section index, using neuron_id and sec_id (unique per section in the table)
+            section_idx = {(n, s): idx for idx, (n, s) in enumerate(zip(table.neuron_id, table.sec_id))}
+            dda_voxels = [(section_idx[(n, s)], x, y, z) for n, s, x, y, z in zip(neuron_id, sec_id, vx, vy, vz)]
+
+            self.assertTrue(len(ref_voxels) > 0)
+            self.assertEqual(set(dda_voxels), ref_voxels)
+
+        with self.subTest(stage="random_segments"):
+            # Long random segments, many passing through or clipped by the hyper voxel
+            rng = np.random.default_rng(4321)
+            geometry = np.zeros((400, 5))
+            geometry[:, :3] = rng.uniform(-20, 70, size=(400, 3)) * self.voxel_size
+            section_start = np.arange(0, 401, 2)
+
+            vx, vy, vz, item_section, s_x, soma_dist = \
+                rasterise_segment_table(geometry, np.tile([0, 1.0], 200), section_start, np.zeros((200,), dtype=int),
+                                        self.hyper_voxel_origo, self.voxel_size, self.num_bins,
+                                        self.step_multiplier, True)
+            ref_voxels = reference_rasterise(geometry, section_start, self.hyper_voxel_origo,
+                                             self.voxel_size, self.num_bins)
+
+            # Every voxel marked exactly once
+            self.assertEqual(len(vx), len(ref_voxels))
+            self.assertEqual(set(zip(item_section, vx, vy, vz)), ref_voxels)
+
+    def test_section_layout(self):
+
+        # The points found by get_section_layout must match the section iterator
+        for section_type in [1, 2, 3]:
+            with self.subTest(section_type=section_type):
+                morphology_data = self.neurons[0].morphology_data["neuron"]
+                section_id, start, num_points, point_idx = \
+                    SegmentTable.get_section_layout(morphology_data.section_data, section_type)
+
+                sections = morphology_data.sections.get(section_type, dict())
+                self.assertEqual(len(section_id), len(sections))
+
+                for sid, st, n_points in zip(section_id, start, num_points):
+                    self.assertTrue((point_idx[st:st + n_points] == sections[sid].point_idx).all())
+
+        with self.subTest(stage="unknown_section_id"):
+            with self.assertRaises(ValueError):
+                SegmentTable().add_sections(self.neurons[0].morphology_data["neuron"], section_type=3,
+                                            section_id=[100000])
+
+    def test_unknown_method(self):
+
+        table = SegmentTable()
+        with self.assertRaises(ValueError):
+            self.rasterise_table(table, method="bresenham")
+
+
+if __name__ == '__main__':
+    unittest.main()
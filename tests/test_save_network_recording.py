@@ -0,0 +1,289 @@
+import os
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+from neuron import h
+
+from snudda.simulate.save_network_recording import SnuddaSaveNetworkRecordings
+from snudda.utils.load_network_simulation import SnuddaLoadNetworkSimulation
+
+
+class TestSaveNetworkRecording(unittest.TestCase):
+
+    def setUp(self):
+
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.num_neurons = 5
+        self.num_time_steps = 40
+
+        self.network_data = {"network_file": "network-synapses.hdf5",
+                             "neurons": [{"neuron_id": idx, "name": f"dSPN_{idx}", "type": "dSPN",
+                                          "morphology": "morph.swc", "parameter_key": "p1",
+                                          "morphology_key": "m1", "modulation_key": None}
+                                         for idx in range(0, self.num_neurons)],
+                             "population_unit": np.zeros((self.num_neurons,), dtype=int),
+                             "neuron_positions": np.zeros((self.num_neurons, 3))}
+
+        self.rng = np.random.default_rng(1234)
+
+        self.time = h.Vector(np.arange(0, self.num_time_steps) * 0.025)
+        self.voltage = dict()
+        self.spikes = dict()
+        self.current = dict()
+
+        for neuron_id in range(0, self.num_neurons):
+            self.voltage[neuron_id] = [h.Vector(self.rng.random(self.num_time_steps))
+                                       for _ in range(0, neuron_id % 3 + 1)]
+            self.spikes[neuron_id] = h.Vector(np.sort(self.rng.random(neuron_id % 4 + 2) * self.num_time_steps * 0.025))
+
+            if neuron_id % 2 == 0:
+                self.current[neuron_id] = [h.Vector(self.rng.random(self.num_time_steps)) for _ in range(0, 2)]
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write_output(self, output_file, flush_steps=None, **kwargs):
+
+        """ Writes recordings to output_file, if flush_steps is given the data is flushed at those time steps. """
+
+        if flush_steps is None:
+            time, voltage, spikes, current = self.time, self.voltage, self.spikes, self.current
+        else:
+            # Recordings start empty, NEURON appends to the vectors during each run
+            time = h.Vector()
+            voltage = {neuron_id: [h.Vector() for _ in v_list] for neuron_id, v_list in self.voltage.items()}
+            spikes = {neuron_id: h.Vector() for neuron_id in self.spikes.keys()}
+            current = {neuron_id: [h.Vector() for _ in i_list] for neuron_id, i_list in self.current.items()}
+
+        record = SnuddaSaveNetworkRecordings(output_file=output_file, network_data=self.network_data, **kwargs)
+        record.add_unit(data_type="voltage", target_unit="V", conversion_factor=1e-3)
+        record.add_unit(data_type="synaptic_current", target_unit="A", conversion_factor=1e-9)
+        record.add_unit(data_type="spikes", target_unit="s", conversion_factor=1e-3)
+        record.add_unit(data_type="time", target_unit="s", conversion_factor=1e-3)
+        record.register_time(time=time)
+
+        for neuron_id in range(0, self.num_neurons):
+            for idx, v in enumerate(voltage[neuron_id]):
+                record.register_compartment_data(data_type="voltage", neuron_id=neuron_id, data=v,
+                                                 sec_id=idx - 1, sec_x=0.5)
+
+            record.register_spike_data(neuron_id=neuron_id, data=spikes[neuron_id], sec_id=-1, sec_x=0.5)
+
+            for idx, i_syn in enumerate(current.get(neuron_id, [])):
+                record.register_synapse_data(data_type="synaptic_current", neuron_id=neuron_id, data=i_syn,
+                                             synapse_type=2, presynaptic_id=idx + 10, sec_id=idx, sec_x=0.25,
+                                             cond=1e-3)
+
+        if flush_steps is not None:
+            time_series = [(time, self.time)] \
+                + [(v, v_ref) for neuron_id in voltage.keys() for v, v_ref in zip(voltage[neuron_id],
+                                                                                 self.voltage[neuron_id])] \
+                + [(i, i_ref) for neuron_id in current.keys() for i, i_ref in zip(current[neuron_id],
+                                                                                 self.current[neuron_id])]
+
+            window_start = 0
+
+            for window_end in list(flush_steps) + [self.num_time_steps]:
+
+                if window_start > 0:
+                    record.flush()
+
+                for v, v_ref in time_series:
+                    v.append(h.Vector(np.array(v_ref)[window_start:window_end]))
+
+                # Spikes that occurred during the time window (time is in ms)
+                t_start = window_start * 0.025
+                t_end = window_end * 0.025 if window_end < self.num_time_steps else np.inf
+
+                for neuron_id, spike_ref in self.spikes.items():
+                    spike_ref = np.array(spike_ref)
+                    spikes[neuron_id].append(h.Vector(spike_ref[np.logical_and(t_start <= spike_ref,
+                                                                               spike_ref < t_end)]))
+
+                window_start = window_end
+
+        record.write()
+
+        return record
+
+    def test_shard_output(self):
+
+        serial_file = os.path.join(self.temp_dir.name, "serial", "output.hdf5")
+        self.write_output(serial_file)
+        serial_data = SnuddaLoadNetworkSimulation(network_simulation_output_file=serial_file, do_test=False)
+
+        for merge_mode in ["virtual", "copy"]:
+            with self.subTest(merge_mode=merge_mode):
+                output_file = os.path.join(self.temp_dir.name, merge_mode, "output.hdf5")
+                record = self.write_output(output_file, shard_output=True, shard_merge_mode=merge_mode)
+
+                self.assertEqual(os.path.isfile(record.get_shard_file()), merge_mode == "virtual")
+
+                with h5py.File(output_file, "r") as f:
+                    self.assertEqual(f["neurons/1/voltage"].is_virtual, merge_mode == "virtual")
+
+                # Load from another directory, virtual datasets use paths relative to the output file
+                old_cwd = os.getcwd()
+                os.chdir(self.temp_dir.name)
+
+                try:
+                    shard_data = SnuddaLoadNetworkSimulation(network_simulation_output_file=output_file,
+                                                             do_test=False)
+
+                    self.assertTrue(np.allclose(serial_data.get_time(), shard_data.get_time()))
+
+                    serial_spikes = serial_data.get_spikes()
+                    shard_spikes = shard_data.get_spikes()
+
+                    for neuron_id in range(0, self.num_neurons):
+                        self.assertEqual(serial_spikes[neuron_id].shape, shard_spikes[neuron_id].shape)
+                        self.assertTrue(np.allclose(serial_spikes[neuron_id], shard_spikes[neuron_id]))
+
+                    for data_type in ["voltage", "synaptic_current"]:
+                        serial_values = serial_data.get_data(data_type)
+                        shard_values = shard_data.get_data(data_type)
+
+                        for ref, val in zip(serial_values, shard_values):
+                            self.assertEqual(ref.keys(), val.keys())
+
+                            for neuron_id in ref.keys():
+                                np.testing.assert_equal(ref[neuron_id], val[neuron_id])
+
+                    shard_data.close()
+
+                finally:
+                    os.chdir(old_cwd)
+
+        serial_data.close()
+
+    def test_flush_output(self):
+
+        for sample_dt in [None, 0.0001]:
+            ref_file = os.path.join(self.temp_dir.name, f"ref-{sample_dt}", "output.hdf5")
+            self.write_output(ref_file, sample_dt=sample_dt)
+            ref_data = SnuddaLoadNetworkSimulation(network_simulation_output_file=ref_file, do_test=False)
+
+            for shard_output, merge_mode in [(False, "virtual"), (True, "virtual"), (True, "copy")]:
+                with self.subTest(sample_dt=sample_dt, shard_output=shard_output, merge_mode=merge_mode):
+                    output_file = os.path.join(self.temp_dir.name, f"flush-{sample_dt}-{shard_output}-{merge_mode}",
+                                               "output.hdf5")
+                    record = self.write_output(output_file, flush_steps=[7, 8, 25], sample_dt=sample_dt,
+                                               shard_output=shard_output, shard_merge_mode=merge_mode)
+
+                    # Flushed recordings are cleared, also the spikes
+                    self.assertEqual(record.time.size(), self.num_time_steps - 25)
+                    self.assertEqual(record.time_flushed, 25)
+
+                    for neuron_id in range(0, self.num_neurons):
+                        spike_ref = np.array(self.spikes[neuron_id])
+                        self.assertEqual(record.neuron_activities[neuron_id].data["spikes"].data[0].size(),
+                                         np.sum(spike_ref >= 25 * 0.025))
+
+                    if shard_output and merge_mode == "virtual":
+                        # One block of spikes per write in the shard file
+                        with h5py.File(record.get_shard_file(), "r") as f:
+                            self.assertEqual(f["spikes/offset"].shape, (self.num_neurons + 1, 4))
+
+                    flush_data = SnuddaLoadNetworkSimulation(network_simulation_output_file=output_file,
+                                                             do_test=False)
+
+                    self.assertTrue(np.allclose(ref_data.get_time(), flush_data.get_time()))
+
+                    ref_spikes = ref_data.get_spikes()
+                    flush_spikes = flush_data.get_spikes()
+
+                    for neuron_id in range(0, self.num_neurons):
+                        self.assertTrue(np.allclose(ref_spikes[neuron_id], flush_spikes[neuron_id]))
+
+                    for data_type in ["voltage", "synaptic_current"]:
+                        for ref, val in zip(ref_data.get_data(data_type), flush_data.get_data(data_type)):
+                            self.assertEqual(ref.keys(), val.keys())
+
+                            for neuron_id in ref.keys():
+                                np.testing.assert_equal(ref[neuron_id], val[neuron_id])
+
+                    flush_data.close()
+
+            ref_data.close()
+
+    def test_spike_table(self):
+
+        output_file = os.path.join(self.temp_dir.name, "spike_table", "output.hdf5")
+        self.write_output(output_file)
+
+        # Older output files do not have the spike table, it is then created from the per neuron spike data
+        old_file = os.path.join(self.temp_dir.name, "spike_table", "old-output.hdf5")
+        with h5py.File(output_file, "r") as f_in, h5py.File(old_file, "w") as f_out:
+            self.assertIn("spike_table", f_in)
+
+            for name in f_in.keys():
+                if name != "spike_table":
+                    f_in.copy(f_in[name], f_out, name=name)
+
+        for file_name in [output_file, old_file]:
+            with self.subTest(file_name=os.path.basename(file_name)):
+                spike_data = SnuddaLoadNetworkSimulation(network_simulation_output_file=file_name, do_test=False)
+
+                all_spikes = spike_data.get_spikes()
+                self.assertEqual(list(all_spikes.keys()), list(range(0, self.num_neurons)))
+
+                for neuron_id in range(0, self.num_neurons):
+                    ref_spikes = np.array(self.spikes[neuron_id]) * 1e-3
+                    self.assertTrue(np.allclose(spike_data.get_spikes(neuron_id), ref_spikes))
+                    self.assertTrue(np.allclose(all_spikes[neuron_id], ref_spikes))
+                    self.assertEqual(spike_data.get_spikes(neuron_id).shape, (1, len(ref_spikes)))
+
+                ref_time = np.concatenate([np.array(self.spikes[neuron_id]) * 1e-3
+                                           for neuron_id in range(0, self.num_neurons)])
+                ref_neuron_id = np.concatenate([np.full((len(self.spikes[neuron_id]),), neuron_id)
+                                                for neuron_id in range(0, self.num_neurons)])
+                ref_order = np.argsort(ref_time)
+
+                spike_times, spike_neuron_id = spike_data.get_spike_raster()
+                self.assertTrue(np.allclose(spike_times, ref_time[ref_order]))
+                self.assertTrue((spike_neuron_id == ref_neuron_id[ref_order]).all())
+
+                merged_spikes = spike_data.merge_spikes()
+                self.assertTrue(np.allclose(merged_spikes, spike_data.merge_spikes(all_spikes)))
+
+                time_range = (0.25e-3, 0.75e-3)
+                window_times, window_neuron_id = spike_data.get_spike_raster(time_range=time_range)
+                ref_idx = np.flatnonzero(np.logical_and(time_range[0] <= ref_time, ref_time < time_range[1]))
+                self.assertTrue(np.allclose(np.sort(window_times), np.sort(ref_time[ref_idx])))
+                self.assertEqual(sorted(window_neuron_id), sorted(ref_neuron_id[ref_idx]))
+
+                # Returned spikes are copies, modifying them must not change the spike table
+                spikes = spike_data.get_spikes(0)
+                spikes[:] = -1
+                self.assertTrue(np.allclose(spike_data.get_spikes(0), np.array(self.spikes[0]) * 1e-3))
+
+                spike_data.close()
+
+    def test_get_spikes_empty_neuron(self):
+
+        spike_data = SnuddaLoadNetworkSimulation.__new__(SnuddaLoadNetworkSimulation)
+        spike_data.spike_table = SnuddaLoadNetworkSimulation.create_spike_table(spike_data={0: [0.2, 0.1],
+                                                                                            2: [0.3]},
+                                                                               num_neurons=4)
+
+        with self.subTest(stage="single-neuron"):
+            self.assertEqual(spike_data.get_spikes(1).shape, (0,))
+            self.assertEqual(spike_data.get_spikes(3).shape, (0,))
+            self.assertEqual(spike_data.get_spikes(2).shape, (1, 1))
+            self.assertTrue(np.allclose(spike_data.get_spikes(0), [[0.1, 0.2]]))
+
+        with self.subTest(stage="all-neurons"):
+            all_spikes = spike_data.get_spikes()
+            self.assertEqual(list(all_spikes.keys()), [0, 1, 2, 3])
+            self.assertEqual(all_spikes[1].shape, (0,))
+            self.assertEqual(all_spikes[3].shape, (0,))
+
+        with self.subTest(stage="copy"):
+            spike_data.get_spikes([0])[0][:] = -1
+            self.assertTrue(np.allclose(spike_data.get_spikes(0), [[0.1, 0.2]]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+
+import numpy as np
+
+from snudda.analyse.analyse_spike_trains import AnalyseSpikeTrains
+from snudda.analyse.spike_time_tiling_coefficient import spike_time_tiling_coefficient, \
+    spike_time_tiling_coefficient_all_to_all, spike_time_tiling_coefficient_block
+
+
+class TestSpikeTimeTilingCoefficient(unittest.TestCase):
+
+    def setUp(self):
+
+        rng = np.random.default_rng(1234)
+        self.end_time = 10.0
+        self.dt = 0.05
+
+        self.spike_trains = [np.sort(rng.uniform(0, self.end_time, rng.integers(1, 30))) for _ in range(0, 40)]
+
+        # Empty spike trains, spikes close to start and end, and identical spike trains
+        self.spike_trains[2] = np.zeros((0,))
+        self.spike_trains[3] = np.array([0.001])
+        self.spike_trains[5] = np.array([self.end_time - 0.001])
+        self.spike_trains[7] = self.spike_trains[8].copy()
+
+        self.offset = np.concatenate([[0], np.cumsum([len(st) for st in self.spike_trains])]).astype(np.int64)
+        self.spike_times = np.concatenate(self.spike_trains)
+
+        n_trains = len(self.spike_trains)
+        self.ref_sttc = np.full((n_trains, n_trains), np.nan)
+
+        for i in range(0, n_trains):
+            for j in range(0, n_trains):
+                self.ref_sttc[i, j] = spike_time_tiling_coefficient(self.spike_trains[i], self.spike_trains[j],
+                                                                    end_time=self.end_time, dt=self.dt)
+
+    def test_all_to_all(self):
+
+        sttc = spike_time_tiling_coefficient_all_to_all(self.spike_times, self.offset,
+                                                        end_time=self.end_time, dt=self.dt)
+
+        n_trains = len(self.spike_trains)
+        i, j = np.triu_indices(n_trains, k=1)
+
+        self.assertEqual(sttc.shape, (n_trains * (n_trains - 1) // 2,))
+        np.testing.assert_allclose(sttc, self.ref_sttc[i, j])
+
+        self.assertTrue(np.isnan(sttc[np.logical_or(i == 2, j == 2)]).all())
+        self.assertAlmostEqual(sttc[np.flatnonzero(np.logical_and(i == 7, j == 8))[0]], 1)
+
+    def test_block(self):
+
+        idx_a = np.array([0, 2, 7, 10, 39])
+        idx_b = np.array([1, 3, 5, 8, 20, 21])
+
+        sttc = spike_time_tiling_coefficient_block(self.spike_times, self.offset, idx_a, idx_b,
+                                                   end_time=self.end_time, dt=self.dt)
+
+        self.assertEqual(sttc.shape, (len(idx_a), len(idx_b)))
+        np.testing.assert_allclose(sttc, self.ref_sttc[np.ix_(idx_a, idx_b)])
+
+    def test_analyse_all_to_all(self):
+
+        # Spike trains padded with -1, as in the input and output files, the padding is outside the time range
+        max_spikes = max(len(st) for st in self.spike_trains)
+        spike_mat = np.full((len(self.spike_trains), max_spikes), -1.0)
+        for idx, st in enumerate(self.spike_trains):
+            spike_mat[idx, :len(st)] = st
+
+        n_spikes = np.array([len(st) for st in self.spike_trains])
+
+        sttc = AnalyseSpikeTrains().calculate_sttc_all_to_all(spike_mat, n_spikes, dt=self.dt, end_time=self.end_time)
+
+        i, j = np.triu_indices(len(self.spike_trains), k=1)
+        np.testing.assert_allclose(sttc, self.ref_sttc[i, j])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from snudda.simulate.simulate import SnuddaSimulate
+from snudda.utils.load import SnuddaLoad
+
+
+class SynapseGroupsTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+        # Synapse matrix sorted on dest_id (column 1), then source_id (column 0). Neurons 1, 4 and 6 have no synapses.
+        self.num_neurons = 7
+        self.synapses = np.zeros((7, 13), dtype=np.int32)
+        self.synapses[:, 0] = [1, 3, 0, 0, 4, 2, 1]
+        self.synapses[:, 1] = [0, 0, 2, 2, 2, 3, 5]
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def get_simulate(self, synapses, use_index):
+
+        sim = SnuddaSimulate.__new__(SnuddaSimulate)
+        sim.pc = None
+        sim.synapses = synapses
+        sim.synapse_groups = None
+        sim.neuron_id_on_node = np.array([True, False, False, True, False, True, False])
+
+        # There is no network file, so without an index the dest_id column of the synapse matrix is used
+        sim.snudda_loader = SnuddaLoad.__new__(SnuddaLoad)
+        sim.snudda_loader.network_file = os.path.join(self.temp_dir.name, "network-synapses.hdf5")
+        sim.snudda_loader.verbose = False
+        sim.snudda_loader.hdf5_file = None
+        sim.snudda_loader.index = None
+
+        if use_index:
+            sim.snudda_loader.index = {"synapses": SnuddaLoad.create_index(synapses, self.num_neurons)}
+
+        return sim
+
+    def test_synapse_groups(self):
+
+        for use_index in [False, True]:
+            with self.subTest(use_index=use_index):
+                sim = self.get_simulate(self.synapses, use_index=use_index)
+
+                dest_id, start_row, end_row = sim.get_synapse_groups()
+                self.assertEqual(list(dest_id), [0, 2, 3, 5])
+                self.assertEqual(list(start_row), [0, 2, 5, 6])
+                self.assertEqual(list(end_row), [2, 5, 6, 7])
+
+                # Only neurons 0, 3 and 5 are on the worker
+                start_row, end_row = sim.find_synapse_ranges()
+                self.assertEqual(list(start_row), [0, 5, 6])
+                self.assertEqual(list(end_row), [2, 6, 7])
+
+                self.assertEqual(sim.find_next_synapse_group(0), (0, 2))
+                self.assertEqual(sim.find_next_synapse_group(1), (1, 2))
+                self.assertEqual(sim.find_next_synapse_group(2), (5, 6))  # Rows 2-4 are onto neuron 2, not on worker
+                self.assertEqual(sim.find_next_synapse_group(6), (6, 7))
+                self.assertIsNone(sim.find_next_synapse_group(7))
+
+    def test_no_synapses(self):
+
+        for use_index in [False, True]:
+            with self.subTest(use_index=use_index):
+                sim = self.get_simulate(np.zeros((0, 13), dtype=np.int32), use_index=use_index)
+
+                dest_id, start_row, end_row = sim.get_synapse_groups()
+                self.assertEqual(len(dest_id), 0)
+                self.assertEqual(len(start_row), 0)
+                self.assertEqual(len(end_row), 0)
+
+                self.assertEqual(len(sim.find_synapse_ranges()[0]), 0)
+                self.assertIsNone(sim.find_next_synapse_group(0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+import unittest
+
+import numpy as np
+
+from snudda.simulate.simulate import SnuddaSimulate
+from snudda.simulate.synapse_registry import SynapseRegistry
+
+
+class TestSynapseRegistry(unittest.TestCase):
+
+    def test_registry(self):
+
+        rng = np.random.default_rng(1234)
+        num_synapses = 250
+
+        source_id = rng.integers(0, 10, num_synapses)
+        dest_id = rng.integers(0, 5, num_synapses)
+        synapse_type_id = rng.integers(1, 3, num_synapses)
+        section_id = rng.integers(-1, 50, num_synapses)
+
+        # Reference, the dictionary SnuddaSimulate used before
+        synapse_dict = dict()
+
+        # Small block size, so the arrays have to grow
+        registry = SynapseRegistry(block_size=16)
+
+        for idx, (s_id, d_id, t_id, sec_id) in enumerate(zip(source_id, dest_id, synapse_type_id, section_id)):
+            syn, nc = f"syn{idx}", f"nc{idx}"
+
+            if (s_id, d_id) not in synapse_dict:
+                synapse_dict[s_id, d_id] = []
+
+            synapse_dict[s_id, d_id].append((syn, nc, t_id, sec_id))
+
+            registry.add(syn=syn, nc=nc, source_id=s_id, dest_id=d_id, synapse_type_id=t_id, section_id=sec_id)
+
+            if idx == 99:
+                self.assertEqual(registry.num_synapses, 100)
+                self.assertEqual(len(registry.synapses), 100)
+
+        with self.subTest(stage="add"):
+            self.assertEqual(registry.num_synapses, num_synapses)
+            self.assertEqual(registry.synapses, [f"syn{idx}" for idx in range(0, num_synapses)])
+            self.assertEqual(registry.net_cons, [f"nc{idx}" for idx in range(0, num_synapses)])
+            self.assertTrue((registry.section_id[:num_synapses] == section_id).all())
+
+        with self.subTest(stage="same-as-dict"):
+            self.assertEqual(len(registry), len(synapse_dict))
+            self.assertEqual(list(registry.keys()), list(synapse_dict.keys()))
+
+            for key, synapse_list in synapse_dict.items():
+                self.assertIn(key, registry)
+                self.assertEqual(registry[key], synapse_list)
+
+            self.assertNotIn((100, 100), registry)
+
+        with self.subTest(stage="lookup-between-adds"):
+            # The pair lookup is updated when synapses are added, lookups and adds can be interleaved
+            registry.clear()
+            registry.add(syn="syn0", nc="nc0", source_id=1, dest_id=2, synapse_type_id=1, section_id=3)
+            self.assertEqual(registry[1, 2], [("syn0", "nc0", 1, 3)])
+
+            registry.add(syn="syn1", nc="nc1", source_id=1, dest_id=2, synapse_type_id=2, section_id=4)
+            registry.add_synapses(synapses=["syn2", "syn3"], net_cons=["nc2", "nc3"], source_id=np.array([5, 1]),
+                                  dest_id=2, synapse_type_id=np.array([1, 1]), section_id=np.array([0, 0]))
+
+            self.assertEqual(registry[1, 2], [("syn0", "nc0", 1, 3), ("syn1", "nc1", 2, 4), ("syn3", "nc3", 1, 0)])
+            self.assertEqual(registry[5, 2], [("syn2", "nc2", 1, 0)])
+            self.assertEqual(list(registry.keys()), [(1, 2), (5, 2)])
+            self.assertEqual(registry.num_synapses, 4)
+
+        with self.subTest(stage="clear"):
+            registry.clear()
+            self.assertEqual(registry.num_synapses, 0)
+            self.assertEqual(len(registry), 0)
+
+    def test_add_synapses(self):
+
+        from neuron import h
+
+        # Small network: neuron 0 has two sections and receives synapses from neurons 1 and 2,
+        # neuron 3 is virtual. Uses the builtin ExpSyn, so no compiled mechanisms are needed.
+        sim = SnuddaSimulate.__new__(SnuddaSimulate)
+        sim.pc = h.ParallelContext()
+        sim.is_virtual_neuron = np.array([False, False, False, True])
+        sim.synapse_registry = SynapseRegistry()
+        sim.synapse_parameters = {1: (h.ExpSyn, [{"tau": 0.005, "cond": 1e-9}, {"tau": 0.01}]),
+                                  2: (h.ExpSyn, None),
+                                  3: (None, None)}
+        sim.synapse_parameter_cache = dict()
+        sim.conv_factor = {"tau": 1e3}
+        sim.print_error_once = dict()
+        sim.axon_speed = 0.8
+        sim.synapse_delay = 1
+        sim.spike_threshold = -20
+        sim.log_file = None
+        sim.verbose = False
+
+        sections = [h.Section(name="dend0"), h.Section(name="dend1")]
+
+        source_id = np.array([1, 2, 1, 1, 2, 1])
+        section_id = np.array([1, 0, 1, 0, 1, 0])
+        section_x = np.array([0.0, 0.5, 1.0, 0.3, 0.7, 0.2])
+        synapse_type_id = np.array([1, 1, 2, 1, 3, 2])
+        parameter_id = np.array([0, 1, 0, 3, 0, 0])
+        axon_dist = np.array([0, 80, 160, 0, 0, 0])
+        conductance = np.array([1, 2, 3, 4, 5, 6]) * 1e-3
+
+        num_net_cons = len(h.List("NetCon"))
+        num_exp_syn = len(h.List("ExpSyn"))
+
+        num_added = sim.add_synapses(cell_id_source=source_id, cell_id_dest=0,
+                                     dend_compartment=[sections[x] for x in section_id], section_id=section_id,
+                                     section_dist=section_x, conductance=conductance, parameter_id=parameter_id,
+                                     synapse_type_id=synapse_type_id, axon_dist=axon_dist)
+
+        with self.subTest(stage="counts"):
+            # Synapse type 3 has no channel module, so that synapse is skipped
+            self.assertEqual(num_added, 5)
+            self.assertEqual(sim.synapse_registry.num_synapses, 5)
+            self.assertEqual(len(sim.synapse_registry.net_cons), 5)
+            self.assertEqual(len(h.List("NetCon")) - num_net_cons, 5)
+            self.assertEqual(len(h.List("ExpSyn")) - num_exp_syn, 5)
+            self.assertEqual(len(sim.synapse_registry[1, 0]), 4)
+            self.assertEqual(len(sim.synapse_registry[2, 0]), 1)
+            self.assertIn(("channel_model_error", 3), sim.print_error_once)
+
+        with self.subTest(stage="grouped-by-section"):
+            # Stable order within section, section 0 first
+            self.assertEqual(list(sim.synapse_registry.section_id[:5]), [0, 0, 0, 1, 1])
+            weights = [nc.weight[0] for nc in sim.synapse_registry.net_cons]
+            self.assertTrue(np.allclose(weights, np.array([2, 4, 6, 1, 3]) * 1e-3))
+
+            delays = [nc.delay for nc in sim.synapse_registry.net_cons]
+            self.assertTrue(np.allclose(delays, [1.1, 1, 1, 1, 1.2]))
+
+        with self.subTest(stage="parameters"):
+            # Parameter id 3 picks parameter set 3 % 2 = 1, cond is not set as a parameter
+            taus = [syn.tau for syn in sim.synapse_registry.synapses]
+            self.assertTrue(np.allclose(taus[:2], [10, 10]))
+            self.assertTrue(np.isclose(taus[3], 5))
+
+        with self.subTest(stage="virtual-neuron"):
+            self.assertEqual(sim.add_synapses(cell_id_source=source_id, cell_id_dest=3,
+                                              dend_compartment=[sections[x] for x in section_id],
+                                              section_id=section_id, section_dist=section_x,
+                                              conductance=conductance, parameter_id=parameter_id,
+                                              synapse_type_id=synapse_type_id, axon_dist=axon_dist), 0)
+            self.assertEqual(sim.synapse_registry.num_synapses, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+
+import h5py
+import numpy as np
+
+from snudda.detect.synapse_writer import SynapseWriter
+
+
+class TestSynapseWriter(unittest.TestCase):
+
+    def setUp(self):
+
+        self.h5_file = h5py.File("synapse-writer-test.hdf5", "w", driver="core", backing_store=False)
+        rng = np.random.default_rng(1234)
+        self.synapses = rng.integers(0, 1000, size=(1000, 13), dtype=np.int32)
+        self.block_sizes = rng.integers(0, 60, size=100)
+
+    def tearDown(self):
+        self.h5_file.close()
+
+    def create_dataset(self, name, num_rows, chunk_size):
+        return self.h5_file.create_dataset(name, dtype=np.int32, shape=(num_rows, 13), chunks=(chunk_size, 13),
+                                           maxshape=(None, 13))
+
+    def write_blocks(self, writer, synapses):
+        block_end = np.minimum(np.cumsum(self.block_sizes), synapses.shape[0])
+        block_start = np.concatenate(([0], block_end[:-1]))
+
+        for start_idx, end_idx in zip(block_start, block_end):
+            writer.write(synapses[start_idx:end_idx, :])
+
+        writer.write(synapses[block_end[-1]:, :])
+
+    def test_write(self):
+
+        for buffer_size in [1, 7, 50, 64, 1000, 5000]:
+            with self.subTest(buffer_size=buffer_size):
+                dataset = self.create_dataset(f"synapses_{buffer_size}", num_rows=20, chunk_size=20)
+                counter = self.h5_file.create_dataset(f"num_synapses_{buffer_size}", data=0, dtype=np.uint64)
+
+                writer = SynapseWriter(dataset=dataset, max_rows=self.synapses.shape[0], buffer_size=buffer_size,
+                                       counter=counter)
+                self.assertEqual(dataset.shape[0], self.synapses.shape[0])
+
+                self.write_blocks(writer, self.synapses)
+                self.assertEqual(writer.close(), self.synapses.shape[0])
+
+                self.assertEqual(dataset.shape, self.synapses.shape)
+                self.assertEqual(counter[()], self.synapses.shape[0])
+                self.assertTrue((dataset[()] == self.synapses).all())
+
+        with self.subTest(stage="append-and-trim"):
+            # Second writer appends after the rows already in the file, the upper bound is not reached
+            dataset = self.create_dataset("synapses_append", num_rows=10, chunk_size=16)
+            counter = self.h5_file.create_dataset("num_synapses_append", data=0, dtype=np.uint64)
+
+            writer = SynapseWriter(dataset=dataset, max_rows=300, buffer_size=32, counter=counter)
+            self.write_blocks(writer, self.synapses[:300, :])
+            writer.close()
+
+            writer = SynapseWriter(dataset=dataset, start_pos=counter[()], max_rows=1000, buffer_size=32,
+                                   counter=counter)
+            self.assertEqual(dataset.shape[0], 1300)
+            self.write_blocks(writer, self.synapses[300:600, :])
+            self.assertEqual(writer.close(), 300)
+
+            self.assertEqual(counter[()], 600)
+            self.assertTrue((dataset[()] == self.synapses[:600, :]).all())
+
+        with self.subTest(stage="chunk-aligned-flush"):
+            # Buffer is rounded up to whole chunks, and every flush ends on a chunk boundary
+            dataset = self.create_dataset("synapses_aligned", num_rows=0, chunk_size=16)
+            writer = SynapseWriter(dataset=dataset, start_pos=5, max_rows=1000, buffer_size=40)
+            self.assertEqual(writer.buffer_size, 48)
+
+            for synapses in np.array_split(self.synapses, 37):
+                writer.write(synapses)
+                self.assertTrue(writer.file_pos == 5 or writer.file_pos % 16 == 0)
+
+            writer.close()
+            self.assertTrue((dataset[5:, :] == self.synapses).all())
+
+
+if __name__ == '__main__':
+    unittest.main()